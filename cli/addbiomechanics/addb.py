@@ -13,6 +13,7 @@ from addbiomechanics.commands.view_energy import ViewEnergyCommand
 from addbiomechanics.commands.compare import CompareCommand
 from addbiomechanics.commands.post_process import PostProcessCommand
 from addbiomechanics.commands.export_csv import ExportCSVCommand
+from addbiomechanics.commands.export_dataset import ExportDatasetCommand
 from addbiomechanics.commands.describe_dataset import DescribeDatasetCommand
 from addbiomechanics.commands.transfer_reviews import TransferReviewsCommand
 from addbiomechanics.commands.create_b3d import CreateB3DCommand
@@ -57,6 +58,7 @@ def main():
                       TransferMarkersetCommand(),
                       PostProcessCommand(),
                       ExportCSVCommand(),
+                      ExportDatasetCommand(),
                       DescribeDatasetCommand(),
                       TransferReviewsCommand(),
                       CreateB3DCommand(),
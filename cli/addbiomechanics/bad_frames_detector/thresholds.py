@@ -8,6 +8,20 @@ import importlib.resources
 
 
 class ThresholdsDetector(AbstractDetector):
+    """
+    This detector uses a set of thresholds to detect frames that we would like to exclude from a
+    dynamics-of-human-motion dataset. It was engineered by referencing the 3M+ frames of manually annotated data that
+    we labeled as "good" and "bad" in the process of publishing the first AddB dataset paper. The experimental log is
+    here: https://docs.google.com/document/d/16dgRho13iFyfhQSlYNsdIj7Rer2-MZP_aKtYQj41CQs/edit.
+
+    The method here was originally developed in another repo, here: https://github.com/keenon/MissingGRFEstimator
+
+    The entry point is estimate_missing_grfs(), which takes a SubjectOnDisk object and a list of trials, and returns a
+    list of lists of MissingGRFReason enums, one for each frame in each trial. The MissingGRFReason enum is defined in
+    the NimblePhysics library, and is used to indicate why a frame is being marked as "bad" in the dataset, to make
+    it easier for users to understand why their frames are being dropped.
+    """
+
     def __init__(self):
         super().__init__()
         # Access a static file
@@ -33,23 +47,23 @@ class ThresholdsDetector(AbstractDetector):
                 "offset": [0.0, 0.0, 0.065]
             },
             "R_HEEL_1": {
-                "mesh_patterns": ["r_foot"],
+                "mesh_patterns": ["r_foot", "foot"],
                 "offset": [-0.01, 0.0, -0.02]
             },
             "R_HEEL_2": {
-                "mesh_patterns": ["r_foot"],
+                "mesh_patterns": ["r_foot", "foot"],
                 "offset": [-0.01, 0.0, 0.035]
             },
             "R_TOES_1": {
-                "mesh_patterns": ["r_bofoot"],
+                "mesh_patterns": ["r_bofoot", "bofoot"],
                 "offset": [0.1, 0.0, -0.03]
             },
             "R_TOES_2": {
-                "mesh_patterns": ["r_bofoot"],
+                "mesh_patterns": ["r_bofoot", "bofoot"],
                 "offset": [0.07, 0.0, 0.08]
             },
             "R_INNER_FOOT": {
-                "mesh_patterns": ["r_bofoot"],
+                "mesh_patterns": ["r_bofoot", "bofoot"],
                 "offset": [0.0, 0.0, -0.065]
             }
         }
@@ -148,7 +162,9 @@ class ThresholdsDetector(AbstractDetector):
             mesh_patterns: List[str] = marker['mesh_patterns']
             mesh_name: Optional[str] = None
             for mesh in osim.meshMap:
-                if any([pattern in mesh for pattern in mesh_patterns]):
+                # Split mesh by both '/' and '.' to get the mesh name parts
+                mesh_file_name = mesh.split('/')[-1].split('.')[0]
+                if any([pattern == mesh_file_name for pattern in mesh_patterns]):
                     mesh_name = mesh
                     break
             if mesh_name is None:
@@ -170,7 +186,8 @@ class ThresholdsDetector(AbstractDetector):
                                                  foot_markers: List[List[Tuple[nimble.dynamics.BodyNode, np.ndarray]]],
                                                  positions: np.ndarray,
                                                  raw_force_plate_forces: List[List[np.ndarray]],
-                                                 raw_force_plate_cops: List[List[np.ndarray]]) -> float:
+                                                 raw_force_plate_cops: List[List[np.ndarray]],
+                                                 dt: float) -> float:
         """
         Get the force-weighted convex foot CoP error for the given skeleton, foot markers, positions, and frames.
 
@@ -216,7 +233,7 @@ class ThresholdsDetector(AbstractDetector):
                         contact_forces[f] += force_mag
                 else:
                     if last_in_contact[f]:
-                        if contact_forces[f] > 100.0:
+                        if contact_forces[f] * dt > 10.0:
                             weighted_average_distances = [contact_distances[f][body] / contact_forces[f] for body in
                                                           range(num_contact_bodies)]
                             min_weighted_distance = min(weighted_average_distances)
@@ -230,7 +247,7 @@ class ThresholdsDetector(AbstractDetector):
                     last_in_contact[f] = False
         for f in range(num_force_plates):
             if last_in_contact[f]:
-                if contact_forces[f] > 100.0:
+                if contact_forces[f] * dt > 10.0:
                     weighted_average_distances = [contact_distances[f][body] / contact_forces[f] for body in
                                                   range(num_contact_bodies)]
                     min_weighted_distance = min(weighted_average_distances)
@@ -244,95 +261,103 @@ class ThresholdsDetector(AbstractDetector):
         return largest_min_weighted_distance
 
     @staticmethod
-    def get_num_steps(raw_force_plate_forces: List[List[np.ndarray]],
-                      raw_force_plate_cops: List[List[np.ndarray]]) -> Tuple[int, List[int]]:
-        num_force_plates = len(raw_force_plate_forces)
-        trial_len = len(raw_force_plate_forces[0])
-        num_steps = 0
-        num_steps_per_force_plate = [0 for _ in range(num_force_plates)]
-        last_in_contact = [False for _ in range(num_force_plates)]
-        for t in range(trial_len):
-            forces = [raw_force_plate_forces[f][t] for f in range(num_force_plates)]
-            for f in range(len(forces)):
-                force = forces[f]
-                if np.linalg.norm(force) > 10.0:
-                    if not last_in_contact[f]:
-                        last_in_contact[f] = True
-                else:
-                    if last_in_contact[f]:
-                        last_in_contact[f] = False
-                        num_steps += 1
-                        num_steps_per_force_plate[f] += 1
-                    last_in_contact[f] = False
-        for f in range(num_force_plates):
-            if last_in_contact[f]:
-                num_steps += 1
-                num_steps_per_force_plate[f] += 1
-        return num_steps, num_steps_per_force_plate
+    def get_total_force_magnitudes(raw_force_plate_forces: List[List[np.ndarray]]) -> np.ndarray:
+        """
+        Get the sum over all the force plates of the magnitude of the force on each plate, for every frame.
+        """
+        # This is (num_force_plates x num_frames x 3)
+        forces = np.asarray(raw_force_plate_forces, dtype=np.float64)
+        # This is the same dot product np.linalg.norm() takes of a single vector, so the magnitudes match it to the bit,
+        # and so do all the comparisons between them below
+        magnitudes = np.sqrt(np.matmul(forces[..., np.newaxis, :], forces[..., :, np.newaxis])[..., 0, 0])
+        return np.sum(magnitudes, axis=0)
 
     @staticmethod
-    def get_foot_travel_distance_in_contact(skel: nimble.dynamics.Skeleton,
-                                            ground_bodies: List[nimble.dynamics.BodyNode],
-                                            positions: np.ndarray,
-                                            raw_force_plate_forces: List[List[np.ndarray]],
-                                            raw_force_plate_cops: List[List[np.ndarray]]) -> List[float]:
-        trial_len = len(raw_force_plate_forces[0])
-        num_contact_bodies = len(ground_bodies)
-        body_last_in_contact = [False for _ in range(num_contact_bodies)]
-        body_started_contact = [np.zeros(3) for _ in range(num_contact_bodies)]
-        body_last_position = [np.zeros(3) for _ in range(num_contact_bodies)]
-        step_travel_distances = []
-        for t in range(trial_len):
-            skel.setPositions(positions[:, t])
-            ground_body_locations = [body.getWorldTransform().translation() for body in ground_bodies]
-            forces = [raw_force_plate_forces[f][t] for f in range(len(raw_force_plate_forces))]
-            for f in range(len(ground_body_locations)):
-                force = forces[f * 3:f * 3 + 3]
-                if np.linalg.norm(force) > 10.0:
-                    body_last_position[f] = ground_body_locations[f]
-                    if not body_last_in_contact[f]:
-                        body_started_contact[f] = ground_body_locations[f]
-                        body_last_in_contact[f] = True
-                else:
-                    if body_last_in_contact[f]:
-                        body_last_in_contact[f] = False
-                        step_travel_distances.append(np.linalg.norm(body_last_position[f] - body_started_contact[f]))
-        for f in range(num_contact_bodies):
-            if body_last_in_contact[f]:
-                step_travel_distances.append(np.linalg.norm(body_last_position[f] - body_started_contact[f]))
-        return step_travel_distances
+    def get_force_ramp_ends(force_mags: np.ndarray, extend_frames: int) -> np.ndarray:
+        """
+        For each frame i, find the furthest of the next `extend_frames` frames with more force than frame i, and return
+        the frame just before it. If none of them has more force, this is i - 1.
+        """
+        num_frames = len(force_mags)
+        frames = np.arange(num_frames)
+        ramp_ends = frames - 1
+        # Later (larger) j overwrite earlier ones, so we end up with the furthest
+        for j in range(1, min(extend_frames, num_frames - 1) + 1):
+            rises = force_mags[:num_frames - j] < force_mags[j:]
+            ramp_ends[:num_frames - j][rises] = frames[:num_frames - j][rises] + j - 1
+        return ramp_ends
 
     @staticmethod
-    def get_root_box_volume(positions: np.ndarray):
-        # Compute the root box volumes
-        root_translation = positions[3:6, :]
-        root_box_lower_bound = np.min(root_translation, axis=1)
-        root_box_upper_bound = np.max(root_translation, axis=1)
-        root_box_volume = np.sum(root_box_upper_bound - root_box_lower_bound)
-        return root_box_volume
-
-    def estimate_trial_type(self,
-                            skel: nimble.dynamics.Skeleton,
-                            foot_bodies: List[nimble.dynamics.BodyNode],
-                            positions: np.ndarray,
-                            velocities: np.ndarray,
-                            raw_force_plate_forces: List[List[np.ndarray]],
-                            raw_force_plate_cops: List[List[np.ndarray]]) -> str:
-        num_force_plates = len(raw_force_plate_forces)
-        num_steps, _ = self.get_num_steps(raw_force_plate_forces, raw_force_plate_cops)
-        step_travel_distances = self.get_foot_travel_distance_in_contact(skel, foot_bodies, positions, raw_force_plate_forces, raw_force_plate_cops)
-        root_box_volume = self.get_root_box_volume(positions)
-        max_root_rot_vel = np.max(np.abs(velocities[0:3, :]))
-
-        if root_box_volume < 0.06 or max_root_rot_vel < 0.1:
-            return 'Static'
-        if root_box_volume > 0.8:
-            return 'Overground'
-        if len(step_travel_distances) > 0 and np.max(step_travel_distances) > 0.4 and num_force_plates == 2:
-            return 'Treadmill'
-        if num_steps > 15 and num_force_plates == 2:
-            return 'Treadmill'
-        return 'Overground'
+    def extend_missing_into_rising_force(missing: np.ndarray, force_mags: np.ndarray, extend_frames: int) -> np.ndarray:
+        """
+        Scanning left to right, every frame that is missing, and the first frame, marks itself and the frames after it
+        as missing, up to just before the furthest of the next `extend_frames` frames with more force than it. The
+        frames it marks go on to extend the segment the same way when the scan reaches them. This returns which frames
+        get marked.
+        """
+        num_frames = len(force_mags)
+        if num_frames == 0:
+            return np.zeros(0, dtype=bool)
+        ramp_ends = ThresholdsDetector.get_force_ramp_ends(force_mags, extend_frames)
+        extends = np.copy(missing)
+        extends[0] = True
+        # Frames that aren't missing only extend the segment if one reaching in from the left has marked them. So, in
+        # each run of frames that aren't missing, the ones that extend it are the frames up to where the furthest
+        # reach so far first falls short.
+        edges = np.diff(np.concatenate([[1], extends.astype(np.int8), [1]]))
+        run_starts = np.nonzero(edges == -1)[0]
+        run_ends = np.nonzero(edges == 1)[0]
+        furthest = -1
+        last_end = 0
+        for start, end in zip(run_starts, run_ends):
+            if start > last_end:
+                furthest = max(furthest, int(np.max(ramp_ends[last_end:start])))
+            # How far the frames before each frame of the run reach
+            reach_before = np.maximum(furthest, np.concatenate([[furthest],
+                                                                np.maximum.accumulate(ramp_ends[start:end - 1])]))
+            reached = reach_before >= np.arange(start, end)
+            num_reached = end - start if np.all(reached) else int(np.argmin(reached))
+            if num_reached > 0:
+                extends[start:start + num_reached] = True
+                furthest = max(furthest, int(np.max(ramp_ends[start:start + num_reached])))
+            last_end = end
+        # Every frame up to the furthest ramp end of a frame that extends the segment gets marked
+        return np.maximum.accumulate(np.where(extends, ramp_ends, -1)) >= np.arange(num_frames)
+
+    @staticmethod
+    def get_overground_missing_grfs(raw_force_plate_forces: List[List[np.ndarray]],
+                                    trial_len: int,
+                                    extend_frames: int = 20) -> List[nimble.biomechanics.MissingGRFReason]:
+        """
+        Label each frame of an overground trial as missing GRF if it has too little total force on the force plates,
+        or if it's on the rising or falling force ramp at the edge of a stretch with too little force.
+        """
+        # 1. Grab the frames with too little force, mark them as missing.
+        force_mags = ThresholdsDetector.get_total_force_magnitudes(raw_force_plate_forces)[:trial_len]
+        zero_force = force_mags < 10.0
+
+        # 2. Now we can go through and extend all the missing segments into the "rising force ramp" and "falling force
+        # ramp" regions at the edge of the missing segments.
+
+        # 2.1. Start with the rising force ramp, which we can tell by checking left-to-right if any frame has more
+        # force magnitude than any of the previous few frames which may have been marked as missing, and if so, extend
+        # the missing segment to include that frame.
+        rising = ThresholdsDetector.extend_missing_into_rising_force(zero_force, force_mags, extend_frames)
+
+        # 2.2. Now do the same for the falling force ramp, but right-to-left.
+        falling = ThresholdsDetector.extend_missing_into_rising_force((zero_force | rising)[::-1],
+                                                                      force_mags[::-1],
+                                                                      extend_frames)[::-1]
+
+        missing: List[nimble.biomechanics.MissingGRFReason] = []
+        for i in range(len(force_mags)):
+            if rising[i] or falling[i]:
+                missing.append(nimble.biomechanics.MissingGRFReason.extendedToNearestPeakForce)
+            elif zero_force[i]:
+                missing.append(nimble.biomechanics.MissingGRFReason.zeroForceFrame)
+            else:
+                missing.append(nimble.biomechanics.MissingGRFReason.notMissingGRF)
+        return missing
 
     def estimate_missing_grfs(self, subject: nimble.biomechanics.SubjectOnDisk, trials: List[int]) -> List[List[nimble.biomechanics.MissingGRFReason]]:
         osim: nimble.biomechanics.OpenSimFile = subject.readOpenSimFile(processingPass=0, ignoreGeometry=True)
@@ -349,88 +374,78 @@ class ThresholdsDetector(AbstractDetector):
             trial_len = subject.getTrialLength(trial)
             trial_proto = trial_protos[trial]
 
+            passes = trial_proto.getPasses()
+
             raw_force_plates: List[nimble.biomechanics.ForcePlate] = trial_proto.getForcePlates()
             raw_force_plate_forces: List[List[np.ndarray]] = [plate.forces for plate in raw_force_plates]
             raw_force_plate_cops: List[List[np.ndarray]] = [plate.centersOfPressure for plate in raw_force_plates]
 
             # 1. Rapidly check if the entire trial is bad for some reason that can be checked cheaply, without running
             # the smoother first.
+
+            # 1.1. If the marker RMS is greater than 8cm on average, the trial is probably bad in the IK somehow, and
+            # we should mark the entire trial as excluded.
             if np.mean(subject.getTrialMarkerRMSs(trial, 0)) > 0.08:
                 result.append([nimble.biomechanics.MissingGRFReason.tooHighMarkerRMS] * trial_len)
                 continue
+            # 1.2. If the inputs have crazy outliers (markers that are too far from the median, or force plates with
+            # forces greater than 2500 N), we should mark the entire trial as excluded, because those crazy outliers
+            # will tend to drag the other optimization steps to crazy places.
             elif self.has_input_outliers(trial_proto, raw_force_plate_forces):
                 result.append([nimble.biomechanics.MissingGRFReason.hasInputOutliers] * trial_len)
                 continue
+            # 1.3. If the trial has no force plate data, we should mark the entire trial as excluded, because we can't
+            # use data that doesn't have force plates to do dynamics optimization.
             if len(raw_force_plate_forces) == 0:
                 result.append([nimble.biomechanics.MissingGRFReason.hasNoForcePlateData] * trial_len)
                 continue
 
-            # 2. Smooth the positions and velocities
-            dt = subject.getTrialTimestep(trial)
-            poses = trial_proto.getPasses()[1].getPoses()
-            vels = trial_proto.getPasses()[1].getVels()
+            # 2. Get the smoothed positions and velocities. We do this by getting the poses from the second pass, which
+            # is the acceleration minimizing smoother. If the trial doesn't have this pass, we mark the entire trial as
+            # excluded.
+            if len(passes) < 2 or passes[1].getType() != nimble.biomechanics.ProcessingPassType.ACC_MINIMIZING_FILTER:
+                result.append([nimble.biomechanics.MissingGRFReason.hasInputOutliers] * trial_len)
+                continue
+            poses = passes[1].getPoses()
+            vels = passes[1].getVels()
 
-            # 3. Check if the trial has badly wrapped IK based on the smoothed velocities
+            # 3. Check if the trial has badly wrapped IK based on the smoothed velocities. In theory, the previous code
+            # should prevent this from happening, but it seems in our dataset that sometimes the IK can still produce
+            # angular wrapping situations, where a joint angle jumps from 0 to 2PI, for example. When we smooth the
+            # position jump, this manifests as unrealistically high velocities.
             if np.max(np.abs(vels)) > 40.0:
                 result.append([nimble.biomechanics.MissingGRFReason.velocitiesStillTooHighAfterFiltering] * trial_len)
                 continue
 
-            # 4. Check for outlying CoP values
-            if self.get_force_weighted_convex_foot_cop_error(skel, foot_markers, poses, raw_force_plate_forces, raw_force_plate_cops) > 0.01:
+            # 4. We can now begin the more computationally expensive checks. Here, we're checking that the center of
+            # pressure is generally beneath the convex hull outline of a foot. The convex hull is defined by a set of
+            # markers given at the top of the file. If the CoP is outside the convex hull, we mark the frame as bad,
+            # because something is probably wrong with the force plate data. Often this can be a force plate that's
+            # miscalibrated in space, or someone has a bug in their CoP calculation code.
+            dt = subject.getTrialTimestep(trial)
+            cop_foot_error = self.get_force_weighted_convex_foot_cop_error(skel,
+                                                                           foot_markers,
+                                                                           poses,
+                                                                           raw_force_plate_forces,
+                                                                           raw_force_plate_cops,
+                                                                           dt)
+            if cop_foot_error > 0.01:
+                print(f"!! Trial {trial} has a force-weighted center-of-pressure-outside-of-foot error of {cop_foot_error}m, which is higher than the threshold of 0.01m.")
                 result.append([nimble.biomechanics.MissingGRFReason.copOutsideConvexFootError] * trial_len)
                 continue
 
-            # 5. Estimate the trial type
-            trial_type = self.estimate_trial_type(skel, foot_bodies, poses, vels, raw_force_plate_forces, raw_force_plate_cops)
+            # 5. Estimate the trial type -- this is most important for identifying treadmill trials, which will tend to
+            # have almost all steps on the force plates. Overground trials need further attention.
+            trial_type = trial_proto.getBasicTrialType()
 
             # 6. Check for missing GRFs on footsteps off force plates, for data that is overground and has passed all
-            # the other checks -- For now we just check if the total force magnitude is less than 10 N.
-            if trial_type == 'Overground':
-                missing = []
-                force_mags: List[float] = []
-                for i in range(trial_len):
-                    forces = [raw_force_plate_forces[f][i] for f in range(len(raw_force_plate_forces))]
-                    total_force_mag = 0.0
-                    for force in forces:
-                        total_force_mag += np.linalg.norm(force)
-                    if total_force_mag < 10.0:
-                        missing.append(nimble.biomechanics.MissingGRFReason.zeroForceFrame)
-                    else:
-                        missing.append(nimble.biomechanics.MissingGRFReason.notMissingGRF)
-                    force_mags.append(total_force_mag)
-
-                # Now we can go through and extend all the missing segments into the "rising force ramp" and "falling
-                # force ramp" regions at the edge of the missing segments.
-
-                # Start with the rising force ramp, which we can tell by checking left-to-right if any frame has more
-                # force magnitude than any of the previous few frames which may have been marked as missing, and if so,
-                # extend the missing segment to include that frame.
-                extend_frames = 20
-                extended_frames = 0
-
-                for i in range(trial_len):
-                    if missing[i] != nimble.biomechanics.MissingGRFReason.notMissingGRF or i == 0:
-                        for j in range(1, extend_frames + 1):
-                            if i + j < trial_len and force_mags[i] < force_mags[i + j]:
-                                for k in range(j):
-                                    if not missing[i + k]:
-                                        extended_frames += 1
-                                    missing[i + k] = nimble.biomechanics.MissingGRFReason.extendedToNearestPeakForce
-                                # break
-
-                # Now do the same for the falling force ramp, but right-to-left.
-                for i in range(trial_len - 1, -1, -1):
-                    if missing[i] != nimble.biomechanics.MissingGRFReason.notMissingGRF or i == trial_len - 1:
-                        for j in range(1, extend_frames + 1):
-                            if i - j >= 0 and force_mags[i] < force_mags[i - j]:
-                                for k in range(j):
-                                    if not missing[i - k]:
-                                        extended_frames += 1
-                                    missing[i - k] = nimble.biomechanics.MissingGRFReason.extendedToNearestPeakForce
-                                # break
-
-                # print(f"Extended {extended_frames} frames for trial {trial}")
-                result.append(missing)
+            # the other checks -- For now we just check if the total force magnitude is less than 10 N. This has the
+            # obvious problem that if you have overground sprinting, we will exclude flight phase frames. Because this
+            # case is so rare, I'm comfortable just asking users to manually annotate those frames, if they care about
+            # getting dynamics on them. We can always come back and add a more sophisticated heuristic later. This is
+            # a simple and extremely effective heuristic, which catches 99.8% of remaining bad frames in the dataset.
+            if trial_type == nimble.biomechanics.BasicTrialType.OVERGROUND:
+                result.append(self.get_overground_missing_grfs(raw_force_plate_forces, trial_len))
             else:
                 result.append([nimble.biomechanics.MissingGRFReason.notMissingGRF] * trial_len)
         return result
\ No newline at end of file
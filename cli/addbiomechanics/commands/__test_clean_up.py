@@ -0,0 +1,101 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import nimblephysics as nimble
+from commands.clean_up import clean_up_file, format_clean_up_report
+
+OSIM_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'server', 'data',
+                         'PresetSkeletons', 'Rajagopal2015_ViconPlugInGait.osim')
+
+
+def write_kinematics_b3d(path: str, num_trials: int = 2, num_timesteps: int = 200):
+    """
+    Write a B3D with just a noisy kinematics pass on each trial, like the ones clean-up starts from.
+    """
+    osim = nimble.biomechanics.OpenSimParser.parseOsim(OSIM_PATH, ignoreGeometry=True)
+    skel = osim.skeleton
+    with open(OSIM_PATH, 'r') as f:
+        osim_text = f.read()
+    header = nimble.biomechanics.SubjectOnDiskHeader()
+    header.setNumDofs(skel.getNumDofs())
+    header.setNumJoints(skel.getNumJoints())
+    header.setMassKg(70.0)
+    header.setHeightM(1.7)
+    header.setGroundForceBodies(['calcn_r', 'calcn_l'])
+    kinematics_pass = header.addProcessingPass()
+    kinematics_pass.setOpenSimFileText(osim_text)
+    kinematics_pass.setProcessingPassType(nimble.biomechanics.ProcessingPassType.KINEMATICS)
+    dt = 0.01
+    random = np.random.RandomState(0)
+    for i in range(num_trials):
+        trial = header.addTrial()
+        trial.setName('trial' + str(i))
+        trial.setTimestep(dt)
+        trial.setTrialLength(num_timesteps)
+        # nimble leaves the trial type uninitialized unless we set it
+        trial.setBasicTrialType(nimble.biomechanics.BasicTrialType.OTHER)
+        poses = skel.getPositions()[:, None] + 0.01 * random.randn(skel.getNumDofs(), num_timesteps)
+        poses[3, :] += np.linspace(0, 2, num_timesteps)
+        plates = []
+        for side in range(2):
+            plate = nimble.biomechanics.ForcePlate()
+            plate.forces = [np.array([0, 350.0 * (1 + np.sin(t * 0.2 + side * np.pi)), 0])
+                            for t in range(num_timesteps)]
+            plate.centersOfPressure = [np.array([0.01 * t, 0, 0.1 - 0.2 * side]) for t in range(num_timesteps)]
+            plate.moments = [np.zeros(3) for _ in range(num_timesteps)]
+            plates.append(plate)
+        trial.setForcePlates(plates)
+        trial.setMarkerObservations([{} for _ in range(num_timesteps)])
+        trial_pass = trial.addPass()
+        trial_pass.setType(nimble.biomechanics.ProcessingPassType.KINEMATICS)
+        trial_pass.setDofPositionsObserved([True] * skel.getNumDofs())
+        trial_pass.setDofVelocitiesFiniteDifferenced([True] * skel.getNumDofs())
+        trial_pass.setDofAccelerationFiniteDifferenced([True] * skel.getNumDofs())
+        trial_pass.computeValuesFromForcePlates(skel, dt, poses, ['calcn_r', 'calcn_l'], plates)
+    header.recomputeColumnNames()
+    nimble.biomechanics.SubjectOnDisk.writeB3D(path, header)
+
+
+class TestCleanUp(unittest.TestCase):
+    def test_clean_up_file(self):
+        with tempfile.TemporaryDirectory() as folder:
+            input_path = os.path.join(folder, 'input.b3d')
+            output_path = os.path.join(folder, 'output', 'subject.b3d')
+            write_kinematics_b3d(input_path)
+
+            result = clean_up_file(input_path, output_path, skip_dynamics=True)
+            self.assertEqual(result['status'], 'written')
+            self.assertEqual(result['trials'], 2)
+            self.assertEqual(sorted(os.listdir(os.path.dirname(output_path))), ['subject.b3d'])
+
+            subject = nimble.biomechanics.SubjectOnDisk(output_path)
+            self.assertEqual(subject.getNumProcessingPasses(), 2)
+            self.assertEqual(subject.getProcessingPassType(1), nimble.biomechanics.ProcessingPassType.ACC_MINIMIZING_FILTER)
+            subject.loadAllFrames(doNotStandardizeForcePlateData=True)
+            for trial_proto in subject.getHeaderProto().getTrials():
+                passes = trial_proto.getPasses()
+                self.assertLess(np.linalg.norm(passes[1].getAccs()), np.linalg.norm(passes[0].getAccs()))
+
+            # Without markers there are no good GRF frames, so there are no dynamics trials to keep
+            filtered_path = os.path.join(folder, 'output', 'filtered.b3d')
+            result = clean_up_file(input_path, filtered_path, filter_non_dynamics_trials=True)
+            self.assertEqual(result['status'], 'error')
+            self.assertFalse(os.path.exists(filtered_path))
+            self.assertTrue(os.path.exists(filtered_path + '.error'))
+
+    def test_failures_are_reported(self):
+        with tempfile.TemporaryDirectory() as folder:
+            input_path = os.path.join(folder, 'broken.b3d')
+            with open(input_path, 'wb') as f:
+                f.write(b'not a b3d file')
+            output_path = os.path.join(folder, 'output', 'broken.b3d')
+            result = clean_up_file(input_path, output_path)
+            self.assertEqual(result['status'], 'failed')
+            # A failure leaves nothing behind, so the next run tries again
+            self.assertFalse(os.path.exists(output_path))
+            self.assertFalse(os.path.exists(output_path + '.error'))
+
+            report = format_clean_up_report([result])
+            self.assertIn('  Failed: 1', report)
+            self.assertIn('  FAILED ' + input_path + ': ' + result['message'], report)
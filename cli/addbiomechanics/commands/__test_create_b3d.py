@@ -0,0 +1,102 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import nimblephysics as nimble
+from commands.create_b3d import find_folder_subjects, read_manifest_subjects, unwrap_poses, create_subject_b3d, \
+    read_trial_poses
+from addbiomechanics.commands.__test_clean_up import OSIM_PATH
+
+
+def write_mot(skel, path: str, num_frames: int, seed: int = 0):
+    """
+    Write a random walk through the skeleton's poses, with the rotations wrapped into [-pi, pi) like some exporters do.
+    """
+    random = np.random.RandomState(seed)
+    poses = skel.getPositions()[:, None] + np.cumsum(0.05 * random.randn(skel.getNumDofs(), num_frames), axis=1)
+    poses[:3] = (poses[:3] + np.pi) % (2 * np.pi) - np.pi
+    nimble.biomechanics.OpenSimParser.saveMot(skel, path, list(np.arange(num_frames) * 0.01), poses)
+
+
+class TestCreateB3D(unittest.TestCase):
+    def setUp(self):
+        self.skel = nimble.biomechanics.OpenSimParser.parseOsim(OSIM_PATH, ignoreGeometry=True).skeleton
+
+    def test_unwrap_matches_skeleton(self):
+        random = np.random.RandomState(0)
+        poses = np.cumsum(0.5 * random.randn(self.skel.getNumDofs(), 300), axis=1)
+        poses = (poses + np.pi) % (2 * np.pi) - np.pi
+        expected = np.copy(poses)
+        for t in range(1, poses.shape[1]):
+            expected[:, t] = self.skel.unwrapPositionToNearest(expected[:, t], expected[:, t - 1])
+        np.testing.assert_allclose(unwrap_poses(self.skel, poses), expected)
+
+    def test_folder_batch(self):
+        with tempfile.TemporaryDirectory() as folder:
+            for subject, motions in [('S01', ['IK/walk.mot', 'IK/run.mot']), ('S02', ['a/trial.mot', 'b/trial.mot'])]:
+                shutil.copy(OSIM_PATH, os.path.join(folder, subject + '.osim'))
+                os.makedirs(os.path.join(folder, subject))
+                shutil.move(os.path.join(folder, subject + '.osim'), os.path.join(folder, subject, 'model.osim'))
+                for i, motion in enumerate(motions):
+                    os.makedirs(os.path.dirname(os.path.join(folder, subject, motion)), exist_ok=True)
+                    write_mot(self.skel, os.path.join(folder, subject, motion), 100, seed=i)
+            # This one is longer than the old 5000 frame cap
+            write_mot(self.skel, os.path.join(folder, 'S01', 'IK', 'long.mot'), 5100)
+            with open(os.path.join(folder, 'S01', 'IK', 'broken.mot'), 'w') as f:
+                f.write('not a motion file')
+            # Ground reaction forces are .mot files too, but they aren't poses
+            os.makedirs(os.path.join(folder, 'S01', 'ID'))
+            with open(os.path.join(folder, 'S01', 'ID', 'walk_grf.mot'), 'w') as f:
+                f.write('walk_grf.mot\nversion=1\nnRows=2\nnColumns=4\ninDegrees=no\nendheader\n')
+                f.write('time\tground_force_vx\tground_force_vy\tground_force_vz\n')
+                f.write('0.00\t0.0\t700.0\t0.0\n0.01\t0.0\t701.0\t0.0\n')
+
+            subjects = find_folder_subjects(folder)
+            self.assertEqual([subject['subject'] for subject in subjects], ['S01', 'S02'])
+            self.assertEqual([trial['name'] for trial in subjects[0]['trials']], ['walk_grf', 'broken', 'long', 'run', 'walk'])
+            # Trials with the same file name are told apart by their folders
+            self.assertEqual([trial['name'] for trial in subjects[1]['trials']], ['a_trial', 'b_trial'])
+
+            output_path = os.path.join(folder, 'out', 'S01.b3d')
+            result = create_subject_b3d(output_path, subjects[0]['opensim'], subjects[0]['trials'])
+            self.assertEqual(result['status'], 'written')
+            self.assertEqual(result['trials'], 3)
+            self.assertEqual(len(result['skipped_trials']), 2)
+            self.assertTrue(any(skipped.startswith(os.path.join(folder, 'S01', 'ID', 'walk_grf.mot') + ': ')
+                                for skipped in result['skipped_trials']))
+            self.assertEqual(os.listdir(os.path.dirname(output_path)), ['S01.b3d'])
+
+            subject = nimble.biomechanics.SubjectOnDisk(output_path)
+            self.assertEqual(subject.getNumTrials(), 3)
+            self.assertEqual([subject.getTrialName(t) for t in range(3)], ['long', 'run', 'walk'])
+            self.assertEqual(subject.getTrialLength(0), 5100)
+            # Nothing is cut off the end of the long motion
+            frames = subject.readFrames(0, 0, 5100, includeSensorData=False, includeProcessingPasses=True)
+            poses = np.array([frame.processingPasses[0].pos for frame in frames]).T
+            expected, timestep = read_trial_poses(self.skel, os.path.join(folder, 'S01', 'IK', 'long.mot'), None)
+            self.assertAlmostEqual(subject.getTrialTimestep(0), timestep)
+            np.testing.assert_allclose(poses, expected, atol=1e-6)
+
+    def test_manifest(self):
+        with tempfile.TemporaryDirectory() as folder:
+            manifest_path = os.path.join(folder, 'manifest.jsonl')
+            with open(manifest_path, 'w') as f:
+                f.write(json.dumps({'subject': 'S02', 'opensim': 'S02/model.osim', 'mot': 'S02/walk.mot'}) + '\n')
+                f.write(json.dumps({'subject': 'S01', 'opensim': 'model.osim', 'mot': 'S01/walk.mot',
+                                    'joint_poses_csv': 'S01/walk.csv', 'trial': 'walking'}) + '\n')
+                f.write('\n')
+                f.write(json.dumps({'subject': 'S02', 'opensim': 'S02/model.osim', 'mot': 'S02/run.mot'}) + '\n')
+            subjects = read_manifest_subjects(manifest_path)
+            self.assertEqual([subject['subject'] for subject in subjects], ['S02', 'S01'])
+            self.assertEqual(subjects[0]['opensim'], os.path.join(folder, 'S02/model.osim'))
+            self.assertEqual([trial['name'] for trial in subjects[0]['trials']], ['walk', 'run'])
+            self.assertEqual(subjects[1]['trials'], [{'name': 'walking',
+                                                      'mot': os.path.join(folder, 'S01/walk.mot'),
+                                                      'joint_poses_csv': os.path.join(folder, 'S01/walk.csv')}])
+
+            with open(manifest_path, 'a') as f:
+                f.write(json.dumps({'subject': 'S01', 'opensim': 'other.osim', 'mot': 'S01/run.mot'}) + '\n')
+            with self.assertRaises(ValueError):
+                read_manifest_subjects(manifest_path)
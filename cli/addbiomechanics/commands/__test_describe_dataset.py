@@ -0,0 +1,35 @@
+import unittest
+import numpy as np
+from commands.describe_dataset import get_contact_phases
+
+
+# The per-frame loop that describe-dataset used to run, kept here to check the run-length version against.
+def get_contact_phases_per_frame(contact, timestep):
+    contact_phases = []
+    contact_durations = []
+    for t in range(contact.shape[0]):
+        if not contact[t, 0] and not contact[t, 1]:
+            contact_phase = "F"
+        elif contact[t, 0] and not contact[t, 1]:
+            contact_phase = "L"
+        elif not contact[t, 0] and contact[t, 1]:
+            contact_phase = "R"
+        else:
+            contact_phase = "D"
+        if len(contact_phases) == 0 or contact_phases[-1] != contact_phase:
+            contact_phases.append(contact_phase)
+            contact_durations.append(0)
+        contact_durations[-1] += timestep
+    return contact_phases, contact_durations
+
+
+class TestDescribeDataset(unittest.TestCase):
+    def test_contact_phases_match_per_frame(self):
+        contact = np.random.RandomState(0).uniform(0, 1, (500, 2)) > 0.3
+        contact_phases, contact_durations = get_contact_phases(contact, 0.01)
+        expected_phases, expected_durations = get_contact_phases_per_frame(contact, 0.01)
+        self.assertEqual(contact_phases, expected_phases)
+        np.testing.assert_allclose(contact_durations, expected_durations)
+
+    def test_contact_phases_empty_trial(self):
+        self.assertEqual(get_contact_phases(np.zeros((0, 2), dtype=bool), 0.01), ([], []))
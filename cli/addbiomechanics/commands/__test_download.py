@@ -0,0 +1,126 @@
+import hashlib
+import os
+import random
+import tempfile
+import time
+import unittest
+from typing import Dict, List, Tuple
+from addbiomechanics.s3_structure import PrefixIndex, group_files_by_prefix
+from addbiomechanics.s3_transfer import compute_etag, local_file_matches_etag, TransferManifest, MiB
+
+
+# The nested loop that download and generate-credits used to group files with, kept here to check the index against.
+def group_files_by_prefix_nested_loop(files: List[Tuple[str, int, str]],
+                                      subject_paths: List[str]) -> Dict[str, List[Tuple[str, int, str]]]:
+    subject_file_sets: Dict[str, List[Tuple[str, int, str]]] = {}
+    for key, size, e_tag in files:
+        for subject_path in subject_paths:
+            if key.startswith(subject_path):
+                if subject_path not in subject_file_sets:
+                    subject_file_sets[subject_path] = []
+                subject_file_sets[subject_path].append((key, size, e_tag))
+                break
+    return subject_file_sets
+
+
+def make_listing(num_subjects: int, files_per_subject: int) -> Tuple[List[Tuple[str, int, str]], List[str]]:
+    files: List[Tuple[str, int, str]] = []
+    for s in range(num_subjects):
+        subject = 'protected/us-west-2:user' + str(s % 500) + '/data/Subject' + str(s) + '/'
+        files.append((subject + '_subject.json', 100, '"' + str(s) + '"'))
+        for f in range(files_per_subject - 1):
+            files.append((subject + 'trials/trial' + str(f) + '/markers.c3d', 1000, '"' + str(s) + '-' + str(f) + '"'))
+    # S3 lists keys in sorted order
+    files.sort()
+    subject_paths = [key.replace('_subject.json', '') for key, _, _ in files if key.endswith('_subject.json')]
+    return files, subject_paths
+
+
+class TestDownload(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, 'file.b3d')
+        self.contents = os.urandom(20 * MiB + 17)
+        with open(self.path, 'wb') as f:
+            f.write(self.contents)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_single_part_etag(self):
+        e_tag = '"' + hashlib.md5(self.contents).hexdigest() + '"'
+        self.assertEqual(compute_etag(self.path), e_tag)
+        self.assertTrue(local_file_matches_etag(self.path, len(self.contents), e_tag))
+        self.assertFalse(local_file_matches_etag(self.path, len(self.contents) + 1, e_tag))
+
+    def test_multipart_etag(self):
+        # This is how S3 computes the ETag of a file uploaded in 8MiB parts, as boto3 does by default
+        parts = [self.contents[i:i + 8 * MiB] for i in range(0, len(self.contents), 8 * MiB)]
+        e_tag = '"' + hashlib.md5(b''.join(hashlib.md5(part).digest() for part in parts)).hexdigest() + '-' + \
+                str(len(parts)) + '"'
+        self.assertEqual(compute_etag(self.path, 8 * MiB), e_tag)
+        self.assertTrue(local_file_matches_etag(self.path, len(self.contents), e_tag))
+        self.assertFalse(local_file_matches_etag(self.path, len(self.contents), e_tag.replace('-3', '-4')))
+
+    def test_manifest_survives_reload(self):
+        manifest_path = os.path.join(self.folder.name, 'manifest.jsonl')
+        manifest = TransferManifest(manifest_path)
+        manifest.record('file.b3d', len(self.contents), '"abc"')
+        # Simulate getting interrupted halfway through writing another entry
+        with open(manifest_path, 'a') as f:
+            f.write('{"key": "other.b3d", "et')
+        reloaded = TransferManifest(manifest_path)
+        self.assertTrue(reloaded.is_complete('file.b3d', self.path, len(self.contents), '"abc"'))
+        self.assertFalse(reloaded.is_complete('file.b3d', self.path, len(self.contents), '"def"'))
+        self.assertFalse(reloaded.is_complete('other.b3d', self.path, len(self.contents), '"abc"'))
+        reloaded.record('other.b3d', len(self.contents), '"abc"')
+        self.assertTrue(TransferManifest(manifest_path).is_complete('other.b3d', self.path, len(self.contents), '"abc"'))
+
+
+class TestSubjectGrouping(unittest.TestCase):
+    def test_nested_subjects_match_nested_loop(self):
+        # "a/S1/b/" sorts before "a/S1/" when listed as _subject.json keys, so it claims its own files first
+        files = sorted([(key, 1, '') for key in [
+            'a/S1/_subject.json', 'a/S1/b/_subject.json', 'a/S1/b/x.b3d', 'a/S1/y.b3d', 'a/S10/_subject.json',
+            'a/S10/z.b3d', 'a/S2.b3d', 'other/thing.b3d']])
+        subject_paths = [key.replace('_subject.json', '') for key, _, _ in files if key.endswith('_subject.json')]
+        self.assertEqual(group_files_by_prefix(files, subject_paths),
+                         group_files_by_prefix_nested_loop(files, subject_paths))
+        self.assertEqual(PrefixIndex(['a/', 'a/b/']).find('a/b/c'), 'a/')
+        self.assertEqual(PrefixIndex(['a/b/', 'a/']).find('a/b/c'), 'a/b/')
+        self.assertIsNone(PrefixIndex(['a/b/']).find('a/c'))
+
+    def test_random_prefixes_match_nested_loop(self):
+        rng = random.Random(0)
+        for _ in range(200):
+            prefixes = [''.join(rng.choice('ab/_') for _ in range(rng.randint(1, 4))) for _ in range(rng.randint(1, 12))]
+            index = PrefixIndex(prefixes)
+            for _ in range(50):
+                key = ''.join(rng.choice('ab/_') for _ in range(rng.randint(0, 6)))
+                self.assertEqual(index.find(key), next((p for p in prefixes if key.startswith(p)), None))
+
+
+def benchmark_group_files_by_prefix(num_subjects: int = 20000, files_per_subject: int = 25):
+    """
+    Time grouping a big S3 listing into subjects with the prefix index, against the nested loop it replaced. This
+    isn't part of the unit tests, because timings on a shared machine are too noisy to assert on. Run it with
+    `PYTHONPATH=.:.. python commands/__test_download.py` from cli/addbiomechanics.
+    """
+    files, subject_paths = make_listing(num_subjects, files_per_subject)
+
+    start = time.time()
+    group_files_by_prefix(files, subject_paths)
+    index_time = time.time() - start
+
+    # The nested loop would take hours on the whole listing, so we time it on a sample of the files and extrapolate
+    sample = files[::500]
+    start = time.time()
+    group_files_by_prefix_nested_loop(sample, subject_paths)
+    nested_loop_time = (time.time() - start) * len(files) / len(sample)
+
+    print(f'Grouping {len(files)} keys into {len(subject_paths)} subjects: nested loop ~{nested_loop_time:.0f}s '
+          f'(extrapolated), prefix index {index_time:.2f}s')
+
+
+if __name__ == '__main__':
+    benchmark_group_files_by_prefix()
@@ -0,0 +1,94 @@
+import argparse
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+import nimblephysics as nimble
+from addbiomechanics.trial_arrays import TrialArrays, load_subject, iter_trial_arrays, get_dof_names
+from addbiomechanics.commands.export_csv import ExportCSVCommand
+from addbiomechanics.commands.__test_clean_up import write_kinematics_b3d
+
+
+def add_pass_to_first_trial(path: str):
+    """
+    Give the first trial of a B3D a second, smoothed processing pass, so its trials have different numbers of passes.
+    """
+    subject = load_subject(path)
+    header = subject.getHeaderProto()
+    header.addProcessingPass().setProcessingPassType(nimble.biomechanics.ProcessingPassType.LOW_PASS_FILTER)
+    trial_proto = header.getTrials()[0]
+    new_pass = trial_proto.addPass()
+    new_pass.copyValuesFrom(trial_proto.getPasses()[0])
+    new_pass.setType(nimble.biomechanics.ProcessingPassType.LOW_PASS_FILTER)
+    new_pass.setPoses(new_pass.getPoses() * 0.5)
+    nimble.biomechanics.SubjectOnDisk.writeB3D(path, header)
+
+
+def export_csv(input_path: str, output_path: str, columns, processing_pass: int = -1) -> bool:
+    return ExportCSVCommand().run_local(argparse.Namespace(command='export-csv',
+                                                           input_path=input_path,
+                                                           output_path=output_path,
+                                                           column=columns,
+                                                           processing_pass=processing_pass,
+                                                           format=None))
+
+
+class TestExportCSV(unittest.TestCase):
+    def test_trial_arrays_match_pass(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'subject.b3d')
+            write_kinematics_b3d(path, num_trials=1, num_timesteps=30)
+            subject = load_subject(path)
+            trial_pass = subject.getHeaderProto().getTrials()[0].getPasses()[-1]
+
+            arrays = TrialArrays(subject, 0)
+            self.assertEqual(arrays.processing_pass, 0)
+            self.assertEqual(arrays.num_frames, 30)
+            np.testing.assert_allclose(arrays.times, np.arange(30) * 0.01)
+            np.testing.assert_array_equal(arrays.poses, trial_pass.getPoses())
+            np.testing.assert_array_equal(arrays.taus, trial_pass.getTaus())
+            self.assertEqual(len(arrays.not_missing_grf), len(arrays.missing_grf_reason))
+            self.assertTrue(arrays.poses.flags['C_CONTIGUOUS'])
+            with self.assertRaises(ValueError):
+                TrialArrays(subject, 0, 1)
+
+    def test_iter_skips_trials_without_pass(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'subject.b3d')
+            write_kinematics_b3d(path, num_trials=2, num_timesteps=20)
+            add_pass_to_first_trial(path)
+            subject = load_subject(path)
+
+            self.assertEqual([arrays.trial for arrays in iter_trial_arrays(subject)], [0, 1])
+            self.assertEqual([arrays.processing_pass for arrays in iter_trial_arrays(subject)], [1, 0])
+            self.assertEqual([arrays.trial for arrays in iter_trial_arrays(subject, 1)], [0])
+            self.assertEqual([arrays.trial for arrays in iter_trial_arrays(subject, -2)], [0])
+            self.assertEqual([arrays.trial for arrays in iter_trial_arrays(subject, 2)], [])
+
+    def test_export_csv(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'subject.b3d')
+            write_kinematics_b3d(path, num_trials=2, num_timesteps=20)
+            add_pass_to_first_trial(path)
+            subject = load_subject(path)
+            dof = get_dof_names(subject)[0]
+            csv_path = os.path.join(folder, 'out.csv')
+
+            self.assertTrue(export_csv(path, csv_path, ['pos_' + dof, 'wrk_' + dof]))
+            df = pd.read_csv(csv_path)
+            self.assertEqual(list(df.columns), ['trial', 'frame', 'time', 'pos_' + dof, 'wrk_' + dof])
+            self.assertEqual(len(df), 40)
+            expected_work = []
+            for trial in range(2):
+                trial_pass = subject.getHeaderProto().getTrials()[trial].getPasses()[-1]
+                np.testing.assert_allclose(df[df['trial'] == trial]['pos_' + dof], trial_pass.getPoses()[0])
+                expected_work.append(trial_pass.getVels()[0] * trial_pass.getTaus()[0] * 0.01)
+            # Work keeps accumulating across trials
+            np.testing.assert_allclose(df['wrk_' + dof], np.cumsum(np.concatenate(expected_work)))
+
+            # Trials without the requested pass are left out, instead of failing the export
+            self.assertTrue(export_csv(path, csv_path, ['pos_' + dof], processing_pass=1))
+            df = pd.read_csv(csv_path)
+            self.assertEqual(set(df['trial']), {0})
+            self.assertEqual(len(df), 20)
@@ -0,0 +1,88 @@
+import argparse
+import os
+import tempfile
+import unittest
+import numpy as np
+import nimblephysics as nimble
+import pyarrow.dataset as ds
+import pyarrow.ipc
+import pyarrow.parquet as pq
+from addbiomechanics.trial_arrays import load_subject, get_dof_names
+from addbiomechanics.commands.export_dataset import ExportDatasetCommand, export_subject, merge_names
+from addbiomechanics.commands.__test_clean_up import write_kinematics_b3d
+
+
+def rename_ground_force_bodies(path: str, ground_force_bodies):
+    subject = load_subject(path)
+    header = subject.getHeaderProto()
+    header.setGroundForceBodies(ground_force_bodies)
+    nimble.biomechanics.SubjectOnDisk.writeB3D(path, header)
+
+
+class TestExportDataset(unittest.TestCase):
+    def test_merge_names(self):
+        self.assertEqual(merge_names([['a', 'b'], ['c', 'b', 'a'], [], ['d']]), ['a', 'b', 'c', 'd'])
+
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'subject.b3d')
+            write_kinematics_b3d(path, num_trials=2, num_timesteps=25)
+            subject = load_subject(path)
+            dof_names = get_dof_names(subject)
+
+            for output_format in ['parquet', 'arrow']:
+                output_path = os.path.join(folder, 'part-0.' + output_format)
+                # A row group size that doesn't divide the trial length, so the last batch of each trial is short
+                self.assertEqual(export_subject(path, output_path, output_format=output_format, row_group_size=10),
+                                 50)
+                if output_format == 'parquet':
+                    table = pq.read_table(output_path)
+                else:
+                    table = pyarrow.ipc.open_file(output_path).read_all()
+                self.assertEqual(table.num_rows, 50)
+                self.assertEqual(table.column('trial').to_pylist(), [0] * 25 + [1] * 25)
+                self.assertEqual(table.column('frame').to_pylist(), list(range(25)) * 2)
+                self.assertEqual(table.column('pass_type').to_pylist(), ['KINEMATICS'] * 50)
+                # The fixture has no missing GRF labels, so those are all left null
+                self.assertEqual(table.column('missing_grf_reason').null_count, 50)
+                for trial in range(2):
+                    trial_pass = subject.getHeaderProto().getTrials()[trial].getPasses()[0]
+                    rows = slice(25 * trial, 25 * (trial + 1))
+                    for d, dof in enumerate(dof_names):
+                        np.testing.assert_array_equal(table.column('pos_' + dof).to_numpy()[rows],
+                                                      trial_pass.getPoses()[d])
+                        np.testing.assert_array_equal(table.column('tau_' + dof).to_numpy()[rows],
+                                                      trial_pass.getTaus()[d])
+                    cop_torque_force = trial_pass.getGroundBodyCopTorqueForce()
+                    np.testing.assert_array_equal(table.column('force_calcn_l_y').to_numpy()[rows],
+                                                  cop_torque_force[9 + 7])
+                    np.testing.assert_array_equal(table.column('cop_calcn_r_x').to_numpy()[rows],
+                                                  cop_torque_force[0])
+
+    def test_subjects_share_a_schema(self):
+        with tempfile.TemporaryDirectory() as folder:
+            input_folder = os.path.join(folder, 'input')
+            output_folder = os.path.join(folder, 'output')
+            os.mkdir(input_folder)
+            write_kinematics_b3d(os.path.join(input_folder, 'a.b3d'), num_trials=1, num_timesteps=20)
+            write_kinematics_b3d(os.path.join(input_folder, 'b.b3d'), num_trials=1, num_timesteps=20)
+            rename_ground_force_bodies(os.path.join(input_folder, 'b.b3d'), ['calcn_r', 'toes_l'])
+
+            self.assertTrue(ExportDatasetCommand().run_local(argparse.Namespace(command='export-dataset',
+                                                                                input_path=input_folder,
+                                                                                output_path=output_folder,
+                                                                                processing_pass=None,
+                                                                                format='parquet',
+                                                                                row_group_size=10000,
+                                                                                jobs=1)))
+            schema_a = pq.read_schema(os.path.join(output_folder, 'subject=a', 'part-0.parquet'))
+            schema_b = pq.read_schema(os.path.join(output_folder, 'subject=b', 'part-0.parquet'))
+            self.assertTrue(schema_a.equals(schema_b))
+
+            table = ds.dataset(output_folder, format='parquet', partitioning='hive').to_table()
+            self.assertEqual(table.num_rows, 40)
+            by_subject = {subject: table.filter(ds.field('subject') == subject) for subject in ['a', 'b']}
+            self.assertEqual(by_subject['a'].column('force_toes_l_y').null_count, 20)
+            self.assertEqual(by_subject['b'].column('force_calcn_l_y').null_count, 20)
+            self.assertEqual(by_subject['b'].column('force_toes_l_y').null_count, 0)
+            self.assertEqual(by_subject['b'].column('force_calcn_r_y').null_count, 0)
@@ -0,0 +1,35 @@
+import os
+import tempfile
+import unittest
+from addbiomechanics.parallel import map_in_processes, atomic_write
+
+
+class TestParallel(unittest.TestCase):
+    def test_map_in_processes(self):
+        args_list = [(2, power) for power in range(10)]
+        results = dict(map_in_processes(pow, args_list, 3))
+        self.assertEqual(results, {index: 2 ** power for index, (_, power) in enumerate(args_list)})
+
+    def test_atomic_write(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'out.txt')
+
+            def write(temp_path: str) -> int:
+                self.assertNotEqual(temp_path, path)
+                with open(temp_path, 'w') as f:
+                    f.write('done')
+                return 4
+            self.assertEqual(atomic_write(path, write), 4)
+            with open(path) as f:
+                self.assertEqual(f.read(), 'done')
+
+            # A writer that fails part way through leaves the old file alone, and doesn't leave its temporary file
+            def fail(temp_path: str):
+                with open(temp_path, 'w') as f:
+                    f.write('half')
+                raise IOError('interrupted')
+            with self.assertRaises(IOError):
+                atomic_write(path, fail)
+            self.assertEqual(os.listdir(folder), ['out.txt'])
+            with open(path) as f:
+                self.assertEqual(f.read(), 'done')
@@ -0,0 +1,140 @@
+import os
+import time
+import unittest
+import numpy as np
+import nimblephysics as nimble
+from commands.post_process import get_nonzero_segments, get_body_world_positions, get_root_acc_corrections, \
+    clamp_cops_to_feet, get_force_plate_array, merge_force_plate_array
+
+OSIM_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'server', 'data',
+                         'PresetSkeletons', 'Rajagopal2015_ViconPlugInGait.osim')
+
+
+def make_trial(num_timesteps: int, num_plates: int = 2):
+    osim = nimble.biomechanics.OpenSimParser.parseOsim(OSIM_PATH, ignoreGeometry=True)
+    skel = osim.skeleton
+    ts = np.linspace(0, 20 * np.pi, num_timesteps)
+    dofs = np.arange(skel.getNumDofs())[:, None]
+    poses = skel.getPositions()[:, None] + 0.2 * np.sin((dofs + 1) * ts[None, :] / 10)
+    vels = np.cos(ts)[None, :].repeat(skel.getNumDofs(), axis=0)
+    accs = -np.sin(ts)[None, :].repeat(skel.getNumDofs(), axis=0)
+    forces = np.zeros((num_plates, 3, num_timesteps))
+    forces[:, 1, :] = 700 * np.maximum(np.sin(ts[None, :] + np.arange(num_plates)[:, None] * np.pi), 0)
+    cops = np.random.RandomState(0).uniform(-1, 1, (num_plates, 3, num_timesteps))
+    check_timesteps = np.random.RandomState(1).uniform(0, 1, num_timesteps) > 0.1
+    return skel, poses, vels, accs, forces, cops, check_timesteps
+
+
+# The per-frame loops that post_process used to run, kept here to check the array versions against.
+def clamp_cops_to_feet_per_frame(skel, poses, foot_bodies, forces, cops, check_timesteps, dist_threshold_m):
+    forces = [list(forces[f].T.copy()) for f in range(forces.shape[0])]
+    cops = [list(cops[f].T.copy()) for f in range(cops.shape[0])]
+    num_timesteps_cop_wrong = 0
+    for t in range(poses.shape[1]):
+        if not check_timesteps[t]:
+            continue
+        skel.setPositions(poses[:, t])
+        foot_body_locations = [body.getWorldTransform().translation() for body in foot_bodies]
+        for f in range(len(forces)):
+            force = forces[f][t]
+            cop = cops[f][t]
+            dist_to_feet = [np.linalg.norm(cop - foot_body_location) for foot_body_location in foot_body_locations]
+            if np.linalg.norm(force) > 5:
+                if min(dist_to_feet) > dist_threshold_m:
+                    closest_foot = np.argmin(dist_to_feet)
+                    num_timesteps_cop_wrong += 1
+                    cops[f][t] = foot_body_locations[closest_foot] + dist_threshold_m * (cop - foot_body_locations[closest_foot]) / np.linalg.norm(cop - foot_body_locations[closest_foot])
+            else:
+                forces[f][t] = np.zeros(3)
+                closest_foot = np.argmin(dist_to_feet)
+                cops[f][t] = foot_body_locations[closest_foot]
+    return np.array(forces).transpose((0, 2, 1)), np.array(cops).transpose((0, 2, 1)), num_timesteps_cop_wrong
+
+
+def root_acc_corrections_per_frame(skel, poses, vels, accs, forces):
+    corrections = np.zeros((3, poses.shape[1]))
+    for t in range(poses.shape[1]):
+        skel.setPositions(poses[:, t])
+        skel.setVelocities(vels[:, t])
+        skel.setAccelerations(accs[:, t])
+        com_acc = skel.getCOMLinearAcceleration() - skel.getGravity()
+        total_acc = np.sum(np.row_stack([forces[f, :, t] for f in range(forces.shape[0])]), axis=0) / skel.getMass()
+        corrections[:, t] = total_acc - com_acc
+    return corrections
+
+
+class TestPostProcess(unittest.TestCase):
+    def test_nonzero_segments(self):
+        self.assertEqual(get_nonzero_segments(np.array([0, 1, 1, 0, 0, 1, 0, 1, 1], dtype=bool)),
+                         [(1, 3), (5, 6), (7, 9)])
+        self.assertEqual(get_nonzero_segments(np.ones(4, dtype=bool)), [(0, 4)])
+        self.assertEqual(get_nonzero_segments(np.zeros(4, dtype=bool)), [])
+
+    def test_clamp_cops_matches_per_frame(self):
+        skel, poses, vels, accs, forces, cops, check_timesteps = make_trial(300)
+        foot_bodies = [skel.getBodyNode('calcn_r'), skel.getBodyNode('calcn_l')]
+        expected_forces, expected_cops, expected_wrong = clamp_cops_to_feet_per_frame(
+            skel, poses, foot_bodies, forces, cops, check_timesteps, 0.35)
+        foot_positions = get_body_world_positions(skel, poses, foot_bodies)
+        new_forces, new_cops, cop_wrong = clamp_cops_to_feet(forces, cops, foot_positions, check_timesteps, 0.35)
+        np.testing.assert_allclose(new_forces, expected_forces)
+        np.testing.assert_allclose(new_cops, expected_cops, atol=1e-12)
+        self.assertEqual(int(np.sum(cop_wrong)), expected_wrong)
+        self.assertGreater(expected_wrong, 0)
+
+    def test_root_acc_corrections_match_per_frame(self):
+        skel, poses, vels, accs, forces, cops, check_timesteps = make_trial(100)
+        np.testing.assert_allclose(get_root_acc_corrections(skel, poses, vels, accs, np.sum(forces, axis=0)),
+                                   root_acc_corrections_per_frame(skel, poses, vels, accs, forces),
+                                   atol=1e-9)
+
+    def test_force_plate_arrays_keep_plate_lengths(self):
+        plate = nimble.biomechanics.ForcePlate()
+        plate.forces = [np.array([0.0, float(t), 0.0]) for t in range(6)]
+        plate.centersOfPressure = [np.array([float(t), 0.0, 0.0]) for t in range(6)]
+        plate.moments = [np.zeros(3) for _ in range(6)]
+        forces = get_force_plate_array([plate], 'forces', 4)
+        self.assertEqual(forces.shape, (1, 3, 4))
+        np.testing.assert_equal(forces[0, 1], [0, 1, 2, 3])
+
+        # Writing back a trial-length array leaves the timesteps past the end of the trial alone
+        merged = merge_force_plate_array(plate, 'forces', 2 * forces[0])
+        self.assertEqual(len(merged), 6)
+        np.testing.assert_equal([force[1] for force in merged], [0, 2, 4, 6, 4, 5])
+
+    def test_force_plate_arrays_reject_short_plates(self):
+        empty_plate = nimble.biomechanics.ForcePlate()
+        short_plate = nimble.biomechanics.ForcePlate()
+        short_plate.forces = [np.zeros(3) for _ in range(3)]
+        with self.assertRaises(IndexError):
+            get_force_plate_array([empty_plate], 'forces', 4)
+        with self.assertRaises(IndexError):
+            get_force_plate_array([short_plate], 'forces', 4)
+
+
+def benchmark_clean_up(num_timesteps: int = 10000):
+    """
+    Time the CoP cleanup and COM acceleration fix against the per-frame loops they replaced. This isn't part of the
+    unit tests, because timings on a shared machine are too noisy to assert on. Run it with
+    `PYTHONPATH=.:.. python commands/__test_post_process.py` from cli/addbiomechanics.
+    """
+    skel, poses, vels, accs, forces, cops, check_timesteps = make_trial(num_timesteps)
+    foot_bodies = [skel.getBodyNode('calcn_r'), skel.getBodyNode('calcn_l')]
+
+    start = time.time()
+    clamp_cops_to_feet_per_frame(skel, poses, foot_bodies, forces, cops, check_timesteps, 0.35)
+    root_acc_corrections_per_frame(skel, poses, vels, accs, forces)
+    per_frame_time = time.time() - start
+
+    start = time.time()
+    foot_positions = get_body_world_positions(skel, poses, foot_bodies)
+    clamp_cops_to_feet(forces, cops, foot_positions, check_timesteps, 0.35)
+    get_root_acc_corrections(skel, poses, vels, accs, np.sum(forces, axis=0))
+    batched_time = time.time() - start
+
+    print(f'CoP cleanup + COM acceleration fix on {num_timesteps} frames: per-frame {per_frame_time:.3f}s, '
+          f'batched {batched_time:.3f}s')
+
+
+if __name__ == '__main__':
+    benchmark_clean_up()
@@ -0,0 +1,96 @@
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+import numpy as np
+import nimblephysics as nimble
+from addbiomechanics.commands.stats import StatsCommand, get_file_stats, INDEX_COLUMNS
+from addbiomechanics.commands.__test_clean_up import write_kinematics_b3d
+
+
+def label_grf_frames(path: str, trial: int):
+    """
+    Mark every frame of one trial as having trusted GRF, so its residuals are counted.
+    """
+    subject = nimble.biomechanics.SubjectOnDisk(path)
+    subject.loadAllFrames()
+    header = subject.getHeaderProto()
+    trial_proto = header.getTrials()[trial]
+    trial_proto.setMissingGRFReason([nimble.biomechanics.MissingGRFReason.notMissingGRF] *
+                                    trial_proto.getPasses()[0].getPoses().shape[1])
+    nimble.biomechanics.SubjectOnDisk.writeB3D(path, header)
+
+
+def set_trial_type(path: str, trial: int, trial_type: nimble.biomechanics.BasicTrialType):
+    """
+    Label one trial with a BasicTrialType, like the classification pass does.
+    """
+    subject = nimble.biomechanics.SubjectOnDisk(path)
+    subject.loadAllFrames()
+    header = subject.getHeaderProto()
+    header.getTrials()[trial].setBasicTrialType(trial_type)
+    nimble.biomechanics.SubjectOnDisk.writeB3D(path, header)
+
+
+class TestStats(unittest.TestCase):
+    def test_file_stats(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'subject.b3d')
+            write_kinematics_b3d(path, num_trials=2, num_timesteps=30)
+            label_grf_frames(path, 0)
+            set_trial_type(path, 0, nimble.biomechanics.BasicTrialType.OVERGROUND)
+
+            lines, records = get_file_stats(path)
+            self.assertIn('  Num Trials: 2', lines)
+            self.assertEqual(len(records), 2)
+            self.assertEqual([record['trial'] for record in records], [0, 1])
+            self.assertEqual([record['trial_type'] for record in records], ['OVERGROUND', 'OTHER'])
+            for record in records:
+                self.assertEqual(set(record.keys()), set(name for name, _ in INDEX_COLUMNS))
+                self.assertEqual(record['pass_type'], 'KINEMATICS')
+
+            self.assertEqual(records[0]['frames_with_grf'], 30)
+            subject = nimble.biomechanics.SubjectOnDisk(path)
+            residuals = np.asarray(subject.getTrialLinearResidualNorms(0, 0))
+            residuals = residuals[residuals > 0.0]
+            self.assertGreater(len(residuals), 0)
+            self.assertAlmostEqual(records[0]['linear_residual_mean'], float(np.mean(residuals)))
+            self.assertAlmostEqual(records[0]['linear_residual_p50'], float(np.percentile(residuals, 50)))
+
+            # Without any frames we trust the GRF on, there are no residuals to summarize
+            self.assertEqual(records[1]['frames_with_grf'], 0)
+            for kind in ['linear', 'angular']:
+                self.assertIsNone(records[1][kind + '_residual_mean'])
+                self.assertIsNone(records[1][kind + '_residual_p90'])
+
+    def test_index_round_trip(self):
+        with tempfile.TemporaryDirectory() as folder:
+            write_kinematics_b3d(os.path.join(folder, 'a.b3d'), num_trials=1, num_timesteps=20)
+            write_kinematics_b3d(os.path.join(folder, 'b.b3d'), num_trials=2, num_timesteps=20)
+            label_grf_frames(os.path.join(folder, 'b.b3d'), 1)
+
+            for index_name in ['index.jsonl', 'index.db']:
+                index_path = os.path.join(folder, index_name)
+                self.assertTrue(StatsCommand().run_local(argparse.Namespace(command='stats',
+                                                                            file_path=folder,
+                                                                            jobs=1,
+                                                                            index=index_path)))
+                if index_name.endswith('.db'):
+                    connection = sqlite3.connect(index_path)
+                    try:
+                        connection.row_factory = sqlite3.Row
+                        rows = [dict(row) for row in
+                                connection.execute('SELECT * FROM trials ORDER BY file, trial, pass')]
+                    finally:
+                        connection.close()
+                else:
+                    with open(index_path) as f:
+                        rows = [json.loads(line) for line in f]
+
+                self.assertEqual([(os.path.basename(row['file']), row['trial']) for row in rows],
+                                 [('a.b3d', 0), ('b.b3d', 0), ('b.b3d', 1)])
+                self.assertEqual([row['linear_residual_mean'] is None for row in rows], [True, True, False])
+                self.assertEqual([row['frames_with_grf'] for row in rows], [0, 0, 20])
+                self.assertEqual([row['trial_type'] for row in rows], ['OTHER', 'OTHER', 'OTHER'])
@@ -0,0 +1,79 @@
+import importlib
+import os
+import sys
+import tempfile
+import unittest
+import numpy as np
+import nimblephysics as nimble
+from addbiomechanics.bad_frames_detector.thresholds import ThresholdsDetector
+from addbiomechanics.dynamics_pass.acceleration_minimizing_pass import add_acceleration_minimizing_pass
+from addbiomechanics.dynamics_pass.classification_pass import classification_pass
+from addbiomechanics.commands.__test_clean_up import write_kinematics_b3d
+
+ENGINE_SRC_PATH = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'server',
+                                               'engine', 'src'))
+
+
+def load_engine_thresholds_detector():
+    """
+    Import the engine's ThresholdsDetector. The CLI folder has a bad_frames_detector package of its own, which may
+    already be imported under the same name, so we set any of those modules aside while we import the engine's.
+    """
+    def is_detector_module(name: str) -> bool:
+        return name == 'bad_frames_detector' or name.startswith('bad_frames_detector.')
+
+    saved_modules = {name: module for name, module in sys.modules.items() if is_detector_module(name)}
+    for name in saved_modules:
+        del sys.modules[name]
+    sys.path.insert(0, ENGINE_SRC_PATH)
+    try:
+        module = importlib.import_module('bad_frames_detector.thresholds')
+    finally:
+        sys.path.remove(ENGINE_SRC_PATH)
+        for name in [name for name in sys.modules if is_detector_module(name)]:
+            del sys.modules[name]
+        sys.modules.update(saved_modules)
+    return module
+
+
+def make_subject(path: str) -> nimble.biomechanics.SubjectOnDisk:
+    """
+    Build a subject that has been through the same passes the missing GRF detection runs after, with a stretch of the
+    first trial unloaded, apart from a brief, light touch on one plate well away from the feet. That touch has too
+    little impulse to count towards the CoP check.
+    """
+    write_kinematics_b3d(path, num_trials=2, num_timesteps=200)
+    subject = nimble.biomechanics.SubjectOnDisk(path)
+    subject.loadAllFrames(doNotStandardizeForcePlateData=True)
+    trial_proto = subject.getHeaderProto().getTrials()[0]
+    plates = trial_proto.getForcePlates()
+    for plate in plates:
+        forces = list(plate.forces)
+        forces[60:100] = [np.zeros(3)] * 40
+        plate.forces = forces
+    forces = list(plates[0].forces)
+    cops = list(plates[0].centersOfPressure)
+    forces[75:85] = [np.array([0.0, 50.0, 0.0])] * 10
+    cops[75:85] = [np.array([5.0, 0.0, 5.0])] * 10
+    plates[0].forces = forces
+    plates[0].centersOfPressure = cops
+    trial_proto.setForcePlates(plates)
+    add_acceleration_minimizing_pass(subject)
+    classification_pass(subject)
+    return subject
+
+
+class TestThresholds(unittest.TestCase):
+    def test_matches_engine(self):
+        engine_thresholds = load_engine_thresholds_detector()
+        self.assertEqual(os.path.dirname(os.path.dirname(os.path.abspath(engine_thresholds.__file__))),
+                         ENGINE_SRC_PATH)
+        with tempfile.TemporaryDirectory() as folder:
+            subject = make_subject(os.path.join(folder, 'subject.b3d'))
+            trials = list(range(subject.getNumTrials()))
+            expected = engine_thresholds.ThresholdsDetector().estimate_missing_grfs(subject, trials)
+            labels = ThresholdsDetector().estimate_missing_grfs(subject, trials)
+        self.assertEqual([[reason.name for reason in trial] for trial in labels],
+                         [[reason.name for reason in trial] for trial in expected])
+        # Make sure the trial actually exercises more than one of the checks
+        self.assertGreater(len(set(reason.name for trial in labels for reason in trial)), 1)
@@ -1,6 +1,10 @@
 import os
+import json
+import hashlib
+import tempfile
+import threading
 import unittest
-from commands.upload import ParserFolderStructure
+from commands.upload import ParserFolderStructure, upload_files, group_by_subject_folder, MAX_UPLOAD_THREADS
 from typing import List, Tuple, Dict
 
 
@@ -22,3 +26,170 @@ class TestParserFolderStructure(unittest.TestCase):
         self.assertEquals(folder_structure.inferred_dataset_name, 'Hamner2010')
         self.assertEquals(folder_structure.inferred_subject_name, 'subject10')
         print(folder_structure.s3_to_local_file)
+
+
+class FakeAWSClient:
+    """
+    Stands in for both the S3 and the PubSub client, recording what gets uploaded and published, and failing every
+    upload of the keys in fail_keys.
+    """
+
+    def __init__(self, fail_keys: List[str]):
+        self.fail_keys = fail_keys
+        self.uploaded: List[str] = []
+        self.published: List[Tuple[str, Dict]] = []
+        self.configs: List = []
+        self.lock = threading.Lock()
+
+    def upload_file(self, local_path, bucket, key, Config=None, Callback=None):
+        self.configs.append(Config)
+        self.put_object(Body=b'', Bucket=bucket, Key=key)
+        if Callback is not None:
+            Callback(os.path.getsize(local_path))
+
+    def put_object(self, Body, Bucket, Key):
+        if Key in self.fail_keys:
+            raise ValueError('Upload of ' + Key + ' failed')
+        with self.lock:
+            self.uploaded.append(Key)
+
+    def publish(self, topic, qos, payload):
+        self.published.append((topic, json.loads(payload)))
+
+
+class FakeSession:
+    def __init__(self, client: FakeAWSClient):
+        self.fake_client = client
+
+    def client(self, name: str):
+        return self.fake_client
+
+
+class FakeAuthContext:
+    def __init__(self, client: FakeAWSClient):
+        self.aws_session = FakeSession(client)
+        self.deployment = {'BUCKET': 'bucket', 'MQTT_PREFIX': 'DEV'}
+        self.num_refreshes = 0
+
+    def refresh(self):
+        self.num_refreshes += 1
+
+
+class TestUploadFiles(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.local_files: Dict[str, str] = {}
+        for subject in ['S01', 'S02']:
+            for trial in ['walk', 'run']:
+                s3_key = subject + '/trials/' + trial + '/markers.trc'
+                local_path = os.path.join(self.folder.name, subject + '_' + trial + '.trc')
+                with open(local_path, 'w') as f:
+                    f.write('markers')
+                self.local_files[s3_key] = local_path
+        self.contents = {'S01/_subject.json': '{}', 'S02/_subject.json': '{}'}
+        self.flags = ['S01/READY_TO_PROCESS', 'S02/READY_TO_PROCESS']
+        self.prefix = 'protected/us-west-2:user/data/Dataset/'
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_one_notification_per_subject(self):
+        client = FakeAWSClient([])
+        self.assertTrue(upload_files(FakeAuthContext(client), self.local_files, self.contents, self.flags,
+                                     self.prefix, jobs=4))
+        self.assertEqual(len(client.uploaded), 8)
+        # The ready flags come after everything else
+        self.assertEqual(sorted(client.uploaded[-2:]), [self.prefix + flag for flag in self.flags])
+        self.assertEqual(len(client.published), 2)
+        for topic, message in client.published:
+            self.assertEqual(topic, '/DEV/UPDATE/protected/us-west-2:user')
+            self.assertEqual(len(message['files']), 4)
+            self.assertTrue(message['key'].endswith('READY_TO_PROCESS'))
+            self.assertTrue(all(file['key'].startswith(message['folder']) for file in message['files']))
+
+    def test_failure_holds_back_ready_flags(self):
+        failing_key = self.prefix + 'S02/trials/run/markers.trc'
+        client = FakeAWSClient([failing_key])
+        ctx = FakeAuthContext(client)
+        self.assertFalse(upload_files(ctx, self.local_files, self.contents, self.flags, self.prefix, jobs=4,
+                                      attempts=2))
+        self.assertEqual(sorted(client.uploaded),
+                         sorted(self.prefix + key for key in list(self.local_files.keys()) + list(self.contents.keys())
+                                if self.prefix + key != failing_key))
+        self.assertGreater(ctx.num_refreshes, 0)
+        # We still tell listeners about the files that did make it up
+        self.assertEqual(sum(len(message['files']) for _, message in client.published), 5)
+        # Without the ready flags, the single-file fields describe the subject file instead
+        self.assertTrue(all(message['key'].endswith('_subject.json') for _, message in client.published))
+
+    def test_part_threads_are_shared_between_jobs(self):
+        for jobs in [1, 4, 32]:
+            client = FakeAWSClient([])
+            self.assertTrue(upload_files(FakeAuthContext(client), self.local_files, self.contents, self.flags,
+                                         self.prefix, jobs=jobs))
+            max_concurrency = client.configs[0].max_concurrency
+            self.assertGreaterEqual(max_concurrency, 1)
+            self.assertLessEqual(min(jobs, len(self.local_files)) * max_concurrency, max(MAX_UPLOAD_THREADS, jobs))
+
+    def test_group_by_innermost_subject_folder(self):
+        files = [('a/S1/_subject.json', 2, 0), ('a/S1/inner/_subject.json', 2, 0), ('a/S1/inner/x.trc', 1, 0),
+                 ('a/S1/trials/x.trc', 1, 0), ('b/loose.trc', 1, 0)]
+        groups = group_by_subject_folder(files, ['a/S1/', 'a/S1/inner/'])
+        self.assertEqual({folder: [file[0] for file in folder_files] for folder, folder_files in groups.items()}, {
+            'a/S1/': ['a/S1/_subject.json', 'a/S1/trials/x.trc'],
+            'a/S1/inner/': ['a/S1/inner/_subject.json', 'a/S1/inner/x.trc'],
+            'b/': ['b/loose.trc'],
+        })
+
+
+class TestSyncUpload(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        files = ['S01/_subject.json', 'S01/unscaled_generic.osim', 'S01/trials/walk/markers.trc',
+                 'S01/trials/run/markers.trc', 'S02/_subject.json', 'S02/unscaled_generic.osim',
+                 'S02/trials/walk/markers.trc']
+        self.paths = []
+        for file in files:
+            path = os.path.join(self.folder.name, 'Dataset', file)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write('contents of ' + file)
+            self.paths.append(path)
+        self.prefix = 'protected/us-west-2:user/data/Dataset/'
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def remote_listing(self, structure: ParserFolderStructure) -> Dict[str, Tuple[int, str]]:
+        remote_files: Dict[str, Tuple[int, str]] = {}
+        for s3_key, local_path in structure.s3_to_local_file.items():
+            with open(local_path, 'rb') as f:
+                contents = f.read()
+            remote_files[self.prefix + s3_key] = (len(contents), '"' + hashlib.md5(contents).hexdigest() + '"')
+        for flag in structure.s3_ready_flags:
+            remote_files[self.prefix + flag] = (0, '"' + hashlib.md5(b'').hexdigest() + '"')
+        return remote_files
+
+    def test_only_changed_files_are_uploaded(self):
+        structure = ParserFolderStructure(self.paths)
+        self.assertTrue(structure.attempt_parse_as_preformatted_dataset(dont_read_files=True))
+        remote_files = self.remote_listing(structure)
+        # Edit one trial since the last upload
+        with open(structure.s3_to_local_file['S01/trials/run/markers.trc'], 'a') as f:
+            f.write(' (fixed)')
+
+        changed_trials = structure.skip_unchanged_files(remote_files, self.prefix, jobs=2)
+        self.assertEqual(changed_trials, {'S01/': ['run']})
+        self.assertEqual(list(structure.s3_to_local_file.keys()), ['S01/trials/run/markers.trc'])
+        self.assertEqual(json.loads(structure.s3_to_contents['S01/_changed_trials.json']),
+                         {'trials': ['run'], 'files': ['trials/run/markers.trc']})
+        self.assertEqual(structure.s3_ready_flags, ['S01/READY_TO_PROCESS'])
+
+    def test_nothing_uploaded_yet(self):
+        structure = ParserFolderStructure(self.paths)
+        self.assertTrue(structure.attempt_parse_as_preformatted_dataset(dont_read_files=True))
+        num_files = len(structure.s3_to_local_file)
+        changed_trials = structure.skip_unchanged_files({}, self.prefix)
+        self.assertEqual(changed_trials, {'S01/': ['run', 'walk'], 'S02/': ['walk']})
+        self.assertEqual(len(structure.s3_to_local_file), num_files)
+        self.assertEqual(sorted(structure.s3_ready_flags), ['S01/READY_TO_PROCESS', 'S02/READY_TO_PROCESS'])
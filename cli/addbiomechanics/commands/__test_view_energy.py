@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import nimblephysics as nimble
+from addbiomechanics.energy_recording import EnergyFrames, record_energy_frames
+from addbiomechanics.commands.__test_clean_up import write_kinematics_b3d
+
+
+def make_energy_frames(path: str, geometry: str, num_frames: int) -> EnergyFrames:
+    """
+    Random values in all the arrays view-energy draws, with particles (and feet on the ground) coming and going.
+    """
+    subject = nimble.biomechanics.SubjectOnDisk(path)
+    skel = subject.readSkel(0, geometry)
+    random = np.random.RandomState(0)
+    num_bodies = skel.getNumBodyNodes()
+    num_joints = skel.getNumJoints()
+    num_stacks = 12
+    particle_live = np.zeros((num_stacks, num_frames), dtype=np.int32)
+    for s in range(num_stacks):
+        start = random.randint(0, num_frames - 5)
+        particle_live[s, start:start + random.randint(3, 30)] = 1
+    return EnergyFrames(
+        file_path=path,
+        geometry=geometry,
+        trial_pass=0,
+        timestep=0.01,
+        num_frames=num_frames,
+        poses=skel.getPositions()[:, np.newaxis] + 0.1 * random.randn(skel.getNumDofs(), num_frames),
+        contact_forces=random.randn(2, 3, num_frames) * 100,
+        contact_cops=random.randn(2, 3, num_frames),
+        contact=random.rand(2, num_frames) > 0.5,
+        graph_dof=None,
+        graph_duration=num_frames * 0.01,
+        graph_values=None,
+        graph_joint_positions=None,
+        body_names=[skel.getBodyNode(i).getName() for i in range(num_bodies)],
+        body_shape_keys=[['world_' + skel.getName() + '_' + skel.getBodyNode(i).getName() + '_0'] for i in range(num_bodies)],
+        body_energy=random.rand(num_bodies, num_frames) * 10,
+        body_colors=random.rand(num_bodies, 4, num_frames),
+        joint_names=[skel.getJoint(j).getName() for j in range(num_joints)],
+        joint_centers=random.randn(num_joints, 3, num_frames),
+        tendon_energy=random.rand(num_joints, num_frames) * 40,
+        tendon_colors=random.rand(num_joints, 3, num_frames),
+        peak_tendon_storage=40.0,
+        particle_trajectories=random.randn(num_stacks * 3, num_frames),
+        particle_live=particle_live,
+        particle_intro_fade=random.rand(num_stacks, num_frames),
+        particle_outro_fade=random.rand(num_stacks, num_frames),
+        particle_colors=random.rand(num_stacks, 3, num_frames),
+        legend_html='Legend')
+
+
+class TestViewEnergy(unittest.TestCase):
+    def test_chunked_recording_matches_serial(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'subject.b3d')
+            write_kinematics_b3d(path, num_trials=1, num_timesteps=60)
+            energy_frames = make_energy_frames(path, folder + '/', 60)
+
+            serial_path = os.path.join(folder, 'serial.bin')
+            self.assertEqual(record_energy_frames(energy_frames, 0, 60, serial_path), 60)
+
+            chunks = [(0, 7), (7, 31), (31, 60)]
+            chunk_bytes = b''
+            for i, (start, end) in enumerate(chunks):
+                chunk_path = os.path.join(folder, 'chunk_' + str(i) + '.bin')
+                record_energy_frames(energy_frames.chunk(start, end), start, end, chunk_path)
+                with open(chunk_path, 'rb') as f:
+                    chunk_bytes += f.read()
+            with open(serial_path, 'rb') as f:
+                self.assertEqual(chunk_bytes, f.read())
+
+    def test_chunk_trims_particles(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'subject.b3d')
+            write_kinematics_b3d(path, num_trials=1, num_timesteps=60)
+            energy_frames = make_energy_frames(path, folder + '/', 60)
+            chunk = energy_frames.chunk(40, 50)
+            # The chunk keeps the frame before it, and the particles' tails behind that
+            self.assertEqual(chunk.particle_first_frame, 40 - 1 - 7)
+            self.assertEqual(chunk.particle_live.shape, (12, 50 - 32))
+            for frame in range(39, 50):
+                for full, trimmed in zip(energy_frames.particle_tails(frame), chunk.particle_tails(frame - 32)):
+                    np.testing.assert_array_equal(full, trimmed)
@@ -0,0 +1,45 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import nimblephysics as nimble
+from addbiomechanics.viewer_data import ViewerTrial, get_display_stride
+from addbiomechanics.commands.__test_clean_up import write_kinematics_b3d, OSIM_PATH
+
+
+class TestViewerData(unittest.TestCase):
+    def test_display_stride(self):
+        self.assertEqual(get_display_stride(0.001, None), 1)
+        self.assertEqual(get_display_stride(0.001, 100), 10)
+        self.assertEqual(get_display_stride(0.001, 60), 17)
+        # We never step faster than the capture rate
+        self.assertEqual(get_display_stride(0.01, 1000), 1)
+
+    def test_matches_read_frames(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'subject.b3d')
+            write_kinematics_b3d(path, num_trials=1, num_timesteps=50)
+            subject = nimble.biomechanics.SubjectOnDisk(path)
+            skel = nimble.biomechanics.OpenSimParser.parseOsim(OSIM_PATH, ignoreGeometry=True).skeleton
+
+            viewer = ViewerTrial(subject, 0, display_hz=50)
+            viewer.precompute_body_transforms(skel)
+            self.assertEqual(viewer.num_frames, 50)
+            self.assertEqual(list(viewer.frames), list(range(0, 50, 2)))
+            self.assertAlmostEqual(viewer.display_timestep, 0.02)
+            self.assertEqual(viewer.body_world_transforms.shape, (25, skel.getNumBodyNodes(), 4, 4))
+
+            for i, frame in enumerate(viewer.frames):
+                loaded = subject.readFrames(0, int(frame), 1, contactThreshold=20)[0]
+                processing_pass = loaded.processingPasses[-1]
+                np.testing.assert_allclose(viewer.arrays.poses[:, frame], processing_pass.pos)
+                np.testing.assert_allclose(viewer.contact_forces[:, :, frame].flatten(),
+                                           processing_pass.groundContactForce)
+                np.testing.assert_allclose(viewer.contact_cops[:, :, frame].flatten(),
+                                           processing_pass.groundContactCenterOfPressure)
+                np.testing.assert_array_equal(viewer.contact[:, frame], np.array(processing_pass.contact) > 0)
+                for plate in range(len(loaded.rawForcePlateForces)):
+                    np.testing.assert_allclose(viewer.raw_force_plate_forces[plate, :, frame],
+                                               loaded.rawForcePlateForces[plate])
+                skel.setPositions(processing_pass.pos)
+                np.testing.assert_allclose(viewer.body_coms[i, 0], skel.getBodyNode(0).getCOM())
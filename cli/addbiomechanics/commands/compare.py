@@ -45,6 +45,12 @@ class CompareCommand(AbstractCommand):
             default=1.0)
         view_parser.add_argument('--loop-frames', type=int, nargs='+', default=[],
                                help='Specific frames to loop over.')
+        view_parser.add_argument(
+            '--display-hz',
+            help='Play back at most this many frames per second (of trial time), skipping frames in between, so that '
+                 'high frame rate trials still play back smoothly. By default every frame is shown.',
+            type=float,
+            default=None)
 
     def run_local(self, args: argparse.Namespace) -> bool:
         if args.command != 'compare':
@@ -55,6 +61,7 @@ class CompareCommand(AbstractCommand):
         graph_dof: str = args.graph_dof
         graph_lowpass_hz: int = args.graph_lowpass_hz
         playback_speed: float = args.playback_speed
+        display_hz: float = args.display_hz
 
         try:
             import nimblephysics as nimble
@@ -73,6 +80,8 @@ class CompareCommand(AbstractCommand):
             print("The required library 'scipy' is not installed. Please install it and try this command again.")
             return True
 
+        from addbiomechanics.viewer_data import ViewerTrial
+
         geometry: str = args.geometry
 
         if geometry is None:
@@ -104,7 +113,12 @@ class CompareCommand(AbstractCommand):
         print('Subject 1 mass: '+str(subject_two.getMassKg())+"kg")
         print('Subject 1 biological sex: '+subject_two.getBiologicalSex())
 
-        num_frames = subject_one.getTrialLength(trial)
+        # Read both trials into memory up front, so playback never has to wait on the files
+        print('Loading trial '+str(trial)+' from both files into memory...')
+        viewer_one = ViewerTrial(subject_one, trial, display_hz=display_hz, frames=args.loop_frames)
+        viewer_two = ViewerTrial(subject_two, trial, display_hz=display_hz, frames=args.loop_frames)
+        num_frames = min(viewer_one.num_frames, viewer_two.num_frames)
+        displayed_frames = [frame for frame in viewer_one.frames if frame < num_frames]
 
         osim_one: nimble.biomechanics.OpenSimFile = subject_one.readOpenSimFile(0, geometry)
         skel_one = osim_one.skeleton
@@ -135,18 +149,9 @@ class CompareCommand(AbstractCommand):
 
             dof_index = dof.getIndexInSkeleton()
 
-            timesteps = np.zeros(num_frames)
-            dof_poses_one = np.zeros(num_frames)
-            dof_poses_two = np.zeros(num_frames)
-
-            for frame in range(num_frames):
-                timesteps[frame] = frame * subject_one.getTrialTimestep(trial)
-
-                loaded_one: List[nimble.biomechanics.Frame] = subject_one.readFrames(trial, frame, 1, False, True)
-                dof_poses_one[frame] = loaded_one[0].processingPasses[-1].pos[dof_index]
-
-                loaded_two: List[nimble.biomechanics.Frame] = subject_two.readFrames(trial, frame, 1, False, True)
-                dof_poses_one[frame] = loaded_two[0].processingPasses[-1].pos[dof_index]
+            timesteps = viewer_one.arrays.times[:num_frames]
+            dof_poses_one = viewer_one.arrays.poses[dof_index, :num_frames]
+            dof_poses_two = viewer_two.arrays.poses[dof_index, :num_frames]
 
             # Filter down to "--graph-lowpass-hz" Hz
             if graph_lowpass_hz is not None:
@@ -174,7 +179,7 @@ class CompareCommand(AbstractCommand):
 
         # Animate the knees back and forth
         ticker: nimble.realtime.Ticker = nimble.realtime.Ticker(
-            subject_one.getTrialTimestep(trial) / playback_speed)
+            viewer_one.display_timestep / playback_speed)
 
         loop_counter: int = 0
 
@@ -191,26 +196,33 @@ class CompareCommand(AbstractCommand):
             # nonlocal marker_map
             # nonlocal show_markers
 
-            frame = loop_counter
+            frame = displayed_frames[loop_counter]
 
-            loaded_one: List[nimble.biomechanics.Frame] = subject_one.readFrames(trial, frame, 1, contactThreshold=20)
-            skel_one.setPositions(loaded_one[0].processingPasses[-1].pos)
+            skel_one.setPositions(viewer_one.arrays.poses[:, frame])
             gui.nativeAPI().renderSkeleton(skel_one, prefix='one_')
 
-            loaded_two: List[nimble.biomechanics.Frame] = subject_two.readFrames(trial, frame, 1, contactThreshold=20)
-            skel_two.setPositions(loaded_two[0].processingPasses[-1].pos)
+            skel_two.setPositions(viewer_two.arrays.poses[:, frame])
             gui.nativeAPI().renderSkeleton(skel_two, prefix='two_', overrideColor=[1, 0, 0, 1])
 
             loop_counter += 1
-            loop_number = num_frames
-            if loop_counter >= loop_number:
+            if loop_counter >= len(displayed_frames):
                 loop_counter = 0
 
         # ticker.registerTickListener(onTick)
         # ticker.start()
+        # We schedule each frame against the clock, rather than sleeping after each one, so the time it takes to render
+        # a frame doesn't slow down playback
+        tick_interval = viewer_one.display_timestep / playback_speed
+        next_tick = time.time()
         while True:
             onTick(time.time())
-            time.sleep(0.01)
+            next_tick += tick_interval
+            delay = next_tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # If we've fallen behind, don't try to catch up by rendering a burst of frames
+                next_tick = time.time()
 
         print(subject.getHref())
         print(subject.getTrialName(trial))
@@ -1,13 +1,24 @@
 from addbiomechanics.commands.abstract_command import AbstractCommand
+from addbiomechanics.parallel import map_in_processes, atomic_write
 import argparse
 import os
-from typing import List, Dict, Optional
+import json
+import time
+import traceback
+from typing import List, Dict, Any, Optional, Tuple
+
+MANIFEST_HELP = ('A JSON lines file with one line per motion to convert, like {"subject": "S01", "opensim": '
+                 '"S01/model.osim", "mot": "S01/IK/walk.mot"}, with optional "joint_poses_csv" and "trial" (the trial '
+                 'name, which defaults to the name of the .mot file) keys. Relative paths are relative to the folder '
+                 'the manifest is in. All the lines for a subject are written, in order, as trials of one B3D file.')
 
 
 class CreateB3DCommand(AbstractCommand):
     def register_subcommand(self, subparsers: argparse._SubParsersAction):
         parser = subparsers.add_parser(
-            'create-b3d', help='This command will read an OpenSim file and a motion, and create a simple B3D file.')
+            'create-b3d', help='This command will read an OpenSim file and a motion, and create a simple B3D file. '
+                               'With --input-folder or --manifest it instead converts many motions at once, writing '
+                               'one B3D per subject, with a trial for each motion, into the output_path folder.')
         parser.add_argument('output_path', type=str)
         parser.add_argument('--opensim-path', type=str, default=None)
         parser.add_argument(
@@ -21,21 +32,26 @@ class CreateB3DCommand(AbstractCommand):
                  'override the MOT file.',
             type=str,
             default=None)
+        parser.add_argument(
+            '--input-folder',
+            help='A folder with a subfolder for each subject. Each subject folder needs exactly one *.osim file '
+                 'somewhere inside it, and every *.mot file inside it becomes a trial. A *.csv file next to a *.mot '
+                 'file, with the same name, overrides its joint poses like --joint-poses-csv-path does.',
+            type=str,
+            default=None)
+        parser.add_argument('--manifest', help=MANIFEST_HELP, type=str, default=None)
+        parser.add_argument(
+            '--jobs',
+            help='The number of subjects to convert in parallel, each in its own process, in batch mode',
+            type=int,
+            default=1)
 
     def run_local(self, args: argparse.Namespace) -> bool:
         if args.command != 'create-b3d':
             return False
-        
+
         output_path: str = args.output_path
         output_path = os.path.abspath(output_path)
-        opensim_path: str = args.opensim_path
-        opensim_path = os.path.abspath(opensim_path)
-        poses_mot_path: Optional[str] = args.poses_mot_path
-        if poses_mot_path is not None:
-            poses_mot_path = os.path.abspath(poses_mot_path)
-        joint_poses_csv_path: Optional[str] = args.joint_poses_csv_path
-        if joint_poses_csv_path is not None:
-            joint_poses_csv_path = os.path.abspath(joint_poses_csv_path)
 
         try:
             import nimblephysics as nimble
@@ -49,8 +65,7 @@ class CreateB3DCommand(AbstractCommand):
             print("The required library 'numpy' is not installed. Please install it and try this command again.")
             return True
         try:
-            from scipy.signal import butter, filtfilt, resample_poly, resample, welch
-            from scipy.interpolate import interp1d
+            from scipy.signal import butter, filtfilt
         except ImportError:
             print("The required library 'scipy' is not installed. Please install it and try this command again.")
             return True
@@ -60,89 +75,340 @@ class CreateB3DCommand(AbstractCommand):
             print("The required library 'pandas' is not installed. Please install it and try this command again.")
             return True
 
+        if args.input_folder is not None or args.manifest is not None:
+            return self.run_batch(args, output_path)
+
+        if args.opensim_path is None or not os.path.exists(args.opensim_path):
+            print('The provided OpenSim file does not exist.')
+            return True
+        opensim_path: str = os.path.abspath(args.opensim_path)
+        if args.poses_mot_path is None or not os.path.exists(args.poses_mot_path):
+            print('The provided poses MOT file does not exist.')
+            return True
+        poses_mot_path: str = os.path.abspath(args.poses_mot_path)
+        joint_poses_csv_path: Optional[str] = args.joint_poses_csv_path
+        if joint_poses_csv_path is not None:
+            joint_poses_csv_path = os.path.abspath(joint_poses_csv_path)
+            if not os.path.exists(joint_poses_csv_path):
+                print('The provided joint poses CSV file does not exist. Skipping.')
+                joint_poses_csv_path = None
+
+        trial = {
+            'name': os.path.splitext(os.path.basename(poses_mot_path))[0],
+            'mot': poses_mot_path,
+            'joint_poses_csv': joint_poses_csv_path
+        }
+        result = create_subject_b3d(output_path, opensim_path, [trial])
+        for line in format_create_b3d_report([result]):
+            print(line)
+        return True
+
+    def run_batch(self, args: argparse.Namespace, output_folder: str) -> bool:
+        jobs: int = args.jobs
+        if args.manifest is not None:
+            try:
+                subjects = read_manifest_subjects(os.path.abspath(args.manifest))
+            except ValueError as e:
+                print('Could not read the manifest: ' + str(e))
+                return True
+        else:
+            subjects = find_folder_subjects(os.path.abspath(args.input_folder))
+
+        results: List[Dict[str, Any]] = []
+        to_convert: List[Dict[str, Any]] = []
+        for subject in subjects:
+            subject['output'] = os.path.join(output_folder, subject['subject'] + '.b3d')
+            if 'error' in subject:
+                results.append(make_result(subject['output'], 'failed', subject['error']))
+            elif os.path.exists(subject['output']):
+                print('Skipping ' + subject['subject'] + ' because the output file already exists at ' +
+                      subject['output'])
+            else:
+                to_convert.append(subject)
+
+        num_trials = sum(len(subject['trials']) for subject in to_convert)
+        print('Will create ' + str(len(to_convert)) + ' B3D file' + ("s" if len(to_convert) != 1 else "") + ', from ' +
+              str(num_trials) + ' motion' + ("s" if num_trials != 1 else ""))
+        if jobs <= 1 or len(to_convert) <= 1:
+            for subject_index, subject in enumerate(to_convert):
+                print('Converting ' + str(subject_index + 1) + '/' + str(len(to_convert)) + ': ' + subject['subject'])
+                results.append(create_subject_b3d(subject['output'], subject['opensim'], subject['trials']))
+        else:
+            print('Converting with ' + str(jobs) + ' parallel jobs')
+            finished = map_in_processes(create_subject_b3d,
+                                        [(subject['output'], subject['opensim'], subject['trials'])
+                                         for subject in to_convert], jobs)
+            for done_count, (_, result) in enumerate(finished):
+                results.append(result)
+                print('Done ' + str(done_count + 1) + '/' + str(len(to_convert)) + ': ' + result['output'])
+
+        for line in format_create_b3d_report(results):
+            print(line)
+        return True
+
+
+def find_folder_subjects(input_folder: str) -> List[Dict[str, Any]]:
+    """
+    Treat every subfolder of `input_folder` as a subject, with the single *.osim file inside it as its model, and every
+    *.mot file inside it (sorted by path) as a trial.
+    """
+    subjects: List[Dict[str, Any]] = []
+    for subject_name in sorted(os.listdir(input_folder)):
+        subject_folder = os.path.join(input_folder, subject_name)
+        if not os.path.isdir(subject_folder):
+            continue
+        opensim_paths: List[str] = []
+        mot_paths: List[str] = []
+        for dirpath, dirnames, filenames in os.walk(subject_folder):
+            for filename in filenames:
+                if filename.endswith('.osim'):
+                    opensim_paths.append(os.path.join(dirpath, filename))
+                elif filename.endswith('.mot'):
+                    mot_paths.append(os.path.join(dirpath, filename))
+        if len(mot_paths) == 0:
+            continue
+        subject: Dict[str, Any] = {'subject': subject_name, 'opensim': None, 'trials': []}
+        if len(opensim_paths) != 1:
+            subject['error'] = 'Found ' + str(len(opensim_paths)) + ' *.osim files in ' + subject_folder + \
+                               ', so pass this subject in a --manifest instead'
+        else:
+            subject['opensim'] = opensim_paths[0]
+        # Trials are named after their files, unless that name is already taken, when we use the whole relative path
+        trial_names: Dict[str, int] = {}
+        for mot_path in sorted(mot_paths):
+            stem = os.path.splitext(os.path.basename(mot_path))[0]
+            trial_names[stem] = trial_names.get(stem, 0) + 1
+        for mot_path in sorted(mot_paths):
+            stem = os.path.splitext(mot_path)[0]
+            name = os.path.basename(stem)
+            if trial_names[name] > 1:
+                name = os.path.relpath(stem, subject_folder).replace(os.sep, '_')
+            csv_path = stem + '.csv'
+            subject['trials'].append({
+                'name': name,
+                'mot': mot_path,
+                'joint_poses_csv': csv_path if os.path.exists(csv_path) else None
+            })
+        subjects.append(subject)
+    return subjects
+
+
+def read_manifest_subjects(manifest_path: str) -> List[Dict[str, Any]]:
+    """
+    Group the lines of a manifest (see MANIFEST_HELP) into subjects, in the order each subject first appears.
+    """
+    manifest_folder = os.path.dirname(manifest_path)
+    subjects: Dict[str, Dict[str, Any]] = {}
+    with open(manifest_path, 'r') as f:
+        for line_number, line in enumerate(f):
+            if len(line.strip()) == 0:
+                continue
+            where = manifest_path + ':' + str(line_number + 1)
+            try:
+                entry: Dict[str, Any] = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(where + ' is not valid JSON: ' + str(e))
+            for key in ['subject', 'opensim', 'mot']:
+                if key not in entry:
+                    raise ValueError(where + ' is missing "' + key + '"')
+            opensim_path = os.path.join(manifest_folder, entry['opensim'])
+            mot_path = os.path.join(manifest_folder, entry['mot'])
+            csv_path = entry.get('joint_poses_csv', None)
+            if csv_path is not None:
+                csv_path = os.path.join(manifest_folder, csv_path)
+            if entry['subject'] not in subjects:
+                subjects[entry['subject']] = {'subject': entry['subject'], 'opensim': opensim_path, 'trials': []}
+            subject = subjects[entry['subject']]
+            if os.path.normpath(subject['opensim']) != os.path.normpath(opensim_path):
+                raise ValueError(where + ' gives subject "' + entry['subject'] + '" a different *.osim file than '
+                                 'its earlier lines')
+            subject['trials'].append({
+                'name': entry.get('trial', os.path.splitext(os.path.basename(mot_path))[0]),
+                'mot': mot_path,
+                'joint_poses_csv': csv_path
+            })
+    return list(subjects.values())
+
+
+def get_unwrapped_dofs(skeleton) -> List[int]:
+    """
+    The DOFs that Skeleton.unwrapPositionToNearest() moves by whole turns, to be as close as possible to the previous
+    pose. On OpenSim models these are the rotations of Euler joints, and it leaves every other DOF alone.
+    """
+    import numpy as np
+    pose = skeleton.getPositions()
+    dofs: List[int] = []
+    for dof in range(skeleton.getNumDofs()):
+        turned = np.copy(pose)
+        turned[dof] += 2 * np.pi
+        if abs(skeleton.unwrapPositionToNearest(turned, pose)[dof] - pose[dof]) < 1e-8:
+            dofs.append(dof)
+    return dofs
+
+
+def unwrap_poses(skeleton, poses: 'np.ndarray') -> 'np.ndarray':
+    """
+    Unwrap every frame of a (num_dofs x num_frames) matrix of poses to be nearest to the frame before it. This gives
+    the same result as calling Skeleton.unwrapPositionToNearest() on each frame in turn, all in one pass over the
+    array.
+    """
+    import numpy as np
+    poses = np.copy(poses)
+    dofs = get_unwrapped_dofs(skeleton)
+    if len(dofs) > 0:
+        poses[dofs, :] = np.unwrap(poses[dofs, :], axis=1)
+    return poses
+
+
+def read_trial_poses(skeleton, mot_path: str, joint_poses_csv_path: Optional[str]) -> Tuple['np.ndarray', float]:
+    """
+    Read the poses for a trial from a .mot file (and optionally a joint poses CSV file), unwrapped and low-pass
+    filtered, along with the timestep between them.
+    """
+    import nimblephysics as nimble
+    import numpy as np
+    from scipy.signal import butter, filtfilt
+
+    from addbiomechanics.motion_file_headers import read_mot_header, HEADER_BYTES
+
+    # loadMot() quietly gives all-zero poses for a .mot that has none of the skeleton's coordinates in it, like the
+    # ground reaction forces (*_grf.mot) that often sit next to the IK results, so we check the column names first
+    with open(mot_path, 'rb') as f:
+        header = read_mot_header(f.read(HEADER_BYTES))
+    if header is not None and len(header.column_names) > 0:
+        dof_names = set(skeleton.getDofByIndex(i).getName() for i in range(skeleton.getNumDofs()))
+        if not any(name in dof_names for name in header.column_names[1:]):
+            raise ValueError('None of the columns are coordinates of the skeleton, so this is not a motion (is it a '
+                             'ground reaction force file?)')
+
+    mot: nimble.biomechanics.OpenSimMot = nimble.biomechanics.OpenSimParser.loadMot(skeleton, mot_path)
+    poses: np.ndarray = np.copy(mot.poses)
+    if len(mot.timestamps) < 2:
+        raise ValueError('The motion has fewer than 2 frames')
+    timestep: float = mot.timestamps[1] - mot.timestamps[0]
+
+    if joint_poses_csv_path is not None:
+        import pandas as pd
+        df: pd.DataFrame = pd.read_csv(joint_poses_csv_path)
+        joint_poses: np.ndarray = df.to_numpy()
+        dof_indices: List[int] = []
+        for name in df.columns:
+            parts = name.split('_')
+            index = int(parts[-1])
+            joint_name = '_'.join(parts[:-2])
+            dof_indices.append(skeleton.getJoint(joint_name).getIndexInSkeleton(index))
+        # Overwrite the MOT poses with the joint poses
+        poses[dof_indices, :] = joint_poses.transpose()
+
+    poses = unwrap_poses(skeleton, poses)
+
+    fs = int(1.0 / timestep)
+    nyq = 0.5 * fs
+    normal_cutoff = 5.0 / nyq
+    b, a = butter(3, normal_cutoff, btype='low', analog=False)
+    poses = filtfilt(b, a, poses, axis=1, padtype='constant')
+    return poses, timestep
+
+
+def make_result(output_path: str, status: str, message: str = '') -> Dict[str, Any]:
+    return {
+        'output': output_path,
+        'status': status,
+        'message': message,
+        'trials': 0,
+        'frames': 0,
+        'skipped_trials': [],
+        'seconds': 0.0,
+    }
+
+
+def create_subject_b3d(output_path: str, opensim_path: str, trials: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Write a B3D at `output_path` with a kinematics trial for each of the `trials` (dicts with 'name', 'mot' and
+    'joint_poses_csv' keys). Each motion is read and processed on its own, however long it is, and a motion that
+    can't be read is left out rather than failing the whole subject. This lives outside the command so it can run in a
+    worker process, and it never raises. Instead it returns a record of what happened, for the report.
+    """
+    import nimblephysics as nimble
+    import numpy as np
+
+    start_time = time.time()
+    result = make_result(output_path, 'written')
+    try:
         # Create an empty subject, which we will fill in with data
         subject: nimble.biomechanics.SubjectOnDiskHeader = nimble.biomechanics.SubjectOnDiskHeader()
         subject_pass: nimble.biomechanics.SubjectOnDiskPassHeader = subject.addProcessingPass()
         subject_pass.setProcessingPassType(nimble.biomechanics.ProcessingPassType.KINEMATICS)
-
-        if not os.path.exists(opensim_path):
-            print('The provided OpenSim file does not exist.')
-            return True
         with open(opensim_path, 'r') as f:
-            file_contents: str = f.read()
-            subject_pass.setOpenSimFileText(file_contents)
+            subject_pass.setOpenSimFileText(f.read())
 
-        trial: nimble.biomechanics.SubjectOnDiskTrial = subject.addTrial()
-        trial_pass: nimble.biomechanics.SubjectOnDiskTrialPass = trial.addPass()
-        trial_pass.setType(nimble.biomechanics.ProcessingPassType.KINEMATICS)
-
-        parsed_opensim: nimble.biomechanics.OpenSimFile = nimble.biomechanics.OpenSimParser.parseOsim(opensim_path)
+        # We only need the skeleton's kinematics, so we don't load the meshes
+        parsed_opensim: nimble.biomechanics.OpenSimFile = nimble.biomechanics.OpenSimParser.parseOsim(
+            opensim_path, ignoreGeometry=True)
         skeleton: nimble.dynamics.Skeleton = parsed_opensim.skeleton
         subject.setNumDofs(skeleton.getNumDofs())
         subject.setNumJoints(skeleton.getNumJoints())
 
-        if not os.path.exists(poses_mot_path):
-            print('The provided poses MOT file does not exist.')
-            return True
-        with open(poses_mot_path, 'r') as f:
-            mot: nimble.biomechanics.OpenSimMot = nimble.biomechanics.OpenSimParser.loadMot(skeleton, poses_mot_path)
-            poses: np.ndarray = np.copy(mot.poses)
+        for trial_spec in trials:
+            try:
+                poses, timestep = read_trial_poses(skeleton, trial_spec['mot'], trial_spec['joint_poses_csv'])
+            except Exception as e:
+                result['skipped_trials'].append(trial_spec['mot'] + ': ' + str(e))
+                continue
+            timesteps: int = poses.shape[1]
+            trial: nimble.biomechanics.SubjectOnDiskTrial = subject.addTrial()
+            trial.setName(trial_spec['name'])
+            trial.setMarkerObservations([{} for _ in range(timesteps)])
+            trial.setTimestep(timestep)
+            trial_pass: nimble.biomechanics.SubjectOnDiskTrialPass = trial.addPass()
+            trial_pass.setType(nimble.biomechanics.ProcessingPassType.KINEMATICS)
+            trial_pass.setPoses(poses)
+            trial_pass.computeValues(
+                skeleton,
+                timestep,
+                poses,
+                [],
+                np.zeros((0, timesteps)),
+                np.zeros((0, timesteps)),
+                np.zeros((0, timesteps)),
+                rootHistoryLen=10,
+                rootHistoryStride=3)
+            result['trials'] += 1
+            result['frames'] += timesteps
 
-        if not os.path.exists(joint_poses_csv_path):
-            print('The provided joint poses CSV file does not exist. Skipping.')
+        if result['trials'] == 0:
+            result['status'] = 'failed'
+            result['message'] = 'None of the motions could be read'
         else:
-            with open(joint_poses_csv_path, 'r') as f:
-                # Parse with pandas
-                df: pd.DataFrame = pd.read_csv(f)
-                # Convert to numpy array
-                joint_poses: np.ndarray = df.to_numpy()
-                # Get column names
-                column_names: List[str] = list(df.columns)
-                dof_indices: List[int] = []
-                for name in column_names:
-                    parts = name.split('_')
-                    index = int(parts[-1])
-                    joint_name = '_'.join(parts[:-2])
-                    dof_index: int = skeleton.getJoint(joint_name).getIndexInSkeleton(index)
-                    dof_indices.append(dof_index)
-                print(dof_indices)
-                print(poses.shape)
-                # Overwrite the MOT poses with the joint poses
-                poses[dof_indices, :] = joint_poses.transpose()
-
-        poses = poses[:, :5000]
-        for t in range(1, poses.shape[1]):
-            poses[:, t] = skeleton.unwrapPositionToNearest(poses[:, t], poses[:, t - 1])
-
-        fs = int(1.0 / (mot.timestamps[1] - mot.timestamps[0]))
-        nyq = 0.5 * fs
-        normal_cutoff = 5.0 / nyq
-        b, a = butter(3, normal_cutoff, btype='low', analog=False)
-        poses = filtfilt(b, a, poses, axis=1, padtype='constant')
-
-        timesteps: int = poses.shape[1]
-        markers: List[Dict[str, np.ndarray]] = [{} for _ in range(timesteps)]
-        trial.setMarkerObservations(markers)
-        trial.setTimestep(mot.timestamps[1] - mot.timestamps[0])
-        print('Timestep: ' + str(mot.timestamps[1] - mot.timestamps[0]))
-        trial_pass.setPoses(poses)
-        trial_pass.computeValues(
-            skeleton,
-            mot.timestamps[1] - mot.timestamps[0],
-            poses,
-            [],
-            np.zeros((0, timesteps)),
-            np.zeros((0, timesteps)),
-            np.zeros((0, timesteps)),
-            rootHistoryLen=10,
-            rootHistoryStride=3)
-
-        # os.path.dirname gets the directory portion from the full path
-        directory = os.path.dirname(output_path)
-        # Create the directory structure, if it doesn't exist already
-        os.makedirs(directory, exist_ok=True)
-        # Now write the output back out to the new SubjectOnDisk file
-        print('Writing SubjectOnDisk to {}...'.format(output_path))
-        nimble.biomechanics.SubjectOnDisk.writeB3D(output_path, subject)
+            # os.path.dirname gets the directory portion from the full path
+            directory = os.path.dirname(output_path)
+            # Create the directory structure, if it doesn't exist already
+            os.makedirs(directory, exist_ok=True)
+            print('Writing SubjectOnDisk to {}...'.format(output_path))
+            atomic_write(output_path, lambda temp_path: nimble.biomechanics.SubjectOnDisk.writeB3D(temp_path, subject))
+    except Exception as e:
+        traceback.print_exc()
+        result['status'] = 'failed'
+        result['message'] = str(e)
+    result['seconds'] = time.time() - start_time
+    return result
 
-        return True
+
+def format_create_b3d_report(results: List[Dict[str, Any]]) -> List[str]:
+    """
+    Summarize a create-b3d run, listing every subject that didn't get written and every motion that was left out.
+    """
+    written = [result for result in results if result['status'] == 'written']
+    lines: List[str] = [
+        'Create-b3d report:',
+        '  Written: ' + str(len(written)) + ' files, with ' + str(sum(result['trials'] for result in written)) +
+        ' trials and ' + str(sum(result['frames'] for result in written)) + ' frames',
+        '  Failed: ' + str(len(results) - len(written)),
+        '  Total processing time: ' + str(round(sum(result['seconds'] for result in results), 1)) + 's',
+    ]
+    for result in sorted(results, key=lambda r: r['output']):
+        if result['status'] != 'written':
+            lines.append('  FAILED ' + result['output'] + ': ' + result['message'])
+        for skipped in result['skipped_trials']:
+            lines.append('  SKIPPED TRIAL in ' + result['output'] + ': ' + skipped)
+    return lines
@@ -1,12 +1,29 @@
-import scipy.signal
 from addbiomechanics.commands.abstract_command import AbstractCommand
 import argparse
 from addbiomechanics.auth import AuthContext
 import os
-import tempfile
-from typing import List, Dict, Tuple
+import json
+from typing import List, Dict, Tuple, Any, Optional
 from datetime import timedelta
 import re
+from addbiomechanics.parallel import map_in_processes, atomic_write
+
+# Bump this whenever the contents of the per-file summaries change, so that stale cached summaries get recomputed
+SUMMARY_VERSION = 1
+SUMMARY_SUFFIX = '.describe.json'
+CONTACT_THRESHOLD_N = 20.0
+
+PHASE_REGEXES: Dict[str, str] = {
+    'walking_left_stance': r'(D|^)(LD)(R|$)',
+    'walking_right_stance': r'(D|^)(RD)(L|$)',
+    'isolated_left_stance': r'(^)(L)($)',
+    'isolated_right_stance': r'(^)(R)($)',
+    'isolated_double_support': r'(^)(D)($)',
+    'isolated_flight': r'(^)(F)($)',
+    'running_left_stance': r'(F|^)(LF)(R|$)',
+    'running_right_stance': r'(F|^)(RF)(L|$)'
+}
+
 
 class DescribeDatasetCommand(AbstractCommand):
     def register_subcommand(self, subparsers: argparse._SubParsersAction):
@@ -15,6 +32,16 @@ class DescribeDatasetCommand(AbstractCommand):
                                      'and compute a bunch of aggregrate statistics and summary data so you know what '
                                      'you are looking at, without having to look at each trial individually.')
         parser.add_argument('data_dir', type=str)
+        parser.add_argument(
+            '--jobs',
+            help='The number of files to summarize in parallel, each in its own process',
+            type=int,
+            default=1)
+        parser.add_argument(
+            '--no-cache',
+            help='Recompute every file\'s summary, instead of reusing the summaries cached next to each file from a '
+                 'previous run',
+            action='store_true')
 
     def run_local(self, args: argparse.Namespace) -> bool:
         if args.command != 'describe-dataset':
@@ -32,219 +59,58 @@ class DescribeDatasetCommand(AbstractCommand):
             print("The required library 'numpy' is not installed. Please install it and try this command again.")
             return True
 
-
         data_dir: str = os.path.abspath(args.data_dir)
+        jobs: int = args.jobs
+        use_cache: bool = not args.no_cache
 
         subject_paths: List[str] = []
         for dirpath, dirnames, filenames in os.walk(data_dir):
             for filename in filenames:
-                if filename.endswith('.bin'):
+                if filename.endswith('.b3d') or filename.endswith('.bin'):
                     input_path = os.path.join(dirpath, filename)
                     subject_paths.append(input_path)
 
         print('Found '+str(len(subject_paths))+' file' + ("s" if len(subject_paths) > 1 else ""))
+
+        # Map: summarize each file on its own (or pick up its cached summary)
+        summaries: Dict[str, Dict[str, Any]] = {}
+        if jobs <= 1 or len(subject_paths) <= 1:
+            for file_index, input_path in enumerate(subject_paths):
+                print('Reading SubjectOnDisk '+str(file_index+1)+'/'+str(len(subject_paths))+' at ' + input_path + '...')
+                summaries[input_path] = describe_file(input_path, use_cache)
+                print('Done '+str(file_index+1)+'/'+str(len(subject_paths)))
+        else:
+            print('Reading with '+str(jobs)+' parallel jobs')
+            finished = map_in_processes(describe_file, [(input_path, use_cache) for input_path in subject_paths], jobs)
+            for done_count, (path_index, summary) in enumerate(finished):
+                summaries[subject_paths[path_index]] = summary
+                print('Done '+str(done_count+1)+'/'+str(len(subject_paths))+': '+subject_paths[path_index])
+
+        print('Done reading data!')
+
+        # Reduce: combine the summaries, in the order we found the files, so the output doesn't depend on which
+        # workers finished first
         all_trial_durations: List[float] = []
         subject_durations: List[float] = []
-
         contact_phase_total_duration: Dict[str, float] = {
             'F': 0.0, # flight phase
             'L': 0.0, # left leg
             'R': 0.0, # right leg
             'D': 0.0, # double support
         }
-
-        phase_regexes: Dict[str, str] = {
-            'walking_left_stance': r'(D|^)(LD)(R|$)',
-            'walking_right_stance': r'(D|^)(RD)(L|$)',
-            'isolated_left_stance': r'(^)(L)($)',
-            'isolated_right_stance': r'(^)(R)($)',
-            'isolated_double_support': r'(^)(D)($)',
-            'isolated_flight': r'(^)(F)($)',
-            'running_left_stance': r'(F|^)(LF)(R|$)',
-            'running_right_stance': r'(F|^)(RF)(L|$)'
-        }
-        phase_durations: Dict[str, List[float]] = { key: [] for key in phase_regexes.keys() }
-
-        for file_index, input_path in enumerate(subject_paths):
-            print('Reading SubjectOnDisk '+str(file_index+1)+'/'+str(len(subject_paths))+' at ' + input_path + '...')
-
-            # Read all the contents from the current SubjectOnDisk
-            subject: nimble.biomechanics.SubjectOnDisk = nimble.biomechanics.SubjectOnDisk(input_path)
-
-            temp = tempfile.NamedTemporaryFile(mode='w+t', delete=False, suffix='.osim')
-            opensim_file_path = temp.name
-            try:
-                temp.write(subject.readRawOsimFileText())
-            finally:
-                temp.close()
-
-            dofs = subject.getNumDofs()
-            trial_timesteps = [subject.getTrialTimestep(trial) for trial in range(subject.getNumTrials())]
-            trial_lengths = [subject.getTrialLength(trial) for trial in range(subject.getNumTrials())]
-            trial_poses: List[np.ndarray] = [np.zeros((dofs, trial_lengths[trial])) for trial in
-                                             range(subject.getNumTrials())]
-            trial_vels: List[np.ndarray] = [np.zeros((dofs, trial_lengths[trial])) for trial in
-                                            range(subject.getNumTrials())]
-            trial_accs: List[np.ndarray] = [np.zeros((dofs, trial_lengths[trial])) for trial in
-                                            range(subject.getNumTrials())]
-            probably_missing_grf: List[List[bool]] = [subject.getProbablyMissingGRF(trial) for trial in
-                                                      range(subject.getNumTrials())]
-            missing_grf_reason: List[List[nimble.biomechanics.MissingGRFReason]] = [
-                subject.getMissingGRFReason(trial) for trial in
-                range(subject.getNumTrials())]
-            dof_positions_observed: List[List[bool]] = [[True for _ in range(dofs)] for _ in range(subject.getNumTrials())]
-            dof_velocity_finite_differenced: List[List[bool]] = [[True for _ in range(dofs)] for _ in range(subject.getNumTrials())]
-            dof_acc_finite_differenced: List[List[bool]] = [[True for _ in range(dofs)] for _ in range(subject.getNumTrials())]
-            trial_taus: List[np.ndarray] = [np.zeros((dofs, trial_lengths[trial])) for trial in
-                                            range(subject.getNumTrials())]
-            trial_com_poses: List[np.ndarray] = [np.zeros((3, trial_lengths[trial])) for trial in
-                                                range(subject.getNumTrials())]
-            trial_com_vels: List[np.ndarray] = [np.zeros((3, trial_lengths[trial])) for trial in
-                                                 range(subject.getNumTrials())]
-            trial_com_accs: List[np.ndarray] = [np.zeros((3, trial_lengths[trial])) for trial in
-                                                range(subject.getNumTrials())]
-            trial_residual_norms: List[List[float]] = [subject.getTrialResidualNorms(trial) for trial in
-                                                       range(subject.getNumTrials())]
-            ground_force_bodies: List[str] = subject.getContactBodies()
-            trial_ground_body_wrenches: List[np.ndarray] = [np.zeros((6 * len(ground_force_bodies), trial_lengths[trial])) for trial in
-                                                            range(subject.getNumTrials())]
-            trial_ground_body_cop_torque_force: List[np.ndarray] = [np.zeros((9 * len(ground_force_bodies), trial_lengths[trial])) for trial in
-                                                            range(subject.getNumTrials())]
-            custom_value_names = subject.getCustomValues()
-            custom_values: List[List[np.ndarray]] = [[np.zeros((len(custom_value_names), trial_lengths[trial])) for _ in range(trial_lengths[trial])] for trial in range(subject.getNumTrials())]
-            marker_observations: List[List[Dict[str, np.ndarray]]] = [[{} for _ in range(trial_lengths[trial])] for trial in range(subject.getNumTrials())]
-            acc_observations: List[List[Dict[str, np.ndarray]]] = [[{} for _ in range(trial_lengths[trial])] for trial in range(subject.getNumTrials())]
-            gyro_observations: List[List[Dict[str, np.ndarray]]] = [[{} for _ in range(trial_lengths[trial])] for trial in range(subject.getNumTrials())]
-            emg_observations: List[List[Dict[str, np.ndarray]]] = [[{} for _ in range(trial_lengths[trial])] for trial in range(subject.getNumTrials())]
-            force_plates: List[List[nimble.biomechanics.ForcePlate]] = [[nimble.biomechanics.ForcePlate() for i in range(subject.getNumForcePlates(trial))] for trial in range(subject.getNumTrials())]
-            biological_sex: str = subject.getBiologicalSex()
-            height_m: float = subject.getHeightM()
-            mass_kg: float = subject.getMassKg()
-            age_years: int = subject.getAgeYears()
-            trial_names: List[str] = [subject.getTrialName(trial) for trial in range(subject.getNumTrials())]
-            subject_tags: List[str] = subject.getSubjectTags()
-            trial_tags: List[List[str]] = [subject.getTrialTags(trial) for trial in range(subject.getNumTrials())]
-            source_href: str = subject.getHref()
-            notes: str = subject.getNotes()
-
-            for trial in range(len(trial_lengths)):
-                contact_phases: List[str] = []
-                contact_durations: List[float] = []
-
-                for t in range(trial_lengths[trial]):
-                    frame: nimble.biomechanics.Frame = subject.readFrames(trial, t, 1, contactThreshold=20.0)[0]
-                    trial_poses[trial][:, t] = frame.pos
-                    trial_vels[trial][:, t] = frame.vel
-                    trial_accs[trial][:, t] = frame.acc
-                    trial_taus[trial][:, t] = frame.tau
-                    trial_com_poses[trial][:, t] = frame.comPos
-                    trial_com_vels[trial][:, t] = frame.comVel
-                    trial_com_accs[trial][:, t] = frame.comAcc
-                    trial_ground_body_wrenches[trial][:, t] = frame.groundContactWrenches
-
-                    cops = frame.groundContactCenterOfPressure
-                    torques = frame.groundContactTorque
-                    forces = frame.groundContactForce
-                    for i in range(len(ground_force_bodies)):
-                        trial_ground_body_cop_torque_force[trial][i*9:i*9+3, t] = cops[i*3:i*3+3]
-                        trial_ground_body_cop_torque_force[trial][i*9+3:i*9+6, t] = torques[i*3:i*3+3]
-                        trial_ground_body_cop_torque_force[trial][i*9+6:i*9+9, t] = forces[i*3:i*3+3]
-
-                    for i in range(len(custom_value_names)):
-                        custom_values[trial][t][i] = frame.customValues[i]
-
-                    marker_observations[trial][t] = dict(frame.markerObservations)
-                    acc_observations[trial][t] = dict(frame.accObservations)
-                    gyro_observations[trial][t] = dict(frame.gyroObservations)
-                    emg_observations[trial][t] = dict(frame.emgSignals)
-
-                    contact_phase = ""
-                    if not frame.contact[0] and not frame.contact[1]:
-                        # Flight phase
-                        contact_phase = "F"
-                    elif frame.contact[0] and not frame.contact[1]:
-                        # Left leg
-                        contact_phase = "L"
-                    elif not frame.contact[0] and frame.contact[1]:
-                        # Right leg
-                        contact_phase = "R"
-                    elif frame.contact[0] and frame.contact[1]:
-                        # Double support
-                        contact_phase = "D"
-                    assert(contact_phase != "")
-                    if len(contact_phases) == 0 or contact_phases[-1] != contact_phase:
-                        contact_phases.append(contact_phase)
-                        contact_durations.append(0)
-                    contact_durations[-1] += trial_timesteps[trial]
-
-                # Want to pre-filter out any super short phases
-                for t in range(len(contact_phases)):
-                    if contact_durations[t] < 0.02:
-                        contact_phases[t] = None
-
-                cursor = 0
-                while cursor < len(contact_phases):
-                    if contact_phases[cursor] is None or (cursor > 0 and contact_phases[cursor] == contact_phases[cursor - 1]):
-                        if cursor > 0:
-                            contact_durations[cursor - 1] += contact_durations[cursor]
-                        elif cursor < len(contact_phases) - 1:
-                            contact_durations[cursor + 1] += contact_durations[cursor]
-
-                        del contact_phases[cursor]
-                        del contact_durations[cursor]
-                    else:
-                        cursor += 1
-
-                for t in range(len(contact_phases)):
-                    contact_phase_total_duration[contact_phases[t]] += contact_durations[t]
-
-                # Complete gait cycle: L to something else and back to L
-                    # Running if middle is FRF
-                    # Walking if middle is DRD
-                # Half gait cycle: L to something else and to R
-                    # Running if middle is F
-                    # Walking if middle is D
-
-                phase_instances: Dict[str, List[Tuple[int, int]]] = {key: [] for key in phase_regexes.keys()}
-
-                phase_string = ''.join(contact_phases)
-                segment_match_counts = [0 for _ in range(len(phase_string))]
-                for phase_name in phase_regexes.keys():
-                    matches = re.finditer(phase_regexes[phase_name], phase_string)
-                    match_count = 0
-                    for match in matches:
-                        match_count += 1
-                        phase_instances[phase_name].append((match.start(2), match.end(2)))
-                        for i in range(match.start(2), match.end(2)):
-                            segment_match_counts[i] += 1
-
-                for phase_name in phase_instances.keys():
-                    for instance in phase_instances[phase_name]:
-                        phase_start = instance[0]
-                        phase_end = instance[1]
-                        phase_duration = 0
-                        for t in range(phase_start, phase_end):
-                            phase_duration += contact_durations[t]
-                        phase_durations[phase_name].append(phase_duration)
-
-                no_match_string = ''.join([str(n) for n in segment_match_counts])
-                no_match_matches = re.finditer(r'0+', no_match_string)
-                num_no_matches = 0
-                for no_match in no_match_matches:
-                    print('Trial '+str(trial)+' no match: ('+str(no_match.start())+'-'+str(no_match.end())+')/'+str(len(phase_string))+' = ')
-                    print(phase_string[:no_match.start()]+' [[[ '+phase_string[no_match.start():no_match.end()]+' ]]] '+phase_string[no_match.end():])
-                    num_no_matches += 1
-
-                if re.match(r'(^)(D)($)', phase_string):
-                    print('Input path '+input_path+' '+str(trial)+' ALL DOUBLE SUPPORT')
-
-            trial_durations = [trial_lengths[trial] * trial_timesteps[trial] for trial in range(subject.getNumTrials())]
-            all_trial_durations.extend(trial_durations)
-            subject_durations.append(sum(trial_durations))
-
-            print('Done '+str(file_index+1)+'/'+str(len(subject_paths)))
-
-        print('Done reading data!')
+        phase_durations: Dict[str, List[float]] = { key: [] for key in PHASE_REGEXES.keys() }
+        missing_grf_frames: List[Tuple[int, int]] = []
+        for input_path in subject_paths:
+            summary = summaries[input_path]
+            for message in summary['messages']:
+                print(message)
+            all_trial_durations.extend(summary['trial_durations'])
+            subject_durations.append(sum(summary['trial_durations']))
+            for key in contact_phase_total_duration.keys():
+                contact_phase_total_duration[key] += summary['contact_phase_total_duration'][key]
+            for key in phase_durations.keys():
+                phase_durations[key].extend(summary['phase_durations'][key])
+            missing_grf_frames = summary['missing_grf_frames']
 
         print('Total subjects: '+str(len(subject_paths)))
         print('Total trials: '+str(len(all_trial_durations)))
@@ -256,7 +122,158 @@ class DescribeDatasetCommand(AbstractCommand):
         for key in phase_durations.keys():
             print('  '+key+': '+str(len(phase_durations[key]))+' instances, avg '+ str(timedelta(seconds=sum(phase_durations[key])/max(len(phase_durations[key]), 1)))+', total '+str(timedelta(seconds=int(sum(phase_durations[key]))))+' ('+str(round(sum(phase_durations[key])/sum(all_trial_durations)*100, 1))+'%)')
         print('Missing GRFs by trial:')
-        for t, bool_list in enumerate(probably_missing_grf):
-            print('   trial: '+ str(t) + ', missing any GRF: ' + str(any(bool_list)) + ', number of frame(s) with missing GRFs: ' + str(sum(bool_list)) + ', total number of frames: ' + str(len(bool_list)))
+        for t, (num_missing, num_frames) in enumerate(missing_grf_frames):
+            print('   trial: '+ str(t) + ', missing any GRF: ' + str(num_missing > 0) + ', number of frame(s) with missing GRFs: ' + str(num_missing) + ', total number of frames: ' + str(num_frames))
 
         return True
+
+
+def get_summary_path(input_path: str) -> str:
+    return input_path + SUMMARY_SUFFIX
+
+
+def describe_file(input_path: str, use_cache: bool = True) -> Dict[str, Any]:
+    """
+    Return the summary of a single file, reusing the one cached next to it if the file hasn't changed (same size and
+    modification time) since that summary was written.
+    """
+    stat = os.stat(input_path)
+    summary_path = get_summary_path(input_path)
+    if use_cache and os.path.exists(summary_path):
+        try:
+            with open(summary_path, 'r') as f:
+                cached = json.load(f)
+            if cached.get('version') == SUMMARY_VERSION and cached.get('size') == stat.st_size and \
+                    cached.get('mtime_ns') == stat.st_mtime_ns:
+                return cached
+        except (OSError, ValueError):
+            pass
+
+    summary = summarize_subject(input_path)
+    summary['version'] = SUMMARY_VERSION
+    summary['size'] = stat.st_size
+    summary['mtime_ns'] = stat.st_mtime_ns
+
+    def write_summary(tmp_path: str):
+        with open(tmp_path, 'w') as f:
+            json.dump(summary, f)
+    try:
+        atomic_write(summary_path, write_summary)
+    except OSError as e:
+        # A read-only dataset folder shouldn't stop us from describing it, we just won't be able to skip it next time
+        print('Unable to cache the summary of ' + input_path + ': ' + str(e))
+    return summary
+
+
+def get_contact_phases(contact: 'np.ndarray', timestep: float) -> Tuple[List[Optional[str]], List[float]]:
+    """
+    Turn a (num_frames x 2) array of left/right contact flags into runs of contact phases, and their durations.
+    """
+    import numpy as np
+    if contact.shape[0] == 0:
+        return [], []
+    # 0 = flight, 1 = left leg, 2 = right leg, 3 = double support
+    codes = contact[:, 0].astype(np.int8) + 2 * contact[:, 1].astype(np.int8)
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(codes)) + 1])
+    lengths = np.diff(np.concatenate([starts, [len(codes)]]))
+    contact_phases: List[Optional[str]] = ['FLRD'[code] for code in codes[starts]]
+    contact_durations: List[float] = [float(length * timestep) for length in lengths]
+    return contact_phases, contact_durations
+
+
+def summarize_subject(input_path: str) -> Dict[str, Any]:
+    """
+    Compute everything describe-dataset needs from one file. This only depends on the file itself, so it can be run
+    in any order, in any process, and cached.
+    """
+    import numpy as np
+    import nimblephysics as nimble
+    from addbiomechanics.trial_arrays import load_subject
+
+    subject: nimble.biomechanics.SubjectOnDisk = load_subject(input_path)
+    header = subject.getHeaderProto()
+
+    messages: List[str] = []
+    trial_durations: List[float] = []
+    missing_grf_frames: List[Tuple[int, int]] = []
+    contact_phase_total_duration: Dict[str, float] = {'F': 0.0, 'L': 0.0, 'R': 0.0, 'D': 0.0}
+    phase_durations: Dict[str, List[float]] = {key: [] for key in PHASE_REGEXES.keys()}
+
+    for trial in range(subject.getNumTrials()):
+        trial_length = subject.getTrialLength(trial)
+        timestep = subject.getTrialTimestep(trial)
+        trial_durations.append(trial_length * timestep)
+        missing_grf = [reason != nimble.biomechanics.MissingGRFReason.notMissingGRF
+                       for reason in subject.getMissingGRF(trial)]
+        missing_grf_frames.append((int(sum(missing_grf)), len(missing_grf)))
+
+        # A foot is in contact whenever the ground reaction force on it is over the threshold, in the last pass
+        contact = np.zeros((trial_length, 2), dtype=bool)
+        trial_passes = header.getTrials()[trial].getPasses()
+        if len(trial_passes) > 0:
+            cop_torque_force = trial_passes[-1].getGroundBodyCopTorqueForce()
+            for i in range(min(cop_torque_force.shape[0] // 9, 2)):
+                contact[:, i] = np.linalg.norm(cop_torque_force[i*9+6:i*9+9, :], axis=0) > CONTACT_THRESHOLD_N
+        contact_phases, contact_durations = get_contact_phases(contact, timestep)
+
+        # Want to pre-filter out any super short phases
+        for t in range(len(contact_phases)):
+            if contact_durations[t] < 0.02:
+                contact_phases[t] = None
+
+        cursor = 0
+        while cursor < len(contact_phases):
+            if contact_phases[cursor] is None or (cursor > 0 and contact_phases[cursor] == contact_phases[cursor - 1]):
+                if cursor > 0:
+                    contact_durations[cursor - 1] += contact_durations[cursor]
+                elif cursor < len(contact_phases) - 1:
+                    contact_durations[cursor + 1] += contact_durations[cursor]
+
+                del contact_phases[cursor]
+                del contact_durations[cursor]
+            else:
+                cursor += 1
+
+        for t in range(len(contact_phases)):
+            contact_phase_total_duration[contact_phases[t]] += contact_durations[t]
+
+        # Complete gait cycle: L to something else and back to L
+            # Running if middle is FRF
+            # Walking if middle is DRD
+        # Half gait cycle: L to something else and to R
+            # Running if middle is F
+            # Walking if middle is D
+
+        phase_instances: Dict[str, List[Tuple[int, int]]] = {key: [] for key in PHASE_REGEXES.keys()}
+
+        phase_string = ''.join(contact_phases)
+        segment_match_counts = [0 for _ in range(len(phase_string))]
+        for phase_name in PHASE_REGEXES.keys():
+            matches = re.finditer(PHASE_REGEXES[phase_name], phase_string)
+            for match in matches:
+                phase_instances[phase_name].append((match.start(2), match.end(2)))
+                for i in range(match.start(2), match.end(2)):
+                    segment_match_counts[i] += 1
+
+        for phase_name in phase_instances.keys():
+            for instance in phase_instances[phase_name]:
+                phase_duration = 0
+                for t in range(instance[0], instance[1]):
+                    phase_duration += contact_durations[t]
+                phase_durations[phase_name].append(phase_duration)
+
+        no_match_string = ''.join([str(n) for n in segment_match_counts])
+        for no_match in re.finditer(r'0+', no_match_string):
+            messages.append('Trial '+str(trial)+' no match: ('+str(no_match.start())+'-'+str(no_match.end())+')/'+str(len(phase_string))+' = ')
+            messages.append(phase_string[:no_match.start()]+' [[[ '+phase_string[no_match.start():no_match.end()]+' ]]] '+phase_string[no_match.end():])
+
+        if re.match(r'(^)(D)($)', phase_string):
+            messages.append('Input path '+input_path+' '+str(trial)+' ALL DOUBLE SUPPORT')
+
+    return {
+        'trial_durations': trial_durations,
+        'missing_grf_frames': missing_grf_frames,
+        'contact_phase_total_duration': contact_phase_total_duration,
+        'phase_durations': phase_durations,
+        'messages': messages,
+    }
@@ -3,11 +3,13 @@ import argparse
 from addbiomechanics.auth import AuthContext
 import os
 from datetime import datetime
-from addbiomechanics.s3_structure import S3Node, retrieve_s3_structure, sizeof_fmt
+from addbiomechanics.s3_structure import S3Node, retrieve_s3_structure, sizeof_fmt, group_files_by_prefix
+from addbiomechanics.s3_transfer import TransferProgress, RefreshingS3Client, TransferManifest, local_file_matches_etag
 from botocore.exceptions import NoCredentialsError, PartialCredentialsError, ClientError
 from typing import List, Dict, Tuple, Set, Optional
 import json
 import re
+import concurrent.futures
 
 
 class SubjectToDownload:
@@ -58,6 +60,15 @@ class DownloadCommand(AbstractCommand):
         download_parser.add_argument('--reviewed-only',
                                      action='store_true',
                                      help='Only download files from subjects that are fully reviewed.')
+        download_parser.add_argument('--jobs',
+                                     type=int,
+                                     default=8,
+                                     help='The number of files to download (and metadata files to read) at once.')
+        download_parser.add_argument('--manifest',
+                                     type=str,
+                                     default='.addb_download_manifest.jsonl',
+                                     help='A file to record each completed download in, along with its ETag, so that '
+                                          'an interrupted download can pick up where it left off.')
 
     def run(self, ctx: AuthContext, args: argparse.Namespace):
         if args.command != 'download':
@@ -66,17 +77,20 @@ class DownloadCommand(AbstractCommand):
         prefix: str = args.prefix
         marker_error_cutoff = args.marker_error_cutoff
         reviewed_only = args.reviewed_only
+        jobs: int = max(1, args.jobs)
+        manifest = TransferManifest(args.manifest)
 
         # Compile the pattern as a regex
         regex = re.compile(pattern) if pattern is not None else None
 
-        s3 = ctx.aws_session.client('s3')
+        s3_client = RefreshingS3Client(ctx)
+        s3 = s3_client.client
 
         response = s3.list_objects_v2(
             Bucket=ctx.deployment['BUCKET'], Prefix=prefix)
 
         files: List[Tuple[str, int, str]] = []
-        keys: List[str] = []
+        keys: Set[str] = set()
 
         print(f'Listing files on S3 at {prefix}...')
         while True:
@@ -86,7 +100,7 @@ class DownloadCommand(AbstractCommand):
                     size: int = obj['Size']
                     e_tag: str = obj['ETag']
                     files.append((key, size, e_tag))
-                    keys.append(key)
+                    keys.add(key)
 
             # Check if there are more objects to retrieve
             if response['IsTruncated']:
@@ -103,18 +117,12 @@ class DownloadCommand(AbstractCommand):
             if key.endswith("_subject.json"):
                 subject_paths.append(key.replace("_subject.json", ""))
 
-        subject_file_sets: Dict[str, List[Tuple[str, int, str]]] = {}
-        for key, size, e_tag in files:
-            for subject_path in subject_paths:
-                if key.startswith(subject_path):
-                    if subject_path not in subject_file_sets:
-                        subject_file_sets[subject_path] = []
-                    subject_file_sets[subject_path].append((key, size, e_tag))
-                    break
+        subject_file_sets: Dict[str, List[Tuple[str, int, str]]] = group_files_by_prefix(files, subject_paths)
 
         subjects: List[SubjectToDownload] = []
         for subject_path in subject_paths:
-            subjects.append(SubjectToDownload(subject_path, subject_file_sets[subject_path]))
+            if subject_path in subject_file_sets:
+                subjects.append(SubjectToDownload(subject_path, subject_file_sets[subject_path]))
 
         print(f'Found {len(subjects)} subjects to download.')
 
@@ -127,54 +135,88 @@ class DownloadCommand(AbstractCommand):
             print(f'After filtering for regex "{pattern}" on subject paths, have {len(subjects)} subjects to download.')
 
         if marker_error_cutoff is not None:
-            skip_files: List[bool] = []
-            for subject in subjects:
+            def should_skip_subject(subject: SubjectToDownload) -> Tuple[bool, Optional[str]]:
                 results_key = subject.path + "_results.json"
-                if results_key in keys:
-                    try:
-                        response = s3.get_object(Bucket=ctx.deployment['BUCKET'], Key=results_key)
-                        file_content = response['Body'].read().decode('utf-8')
-                        results_json = json.loads(file_content)
-                        if 'autoAvgRMSE' in results_json:
-                            error_meters = results_json['autoAvgRMSE']
-                            if error_meters > marker_error_cutoff:
-                                print('!! Skipping ' + key + ' because the marker error is ' +
-                                      str(results_json['autoAvgRMSE']) + ' m')
-                                skip_file = True
-                                break
-                            else:
-                                print('Including ' + key + ' because the marker error is ' +
-                                      str(results_json['autoAvgRMSE']) + ' m')
-                    except Exception as e:
-                        print('!! Skipping ' + key + ' because we could not read the results file.')
-                        skip_file = True
-                skip_files.append(skip_file)
-
-            subjects = [subject for i, subject in enumerate(subjects) if not skip_files[i]]
+                if results_key not in keys:
+                    return False, None
+                try:
+                    response = s3.get_object(Bucket=ctx.deployment['BUCKET'], Key=results_key)
+                    file_content = response['Body'].read().decode('utf-8')
+                    results_json = json.loads(file_content)
+                    if 'autoAvgRMSE' in results_json:
+                        error_meters = results_json['autoAvgRMSE']
+                        if error_meters > marker_error_cutoff:
+                            return True, '!! Skipping ' + subject.path + ' because the marker error is ' + \
+                                str(results_json['autoAvgRMSE']) + ' m'
+                        else:
+                            return False, 'Including ' + subject.path + ' because the marker error is ' + \
+                                str(results_json['autoAvgRMSE']) + ' m'
+                    return False, None
+                except Exception as e:
+                    return True, '!! Skipping ' + subject.path + ' because we could not read the results file.'
+
+            # The results files are tiny, so reading them is all round trips, which we overlap
+            skip_subjects: List[bool] = []
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                for skip_subject, message in executor.map(should_skip_subject, subjects):
+                    if message is not None:
+                        print(message)
+                    skip_subjects.append(skip_subject)
+
+            subjects = [subject for i, subject in enumerate(subjects) if not skip_subjects[i]]
             print(f'After filtering for marker error cutoff, have {len(subjects)} subjects to download.')
 
         usernames: Set[str] = set([subject.username for subject in subjects])
         to_download: List[str] = []
-        to_download_e_tags: List[str] = []
+        to_download_e_tags: Set[str] = set()
         to_download_sizes: List[int] = []
+        to_download_etag_list: List[str] = []
         to_download_size: int = 0
         already_downloaded: List[str] = []
         already_downloaded_size: int = 0
+        # Files that are on disk, but that the manifest doesn't vouch for, and that we need to check the contents of
+        to_verify: List[Tuple[str, int, str]] = []
 
         for subject in subjects:
             for key, size, e_tag in subject.contained_files:
                 if size > 0 and e_tag in to_download_e_tags:
                     continue
                 if key.endswith('.b3d') or key.endswith('review.json') or key.endswith('REVIEWED'):
-                    if os.path.exists(key):
+                    if manifest.is_complete(key, key, size, e_tag):
                         already_downloaded.append(key)
                         already_downloaded_size += size
+                    elif os.path.exists(key):
+                        to_verify.append((key, size, e_tag))
                     else:
                         to_download.append(key)
-                        to_download_e_tags.append(e_tag)
+                        to_download_e_tags.add(e_tag)
+                        to_download_etag_list.append(e_tag)
                         to_download_sizes.append(size)
                         to_download_size += size
 
+        if len(to_verify) > 0:
+            print('Checking '+str(len(to_verify))+' files that are already on disk against their ETags...')
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                matches: List[bool] = list(executor.map(lambda file: local_file_matches_etag(*file), to_verify))
+            num_changed = 0
+            for (key, size, e_tag), match in zip(to_verify, matches):
+                if match:
+                    manifest.record(key, size, e_tag)
+                    already_downloaded.append(key)
+                    already_downloaded_size += size
+                elif size > 0 and e_tag in to_download_e_tags:
+                    continue
+                else:
+                    num_changed += 1
+                    to_download.append(key)
+                    to_download_e_tags.add(e_tag)
+                    to_download_etag_list.append(e_tag)
+                    to_download_sizes.append(size)
+                    to_download_size += size
+            if num_changed > 0:
+                print('Found '+str(num_changed)+' files on disk that are incomplete, or have changed on the server, '
+                      'which we will download again.')
+
         print('A total of '+str(len(usernames))+' AddBiomechanics users will be credited in the ATTRIBUTION.txt file.')
         if len(already_downloaded) > 0:
             print('Found '+str(len(already_downloaded))+' files already downloaded.')
@@ -206,7 +248,7 @@ class DownloadCommand(AbstractCommand):
                 else:
                     print('Downloading only the first '+str(num)+' results')
                 to_download = to_download[:num]
-                to_download_e_tags = to_download_e_tags[:num]
+                to_download_etag_list = to_download_etag_list[:num]
                 to_download_sizes = to_download_sizes[:num]
             except ValueError:
                 pass
@@ -215,8 +257,7 @@ class DownloadCommand(AbstractCommand):
             print('Aborting')
             return
 
-        credit_list: List[str] = []
-        for username in usernames:
+        def get_credit(username: str) -> str:
             credit = username
             profile_link = 'https://' + ('dev' if ctx.deployment['NAME'] == 'DEV' else 'app') + '.addbiomechanics.org/profile/' + username.replace('us-west-2:', '')
 
@@ -236,9 +277,10 @@ class DownloadCommand(AbstractCommand):
                     credit = name + ' ' + surname + ' (' + profile_link + ')'
             except Exception as e:
                 credit = 'Anonymous (' + profile_link + ')'
-                pass
+            return credit
 
-            credit_list.append(credit)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            credit_list: List[str] = list(executor.map(get_credit, usernames))
 
         data_credits = 'Data Licensed as Creative Commons BY 4.0 (See https://creativecommons.org/licenses/by/4.0/ for details)\nCredits:\n'
         for credit in credit_list:
@@ -247,26 +289,73 @@ class DownloadCommand(AbstractCommand):
         with open('DATA_LICENSE.txt' if ctx.deployment['NAME'] == 'PROD' else 'DATA_LICENSE_DEV_SERVER.txt', 'w') as f:
             f.write(data_credits)
 
-        for i, key in enumerate(to_download):
-            print(f'Downloading {i+1}/{len(to_download)}: {key}')
-            if os.path.exists(key):
-                print('File already exists, skipping')
-                continue
-            # os.path.dirname gets the directory portion from the full path
-            directory = os.path.dirname(key)
-            # Create the directory structure, if it doesn't exist already
-            os.makedirs(directory, exist_ok=True)
-            # Download the file
-            if to_download_sizes[i] == 0:
-                # Create an empty file
-                open(key, 'a').close()
-            else:
+        progress = TransferProgress(sum(to_download_sizes), len(to_download))
+        print('Downloading '+str(len(to_download))+' files with '+str(jobs)+' parallel jobs')
+        failed: List[str] = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(download_file, s3_client, ctx.deployment['BUCKET'], key, to_download_sizes[i],
+                                       to_download_etag_list[i], progress): i
+                       for i, key in enumerate(to_download)}
+            for future in concurrent.futures.as_completed(futures):
+                i = futures[future]
+                key = to_download[i]
                 try:
-                    s3.download_file(ctx.deployment['BUCKET'], key, key)
+                    future.result()
+                    # Only this thread writes to the manifest, after the file is completely in place
+                    manifest.record(key, to_download_sizes[i], to_download_etag_list[i])
                 except Exception as e:
-                    print('Caught an exception trying to download. Trying refreshing AWS session and trying again.')
-                    print(e)
-                    ctx.refresh()
-                    s3 = ctx.aws_session.client('s3')
-                    # Retry the download operation
-                    s3.download_file(ctx.deployment['BUCKET'], key, key)
+                    print('!! Failed to download ' + key + ': ' + str(e))
+                    failed.append(key)
+        progress.report(force=True)
+        if len(failed) > 0:
+            print(str(len(failed))+' files failed to download. Run the same command again to retry them, and '
+                  'everything that has already been downloaded will be skipped.')
+
+
+def download_file(s3_client: RefreshingS3Client,
+                  bucket: str,
+                  key: str,
+                  size: int,
+                  e_tag: str,
+                  progress: TransferProgress,
+                  attempts: int = 3):
+    """
+    Download a single file to the path matching its key. We download into a temporary file next to it, and only move
+    it into place once it's complete, so a file that exists at its key is never a partial download.
+    """
+    # os.path.dirname gets the directory portion from the full path
+    directory = os.path.dirname(key)
+    # Create the directory structure, if it doesn't exist already
+    if directory != '':
+        os.makedirs(directory, exist_ok=True)
+    if size == 0:
+        # Create an empty file
+        open(key, 'w').close()
+        progress.file_done()
+        return
+    tmp_path = key + '.part'
+    for attempt in range(attempts):
+        s3, generation = s3_client.get()
+        transferred: List[int] = [0]
+
+        def callback(num_bytes: int):
+            transferred[0] += num_bytes
+            progress.add_bytes(num_bytes)
+
+        try:
+            s3.download_file(bucket, key, tmp_path, Callback=callback)
+            if os.path.getsize(tmp_path) != size:
+                raise ValueError('Expected ' + str(size) + ' bytes, but got ' + str(os.path.getsize(tmp_path)))
+            os.replace(tmp_path, key)
+            progress.file_done()
+            return
+        except Exception as e:
+            # Don't double count the bytes of the failed attempt
+            progress.add_bytes(-transferred[0])
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if attempt == attempts - 1:
+                raise
+            print('Caught an exception trying to download ' + key + '. Trying refreshing AWS session and trying again.')
+            print(e)
+            s3_client.refresh(generation)
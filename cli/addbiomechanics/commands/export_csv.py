@@ -1,13 +1,16 @@
 from addbiomechanics.commands.abstract_command import AbstractCommand
 import argparse
 import os
-from typing import List, Dict
+from typing import List
+
+COLUMN_PREFIXES = ['pos_', 'vel_', 'acc_', 'tau_', 'pwr_', 'wrk_']
+
 
 class ExportCSVCommand(AbstractCommand):
     def register_subcommand(self, subparsers: argparse._SubParsersAction):
         parser = subparsers.add_parser(
             'export-csv', help='This command will read a SubjectOnDisk binary file, and will spit out a CSV '
-                               'with the requested columns.')
+                               '(or Parquet) file with the requested columns.')
         parser.add_argument('input_path', type=str)
         parser.add_argument('output_path', type=str)
         parser.add_argument(
@@ -16,6 +19,19 @@ class ExportCSVCommand(AbstractCommand):
             help='This adds a column to the export list. Columns follow the pattern of [pos/vel/acc/tau/pwr/wrk]_[dof]',
             nargs='+',
             type=str)
+        parser.add_argument(
+            '--processing-pass',
+            help='The index of the processing pass to export. Negative values count back from the last pass, which is '
+                 'the default.',
+            type=int,
+            default=-1)
+        parser.add_argument(
+            '--format',
+            help='The format to write. By default this is inferred from the extension of the output path, and '
+                 'anything other than .parquet is written as CSV.',
+            choices=['csv', 'parquet'],
+            type=str,
+            default=None)
 
     def run_local(self, args: argparse.Namespace) -> bool:
         if args.command != 'export-csv':
@@ -26,10 +42,12 @@ class ExportCSVCommand(AbstractCommand):
             print('ERROR: At least one column must be specified with the --column option')
             return True
         columns: List[str] = args.column
+        output_format: str = args.format
+        if output_format is None:
+            output_format = 'parquet' if output_path.lower().endswith('.parquet') else 'csv'
 
         try:
             import nimblephysics as nimble
-            from nimblephysics import NimbleGUI
         except ImportError:
             print("The required library 'nimblephysics' is not installed. Please install it and try this command again.")
             return True
@@ -38,57 +56,73 @@ class ExportCSVCommand(AbstractCommand):
         except ImportError:
             print("The required library 'numpy' is not installed. Please install it and try this command again.")
             return True
+        try:
+            import pandas as pd
+        except ImportError:
+            print("The required library 'pandas' is not installed. Please install it and try this command again.")
+            return True
+        if output_format == 'parquet':
+            try:
+                import pyarrow
+            except ImportError:
+                print("The required library 'pyarrow' is not installed. Please install it and try this command again.")
+                return True
+        from addbiomechanics.trial_arrays import load_subject, iter_trial_arrays, get_dof_names
 
         print('Reading SubjectOnDisk at '+input_path+'...')
-        subject: nimble.biomechanics.SubjectOnDisk = nimble.biomechanics.SubjectOnDisk(input_path)
+        subject: nimble.biomechanics.SubjectOnDisk = load_subject(input_path)
+        dofs: List[str] = get_dof_names(subject)
 
-        skel = subject.readSkel()
-        dofs: List[str] = []
-        for i in range(skel.getNumDofs()):
-            dof = skel.getDofByIndex(i)
-            dofs.append(dof.getName())
-
-        print('Exporting to CSV...')
         col_dof_index: List[int] = []
-        with open(output_path, 'w') as f:
-            # Write the header
-            header: str = 'trial,frame,time'
-            for column in columns:
-                if column.startswith('pos_') or column.startswith('vel_') or column.startswith('acc_') or column.startswith('tau_') or column.startswith('pwr_') or column.startswith('wrk_'):
-                    dof = column[4:]
-                    if dof not in dofs:
-                        print('ERROR: ' + dof + ' is not a valid degree of freedom for col '+column)
-                        return True
-                    col_dof_index.append(dofs.index(dof))
-                else:
-                    print('ERROR: ' + column + ' is not a valid column name')
+        for column in columns:
+            if column[:4] in COLUMN_PREFIXES:
+                dof = column[4:]
+                if dof not in dofs:
+                    print('ERROR: ' + dof + ' is not a valid degree of freedom for col '+column)
                     return True
-                header += ',' + column
-            header += '\n'
-            f.write(header)
+                col_dof_index.append(dofs.index(dof))
+            else:
+                print('ERROR: ' + column + ' is not a valid column name')
+                return True
+
+        print('Exporting to '+output_format.upper()+'...')
+        tables: List[pd.DataFrame] = []
+        # Work is accumulated across the whole file, not reset at the start of each trial
+        work_sums: np.ndarray = np.zeros(len(columns))
+        for trial in iter_trial_arrays(subject, args.processing_pass):
+            table = {
+                'trial': np.full(trial.num_frames, trial.trial, dtype=np.int64),
+                'frame': np.arange(trial.num_frames, dtype=np.int64),
+                'time': trial.times,
+            }
+            for i, column in enumerate(columns):
+                dof_index = col_dof_index[i]
+                if column.startswith('pos_'):
+                    table[column] = trial.poses[dof_index]
+                elif column.startswith('vel_'):
+                    table[column] = trial.vels[dof_index]
+                elif column.startswith('acc_'):
+                    table[column] = trial.accs[dof_index]
+                elif column.startswith('tau_'):
+                    table[column] = trial.taus[dof_index]
+                elif column.startswith('pwr_'):
+                    table[column] = trial.vels[dof_index] * trial.taus[dof_index]
+                elif column.startswith('wrk_'):
+                    work = trial.vels[dof_index] * trial.taus[dof_index] * trial.timestep
+                    # Summing from the running total keeps this identical to adding up one frame at a time
+                    table[column] = np.cumsum(np.concatenate([[work_sums[i]], work]))[1:]
+                    if trial.num_frames > 0:
+                        work_sums[i] = table[column][-1]
+            tables.append(pd.DataFrame(table))
 
-            # Write the data
-            work_sums: Dict[str, float] = {key: 0 for key in columns}
-            for trial in range(subject.getNumTrials()):
-                for i in range(subject.getTrialLength(trial)):
-                    frame: nimble.biomechanics.Frame = subject.readFrames(trial, i, 1)[0]
-                    row: str = str(trial)+','+str(i)+','+str(i * subject.getTrialTimestep(trial))
-                    for i, column in enumerate(columns):
-                        if column.startswith('pos_'):
-                            row += ','+str(frame.pos[col_dof_index[i]])
-                        elif column.startswith('vel_'):
-                            row += ','+str(frame.vel[col_dof_index[i]])
-                        elif column.startswith('acc_'):
-                            row += ','+str(frame.acc[col_dof_index[i]])
-                        elif column.startswith('tau_'):
-                            row += ','+str(frame.tau[col_dof_index[i]])
-                        elif column.startswith('pwr_'):
-                            row += ',' + str(frame.vel[col_dof_index[i]] * frame.tau[col_dof_index[i]])
-                        elif column.startswith('wrk_'):
-                            pwr = frame.vel[col_dof_index[i]] * frame.tau[col_dof_index[i]]
-                            work_sums[column] += pwr * subject.getTrialTimestep(trial)
-                            row += ',' + str(work_sums[column])
-                    row += '\n'
-                    f.write(row)
+        if len(tables) > 0:
+            df = pd.concat(tables, ignore_index=True)
+        else:
+            df = pd.DataFrame({name: [] for name in ['trial', 'frame', 'time'] + columns})
+        if output_format == 'parquet':
+            df.to_parquet(output_path, index=False)
+        else:
+            df.to_csv(output_path, index=False)
+        print('Wrote '+str(len(df))+' rows to '+output_path)
 
         return True
@@ -0,0 +1,299 @@
+from addbiomechanics.commands.abstract_command import AbstractCommand
+import argparse
+import os
+from typing import List, Optional, Tuple
+from urllib.parse import quote
+import functools
+from addbiomechanics.parallel import map_in_processes, atomic_write
+
+FILE_EXTENSIONS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+
+class ExportDatasetCommand(AbstractCommand):
+    def register_subcommand(self, subparsers: argparse._SubParsersAction):
+        parser = subparsers.add_parser(
+            'export-dataset', help='This command will read a folder full of SubjectOnDisk binary files, and write '
+                                   'every frame of every processing pass out as one columnar dataset, with a folder '
+                                   'for each subject (subject=<relative path>/part-0.parquet), that you can load '
+                                   'with pyarrow.dataset, pandas, polars, DuckDB, Spark, etc.')
+        parser.add_argument('input_path', type=str)
+        parser.add_argument('output_path', type=str)
+        parser.add_argument(
+            '--processing-pass',
+            help='Only export this processing pass. Negative values count back from the last pass. By default every '
+                 'pass is exported, and you can tell them apart with the "pass" and "pass_type" columns.',
+            type=int,
+            default=None)
+        parser.add_argument(
+            '--format',
+            help='The file format to write each subject\'s partition in. "arrow" writes Arrow IPC (Feather v2) files.',
+            choices=['parquet', 'arrow'],
+            type=str,
+            default='parquet')
+        parser.add_argument(
+            '--row-group-size',
+            help='The maximum number of frames to hold in memory and write at once. Each worker only ever holds one '
+                 'subject, plus one row group of output.',
+            type=int,
+            default=10000)
+        parser.add_argument(
+            '--jobs',
+            help='The number of subjects to export in parallel, each in its own process',
+            type=int,
+            default=1)
+
+    def run_local(self, args: argparse.Namespace) -> bool:
+        if args.command != 'export-dataset':
+            return False
+
+        try:
+            import nimblephysics as nimble
+        except ImportError:
+            print(
+                "The required library 'nimblephysics' is not installed. Please install it and try this command again.")
+            return True
+        try:
+            import numpy as np
+        except ImportError:
+            print("The required library 'numpy' is not installed. Please install it and try this command again.")
+            return True
+        try:
+            import pyarrow
+        except ImportError:
+            print("The required library 'pyarrow' is not installed. Please install it and try this command again.")
+            return True
+
+        input_path_raw: str = os.path.abspath(args.input_path)
+        output_path_raw: str = os.path.abspath(args.output_path)
+        jobs: int = args.jobs
+        if args.row_group_size < 1:
+            print('ERROR: --row-group-size must be at least 1')
+            return True
+        options = {
+            'processing_pass': args.processing_pass,
+            'output_format': args.format,
+            'row_group_size': args.row_group_size,
+        }
+
+        input_output_pairs: List[Tuple[str, str]] = []
+        input_paths: List[Tuple[str, str]] = []
+        if os.path.isfile(input_path_raw):
+            input_paths.append((input_path_raw, os.path.basename(input_path_raw)))
+        elif os.path.isdir(input_path_raw):
+            for dirpath, dirnames, filenames in os.walk(input_path_raw):
+                for filename in filenames:
+                    if filename.endswith('.b3d'):
+                        input_path = os.path.join(dirpath, filename)
+                        input_paths.append((input_path, os.path.relpath(input_path, input_path_raw)))
+        input_paths.sort(key=lambda pair: pair[1])
+        for input_path, relative_path in input_paths:
+            output_path = get_partition_path(output_path_raw, get_subject_name(relative_path), args.format)
+            if os.path.exists(output_path):
+                print('Skipping ' + input_path + ' because the output file already exists at ' + output_path)
+            else:
+                input_output_pairs.append((input_path, output_path))
+
+        print('Will export '+str(len(input_output_pairs))+' file' + ("s" if len(input_output_pairs) != 1 else ""))
+
+        # Subjects can have different skeletons and contact bodies, but every partition needs the same schema for the
+        # dataset to load as one table, so we write the union of all the subjects' columns into every file.
+        print('Reading the degrees of freedom and contact bodies of every subject...')
+        dof_names, ground_force_bodies = get_dataset_columns([input_path for input_path, _ in input_paths])
+        options['dof_names'] = dof_names
+        options['ground_force_bodies'] = ground_force_bodies
+
+        total_rows = 0
+        if jobs <= 1 or len(input_output_pairs) <= 1:
+            for file_index, (input_path, output_path) in enumerate(input_output_pairs):
+                print('Exporting SubjectOnDisk '+str(file_index+1)+'/'+str(len(input_output_pairs))+' at '+input_path)
+                total_rows += export_subject(input_path, output_path, **options)
+                print('Done '+str(file_index+1)+'/'+str(len(input_output_pairs)))
+        else:
+            print('Exporting with '+str(jobs)+' parallel jobs')
+            # Each worker writes its own subject's partition, and only hands back a row count, so nothing but the
+            # paths ever passes through this process.
+            finished = map_in_processes(functools.partial(export_subject, **options), input_output_pairs, jobs)
+            for done_count, (pair_index, num_rows) in enumerate(finished):
+                total_rows += num_rows
+                print('Done '+str(done_count+1)+'/'+str(len(input_output_pairs))+': '+input_output_pairs[pair_index][0])
+
+        print('Exported '+str(total_rows)+' rows to '+output_path_raw)
+        return True
+
+
+def get_subject_name(relative_path: str) -> str:
+    """
+    Subjects are named by their path relative to the input folder, without the .b3d extension.
+    """
+    if relative_path.endswith('.b3d'):
+        relative_path = relative_path[:-len('.b3d')]
+    return relative_path.replace(os.sep, '/')
+
+
+def get_partition_path(output_folder: str, subject_name: str, output_format: str = 'parquet') -> str:
+    """
+    This lays the dataset out with Hive-style partitioning, which is what pyarrow and friends expect by default. The
+    subject name is URI-encoded so that the nested folders in its path don't turn into extra partition levels.
+    """
+    return os.path.join(output_folder, 'subject=' + quote(subject_name, safe=''),
+                        'part-0' + FILE_EXTENSIONS[output_format])
+
+
+def merge_names(name_lists: List[List[str]]) -> List[str]:
+    """
+    Every name that appears in any of the lists, in the order they first appear.
+    """
+    merged: List[str] = []
+    seen = set()
+    for names in name_lists:
+        for name in names:
+            if name not in seen:
+                seen.add(name)
+                merged.append(name)
+    return merged
+
+
+def get_dataset_columns(input_paths: List[str]) -> Tuple[List[str], List[str]]:
+    """
+    Get the degrees of freedom and contact bodies to give columns to in the dataset, which are the union of the ones
+    in each of the subjects. This only reads the subjects' headers, not their frames.
+    """
+    import nimblephysics as nimble
+    from addbiomechanics.trial_arrays import get_dof_names
+    dof_name_lists: List[List[str]] = []
+    ground_force_body_lists: List[List[str]] = []
+    for input_path in input_paths:
+        subject = nimble.biomechanics.SubjectOnDisk(input_path)
+        dof_name_lists.append(get_dof_names(subject))
+        ground_force_body_lists.append(subject.getGroundForceBodies())
+    return merge_names(dof_name_lists), merge_names(ground_force_body_lists)
+
+
+def get_dataset_schema(dof_names: List[str], ground_force_bodies: List[str]):
+    import pyarrow as pa
+    fields = [
+        pa.field('trial', pa.int32()),
+        pa.field('trial_name', pa.dictionary(pa.int32(), pa.string())),
+        pa.field('frame', pa.int32()),
+        pa.field('time', pa.float64()),
+        pa.field('pass', pa.int32()),
+        pa.field('pass_type', pa.dictionary(pa.int32(), pa.string())),
+        pa.field('missing_grf_reason', pa.dictionary(pa.int32(), pa.string())),
+    ]
+    for prefix in ['pos_', 'vel_', 'acc_', 'tau_']:
+        fields.extend(pa.field(prefix + dof, pa.float64()) for dof in dof_names)
+    for body in ground_force_bodies:
+        for prefix in ['cop_', 'torque_', 'force_']:
+            fields.extend(pa.field(prefix + body + '_' + axis, pa.float64()) for axis in ['x', 'y', 'z'])
+    return pa.schema(fields)
+
+
+def export_subject(input_path: str,
+                   output_path: str,
+                   processing_pass: Optional[int] = None,
+                   output_format: str = 'parquet',
+                   row_group_size: int = 10000,
+                   dof_names: Optional[List[str]] = None,
+                   ground_force_bodies: Optional[List[str]] = None) -> int:
+    """
+    Write every frame of one subject into its own partition file, one row group at a time, and return the number of
+    rows written. The file is written under a temporary name, and only moved into place once it is complete.
+
+    `dof_names` and `ground_force_bodies` set the columns of the file, and default to the subject's own. Columns for
+    degrees of freedom or contact bodies the subject doesn't have are left null.
+    """
+    import numpy as np
+    import nimblephysics as nimble
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from addbiomechanics.trial_arrays import load_subject, read_trial_arrays, get_dof_names
+
+    subject = load_subject(input_path)
+    subject_dof_names = get_dof_names(subject)
+    subject_ground_force_bodies: List[str] = subject.getGroundForceBodies()
+    if dof_names is None:
+        dof_names = subject_dof_names
+    if ground_force_bodies is None:
+        ground_force_bodies = subject_ground_force_bodies
+    schema = get_dataset_schema(dof_names, ground_force_bodies)
+    # The row of each dataset column in the subject's arrays, or None where the subject doesn't have it
+    dof_rows: List[Optional[int]] = [subject_dof_names.index(dof) if dof in subject_dof_names else None
+                                     for dof in dof_names]
+    grf_rows: List[Optional[int]] = []
+    for body in ground_force_bodies:
+        if body in subject_ground_force_bodies:
+            grf_rows.extend(range(9 * subject_ground_force_bodies.index(body),
+                                  9 * subject_ground_force_bodies.index(body) + 9))
+        else:
+            grf_rows.extend([None] * 9)
+    header = subject.getHeaderProto()
+
+    # Every batch in a file shares the same dictionaries for its string columns (which the Arrow IPC file format
+    # requires), so the categorical columns are just indices into these
+    trial_names = pa.array([subject.getTrialName(trial) for trial in range(subject.getNumTrials())], type=pa.string())
+    pass_type_names: List[str] = list(nimble.biomechanics.ProcessingPassType.__members__.keys())
+    pass_types = pa.array(pass_type_names, type=pa.string())
+    reason_names: List[str] = list(nimble.biomechanics.MissingGRFReason.__members__.keys())
+    reasons = pa.array(reason_names, type=pa.string())
+    reason_index = {name: i for i, name in enumerate(reason_names)}
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    def write_partition(tmp_path: str) -> int:
+        num_rows = 0
+        if output_format == 'parquet':
+            writer = pq.ParquetWriter(tmp_path, schema)
+        else:
+            writer = pa.ipc.new_file(tmp_path, schema)
+        try:
+            for trial in range(subject.getNumTrials()):
+                num_passes = len(header.getTrials()[trial].getPasses())
+                if processing_pass is None:
+                    passes = list(range(num_passes))
+                elif -num_passes <= processing_pass < num_passes:
+                    passes = [processing_pass]
+                else:
+                    passes = []
+                for pass_index in passes:
+                    arrays = read_trial_arrays(subject, trial, pass_index)
+                    # The missing GRF labels aren't guaranteed to cover every frame, so any frames without one are
+                    # left null
+                    num_reasons = min(len(arrays.missing_grf_reason), arrays.num_frames)
+                    if len(arrays.missing_grf_reason) != arrays.num_frames:
+                        print('Warning! Trial ' + str(trial) + ' of ' + input_path + ' has ' +
+                              str(len(arrays.missing_grf_reason)) + ' missing GRF labels for ' +
+                              str(arrays.num_frames) + ' frames')
+                    reason_indices = np.zeros(arrays.num_frames, dtype=np.int32)
+                    reason_indices[:num_reasons] = [reason_index[reason.name]
+                                                    for reason in arrays.missing_grf_reason[:num_reasons]]
+                    reason_nulls = np.arange(arrays.num_frames) >= num_reasons
+                    times = arrays.times
+                    for start in range(0, arrays.num_frames, row_group_size):
+                        end = min(start + row_group_size, arrays.num_frames)
+                        n = end - start
+                        columns = [
+                            pa.array(np.full(n, trial, dtype=np.int32)),
+                            pa.DictionaryArray.from_arrays(np.full(n, trial, dtype=np.int32), trial_names),
+                            pa.array(np.arange(start, end, dtype=np.int32)),
+                            pa.array(times[start:end]),
+                            pa.array(np.full(n, arrays.processing_pass, dtype=np.int32)),
+                            pa.DictionaryArray.from_arrays(
+                                np.full(n, pass_type_names.index(arrays.pass_type.name), dtype=np.int32), pass_types),
+                            pa.DictionaryArray.from_arrays(
+                                pa.array(reason_indices[start:end], mask=reason_nulls[start:end]), reasons),
+                        ]
+                        for values in [arrays.poses, arrays.vels, arrays.accs, arrays.taus]:
+                            columns.extend(pa.array(values[row, start:end]) if row is not None
+                                           else pa.nulls(n, pa.float64()) for row in dof_rows)
+                        # The rows of getGroundBodyCopTorqueForce() are already cop, torque, force (xyz) for each
+                        # body, which is the order of the GRF columns in the schema
+                        cop_torque_force = arrays.ground_body_cop_torque_force
+                        columns.extend(pa.array(cop_torque_force[row, start:end]) if row is not None
+                                       else pa.nulls(n, pa.float64()) for row in grf_rows)
+                        writer.write_batch(pa.RecordBatch.from_arrays(columns, schema=schema))
+                        num_rows += n
+        finally:
+            writer.close()
+        return num_rows
+
+    return atomic_write(output_path, write_partition)
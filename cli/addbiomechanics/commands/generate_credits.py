@@ -3,7 +3,7 @@ import argparse
 from addbiomechanics.auth import AuthContext
 import os
 from datetime import datetime
-from addbiomechanics.s3_structure import S3Node, retrieve_s3_structure, sizeof_fmt
+from addbiomechanics.s3_structure import S3Node, retrieve_s3_structure, sizeof_fmt, group_files_by_prefix
 from botocore.exceptions import NoCredentialsError, PartialCredentialsError, ClientError
 from typing import List, Dict, Tuple, Set, Optional
 import json
@@ -77,7 +77,7 @@ class GenerateCreditsCommand(AbstractCommand):
             Bucket=ctx.deployment['BUCKET'], Prefix=prefix)
 
         files: List[Tuple[str, int, str]] = []
-        keys: List[str] = []
+        keys: Set[str] = set()
 
         print(f'Listing files on S3 at {prefix}...')
         while True:
@@ -87,7 +87,7 @@ class GenerateCreditsCommand(AbstractCommand):
                     size: int = obj['Size']
                     e_tag: str = obj['ETag']
                     files.append((key, size, e_tag))
-                    keys.append(key)
+                    keys.add(key)
 
             # Check if there are more objects to retrieve
             if response['IsTruncated']:
@@ -104,14 +104,7 @@ class GenerateCreditsCommand(AbstractCommand):
             if key.endswith("_subject.json"):
                 subject_paths.append(key.replace("_subject.json", ""))
 
-        subject_file_sets: Dict[str, List[Tuple[str, int, str]]] = {}
-        for key, size, e_tag in files:
-            for subject_path in subject_paths:
-                if key.startswith(subject_path):
-                    if subject_path not in subject_file_sets:
-                        subject_file_sets[subject_path] = []
-                    subject_file_sets[subject_path].append((key, size, e_tag))
-                    break
+        subject_file_sets: Dict[str, List[Tuple[str, int, str]]] = group_files_by_prefix(files, subject_paths)
 
         subjects: List[SubjectToDownload] = []
         for subject_path in subject_paths:
@@ -157,7 +150,7 @@ class GenerateCreditsCommand(AbstractCommand):
 
         usernames: Set[str] = set([subject.username for subject in subjects])
         to_download: List[str] = []
-        to_download_e_tags: List[str] = []
+        to_download_e_tags: Set[str] = set()
         to_download_sizes: List[int] = []
         to_download_size: int = 0
         already_downloaded_size: int = 0
@@ -168,7 +161,7 @@ class GenerateCreditsCommand(AbstractCommand):
                     continue
                 if key.endswith('.b3d') or key.endswith('review.json') or key.endswith('REVIEWED'):
                     to_download.append(key)
-                    to_download_e_tags.append(e_tag)
+                    to_download_e_tags.add(e_tag)
                     to_download_sizes.append(size)
                     to_download_size += size
 
@@ -3,10 +3,33 @@ import time
 from addbiomechanics.commands.abstract_command import AbstractCommand
 import argparse
 from addbiomechanics.auth import AuthContext
+from addbiomechanics.parallel import atomic_write
 import os
+import json
+import sqlite3
+import concurrent.futures
+import multiprocessing
 from datetime import datetime
 from addbiomechanics.s3_structure import S3Node, retrieve_s3_structure, sizeof_fmt
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Any
+
+RESIDUAL_PERCENTILES = [50, 90, 99]
+INDEX_COLUMNS: List[Tuple[str, str]] = [
+    ('file', 'TEXT'),
+    ('trial', 'INTEGER'),
+    ('trial_name', 'TEXT'),
+    ('trial_tags', 'TEXT'),
+    ('trial_type', 'TEXT'),
+    ('pass', 'INTEGER'),
+    ('pass_type', 'TEXT'),
+    ('timestep', 'REAL'),
+    ('frames', 'INTEGER'),
+    ('frames_with_grf', 'INTEGER'),
+    ('marker_rms', 'REAL'),
+    ('marker_max', 'REAL'),
+] + [(kind + '_residual_' + stat, 'REAL')
+     for kind in ['linear', 'angular'] for stat in ['mean'] + ['p' + str(p) for p in RESIDUAL_PERCENTILES]]
+
 
 class StatsCommand(AbstractCommand):
     def register_subcommand(self, subparsers: argparse._SubParsersAction):
@@ -14,12 +37,25 @@ class StatsCommand(AbstractCommand):
             'stats', help='Prints the statistics for a *.b3d file (or set of *.b3d files) from AddBiomechanics')
 
         view_parser.add_argument(
-            'file_path', help='The name of the file to view')
+            'file_path', help='The name of the file to view, or a folder to search for *.b3d files')
+        view_parser.add_argument(
+            '--jobs',
+            help='The number of files to read in parallel, each in its own process',
+            type=int,
+            default=1)
+        view_parser.add_argument(
+            '--index',
+            help='Also write the per-trial, per-pass statistics to this file, so they can be queried later without '
+                 'opening the B3D files again. Paths ending in .db, .sqlite or .sqlite3 are written as a SQLite '
+                 'database with a single "trials" table, and anything else is written as JSON lines.',
+            type=str,
+            default=None)
 
     def run_local(self, args: argparse.Namespace) -> bool:
         if args.command != 'stats':
             return False
         file_path: str = args.file_path
+        jobs: int = args.jobs
 
         try:
             import nimblephysics as nimble
@@ -38,39 +74,139 @@ class StatsCommand(AbstractCommand):
             print("The required library 'scipy' is not installed. Please install it and try this command again.")
             return True
 
-        # 5. Read the file back in, and print out some summary stats
-        print('B3D Summary Statistics:', flush=True)
-        read_back: nimble.biomechanics.SubjectOnDisk = nimble.biomechanics.SubjectOnDisk(file_path)
-        print('  Num Trials: ' + str(read_back.getNumTrials()), flush=True)
-        print('  Num Processing Passes: ' + str(read_back.getNumProcessingPasses()), flush=True)
-        print('  Num Dofs: ' + str(read_back.getNumDofs()), flush=True)
-        for t in range(read_back.getNumTrials()):
-            print('  Trial '+str(t)+':', flush=True)
-            print('    Name: ' + read_back.getTrialName(t), flush=True)
-            missing_grf_reason = read_back.getMissingGRF(t)
-            num_have_grf = len([r for r in missing_grf_reason if r == nimble.biomechanics.MissingGRFReason.notMissingGRF])
-            print('    Num have GRF frames: ' + str(num_have_grf), flush=True)
-            print('    Num missing GRF frames: ' + str(len([r for r in missing_grf_reason if r != nimble.biomechanics.MissingGRFReason.notMissingGRF])), flush=True)
-            for p in range(read_back.getTrialNumProcessingPasses(t)):
-                print('    Processing pass '+str(p)+':', flush=True)
-                print('      Marker RMS: ' + str(np.mean(read_back.getTrialMarkerRMSs(t, p))), flush=True)
-                print('      Marker Max: ' + str(np.mean(read_back.getTrialMarkerMaxs(t, p))), flush=True)
+        file_paths: List[str] = []
+        if os.path.isdir(file_path):
+            for dirpath, dirnames, filenames in os.walk(file_path):
+                for filename in filenames:
+                    if filename.endswith('.b3d'):
+                        file_paths.append(os.path.join(dirpath, filename))
+            file_paths.sort()
+            print('Found '+str(len(file_paths))+' file' + ("s" if len(file_paths) != 1 else ""), flush=True)
+        else:
+            file_paths.append(file_path)
+
+        records: List[Dict[str, Any]] = []
+        if jobs <= 1 or len(file_paths) <= 1:
+            for path in file_paths:
+                lines, file_records = get_file_stats(path)
+                for line in lines:
+                    print(line, flush=True)
+                records.extend(file_records)
+        else:
+            # Print each file's statistics as a block, in the order of the files, once it and all the files before it
+            # are done
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+                                                        mp_context=multiprocessing.get_context('spawn')) as executor:
+                for lines, file_records in executor.map(get_file_stats, file_paths):
+                    for line in lines:
+                        print(line, flush=True)
+                    records.extend(file_records)
+
+        if args.index is not None:
+            write_stats_index(args.index, records)
+            print('Wrote statistics for '+str(len(records))+' trial passes to '+args.index, flush=True)
+
+        return True
+
+
+def get_file_stats(file_path: str) -> Tuple[List[str], List[Dict[str, Any]]]:
+    """
+    Read the summary statistics for one B3D file from its header. This returns the lines to print, and one index
+    record for each pass of each trial.
+    """
+    import numpy as np
+    import nimblephysics as nimble
+
+    lines: List[str] = []
+    records: List[Dict[str, Any]] = []
+
+    # 5. Read the file back in, and print out some summary stats
+    lines.append('B3D Summary Statistics:')
+    read_back: nimble.biomechanics.SubjectOnDisk = nimble.biomechanics.SubjectOnDisk(file_path)
+    lines.append('  Num Trials: ' + str(read_back.getNumTrials()))
+    lines.append('  Num Processing Passes: ' + str(read_back.getNumProcessingPasses()))
+    lines.append('  Num Dofs: ' + str(read_back.getNumDofs()))
+    trial_protos = read_back.getHeaderProto().getTrials()
+    for t in range(read_back.getNumTrials()):
+        lines.append('  Trial '+str(t)+':')
+        lines.append('    Name: ' + read_back.getTrialName(t))
+        have_grf = np.array([r == nimble.biomechanics.MissingGRFReason.notMissingGRF
+                             for r in read_back.getMissingGRF(t)], dtype=bool)
+        num_have_grf = int(np.sum(have_grf))
+        lines.append('    Num have GRF frames: ' + str(num_have_grf))
+        lines.append('    Num missing GRF frames: ' + str(len(have_grf) - num_have_grf))
+        for p in range(read_back.getTrialNumProcessingPasses(t)):
+            marker_rms = np.mean(read_back.getTrialMarkerRMSs(t, p))
+            marker_max = np.mean(read_back.getTrialMarkerMaxs(t, p))
+            lines.append('    Processing pass '+str(p)+':')
+            lines.append('      Marker RMS: ' + str(marker_rms))
+            lines.append('      Marker Max: ' + str(marker_max))
+            record: Dict[str, Any] = {
+                'file': file_path,
+                'trial': t,
+                'trial_name': read_back.getTrialName(t),
+                'trial_tags': ','.join(read_back.getTrialTags(t)),
+                'trial_type': trial_protos[t].getBasicTrialType().name,
+                'pass': p,
+                'pass_type': read_back.getProcessingPassType(p).name,
+                'timestep': read_back.getTrialTimestep(t),
+                'frames': len(have_grf),
+                'frames_with_grf': num_have_grf,
+                'marker_rms': finite_or_none(marker_rms),
+                'marker_max': finite_or_none(marker_max),
+            }
+            for kind, residuals in [('linear', read_back.getTrialLinearResidualNorms(t, p)),
+                                    ('angular', read_back.getTrialAngularResidualNorms(t, p))]:
+                # Only count the frames we trust the GRF on, and that actually have a residual. Frames without a
+                # missing GRF label aren't trusted.
+                residuals = np.asarray(residuals, dtype=np.float64)
+                trusted = np.zeros(len(residuals), dtype=bool)
+                trusted[:len(have_grf)] = have_grf[:len(residuals)]
+                residuals = residuals[trusted & (residuals > 0.0)]
+                if len(residuals) > 0:
+                    record[kind + '_residual_mean'] = float(np.mean(residuals))
+                    for percentile, value in zip(RESIDUAL_PERCENTILES, np.percentile(residuals, RESIDUAL_PERCENTILES)):
+                        record[kind + '_residual_p' + str(percentile)] = float(value)
+                else:
+                    record[kind + '_residual_mean'] = None
+                    for percentile in RESIDUAL_PERCENTILES:
+                        record[kind + '_residual_p' + str(percentile)] = None
                 if num_have_grf > 0:
-                    linear_residuals = read_back.getTrialLinearResidualNorms(t, p)
-                    angular_residuals = read_back.getTrialAngularResidualNorms(t, p)
-                    for j in range(len(linear_residuals)):
-                        if missing_grf_reason[j] != nimble.biomechanics.MissingGRFReason.notMissingGRF:
-                            linear_residuals[j] = 0.0
-                            angular_residuals[j] = 0.0
-
-                    non_zero_linear_residuals = [r for r in linear_residuals if r > 0.0]
-                    if len(non_zero_linear_residuals) > 0:
-                        print('      Linear Residual (on frames with GRF): ' + str(np.mean(non_zero_linear_residuals)), flush=True)
-                    else:
-                        print('      Linear Residual (on frames with GRF): 0.0', flush=True)
-
-                    non_zero_angular_residuals = [r for r in angular_residuals if r > 0.0]
-                    if len(non_zero_angular_residuals) > 0:
-                        print('      Angular Residual (on frames with GRF): ' + str(np.mean(non_zero_angular_residuals)), flush=True)
-                    else:
-                        print('      Angular Residual (on frames with GRF): 0.0', flush=True)
+                    lines.append('      ' + kind.capitalize() + ' Residual (on frames with GRF): ' +
+                                 (str(np.mean(residuals)) if len(residuals) > 0 else '0.0'))
+            records.append(record)
+    return lines, records
+
+
+def finite_or_none(value: float):
+    """
+    NaN isn't valid JSON, and sorts strangely in SQLite, so we store missing values (e.g. the marker error of a trial
+    without markers) as null.
+    """
+    import math
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+
+def write_stats_index(index_path: str, records: List[Dict[str, Any]]):
+    """
+    Write the index to a temporary file first, and then move it into place, so anyone reading the old index never
+    sees a half-written one.
+    """
+    def write_index(tmp_path: str):
+        if index_path.endswith('.db') or index_path.endswith('.sqlite') or index_path.endswith('.sqlite3'):
+            connection = sqlite3.connect(tmp_path)
+            try:
+                connection.execute('CREATE TABLE trials (' +
+                                   ', '.join('"' + name + '" ' + kind for name, kind in INDEX_COLUMNS) + ')')
+                connection.executemany('INSERT INTO trials VALUES (' + ', '.join('?' for _ in INDEX_COLUMNS) + ')',
+                                       [tuple(record[name] for name, _ in INDEX_COLUMNS) for record in records])
+                connection.execute('CREATE INDEX trials_file ON trials (file)')
+                connection.commit()
+            finally:
+                connection.close()
+        else:
+            with open(tmp_path, 'w') as f:
+                for record in records:
+                    f.write(json.dumps({name: record[name] for name, _ in INDEX_COLUMNS}) + '\n')
+    atomic_write(index_path, write_index)
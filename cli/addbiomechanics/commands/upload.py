@@ -1,79 +1,229 @@
 from addbiomechanics.commands.abstract_command import AbstractCommand
 import argparse
 from addbiomechanics.auth import AuthContext
-from typing import Dict, List, Tuple
+from addbiomechanics.s3_structure import PrefixIndex
+from addbiomechanics.motion_file_headers import MotionFileHeader, probe_file
+from addbiomechanics.s3_transfer import RefreshingS3Client, TransferProgress, backoff_delay, local_file_matches_etag, \
+    UPLOAD_PART_SIZE
+from typing import Dict, List, Tuple, Optional, Set
 from botocore.exceptions import NoCredentialsError, PartialCredentialsError, ClientError
+from boto3.s3.transfer import TransferConfig
 import boto3
 import os
 import json
 import time
-
-
-def upload_files(ctx: AuthContext, s3_to_local_file: Dict[str, str], s3_to_contents: Dict[str, str], s3_ready_flags: List[str], s3_prefix: str):
+import hashlib
+import concurrent.futures
+
+# The server drops trials shorter than this many frames, so we warn about them before uploading
+MIN_TRIAL_LENGTH = 15
+# The most threads we run at once across all the files being uploaded. The `jobs` files in flight split these between
+# them for their parts, so more jobs means fewer parts in parallel per file, rather than jobs * jobs threads.
+MAX_UPLOAD_THREADS = 16
+# When a folder changes, we tell PubSub listeners that only read one file per message about the first of these we find
+# in the folder, since these are the files that make the rest of the folder show up and get processed
+NOTIFY_KEY_SUFFIXES = ['READY_TO_PROCESS', '_subject.json']
+
+def upload_files(ctx: AuthContext, s3_to_local_file: Dict[str, str], s3_to_contents: Dict[str, str], s3_ready_flags: List[str], s3_prefix: str, jobs: int = 8, attempts: int = 5) -> bool:
     """
     This method will upload a dictionary of files to S3 as a bulk operation, and send the 
     appropriate notifications to PubSub to notify other listeners that the files have changed.
+
+    Up to `jobs` files are uploaded at once, and large files are uploaded in parts, in parallel. Each file is retried
+    with exponential backoff if it fails. The ready flags are only uploaded once every other file has made it, since
+    as soon as a flag appears the processing server may start on that subject. PubSub gets one message per subject
+    folder at the end, listing every file that changed in it, rather than one message per file.
+
+    Returns True if everything, including the ready flags, was uploaded.
     """
-    session: boto3.Session = ctx.aws_session
     deployment: Dict[str, str] = ctx.deployment
+    bucket: str = deployment['BUCKET']
+    s3_client = RefreshingS3Client(ctx)
+    transfer_config = TransferConfig(multipart_threshold=UPLOAD_PART_SIZE,
+                                     multipart_chunksize=UPLOAD_PART_SIZE,
+                                     max_concurrency=max(1, MAX_UPLOAD_THREADS // max(1, jobs)))
+
+    def full_key(s3_key: str) -> str:
+        return (s3_prefix + s3_key).replace('//', '/')
+
+    # Each upload is (key, local path or None, raw contents or None, size in bytes)
+    uploads: List[Tuple[str, Optional[str], Optional[bytes], int]] = []
+    for s3_key, local_path in s3_to_local_file.items():
+        uploads.append((full_key(s3_key), local_path, None, os.path.getsize(local_path)))
+    for s3_key, contents in s3_to_contents.items():
+        body = contents.encode('utf-8')
+        uploads.append((full_key(s3_key), None, body, len(body)))
+    flags: List[Tuple[str, Optional[str], Optional[bytes], int]] = [
+        (full_key(s3_key), None, b'', 0) for s3_key in s3_ready_flags]
+
+    # (key, size, lastModified) for everything that made it up, to tell PubSub about at the end
+    uploaded: List[Tuple[str, int, int]] = []
+
+    def upload_all(batch: List[Tuple[str, Optional[str], Optional[bytes], int]]) -> List[str]:
+        progress = TransferProgress(sum(upload[3] for upload in batch), len(batch), verb='Uploaded')
+        failed: List[str] = []
+        for key, local_path, contents, _ in batch:
+            if local_path is not None:
+                print(f'Uploading {local_path} to {key}')
+            else:
+                print(f'Uploading raw string of length {str(len(contents))} to {key}')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            futures = {executor.submit(upload_file, s3_client, bucket, key, local_path, contents, transfer_config,
+                                       progress, attempts): (key, size)
+                       for key, local_path, contents, size in batch}
+            for future in concurrent.futures.as_completed(futures):
+                key, size = futures[future]
+                try:
+                    future.result()
+                    uploaded.append((key, size, int(time.time()*1000)))
+                except Exception as e:
+                    print('!! Failed to upload ' + key + ': ' + str(e))
+                    failed.append(key)
+        progress.report(force=True)
+        return failed
+
+    print('Uploading '+str(len(uploads))+' files with '+str(max(1, jobs))+' parallel jobs')
+    failed = upload_all(uploads)
+    if len(failed) == 0:
+        # Upload the ready flags last, once everything else is already uploaded
+        failed = upload_all(flags)
+    elif len(flags) > 0:
+        print(str(len(failed))+' files failed to upload, so not uploading the ready flags for processing.')
+
+    notify_files_changed(ctx, s3_client, uploaded, subject_folders=[
+        key[:key.rfind('/')+1] for key, _, _, _ in uploads + flags
+        if key.endswith('_subject.json') or key.endswith('READY_TO_PROCESS')])
+    return len(failed) == 0
+
+
+def upload_file(s3_client: RefreshingS3Client,
+                bucket: str,
+                key: str,
+                local_path: Optional[str],
+                contents: Optional[bytes],
+                transfer_config: TransferConfig,
+                progress: TransferProgress,
+                attempts: int = 5):
+    """
+    Upload a single local file (or raw contents, if local_path is None) to the key. Our credentials are temporary, so
+    on failure we refresh the session before backing off and trying again.
+    """
+    for attempt in range(attempts):
+        s3, generation = s3_client.get()
+        transferred: List[int] = [0]
 
-    s3 = session.client('s3')
-    pubsub = session.client('iot-data')
+        def callback(num_bytes: int):
+            transferred[0] += num_bytes
+            progress.add_bytes(num_bytes)
 
-    # Send real-time updates to PubSub saying that this file was uploaded
-    def notifyFileChanged(key: str, size_bytes: int = 0):
-        parts = key.split('/')
-        topic = '/' + deployment['MQTT_PREFIX'] + '/UPDATE/'
+        try:
+            if local_path is not None:
+                s3.upload_file(local_path, bucket, key, Config=transfer_config, Callback=callback)
+            else:
+                s3.put_object(Body=contents, Bucket=bucket, Key=key)
+                callback(len(contents))
+            progress.file_done()
+            return
+        except Exception as e:
+            # Don't double count the bytes of the failed attempt
+            progress.add_bytes(-transferred[0])
+            if attempt == attempts - 1:
+                raise
+            delay = backoff_delay(attempt)
+            print(f'Caught an exception trying to upload {key}. Refreshing AWS session and trying again in '
+                  f'{delay:.1f}s.')
+            print(e)
+            s3_client.refresh(generation)
+            time.sleep(delay)
+
+
+def group_by_subject_folder(files: List[Tuple[str, int, int]],
+                            subject_folders: List[str]) -> Dict[str, List[Tuple[str, int, int]]]:
+    """
+    Group the files by the subject folder they're in. When subject folders are nested, files go with the innermost
+    one. Files that aren't in any subject folder are grouped by the folder they're directly in.
+    """
+    # The index picks the first matching prefix in the list, so putting the longest first picks the innermost folder
+    index = PrefixIndex(sorted(set(subject_folders), key=lambda folder: -len(folder)))
+    groups: Dict[str, List[Tuple[str, int, int]]] = {}
+    for file in files:
+        folder = index.find(file[0])
+        if folder is None:
+            folder = file[0][:file[0].rfind('/')+1]
+        if folder not in groups:
+            groups[folder] = []
+        groups[folder].append(file)
+    return groups
+
+
+def notify_files_changed(ctx: AuthContext,
+                         s3_client: RefreshingS3Client,
+                         files: List[Tuple[str, int, int]],
+                         subject_folders: List[str],
+                         attempts: int = 5):
+    """
+    Send real-time updates to PubSub saying that these files were uploaded, with one message per subject folder, which
+    lists all of them under "files". Each message still has the "key", "size" and "lastModified" of a single file, for
+    listeners that only understand one file per message. That's the folder's ready flag or _subject.json if it has
+    one, so those listeners at least see the subject appear, and pick up the rest of the folder on their next refresh.
+    """
+    pubsub = ctx.aws_session.client('iot-data')
+    for folder, folder_files in group_by_subject_folder(files, subject_folders).items():
+        parts = folder.split('/')
+        topic = '/' + ctx.deployment['MQTT_PREFIX'] + '/UPDATE/'
         if len(parts) > 0:
             topic += parts[0]
         if len(parts) > 1:
             topic += '/' + parts[1]
-        print('publishing to '+topic)
-        pubsub.publish(
-            topic=topic,
-            qos=1,
-            payload=json.dumps({'key': key, 'topic': topic, 'size': size_bytes, 'lastModified': int(time.time()*1000)}))
+        key, size_bytes, last_modified = get_notify_file(folder_files)
+        payload = json.dumps({
+            'key': key,
+            'topic': topic,
+            'size': size_bytes,
+            'lastModified': last_modified,
+            'folder': folder,
+            'files': [{'key': key, 'size': size_bytes, 'lastModified': last_modified}
+                      for key, size_bytes, last_modified in folder_files]})
+        print('publishing '+str(len(folder_files))+' changes in '+folder+' to '+topic)
+        for attempt in range(attempts):
+            _, generation = s3_client.get()
+            try:
+                pubsub.publish(topic=topic, qos=1, payload=payload)
+                break
+            except Exception as e:
+                if attempt == attempts - 1:
+                    # The files are uploaded either way, so listeners will see them next time they refresh
+                    print('!! Failed to publish the changes in '+folder+': '+str(e))
+                    break
+                print('Caught an exception trying to publish. Refreshing AWS session and trying again.')
+                print(e)
+                s3_client.refresh(generation)
+                pubsub = ctx.aws_session.client('iot-data')
+                time.sleep(backoff_delay(attempt))
+
+
+def get_notify_file(files: List[Tuple[str, int, int]]) -> Tuple[str, int, int]:
+    """
+    Pick the file to describe in the single-file fields of a folder's PubSub message.
+    """
+    for suffix in NOTIFY_KEY_SUFFIXES:
+        for file in files:
+            if file[0].endswith(suffix):
+                return file
+    return files[-1]
 
-    # Upload the files
-    for s3_key, local_path in s3_to_local_file.items():
-        s3_key = s3_prefix + s3_key
-        s3_key = s3_key.replace('//', '/')
-        try:
-            print(f'Uploading {local_path} to {s3_key}')
-            s3.upload_file(local_path, deployment['BUCKET'], s3_key)
-            # Notify PubSub that this file changed
-            notifyFileChanged(s3_key, size_bytes=os.path.getsize(local_path))
-        except Exception as e:
-            print('Caught an exception trying to upload. Trying refreshing AWS session and trying again.')
-            print(e)
-            ctx.refresh()
-            s3 = ctx.aws_session.client('s3')
-            pubsub = ctx.aws_session.client('iot-data')
-            # Retry the upload operation
-            print(f'Retrying uploading {local_path} to {s3_key}')
-            s3.upload_file(local_path, deployment['BUCKET'], s3_key)
-            # Notify PubSub that this file changed
-            notifyFileChanged(s3_key, size_bytes=os.path.getsize(local_path))
-
-    # Upload the raw contents
-    for s3_key, contents in s3_to_contents.items():
-        s3_key = s3_prefix + s3_key
-        s3_key = s3_key.replace('//', '/')
-        print(
-            f'Uploading raw string of length {str(len(contents))} to {s3_key}')
-        s3.put_object(Body=contents,
-                      Bucket=deployment['BUCKET'], Key=s3_key)
-        # Notify PubSub that this file changed
-        notifyFileChanged(s3_key, size_bytes=len(contents))
-
-    # Upload the ready flags last, once everything else is already uploaded
-    for s3_key in s3_ready_flags:
-        s3_key = s3_prefix + s3_key
-        s3_key = s3_key.replace('//', '/')
-        s3.put_object(Body="",
-                      Bucket=deployment['BUCKET'], Key=s3_key)
-        # Notify PubSub that this file changed
-        notifyFileChanged(s3_key, size_bytes=0)
+
+def list_remote_files(ctx: AuthContext, s3_prefix: str) -> Dict[str, Tuple[int, str]]:
+    """
+    List every file already on S3 under the prefix, with its size and ETag.
+    """
+    s3 = ctx.aws_session.client('s3')
+    remote_files: Dict[str, Tuple[int, str]] = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=ctx.deployment['BUCKET'], Prefix=s3_prefix.replace('//', '/')):
+        for obj in page.get('Contents', []):
+            remote_files[obj['Key']] = (obj['Size'], obj['ETag'])
+    return remote_files
 
 
 class ParserFolderStructure:
@@ -128,6 +278,7 @@ class ParserFolderStructure:
 
         num_subjects = 0
         num_trials = 0
+        num_frames = 0
         for subjectFolder in subjectRootFolders:
             trialPath = subjectFolder+'trials/'
             trialFiles = [
@@ -159,6 +310,8 @@ class ParserFolderStructure:
                         print(
                             f' > {trialFolder} does not have a markers.trc or markers.c3d file, failing as invalid')
                     return False
+                if not dont_read_files:
+                    num_frames += self.check_trial_headers(trialFolder, trialFiles, verbose)
 
             # Check for the _subject.json file
             subjectJsonFile = subjectFolder+'_subject.json'
@@ -250,14 +403,91 @@ class ParserFolderStructure:
                 common_prefix_parts) > 0 else ''
 
         if verbose:
-            print(f'Parsed {num_subjects} subjects with {num_trials} trials')
+            print(f'Parsed {num_subjects} subjects with {num_trials} trials' +
+                  (f' and {num_frames} frames of marker data' if not dont_read_files else ''))
 
         return True
 
+    def check_trial_headers(self, trialFolder: str, trialFiles: List[str], verbose=False) -> int:
+        """
+        This reads just the headers of a trial's marker and GRF files, to warn about files the server won't be able to
+        read, or trials too short to process, before we upload anything. This only warns, and never fails the upload.
+        It returns the number of marker frames in the trial.
+        """
+        num_frames = 0
+        for fileName in ['markers.c3d', 'markers.trc', 'grf.mot']:
+            if fileName not in trialFiles:
+                continue
+            header: Optional[MotionFileHeader] = probe_file(self.common_prefix + trialFolder + fileName)
+            if header is None or header.num_frames is None:
+                print(f' > WARNING: could not read the header of {trialFolder}{fileName}, it may fail to process')
+                continue
+            if fileName == 'grf.mot':
+                continue
+            num_frames = header.num_frames
+            if header.num_frames < MIN_TRIAL_LENGTH:
+                print(f' > WARNING: {trialFolder}{fileName} only has {header.num_frames} frames, so it will be '
+                      f'skipped during processing')
+            elif verbose:
+                print(f' > {trialFolder}{fileName} has {header.num_frames} frames of {header.num_markers} markers' +
+                      (f' at {header.frame_rate}Hz' if header.frame_rate is not None else ''))
+        return num_frames
+
     def attempt_parse_subject_as_osim_standard_folder(self) -> bool:
         # TODO: implement this
         return False
 
+    def skip_unchanged_files(self, remote_files: Dict[str, Tuple[int, str]], s3_prefix: str, jobs: int = 8) -> Dict[str, List[str]]:
+        """
+        Drop every file that's already on S3 with the same contents, by comparing the MD5 of each local file with the
+        remote ETag (or the ETags it could have, if it was uploaded in parts). For each subject that still has
+        something to upload, we also upload a _changed_trials.json listing the trials and files that changed, so the
+        server can tell what's new. Ready flags are only kept for subjects that changed, or don't have one yet.
+
+        Returns the changed trials for each subject folder that has any changes.
+        """
+        def full_key(s3_key: str) -> str:
+            return (s3_prefix + s3_key).replace('//', '/')
+
+        def is_unchanged(s3_key: str) -> bool:
+            key = full_key(s3_key)
+            if key not in remote_files:
+                return False
+            size, e_tag = remote_files[key]
+            if s3_key in self.s3_to_local_file:
+                return local_file_matches_etag(self.s3_to_local_file[s3_key], size, e_tag)
+            body = self.s3_to_contents[s3_key].encode('utf-8')
+            return len(body) == size and '"' + hashlib.md5(body).hexdigest() + '"' == e_tag
+
+        # Hashing is mostly reading the files, so it goes faster with a few of them at once
+        s3_keys: List[str] = list(self.s3_to_local_file.keys()) + list(self.s3_to_contents.keys())
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            unchanged: Set[str] = {s3_key for s3_key, same in zip(s3_keys, executor.map(is_unchanged, s3_keys))
+                                   if same}
+        self.s3_to_local_file = {k: v for k, v in self.s3_to_local_file.items() if k not in unchanged}
+        self.s3_to_contents = {k: v for k, v in self.s3_to_contents.items() if k not in unchanged}
+        print('Skipping '+str(len(unchanged))+' files that are already uploaded and unchanged')
+
+        subject_folders: List[str] = [f[:-len('_subject.json')] for f in self.input_file_list
+                                      if f.endswith('_subject.json')]
+        index = PrefixIndex(sorted(set(subject_folders), key=lambda folder: -len(folder)))
+        changed_files: Dict[str, List[str]] = {}
+        for s3_key in list(self.s3_to_local_file.keys()) + list(self.s3_to_contents.keys()):
+            folder = index.find(s3_key)
+            if folder is not None:
+                if folder not in changed_files:
+                    changed_files[folder] = []
+                changed_files[folder].append(s3_key[len(folder):])
+
+        changed_trials: Dict[str, List[str]] = {}
+        for folder, files in changed_files.items():
+            changed_trials[folder] = sorted(set(f.split('/')[1] for f in files if f.startswith('trials/')))
+            self.s3_to_contents[folder + '_changed_trials.json'] = json.dumps(
+                {'trials': changed_trials[folder], 'files': sorted(files)}, indent=2)
+        self.s3_ready_flags = [flag for flag in self.s3_ready_flags
+                               if flag[:-len('READY_TO_PROCESS')] in changed_trials or full_key(flag) not in remote_files]
+        return changed_trials
+
     def confirm_with_user(self, s3_prefix: str) -> bool:
         print('We are about to upload the following files:')
         for s3_key, local_path in self.s3_to_local_file.items():
@@ -306,6 +536,10 @@ class UploadCommand(AbstractCommand):
                                     help='Add this flag to only upload the subject.json files, instead of the whole directory.')
         process_parser.add_argument('--only-subject-osim', action='store_true',
                                     help='Add this flag to only upload the unscaled_generic.osim files, instead of the whole directory.')
+        process_parser.add_argument('--sync', action='store_true',
+                                    help='Only upload the files that are new, or have changed since they were last uploaded, by comparing their MD5 hashes against what is already on AddBiomechanics. Each subject with changes also gets a _changed_trials.json, listing the trials that changed.')
+        process_parser.add_argument('--jobs', type=int, default=8,
+                                    help='The number of files (or parts of large files) to upload at once.')
         pass
 
     def run(self, ctx: AuthContext, args: argparse.Namespace):
@@ -377,7 +611,18 @@ class UploadCommand(AbstractCommand):
             structure.s3_to_contents = {}
             structure.s3_ready_flags = []
 
+        if args.sync:
+            changed_trials = structure.skip_unchanged_files(list_remote_files(ctx, prefix), prefix, jobs=args.jobs)
+            for folder, trials in changed_trials.items():
+                print(f'Changed trials in {(prefix + folder).replace("//", "/")}: ' +
+                      (', '.join(trials) if len(trials) > 0 else '(none)'))
+            if len(structure.s3_to_local_file) == 0 and len(structure.s3_to_contents) == 0 and \
+                    len(structure.s3_ready_flags) == 0:
+                print('Everything is already up to date, so there is nothing to upload.')
+                return
+
         if skip_confirm or structure.confirm_with_user(prefix):
             print('Uploading...')
-            upload_files(ctx, structure.s3_to_local_file,
-                         structure.s3_to_contents, structure.s3_ready_flags, prefix)
+            if not upload_files(ctx, structure.s3_to_local_file,
+                                structure.s3_to_contents, structure.s3_ready_flags, prefix, jobs=args.jobs):
+                print('Some files failed to upload. Run the same command again to retry.')
@@ -58,6 +58,12 @@ class ViewCommand(AbstractCommand):
                                help='Specific frames to loop over.')
         view_parser.add_argument('--grf-body-radius', type=float, default=0.0,
                                  help='Specify the radius of spheres to place at the GRF bodies, if greater than 0.')
+        view_parser.add_argument(
+            '--display-hz',
+            help='Play back at most this many frames per second (of trial time), skipping frames in between, so that '
+                 'high frame rate trials still play back smoothly. By default every frame is shown.',
+            type=float,
+            default=None)
 
     def run_local(self, args: argparse.Namespace) -> bool:
         if args.command != 'view':
@@ -75,6 +81,7 @@ class ViewCommand(AbstractCommand):
         if len(loop_frames) == 2:
             loop_frames = list(range(loop_frames[0], loop_frames[1]))
         grf_body_radius: float = args.grf_body_radius
+        display_hz: float = args.display_hz
 
         try:
             import nimblephysics as nimble
@@ -93,6 +100,8 @@ class ViewCommand(AbstractCommand):
             print("The required library 'scipy' is not installed. Please install it and try this command again.")
             return True
 
+        from addbiomechanics.viewer_data import ViewerTrial
+
         geometry: str = args.geometry
 
         if geometry is None:
@@ -142,6 +151,16 @@ class ViewCommand(AbstractCommand):
         for i in range(skel.getNumDofs()):
             print(' ['+str(i)+']: '+skel.getDofByIndex(i).getName())
 
+        # Read everything we need to play back the trial into memory up front, so playback never has to wait on the
+        # file
+        print('Loading trial '+str(trial)+' into memory...')
+        viewer = ViewerTrial(subject, trial, trial_pass, display_hz=display_hz, frames=loop_frames)
+        viewer.precompute_body_transforms(skel)
+        if viewer.display_timestep > subject.getTrialTimestep(trial):
+            print('Showing 1 in every '+str(int(round(viewer.display_timestep / subject.getTrialTimestep(trial)))) +
+                  ' frames, to play back at '+str(display_hz)+' Hz')
+        contact_body_indices = [skel.getBodyNode(body).getIndexInSkeleton() for body in contact_bodies]
+
         world = nimble.simulation.World()
         world.addSkeleton(skel)
         world.setGravity([0, -9.81, 0])
@@ -158,29 +177,16 @@ class ViewCommand(AbstractCommand):
                 print('ERROR: DOF to graph "'+graph_dof+'" not found')
                 return False
             graph_joint = skel.getJoint(dof.getJointName())
-            joint_pos = skel.getJointWorldPositions([graph_joint])
+            graph_joint_index = graph_joint.getJointIndexInSkeleton()
+            joint_pos = viewer.joint_world_positions[0, graph_joint_index*3:graph_joint_index*3+3]
             gui.nativeAPI().createSphere('active_joint', [0.05, 0.05, 0.05], joint_pos, [1,0,0,1])
             dof_index = dof.getIndexInSkeleton()
 
-            timesteps = np.zeros(num_frames)
-            dof_poses = np.zeros(num_frames)
-            dof_vels = np.zeros(num_frames)
-            dof_accs = np.zeros(num_frames)
-            dof_taus = np.zeros(num_frames)
-            dof_power = np.zeros(num_frames)
-            dof_work = np.zeros(num_frames)
-            for frame in range(num_frames):
-                timesteps[frame] = frame * subject.getTrialTimestep(trial)
-                loaded: List[nimble.biomechanics.Frame] = subject.readFrames(trial, frame, 1, True, True)
-                processing_pass = loaded[0].processingPasses[trial_pass]
-                p = processing_pass.pos[dof_index]
-                v = processing_pass.vel[dof_index]
-                a = processing_pass.acc[dof_index]
-                t = processing_pass.tau[dof_index]
-                dof_poses[frame] = p
-                dof_vels[frame] = v
-                dof_accs[frame] = a
-                dof_taus[frame] = t
+            timesteps = viewer.arrays.times
+            dof_poses = viewer.arrays.poses[dof_index, :]
+            dof_vels = viewer.arrays.vels[dof_index, :]
+            dof_accs = viewer.arrays.accs[dof_index, :]
+            dof_taus = viewer.arrays.taus[dof_index, :]
 
             # Filter down to "--graph-lowpass-hz" Hz
             if graph_lowpass_hz is not None:
@@ -215,14 +221,7 @@ class ViewCommand(AbstractCommand):
             dof = None
 
         if show_energy:
-            body_min_height = np.ones(skel.getNumBodyNodes()) * 1000
-
-            for frame in range(num_frames):
-                loaded: List[nimble.biomechanics.Frame] = subject.readFrames(trial, frame, 1)
-                skel.setPositions(loaded[0].pos)
-
-                for i in range(skel.getNumBodyNodes()):
-                    body_min_height[i] = min(body_min_height[i], skel.getBodyNode(i).getCOM()[1])
+            body_min_height = np.min(viewer.body_coms[:, :, 1], axis=0)
 
             body_last_energy = np.zeros(skel.getNumBodyNodes())
 
@@ -236,7 +235,6 @@ class ViewCommand(AbstractCommand):
 
         def onTick(now):
             nonlocal loop_counter
-            nonlocal loop_frames
             nonlocal skel
             nonlocal marker_map
             nonlocal subject
@@ -249,61 +247,54 @@ class ViewCommand(AbstractCommand):
             nonlocal running_energy_deriv
             nonlocal show_markers
 
-            if len(loop_frames) == 0:
-                frame = loop_counter
-            else:
-                frame = loop_frames[loop_counter]
-
-            loaded: List[nimble.biomechanics.Frame] = subject.readFrames(trial, frame, 1, contactThreshold=20)
+            frame = viewer.frames[loop_counter]
+            missing_grf_reason = viewer.arrays.missing_grf_reason[frame]
 
             if show_root_frame:
-                pos_in_root_frame = np.copy(loaded[0].processingPasses[trial_pass].pos)
+                pos_in_root_frame = np.copy(viewer.arrays.poses[:, frame])
                 pos_in_root_frame[0:6] = 0
                 skel.setPositions(pos_in_root_frame)
 
-                missing_grf = loaded[0].missingGRFReason != nimble.biomechanics.MissingGRFReason.notMissingGRF
+                missing_grf = missing_grf_reason != nimble.biomechanics.MissingGRFReason.notMissingGRF
 
                 gui.nativeAPI().renderSkeleton(skel, overrideColor=[1,0,0,1] if missing_grf else [0.7,0.7,0.7,1])
-                gui.nativeAPI().setTextContents('missing_reason', str(loaded[0].missingGRFReason))
+                gui.nativeAPI().setTextContents('missing_reason', str(missing_grf_reason))
 
-                joint_centers = loaded[0].processingPasses[trial_pass].jointCentersInRootFrame
+                joint_centers = viewer.joint_centers_in_root_frame[:, frame]
                 num_joints = int(len(joint_centers) / 3)
                 for j in range(num_joints):
                     gui.nativeAPI().createSphere('joint_'+str(j), [0.05, 0.05, 0.05], joint_centers[j*3:(j+1)*3], [1,0,0,1])
 
-                root_lin_vel = loaded[0].processingPasses[trial_pass].rootLinearAccInRootFrame
+                root_lin_vel = viewer.root_linear_acc_in_root_frame[:, frame]
                 gui.nativeAPI().createLine('root_lin_vel', [[0,0,0], root_lin_vel], [1,0,0,1])
 
-                root_pos_history = loaded[0].processingPasses[trial_pass].rootPosHistoryInRootFrame
+                root_pos_history = viewer.root_pos_history_in_root_frame[:, frame]
                 num_history = int(len(root_pos_history) / 3)
                 for h in range(num_history):
                     gui.nativeAPI().createSphere('root_pos_history_'+str(h), [0.05, 0.05, 0.05], root_pos_history[h*3:(h+1)*3], [0,1,0,1])
 
-                force_cops = loaded[0].processingPasses[trial_pass].groundContactCenterOfPressureInRootFrame
-                force_fs = loaded[0].processingPasses[trial_pass].groundContactForceInRootFrame
-                num_forces = int(len(force_cops) / 3)
-                for f in range(num_forces):
-                    cop = force_cops[f*3:(f+1)*3]
-                    force = force_fs[f*3:(f+1)*3] * 0.001
+                for f in range(len(contact_bodies)):
+                    cop = viewer.contact_cops_in_root_frame[f, :, frame]
+                    force = viewer.contact_forces_in_root_frame[f, :, frame] * 0.001
                     gui.nativeAPI().createLine('force_'+str(f),
                                                [cop,
                                                 cop + force],
                                                [1,0,1,1])
             else:
-                skel.setPositions(loaded[0].processingPasses[trial_pass].pos)
+                skel.setPositions(viewer.arrays.poses[:, frame])
                 gui.nativeAPI().renderSkeleton(skel)
                 # Render assigned force plates
-                for i in range(0, subject.getNumForcePlates(trial)):
-                    cop = loaded[0].rawForcePlateCenterOfPressures[i]
-                    f = loaded[0].rawForcePlateForces[i] * 0.001
+                for i in range(0, viewer.raw_force_plate_forces.shape[0]):
+                    cop = viewer.raw_force_plate_cops[i, :, frame]
+                    f = viewer.raw_force_plate_forces[i, :, frame] * 0.001
                     color: np.ndarray = np.array([1, 1, 0, 1])
                     gui.nativeAPI().createLine('raw_grf'+str(i), [cop, cop+f], color)
 
                 if show_markers:
                     virtual_markers = skel.getMarkerMapWorldPositions(marker_map)
 
-                    markers = loaded[0].markerObservations
-                    for marker_name, marker_pos in markers:
+                    markers = viewer.marker_observations[frame]
+                    for marker_name, marker_pos in markers.items():
                         if marker_name in virtual_markers:
                             virtual_pos = virtual_markers[marker_name]
                             gui.nativeAPI().createLine(marker_name+"_err", [virtual_pos, marker_pos], [1,0,0,1])
@@ -318,15 +309,15 @@ class ViewCommand(AbstractCommand):
                         visit_queue = [body]
                         while visit_queue:
                             current = visit_queue.pop(0)
-                            gui.nativeAPI().createSphere('grf_body_'+str(b)+'_'+current.getName(), [grf_body_radius, grf_body_radius, grf_body_radius], current.getWorldTransform().translation(), [0,0,1,1])
+                            gui.nativeAPI().createSphere('grf_body_'+str(b)+'_'+current.getName(), [grf_body_radius, grf_body_radius, grf_body_radius], viewer.body_world_transforms[loop_counter, current.getIndexInSkeleton(), :3, 3], [0,0,1,1])
                             for j in range(current.getNumChildJoints()):
                                 visit_queue.append(current.getChildJoint(j).getChildBodyNode())
 
                 for i in range(0, len(contact_bodies)):
-                    cop = loaded[0].processingPasses[trial_pass].groundContactCenterOfPressure[i*3:(i+1)*3]
-                    f = loaded[0].processingPasses[trial_pass].groundContactForce[i*3:(i+1)*3] * 0.001
+                    cop = viewer.contact_cops[i, :, frame]
+                    f = viewer.contact_forces[i, :, frame] * 0.001
                     if np.linalg.norm(f) > 0:
-                        body_pos = skel.getBodyNode(contact_bodies[i]).getWorldTransform().translation()
+                        body_pos = viewer.body_world_transforms[loop_counter, contact_body_indices[i], :3, 3]
                         color: np.ndarray = np.array([0, 0, 0, 1])
                         color[i] = 1.0
                         gui.nativeAPI().createLine('grf'+str(i), [body_pos, cop, cop+f], color)
@@ -340,7 +331,7 @@ class ViewCommand(AbstractCommand):
                     #         gui.nativeAPI().setObjectColor('world_' + skel.getName() + "_" + contact_bodies[i] + "_" + str(k),
                     #                                        [0.5, 0.5, 0.5, 1])
 
-                if loaded[0].missingGRFReason != nimble.biomechanics.MissingGRFReason.notMissingGRF:
+                if missing_grf_reason != nimble.biomechanics.MissingGRFReason.notMissingGRF:
                     for b in range(skel.getNumBodyNodes()):
                         for k in range(skel.getBodyNode(b).getNumShapeNodes()):
                             gui.nativeAPI().setObjectColor('world_' + skel.getName() + "_" + skel.getBodyNode(b).getName() + "_" + str(k),
@@ -351,10 +342,10 @@ class ViewCommand(AbstractCommand):
                             gui.nativeAPI().setObjectColor('world_' + skel.getName() + "_" + skel.getBodyNode(b).getName() + "_" + str(k),
                                                            [0.7, 0.7, 0.7, 1])
 
-                gui.nativeAPI().setTextContents('missing_reason', str(loaded[0].missingGRFReason))
+                gui.nativeAPI().setTextContents('missing_reason', str(missing_grf_reason))
 
                 if dof is not None:
-                    joint_pos = skel.getJointWorldPositions([graph_joint])
+                    joint_pos = viewer.joint_world_positions[loop_counter, graph_joint_index*3:graph_joint_index*3+3]
                     gui.nativeAPI().setObjectPosition('active_joint', joint_pos)
                     p = dof_poses[frame]
                     v = dof_vels[frame]
@@ -381,9 +372,9 @@ class ViewCommand(AbstractCommand):
 
                 if show_energy:
                     # Compute and render energy
-                    skel.setPositions(loaded[0].pos)
-                    skel.setVelocities(loaded[0].vel)
-                    skel.setAccelerations(loaded[0].acc)
+                    skel.setPositions(viewer.arrays.poses[:, frame])
+                    skel.setVelocities(viewer.arrays.vels[:, frame])
+                    skel.setAccelerations(viewer.arrays.accs[:, frame])
 
                     contact_body_pointers = []
                     cops = []
@@ -392,9 +383,9 @@ class ViewCommand(AbstractCommand):
 
                     skel.clearExternalForces()
                     for i in range(0, len(contact_bodies)):
-                        cop = loaded[0].groundContactCenterOfPressure[i*3:(i+1)*3]
-                        f = loaded[0].groundContactForce[i*3:(i+1)*3]
-                        tau = loaded[0].groundContactTorque[i*3:(i+1)*3]
+                        cop = viewer.contact_cops[i, :, frame]
+                        f = viewer.contact_forces[i, :, frame]
+                        tau = viewer.contact_torques[i, :, frame]
 
                         local_wrench = np.zeros(6)
                         local_wrench[0:3] = tau
@@ -434,7 +425,7 @@ class ViewCommand(AbstractCommand):
                         body_radii[i] = radius
 
                         # Verify energy gradients
-                        body_energy_grad[i] = (total_energy - body_last_energy[i]) / subject.getTrialTimestep(trial)
+                        body_energy_grad[i] = (total_energy - body_last_energy[i]) / viewer.display_timestep
                         body_last_energy[i] = total_energy
 
                         # body_power_sources[i].append(("Gravity", energy.bodyGravityPower[i]))
@@ -458,7 +449,7 @@ class ViewCommand(AbstractCommand):
                     # for i in range(skel.getNumBodyNodes()):
                     #     if energy.bodyExternalForcePower[i] != 0:
                     #         print(skel.getBodyNode(i).getName()+': '+str(compare[i, :])+', '+str(body_power_sources[i]))
-                    running_energy_deriv += np.sum(energy.bodyKineticEnergyDeriv + energy.bodyPotentialEnergyDeriv) * subject.getTrialTimestep(trial)
+                    running_energy_deriv += np.sum(energy.bodyKineticEnergyDeriv + energy.bodyPotentialEnergyDeriv) * viewer.display_timestep
 
                     for joint in energy.joints:
                         net_power = joint.powerToChild + joint.powerToParent
@@ -507,17 +498,24 @@ class ViewCommand(AbstractCommand):
                     #     V = body.getSpatialVelocity(offset, relativeTo=Frame::World(), inCoordinatesOf)
 
             loop_counter += 1
-            loop_number = num_frames
-            if len(loop_frames) > 0:
-                loop_number = len(loop_frames)
-            if loop_counter >= loop_number:
+            if loop_counter >= viewer.num_displayed_frames:
                 loop_counter = 0
 
         # ticker.registerTickListener(onTick)
         # ticker.start()
+        # We schedule each frame against the clock, rather than sleeping a full timestep after each one, so the time it
+        # takes to render a frame doesn't slow down playback
+        tick_interval = viewer.display_timestep / playback_speed
+        next_tick = time.time()
         while True:
             onTick(time.time())
-            time.sleep(subject.getTrialTimestep(trial) / playback_speed)
+            next_tick += tick_interval
+            delay = next_tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # If we've fallen behind, don't try to catch up by rendering a burst of frames
+                next_tick = time.time()
 
         print(subject.getHref())
         print(subject.getTrialName(trial))
@@ -2,6 +2,7 @@ from addbiomechanics.commands.abstract_command import AbstractCommand
 import argparse
 from addbiomechanics.auth import AuthContext
 import os
+import time
 from datetime import datetime
 from addbiomechanics.s3_structure import S3Node, retrieve_s3_structure, sizeof_fmt
 from typing import List, Dict, Tuple
@@ -59,6 +60,12 @@ class ViewEnergyCommand(AbstractCommand):
             help='The frequency to filter the particles at',
             type=int,
             default=30)
+        view_parser.add_argument(
+            '--jobs',
+            help='When saving to a file, the number of processes to draw the frames of the recording in, each taking a '
+                 'chunk of the trial',
+            type=int,
+            default=1)
 
     def run_local(self, args: argparse.Namespace) -> bool:
         if args.command != 'view-energy':
@@ -73,6 +80,7 @@ class ViewEnergyCommand(AbstractCommand):
         end_frame: int = args.end_frame
         num_packets: int = args.num_energy_packets
         particle_lowpass_hz = args.particle_lowpass_hz
+        jobs: int = args.jobs
 
         try:
             import nimblephysics as nimble
@@ -96,6 +104,9 @@ class ViewEnergyCommand(AbstractCommand):
             print("The required library 'matplotlib' is not installed. Please install it and try this command again.")
             return True
 
+        from addbiomechanics.viewer_data import ViewerTrial
+        from addbiomechanics.energy_recording import EnergyFrames, write_energy_recording
+
         geometry: str = args.geometry
 
         if geometry is None:
@@ -134,90 +145,61 @@ class ViewEnergyCommand(AbstractCommand):
         for i in range(skel.getNumDofs()):
             print(' ['+str(i)+']: '+skel.getDofByIndex(i).getName())
 
+        # Read the trial into memory once, and run forward kinematics once per frame, rather than going back to the
+        # file for every frame in each of the passes below
+        print('Loading trial '+str(trial)+' into memory...')
+        viewer = ViewerTrial(subject, trial, trial_pass, frames=range(num_frames))
+        viewer.precompute_body_transforms(skel)
+
         world = nimble.simulation.World()
         world.addSkeleton(skel)
         world.setGravity([0, -9.81, 0])
         skel.setGravity([0, -9.81, 0])
 
-        if save_to_file is not None:
-            gui = nimble.server.GUIRecording()
-        else:
-            nimble_gui = NimbleGUI(world)
-            nimble_gui.serve(8080)
-            gui = nimble_gui.nativeAPI()
+        timestep = subject.getTrialTimestep(trial)
+        num_bodies = skel.getNumBodyNodes()
+        num_joints = skel.getNumJoints()
 
         if graph_dof is not None:
             dof = skel.getDof(graph_dof)
             if dof is None:
                 print('ERROR: DOF to graph "'+graph_dof+'" not found')
                 return False
-            graph_joint = skel.getJoint(dof.getJointName())
-            joint_pos = skel.getJointWorldPositions([graph_joint])
-            gui.createSphere('active_joint', [0.05, 0.05, 0.05], joint_pos, [1,0,0,1])
+            graph_joint_index = skel.getJoint(dof.getJointName()).getJointIndexInSkeleton()
+            graph_joint_positions = viewer.joint_world_positions[:, graph_joint_index*3:graph_joint_index*3+3].T
             dof_index = dof.getIndexInSkeleton()
 
-            timesteps = np.zeros(num_frames)
-            dof_poses = np.zeros(num_frames)
-            dof_vels = np.zeros(num_frames)
-            dof_accs = np.zeros(num_frames)
-            dof_taus = np.zeros(num_frames)
-            dof_power = np.zeros(num_frames)
-            dof_work = np.zeros(num_frames)
-            for frame in range(num_frames):
-                timesteps[frame] = frame * subject.getTrialTimestep(trial)
-                loaded: List[nimble.biomechanics.Frame] = subject.readFrames(trial, frame, 1)
-                p = loaded[0].processingPasses[trial_pass].pos[dof_index]
-                v = loaded[0].processingPasses[trial_pass].vel[dof_index]
-                a = loaded[0].processingPasses[trial_pass].acc[dof_index]
-                t = loaded[0].processingPasses[trial_pass].tau[dof_index]
-                dof_poses[frame] = p
-                dof_vels[frame] = v
-                dof_accs[frame] = a
-                dof_taus[frame] = t
-
+            dof_poses = viewer.arrays.poses[dof_index, :num_frames]
+            dof_vels = viewer.arrays.vels[dof_index, :num_frames]
+            dof_accs = viewer.arrays.accs[dof_index, :num_frames]
+            dof_taus = viewer.arrays.taus[dof_index, :num_frames]
             dof_power = dof_vels * dof_taus
-            dof_work = np.cumsum(dof_power) * subject.getTrialTimestep(trial)
-
-            max_over_all = np.percentile(np.concatenate((dof_poses, dof_vels, dof_accs, dof_taus, dof_power)), 95)
-            min_over_all = np.percentile(np.concatenate((dof_poses, dof_vels, dof_accs, dof_taus, dof_power)), 5)
-
-            gui.createRichPlot('dof_plot', [50, 100], [400, 200], 0, subject.getTrialLength(trial) * subject.getTrialTimestep(trial), min_over_all, max_over_all, 'DOF '+graph_dof, 'Time (s)', 'Values')
-
-            gui.setRichPlotData('dof_plot', 'Pose', 'blue', 'line', timesteps, dof_poses)
-            gui.setRichPlotData('dof_plot', 'Vel', 'green', 'line', timesteps, dof_vels)
-            gui.setRichPlotData('dof_plot', 'Tau', 'red', 'line', timesteps, dof_taus)
-            # gui.setRichPlotData('dof_plot', 'Power', 'purple', 'line', timesteps, dof_power)
-            gui.setRichPlotData('dof_plot', 'Net Work', 'purple', 'line', timesteps, dof_work)
-
-            gui.createText('dof_plot_text', 'DOF '+graph_dof+' values', [50, 350], [400, 50])
+            dof_work = np.cumsum(dof_power) * timestep
+            graph_values = np.stack((dof_poses, dof_vels, dof_accs, dof_taus, dof_power, dof_work))
         else:
-            dof = None
+            graph_joint_positions = None
+            graph_values = None
 
         #########################################################################
         # Estimate body COM minimum height (to set 0 potential energy) and treadmill speed
         #########################################################################
 
-        body_min_height = np.ones(skel.getNumBodyNodes()) * 1000
-        for frame in range(num_frames):
-            loaded: List[nimble.biomechanics.Frame] = subject.readFrames(trial, frame, 1)
-            skel.setPositions(loaded[0].processingPasses[trial_pass].pos)
-            for i in range(skel.getNumBodyNodes()):
-                body_min_height[i] = min(body_min_height[i], skel.getBodyNode(i).getCOM()[1])
+        # (num_frames x num_bodies x 3)
+        body_coms = viewer.body_coms
+        body_min_height = np.min(body_coms[:, :, 1], axis=0)
 
         print('Estimating treadmill speed...')
         avg_vel = np.zeros(3)
         vel_obs_count = 0
-        for frame in range(num_frames):
-            loaded: List[nimble.biomechanics.Frame] = subject.readFrames(trial, frame, 1)
-            skel.setPositions(loaded[0].processingPasses[trial_pass].pos)
-            skel.setVelocities(loaded[0].processingPasses[trial_pass].vel)
-            skel.setAccelerations(loaded[0].processingPasses[trial_pass].acc)
+        contact_body_nodes = [skel.getBodyNode(name) for name in contact_bodies]
+        in_contact = np.linalg.norm(viewer.contact_forces[:, :, :num_frames], axis=1) > 5
+        # We only need the body velocities on frames where a foot is pushing on the ground
+        for frame in np.nonzero(np.any(in_contact, axis=0))[0]:
+            skel.setPositions(viewer.arrays.poses[:, frame])
+            skel.setVelocities(viewer.arrays.vels[:, frame])
             for i in range(0, len(contact_bodies)):
-                f = loaded[0].processingPasses[trial_pass].groundContactForce[i*3:(i+1)*3]
-
-                if np.linalg.norm(f) > 5:
-                    body = skel.getBodyNode(contact_bodies[i])
-                    avg_vel += body.getLinearVelocity()
+                if in_contact[i, frame]:
+                    avg_vel += contact_body_nodes[i].getLinearVelocity()
                     vel_obs_count += 1
         if vel_obs_count > 0:
             avg_vel /= vel_obs_count
@@ -229,110 +211,86 @@ class ViewEnergyCommand(AbstractCommand):
         # Compute the energy at each frame, with adjustments for potential energy and treadmill speed
         #########################################################################
 
-        energy_frames: List[nimble.dynamics.EnergyAccountingFrame] = []
-        body_total_energy = np.zeros(num_frames)
-        conserved_energy = np.zeros(num_frames)
+        # The energy accounting itself has to run frame by frame, but we only keep the numbers we need out of each
+        # frame, so everything after this works on whole arrays at once
+        body_kinetic_energy = np.zeros((num_bodies, num_frames))
+        joint_power_to_parent = np.zeros((num_joints, num_frames))
+        joint_power_to_child = np.zeros((num_joints, num_frames))
+        joint_centers = np.zeros((num_joints, 3, num_frames))
+        joint_names: List[str] = []
         print('Precomputing energy in '+str(num_frames)+' frames...')
 
         for frame in range(num_frames):
             if frame % 100 == 0:
                 print('  '+str(frame)+'/'+str(num_frames))
-            loaded: List[nimble.biomechanics.Frame] = subject.readFrames(trial, frame, 1)
-            skel.setPositions(loaded[0].processingPasses[trial_pass].pos)
-            skel.setVelocities(loaded[0].processingPasses[trial_pass].vel)
-            skel.setAccelerations(loaded[0].processingPasses[trial_pass].acc)
-            contact_body_pointers = []
+            skel.setPositions(viewer.arrays.poses[:, frame])
+            skel.setVelocities(viewer.arrays.vels[:, frame])
+            skel.setAccelerations(viewer.arrays.accs[:, frame])
             cops = []
             forces = []
             moments = []
             skel.clearExternalForces()
             for i in range(0, len(contact_bodies)):
-                start_cop = loaded[0].processingPasses[trial_pass].groundContactCenterOfPressure[i*3:(i+1)*3]
-                f = loaded[0].processingPasses[trial_pass].groundContactForce[i*3:(i+1)*3]
-                tau = loaded[0].processingPasses[trial_pass].groundContactTorque[i*3:(i+1)*3]
+                start_cop = viewer.contact_cops[i, :, frame]
+                f = viewer.contact_forces[i, :, frame]
+                tau = viewer.contact_torques[i, :, frame]
 
                 local_wrench = np.zeros(6)
                 local_wrench[0:3] = tau
                 local_wrench[3:6] = f
                 global_wrench = nimble.math.dAdInvT(np.eye(3), start_cop, local_wrench)
-                body = skel.getBodyNode(contact_bodies[i])
+                body = contact_body_nodes[i]
                 wrench_local = nimble.math.dAdT(body.getWorldTransform().rotation(), body.getWorldTransform().translation(), global_wrench)
                 body.setExtWrench(wrench_local)
 
-                contact_body_pointers.append(body)
                 cops.append(start_cop)
                 forces.append(f)
                 moments.append(tau)
-            energy = skel.getEnergyAccounting(0.0, avg_vel, contact_body_pointers, cops, forces, moments)
-            # Reset potential energies to be relative to the lowest point these bodies reach over the trial
-            potential_energy = np.copy(energy.bodyPotentialEnergy)
-            for i in range(0, skel.getNumBodyNodes()):
-                body = skel.getBodyNode(i)
-                potential_energy[i] = body.getMass() * 9.81 * (body.getCOM()[1] - body_min_height[i])
-            energy.bodyPotentialEnergy = potential_energy
-            energy_frames.append(energy)
-            body_total_energy[frame] = np.sum(energy.bodyKineticEnergy) + np.sum(energy.bodyPotentialEnergy)
-        # Compute the conserved energy reserve, so total energy every frame is constant
-        peak_body_energy = np.max(body_total_energy)
-        for frame in range(num_frames):
-            conserved_energy[frame] = peak_body_energy - body_total_energy[frame]
-
-        peak_energy_density = 0.0
-        for frame in range(num_frames):
-            for i in range(skel.getNumBodyNodes()):
-                body_energy_density = (energy_frames[frame].bodyKineticEnergy[i] + energy_frames[frame].bodyPotentialEnergy[i]) / skel.getBodyNode(i).getMass()
-                peak_energy_density = max(peak_energy_density, body_energy_density)
+            energy = skel.getEnergyAccounting(0.0, avg_vel, contact_body_nodes, cops, forces, moments)
+            body_kinetic_energy[:, frame] = energy.bodyKineticEnergy
+            for j, joint in enumerate(energy.joints):
+                joint_power_to_parent[j, frame] = joint.powerToParent
+                joint_power_to_child[j, frame] = joint.powerToChild
+                joint_centers[j, :, frame] = joint.worldCenter
+            if frame == 0:
+                joint_names = [joint.name for joint in energy.joints]
+
+        # Reset potential energies to be relative to the lowest point these bodies reach over the trial
+        body_masses = np.array([skel.getBodyNode(i).getMass() for i in range(num_bodies)])
+        body_potential_energy = body_masses[:, np.newaxis] * 9.81 * (body_coms[:, :, 1].T - body_min_height[:, np.newaxis])
+        body_energy = body_kinetic_energy + body_potential_energy
+        peak_energy_density = max(0.0, np.max(body_energy / body_masses[:, np.newaxis]))
 
         #########################################################################
         # Compute tendons
         #########################################################################
 
-        best_case_tendon_capacity = np.zeros(skel.getNumJoints())
-        for joint in range(skel.getNumJoints()):
-            stored_energy = np.zeros(num_frames)
-            for frame in range(num_frames - 1):
-                this_energy = energy_frames[frame]
-                stored_energy[frame + 1] = stored_energy[frame] + (this_energy.joints[joint].powerToParent + this_energy.joints[joint].powerToChild) * subject.getTrialTimestep(trial)
-
-            # Now we look for the largest amount of positive work done by the joint over any time period, and cap
-            # the tendons at that amount of storage. For joints that do positive work, it'll mean the tendons are
-            # effectively uncapped, and for joints that do negative work it'll be a cap to ensure some energy is
-            # still vented.
-
-            # Find the running smallest value of stored energy over time
-            smallest_seen = stored_energy[0]
-            lowest_previous_stored_energy = np.zeros(num_frames)
-            for frame in range(num_frames):
-                if stored_energy[frame] < smallest_seen:
-                    smallest_seen = stored_energy[frame]
-                lowest_previous_stored_energy[frame] = smallest_seen
-
-            best = 0
-            for frame in range(num_frames):
-                if stored_energy[frame] - lowest_previous_stored_energy[frame] > best:
-                    best = stored_energy[frame] - lowest_previous_stored_energy[frame]
-            best_case_tendon_capacity[joint] = best
-        energy_stored_in_tendons = np.zeros((skel.getNumJoints(), num_frames))
+        joint_power = joint_power_to_parent + joint_power_to_child
+        # The energy each joint would store if it could hold on to all of it, over time
+        stored_energy = np.zeros((num_joints, num_frames))
+        stored_energy[:, 1:] = np.cumsum(joint_power[:, :-1] * timestep, axis=1)
+
+        # Now we look for the largest amount of positive work done by the joint over any time period, and cap
+        # the tendons at that amount of storage. For joints that do positive work, it'll mean the tendons are
+        # effectively uncapped, and for joints that do negative work it'll be a cap to ensure some energy is
+        # still vented.
+        lowest_previous_stored_energy = np.minimum.accumulate(stored_energy, axis=1)
+        best_case_tendon_capacity = np.maximum(np.max(stored_energy - lowest_previous_stored_energy, axis=1), 0)
+
+        # Filling and draining the tendons depends on how full they were on the previous frame, so we step through
+        # time, but do every joint at once
+        energy_stored_in_tendons = np.zeros((num_joints, num_frames))
         for frame in range(num_frames - 1):
-            this_energy = energy_frames[frame]
-            for joint in range(skel.getNumJoints()):
-                power = this_energy.joints[joint].powerToParent + this_energy.joints[joint].powerToChild
-                delta_energy = power * subject.getTrialTimestep(trial)
-
-                if delta_energy < 0:
-                    energy_to_tendon = -delta_energy
-                    if energy_to_tendon > best_case_tendon_capacity[joint] - energy_stored_in_tendons[joint, frame]:
-                        energy_to_tendon = best_case_tendon_capacity[joint] - energy_stored_in_tendons[joint, frame]
-                    energy_stored_in_tendons[joint, frame + 1] = energy_stored_in_tendons[joint, frame] + energy_to_tendon
-                if delta_energy > 0:
-                    energy_from_tendon = delta_energy
-                    if energy_from_tendon > energy_stored_in_tendons[joint, frame]:
-                        energy_from_tendon = energy_stored_in_tendons[joint, frame]
-                    energy_stored_in_tendons[joint, frame + 1] = energy_stored_in_tendons[joint, frame] - energy_from_tendon
-                assert(energy_stored_in_tendons[joint, frame + 1] <= best_case_tendon_capacity[joint])
-                assert(energy_stored_in_tendons[joint, frame + 1] >= 0)
+            delta_energy = joint_power[:, frame] * timestep
+            stored = energy_stored_in_tendons[:, frame]
+            energy_to_tendon = np.minimum(-delta_energy, best_case_tendon_capacity - stored)
+            energy_from_tendon = np.minimum(delta_energy, stored)
+            energy_stored_in_tendons[:, frame + 1] = np.where(delta_energy < 0, stored + energy_to_tendon,
+                                                              np.where(delta_energy > 0, stored - energy_from_tendon, 0))
+        assert(np.all(energy_stored_in_tendons <= best_case_tendon_capacity[:, np.newaxis]))
+        assert(np.all(energy_stored_in_tendons >= 0))
         peak_tendon_storage = np.max(energy_stored_in_tendons)
-        for joint in range(skel.getNumJoints()):
+        for joint in range(num_joints):
             print('peak tendon energy for joint '+str(joint)+' ['+skel.getJoint(joint).getName()+']: '+str(np.max(energy_stored_in_tendons[joint, :]))+' of peak '+str(best_case_tendon_capacity[joint])+'J')
         # Don't pick a max that's too small, or the visualization will have tendons way too large
         if peak_tendon_storage < 40:
@@ -347,21 +305,21 @@ class ViewEnergyCommand(AbstractCommand):
 
         # Joints can generate energy, but bodies cannot
         node_attached_to_sink: List[bool] = []
-        for _ in range(skel.getNumBodyNodes()):
+        for _ in range(num_bodies):
             node_attached_to_sink.append(False)
-        for _ in range(skel.getNumJoints()):
+        for _ in range(num_joints):
             node_attached_to_sink.append(True)
 
         # Set up the arcs connecting the graph
         arcs: List[Tuple[int, int]] = []
         joint_to_parent_arc: Dict[int, int] = {}
         joint_to_child_arc: Dict[int, int] = {}
-        for j in range(skel.getNumJoints()):
+        for j in range(num_joints):
             joint = skel.getJoint(j)
 
             # All arcs are (from, to), and because the energy frames express joints in powerToParent and
             # powerToChild, the (from) is always the joint, and (to) is always the body
-            from_node = skel.getNumBodyNodes() + j
+            from_node = num_bodies + j
 
             to_child = joint.getChildBodyNode().getIndexInSkeleton()
             joint_to_child_arc[j] = len(arcs)
@@ -375,22 +333,15 @@ class ViewEnergyCommand(AbstractCommand):
                 joint_to_parent_arc[j] = -1
 
         # Create the native-code discretizer
-        native_discretizer = nimble.math.GraphFlowDiscretizer(skel.getNumBodyNodes() + skel.getNumJoints(), arcs, node_attached_to_sink)
+        native_discretizer = nimble.math.GraphFlowDiscretizer(num_bodies + num_joints, arcs, node_attached_to_sink)
 
         # Create the matrices for energy levels and arc flows
-        energy_levels = np.zeros((skel.getNumBodyNodes() + skel.getNumJoints(), num_frames))
+        energy_levels = np.concatenate((body_energy, energy_stored_in_tendons), axis=0)
         arc_rates = np.zeros((len(arcs), num_frames))
-
-        for frame in range(num_frames):
-            this_energy = energy_frames[frame]
-            for i in range(skel.getNumBodyNodes()):
-                energy_levels[i, frame] = this_energy.bodyKineticEnergy[i] + this_energy.bodyPotentialEnergy[i]
-            for j in range(skel.getNumJoints()):
-                energy_levels[skel.getNumBodyNodes() + j, frame] = energy_stored_in_tendons[j, frame]
-            for j in range(skel.getNumJoints()):
-                if joint_to_parent_arc[j] != -1:
-                    arc_rates[joint_to_parent_arc[j], frame] = this_energy.joints[j].powerToParent * subject.getTrialTimestep(trial)
-                arc_rates[joint_to_child_arc[j], frame] = this_energy.joints[j].powerToChild * subject.getTrialTimestep(trial)
+        child_arcs = [joint_to_child_arc[j] for j in range(num_joints)]
+        arc_rates[child_arcs, :] = joint_power_to_child * timestep
+        parent_joints = [j for j in range(num_joints) if joint_to_parent_arc[j] != -1]
+        arc_rates[[joint_to_parent_arc[j] for j in parent_joints], :] = joint_power_to_parent[parent_joints, :] * timestep
 
         arc_rates = native_discretizer.cleanUpArcRates(energy_levels, arc_rates)
 
@@ -402,23 +353,17 @@ class ViewEnergyCommand(AbstractCommand):
         #########################################################################
 
         # First collect all the body and joint positions
-        body_com_positions = np.zeros((skel.getNumBodyNodes() * 3, num_frames))
-        joint_positions = np.zeros((skel.getNumJoints() * 3, num_frames))
-        for frame in range(num_frames):
-            loaded = subject.readFrames(trial, frame, 1)
-            skel.setPositions(loaded[0].processingPasses[trial_pass].pos)
-            for b in range(skel.getNumBodyNodes()):
-                body_com_positions[b*3:b*3+3, frame] = skel.getBodyNode(b).getCOM()
-            joint_positions[:, frame] = skel.getJointWorldPositions([skel.getJoint(j) for j in range(skel.getNumJoints())])
+        body_com_positions = body_coms.reshape(num_frames, -1).T
+        joint_positions = viewer.joint_world_positions.T
 
         # Animation parameters
         particle_intro_duration = 0.015
-        particle_intro_frames = int(particle_intro_duration / subject.getTrialTimestep(trial))
+        particle_intro_frames = int(particle_intro_duration / timestep)
         particle_intro_distance = 0.05
         particle_outro_duration = 0.045
-        particle_outro_frames = int(particle_outro_duration / subject.getTrialTimestep(trial))
+        particle_outro_frames = int(particle_outro_duration / timestep)
         particle_outro_distance = 0.05
-        fs = 1 / subject.getTrialTimestep(trial)
+        fs = 1 / timestep
         nyquist = fs / 2
         if particle_lowpass_hz < nyquist:
             b, a = butter(2, particle_lowpass_hz, 'low', fs=fs)
@@ -501,8 +446,7 @@ class ViewEnergyCommand(AbstractCommand):
                         body_offset = sec_offsets[sec]
 
                         particle_trajectories[s*3:s*3+3, start_time:end_time] = body_com_positions[node*3:node*3+3, start_time:end_time]
-                        for t in range(start_time, end_time):
-                            particle_trajectories[s * 3:s * 3 + 3, t] += body_offset
+                        particle_trajectories[s*3:s*3+3, start_time:end_time] += body_offset[:, np.newaxis]
 
                         if blend_frames > 0:
                             if sec > 0:
@@ -538,8 +482,7 @@ class ViewEnergyCommand(AbstractCommand):
                         joint = node - skel.getNumBodyNodes()
                         particle_trajectories[s*3:s*3+3, start_time:end_time] = joint_positions[joint * 3:joint * 3 + 3, start_time:end_time]
                         node_offset = sec_offsets[sec]
-                        for t in range(start_time, end_time):
-                            particle_trajectories[s * 3:s * 3 + 3, t] += node_offset
+                        particle_trajectories[s*3:s*3+3, start_time:end_time] += node_offset[:, np.newaxis]
 
                 # Compute the intro
                 if particle.startTime > 0:
@@ -579,20 +522,15 @@ class ViewEnergyCommand(AbstractCommand):
                 # if particle_lowpass_hz < nyquist and end_time - start_time > 9:
                 #     particle_trajectories[s * 3:s * 3 + 3, start_time:end_time] = filtfilt(b, a, particle_trajectories[s * 3:s * 3 + 3, start_time:end_time])
 
-                for t in range(start_time, end_time):
-                    particle_age[s, t] = (t - start_time) / (end_time - start_time)
+                particle_age[s, start_time:end_time] = (np.arange(start_time, end_time) - start_time) / (end_time - start_time)
 
                 # If we have a particle that starts on the first frame, then just assume age cannot go below 0.5
                 if start_time == 0:
-                    for t in range(start_time, end_time):
-                        if particle_age[s, t] < 0.5:
-                            particle_age[s, t] = 0.5
+                    particle_age[s, start_time:end_time] = np.maximum(particle_age[s, start_time:end_time], 0.5)
 
                 # If we have a particle that ends on the last frame, then just assume age cannot go above 0.5
                 if end_time >= num_frames - 1:
-                    for t in range(start_time, end_time):
-                        if particle_age[s, t] > 0.5:
-                            particle_age[s, t] = 0.5
+                    particle_age[s, start_time:end_time] = np.minimum(particle_age[s, start_time:end_time], 0.5)
 
                 # if node < skel.getNumBodyNodes():
                 #     body = skel.getBodyNode(node)
@@ -605,237 +543,83 @@ class ViewEnergyCommand(AbstractCommand):
                 #     color = filtfilt(b, a, color)
                 # gui.createSphere('particle_'+str(p), [0.01, 0.01, 0.01], pos, color, layer=ENERGY_LAYER_NAME)
 
-        if save_to_file is None:
-            ticker: nimble.realtime.Ticker = nimble.realtime.Ticker(
-                subject.getTrialTimestep(trial) / playback_speed)
-        else:
-            ticker: nimble.realtime.Ticker = None
-
-        frame: int = 0
+        #########################################################################
+        # Work out everything we draw on every frame, up front
+        #########################################################################
 
-        running_energy_deriv: float = 0.0
-        stored_energy = np.zeros(skel.getNumJoints())
+        coolwarm_cmap = plt.get_cmap('coolwarm')
 
-        SKELETON_LAYER_NAME = 'Skeleton'
-        ENERGY_LAYER_NAME = 'Energy Flow'
-        TENDON_LAYER_NAME = 'Spring Energy (Idealized Tendons)'
-        gui.createLayer(SKELETON_LAYER_NAME)
-        gui.createLayer(ENERGY_LAYER_NAME)
-        # gui.createLayer(TENDON_LAYER_NAME, defaultShow=True)
+        def heat_to_rgb(heat: np.ndarray) -> np.ndarray:
+            # ensure the heat values are between 0 and 1
+            heat = np.where(np.isnan(heat), 0.0, np.clip(heat, 0.0, 1.0))
+            # get the RGB values from the colormap, with the color channels just before the time axis
+            return np.moveaxis(coolwarm_cmap(heat)[..., 0:3], -1, -2)
 
-        coolwarm_cmap = plt.get_cmap('coolwarm')
-        plasma_cmap = plt.get_cmap('plasma')
-        # plasma_cmap = plt.get_cmap('viridis')
-        # plasma_cmap = plt.get_cmap('cividis')
+        body_colors = np.ones((num_bodies, 4, num_frames))
+        body_colors[:, 0:3, :] = heat_to_rgb(np.cbrt((body_energy / body_masses[:, np.newaxis]) / peak_energy_density))
+        # Only show the top 50% of tendon energy in color, only the part that gets warm
+        tendon_colors = heat_to_rgb(0.5 + 0.5 * (energy_stored_in_tendons / peak_tendon_storage))
+        particle_colors = heat_to_rgb(1.0 - particle_age)
 
+        legend_html = None
         if len(particle_stacks) > 0:
             hot_rgb = coolwarm_cmap(1.0)[0:3]
             hot_color_style = 'color: rgb('+str(int(hot_rgb[0]*255))+','+str(int(hot_rgb[1]*255))+','+str(int(hot_rgb[2]*255))+')'
             cold_rgb = coolwarm_cmap(0.0)[0:3]
             cold_color_style = 'color: rgb('+str(int(cold_rgb[0]*255))+','+str(int(cold_rgb[1]*255))+','+str(int(cold_rgb[2]*255))+')'
-            gui.createText('energy_plot_text', '<b>Legend:</b><br>Each particle is <b>'+str(round(particle_stacks[0][0].energyValue, 2))+'J</b><br> Particles start <b><span style="'+hot_color_style+'">red</span></b> (when created by positive mechanical work), and slowly turn <b><span style="'+cold_color_style+'">blue</span></b> until they are vented to heat (by negative work).<br/><br/> Bone colors are <b>energy density (J/kg)</b>.<br/><br/><b><span style="'+hot_color_style+'">Red spheres</span></b> at the joints show an upper-bound on how much potential energy could be stored in springs at the joint (this is probably an over-estimate of actual tendon storage).', [20, 200], [180, 30], ENERGY_LAYER_NAME)
-
-        def onTick(now):
-            nonlocal frame
-            nonlocal skel
-            nonlocal subject
-            nonlocal dof
-            nonlocal dof_poses
-            nonlocal dof_vels
-            nonlocal dof_accs
-            nonlocal dof_taus
-            nonlocal timesteps
-            nonlocal running_energy_deriv
-
-            loaded: List[nimble.biomechanics.Frame] = subject.readFrames(trial, frame, 1, contactThreshold=20)
-            skel.setPositions(loaded[0].processingPasses[trial_pass].pos)
-            color = [-1, -1, -1, -1]
-            layer = SKELETON_LAYER_NAME
-            gui.renderSkeleton(skel, overrideColor=color, layer=layer)
-
-            for f in range(len(subject.getGroundForceBodies())):
-                force = loaded[0].processingPasses[trial_pass].groundContactForce[f*3:f*3+3]
-                cop = loaded[0].processingPasses[trial_pass].groundContactCenterOfPressure[f*3:f*3+3]
-                if loaded[0].processingPasses[trial_pass].contact[f]:
-                # if np.linalg.norm(force) > 1:
-                    points = []
-                    points.append(cop)
-                    points.append(cop + force * 0.001)
-                    gui.createLine("grf"+str(f), points, [1, 0, 0, 1])
-                else:
-                    gui.deleteObject('grf'+str(f))
-
-            if dof is not None:
-                joint_pos = skel.getJointWorldPositions([graph_joint])
-                gui.setObjectPosition('active_joint', joint_pos)
-                p = dof_poses[frame]
-                v = dof_vels[frame]
-                a = dof_accs[frame]
-                t = dof_taus[frame]
-
-                # dof_poses_with_zeros = np.zeros(num_frames)
-                # dof_poses_with_zeros[0:frame] = dof_poses[0:frame]
-                # gui.setRichPlotData('dof_plot', 'Pose', 'blue', 'line', timesteps, dof_poses_with_zeros)
-                # dof_vels_with_zeros = np.zeros(num_frames)
-                # dof_vels_with_zeros[0:frame] = dof_vels[0:frame]
-                # gui.setRichPlotData('dof_plot', 'Vel', 'green', 'line', timesteps, dof_vels_with_zeros)
-                # dof_taus_with_zeros = np.zeros(num_frames)
-                # dof_taus_with_zeros[0:frame] = dof_taus[0:frame]
-                # gui.setRichPlotData('dof_plot', 'Tau', 'red', 'line', timesteps, dof_taus_with_zeros)
-                # # dof_power_with_zeros = np.zeros(num_frames)
-                # # dof_power_with_zeros[0:frame] = dof_power[0:frame]
-                # # gui.setRichPlotData('dof_plot', 'Power', 'purple', 'line', timesteps, dof_power_with_zeros)
-                # dof_work_with_zeros = np.zeros(num_frames)
-                # dof_work_with_zeros[0:frame] = dof_work[0:frame]
-                # gui.setRichPlotData('dof_plot', 'Net Work', 'purple', 'line', timesteps, dof_work_with_zeros)
-
-                gui.setTextContents('dof_plot_text', 'DOF '+graph_dof+' values<br>Pos: '+str(p)+'<br>Vel: '+str(v)+'<br>Acc: '+str(a)+'<br>Tau: '+str(t)+'<br>Power:'+str(dof_power[frame])+'<br>Work: '+str(dof_work[frame]))
-
-            energy = energy_frames[frame]
-
-            def heat_to_rgb(heat):
-                # ensure the heat value is between 0 and 1
-                heat = max(0, min(heat, 1))
-
-                # get the RGB value from the 'magma' colormap
-                rgb = coolwarm_cmap(heat)[0:3]
-                # rgb = plt.get_cmap('plasma')(1.0 - heat)[0:3]
-
-                # scale the RGB value to between 0 and 255
-                return rgb
-
-            energy_sphere_scale_factor = 5e-3
-            # power_sphere_scale_factor = 1e-4
-
-            # gui.createSphere('recycled_power', np.ones(3) * energy_sphere_scale_factor * conserved_energy[frame], [1, 0, 0], [0, 0, 1, 1])
-
-            body_radii = np.zeros(skel.getNumBodyNodes())
-            # for i in range(0, skel.getNumBodyNodes()):
-            #     body = skel.getBodyNode(i)
-            #     total_energy = energy.bodyKineticEnergy[i] + energy.bodyPotentialEnergy[i]
-            #     radius = energy_sphere_scale_factor * total_energy
-            #     gui.createSphere(body.getName()+"_energy", radius * np.ones(3), energy.bodyCenters[i], [0, 0, 1, 0.5])
-            #     body_radii[i] = radius
-
-            # for i in range(0, skel.getNumBodyNodes()):
-            #     body = skel.getBodyNode(i)
-            #     radius = (float(quantized_body_energies[frame][i+1]) * 0.3 / num_packets)
-            #     gui.createSphere(body.getName()+"_energy_discrete", radius * np.ones(3), energy.bodyCenters[i], [0, 0, 1, 0.5])
-            #     body_radii[i] = radius
-
-            body_plasma_colors = []
-
-            for i in range(0, skel.getNumBodyNodes()):
-                body = skel.getBodyNode(i)
-                name = body.getName()
-                body_energy = energy.bodyKineticEnergy[i] + energy.bodyPotentialEnergy[i]
-                body_energy_density = body_energy / skel.getBodyNode(i).getMass()
-                raw_percentage = body_energy_density / peak_energy_density
-                scaled_percentage = np.cbrt(raw_percentage)
-                rgb = heat_to_rgb(scaled_percentage)
-                color: np.ndarray = np.array([rgb[0], rgb[1], rgb[2], 1.0])
-                for k in range(body.getNumShapeNodes()):
-                    key = 'world_' + skel.getName() + "_" + body.getName() + "_" + str(k)
-                    gui.setObjectColor(
-                        key, color)
-                    gui.setObjectTooltip(key, name + " Energy: " + str(round(body_energy, 1))+'J')
-                body_plasma_colors.append(plasma_cmap(np.sqrt(scaled_percentage))[0:3])
-
-
-            for i in range(len(particle_stacks)):
-                if particle_live[i, frame] == 0:
-                    gui.deleteObject('particle'+str(i))
-                else:
-                    points = []
-                    width = []
-                    hist_size = 7
-                    hist_stride = max(int((0.02 / subject.getTrialTimestep(trial)) / hist_size), 1)
-
-                    cursor = frame
-                    for hist in range(hist_size * hist_stride):
-                        if cursor < 0 or particle_live[i, cursor] == 0:
-                            cursor += 1
-                        if hist % hist_stride == 0:
-                            points.append(particle_trajectories[i * 3:i * 3 + 3, cursor])
-                            point_intro = particle_intro_fade[i, cursor]
-                            point_outro = particle_outro_fade[i, cursor]
-                            width.append(1.0 + (point_outro + point_intro) * 4.0)
-                        cursor -= 1
-                    transition = particle_intro_fade[i, frame] + particle_outro_fade[i, frame]
-
-                    points.reverse()
-                    width.reverse()
-
-                    # Ensure the points and width are always a fixed length
-                    while len(points) < hist_size:
-                        points.append(points[-1])
-                        width.append(width[-1])
-
-                    # particle_velocity = 0.0
-                    # if particle_live[i, frame-1] == 1:
-                    #     particle_velocity = np.linalg.norm(particle_trajectories[i*3:i*3+3, frame] - particle_trajectories[i*3:i*3+3, frame - 1])
-
-                    # node_index: int = particle_nodes[i][frame]
-                    # if node_index < skel.getNumBodyNodes():
-                    #     rgb = body_plasma_colors[node_index]
-                    # else:
-                    #     # joint = node_index - skel.getNumBodyNodes()
-                    #     rgb = [0.5, 0.0, 0.5]
-                    # # rgb = heat_to_rgb(scaled_percentage)
-
-                    rgb = heat_to_rgb(1.0 - particle_age[i, frame])
-
-                    color = [rgb[0], rgb[1], rgb[2], 1.0 - transition]
-
-                    gui.createLine('particle'+str(i), points, color, layer=ENERGY_LAYER_NAME, width=width)
-                    # gui.createBox('particle' + str(i), np.ones(3) * 0.02, particle_trajectories[i*3:i*3+3, frame],
-                    #                           np.zeros(3), color, layer=ENERGY_LAYER_NAME)
-
-            # negative_work_rgb = heat_to_rgb(1.0)
-            # for i in range(num_negative_work_particles):
-            #     if negative_work_particle_live[i, frame] == 0:
-            #         gui.deleteObject('negative_work_particle'+str(i))
-            #     else:
-            #         age: float = negative_work_particle_age[i, frame]
-            #         size: float = age * age * age
-            #         color = [negative_work_rgb[0], negative_work_rgb[1], negative_work_rgb[2], 0.2 * (1.0 - age) + 0.025]
-            #         gui.createBox('negative_work_particle' + str(i), np.ones(3) * 0.02 * (1.0 + 4.0 * size), negative_work_particle_trajectories[i*3:i*3+3, frame],
-            #                                   np.zeros(3), color, layer=ENERGY_LAYER_NAME)
-
-            running_energy_deriv += np.sum(energy.bodyKineticEnergyDeriv + energy.bodyPotentialEnergyDeriv) * subject.getTrialTimestep(trial)
-
-            positive_power_rgb = heat_to_rgb(1.0)
-            positive_power_color = [positive_power_rgb[0], positive_power_rgb[1], positive_power_rgb[2], 1.0]
-            stored_power_rgb = heat_to_rgb(0.5)
-            stored_power_color = [179.0 / 255, 123.0 / 255, 201.0 / 255, 0.8]
-            negative_power_rgb = heat_to_rgb(0.0)
-            negative_power_color = [negative_power_rgb[0], negative_power_rgb[1], negative_power_rgb[2], 1.0]
-
-            treadmill_offset = avg_vel / np.linalg.norm(avg_vel)
-            # gui.createSphere('recycled_power', np.ones(3) * tendon_sphere_scale_factor * conserved_energy[frame], skel.getCOM() - (treadmill_offset * 2), stored_power_color, layer=CONSERVED_ENERGY_LAYER_NAME)
-
-            for j, joint in enumerate(energy.joints):
-                # Don't store energy in "tendons" at the root joint, since the residuals aren't physical anyways
-                if j > 0:
-                    tendon_percent = energy_stored_in_tendons[j, frame] / peak_tendon_storage
-                    # Only show the top 50% of tendon energy in color, only the part that gets warm
-                    tendon_rgb = heat_to_rgb(0.5 + 0.5 * tendon_percent)
-                    tendon_color = [tendon_rgb[0], tendon_rgb[1], tendon_rgb[2], 0.5]
-                    gui.createSphere('tendon_'+joint.name, np.ones(3) * tendon_percent * 0.15, joint.worldCenter, tendon_color, layer=ENERGY_LAYER_NAME)
-                    gui.setObjectTooltip('tendon_'+joint.name, "Spring at " + joint.name + ": " + str(round(energy_stored_in_tendons[j, frame], 1))+'J')
-
-            # for contact in energy.contacts:
-            #     if contact.powerToBody < 0:
-            #         gui.deleteObject('energy_' + contact.contactBody)
-            #     else:
-            #         gui.createSphere('energy_'+contact.contactBody, np.ones(3) * np.cbrt(contact.powerToBody) * power_sphere_scale_factor, contact.worldCenter, positive_power_color, layer=ENERGY_LAYER_NAME)
-
-            frame += 1
-            # Loop before the last frame, if we're showing energy
-            if frame >= num_frames - 1:
-                frame = 0
+            legend_html = '<b>Legend:</b><br>Each particle is <b>'+str(round(particle_stacks[0][0].energyValue, 2))+'J</b><br> Particles start <b><span style="'+hot_color_style+'">red</span></b> (when created by positive mechanical work), and slowly turn <b><span style="'+cold_color_style+'">blue</span></b> until they are vented to heat (by negative work).<br/><br/> Bone colors are <b>energy density (J/kg)</b>.<br/><br/><b><span style="'+hot_color_style+'">Red spheres</span></b> at the joints show an upper-bound on how much potential energy could be stored in springs at the joint (this is probably an over-estimate of actual tendon storage).'
+
+        energy_frames = EnergyFrames(
+            file_path=os.path.abspath(file_path),
+            geometry=geometry,
+            trial_pass=trial_pass,
+            timestep=timestep,
+            num_frames=num_frames,
+            poses=viewer.arrays.poses[:, :num_frames],
+            contact_forces=viewer.contact_forces[:, :, :num_frames],
+            contact_cops=viewer.contact_cops[:, :, :num_frames],
+            contact=viewer.contact[:, :num_frames],
+            graph_dof=graph_dof,
+            graph_duration=subject.getTrialLength(trial) * timestep,
+            graph_values=graph_values,
+            graph_joint_positions=graph_joint_positions,
+            body_names=[skel.getBodyNode(i).getName() for i in range(num_bodies)],
+            body_shape_keys=[['world_' + skel.getName() + "_" + skel.getBodyNode(i).getName() + "_" + str(k)
+                              for k in range(skel.getBodyNode(i).getNumShapeNodes())] for i in range(num_bodies)],
+            body_energy=body_energy,
+            body_colors=body_colors,
+            joint_names=joint_names,
+            joint_centers=joint_centers,
+            tendon_energy=energy_stored_in_tendons,
+            tendon_colors=tendon_colors,
+            peak_tendon_storage=peak_tendon_storage,
+            particle_trajectories=particle_trajectories,
+            particle_live=particle_live,
+            particle_intro_fade=particle_intro_fade,
+            particle_outro_fade=particle_outro_fade,
+            particle_colors=particle_colors,
+            legend_html=legend_html)
+
+        # Like the live view, we loop before the last frame
+        num_loop_frames = max(num_frames - 1, 1)
 
         if save_to_file is None:
+            nimble_gui = NimbleGUI(world)
+            nimble_gui.serve(8080)
+            gui = nimble_gui.nativeAPI()
+            energy_frames.setup(gui)
+
+            ticker: nimble.realtime.Ticker = nimble.realtime.Ticker(timestep / playback_speed)
+
+            frame: int = 0
+
+            def onTick(now):
+                nonlocal frame
+                energy_frames.render_frame(gui, skel, frame)
+                frame += 1
+                if frame >= num_loop_frames:
+                    frame = 0
+
             ticker.registerTickListener(onTick)
             ticker.start()
 
@@ -845,13 +629,10 @@ class ViewEnergyCommand(AbstractCommand):
             # Don't immediately exit while we're serving
             nimble_gui.blockWhileServing()
         else:
-            gui.setFramesPerSecond(int(1.0/ subject.getTrialTimestep(trial)))
-            print('Constructing frames:')
-            for t in range(num_frames):
-                if t % 25 == 0:
-                    print(str(t)+'/'+str(num_frames))
-                onTick(t)
-                gui.saveFrame()
-            gui.writeFramesJson(save_to_file)
+            # There's no need to keep to the clock when we're recording, so this draws frames as fast as it can
+            record_start_time = time.time()
+            write_energy_recording(energy_frames, num_loop_frames, save_to_file, jobs)
+            record_seconds = time.time() - record_start_time
+            print('Recorded '+str(num_loop_frames)+' frames ('+str(round(num_loop_frames * timestep, 1))+'s of motion) in '+str(round(record_seconds, 1))+'s')
 
         return True
@@ -0,0 +1,244 @@
+import copy
+import os
+import shutil
+import tempfile
+import numpy as np
+from typing import List, Optional, Tuple
+from addbiomechanics.parallel import map_in_processes, atomic_write
+
+SKELETON_LAYER_NAME = 'Skeleton'
+ENERGY_LAYER_NAME = 'Energy Flow'
+TENDON_LAYER_NAME = 'Spring Energy (Idealized Tendons)'
+
+
+class EnergyFrames:
+    """
+    Everything view-energy draws for each frame of a trial, all computed up front as arrays (with time on the last
+    axis). This doesn't hold on to any nimble objects, so it can be sent to worker processes, which each load their own
+    copy of the skeleton and draw a chunk of the frames of a recording.
+    """
+    file_path: str
+    geometry: str
+    trial_pass: int
+    timestep: float
+    num_frames: int
+    # (num_dofs x num_frames)
+    poses: np.ndarray
+    # (num_contact_bodies x 3 x num_frames) and (num_contact_bodies x num_frames)
+    contact_forces: np.ndarray
+    contact_cops: np.ndarray
+    contact: np.ndarray
+    # The rows are pos, vel, acc, tau, power and work for the graphed DOF, and then the position of its joint
+    graph_dof: Optional[str]
+    graph_duration: float
+    graph_values: Optional[np.ndarray]
+    graph_joint_positions: Optional[np.ndarray]
+    # (num_bodies x num_frames) and (num_bodies x 4 x num_frames)
+    body_names: List[str]
+    body_shape_keys: List[List[str]]
+    body_energy: np.ndarray
+    body_colors: np.ndarray
+    # (num_joints x num_frames) and (num_joints x 3 x num_frames)
+    joint_names: List[str]
+    joint_centers: np.ndarray
+    tendon_energy: np.ndarray
+    tendon_colors: np.ndarray
+    peak_tendon_storage: float
+    # Each particle stack is drawn as a single line. These are (num_stacks * 3 x num_frames), (num_stacks x num_frames)
+    # and (num_stacks x 3 x num_frames), but only from particle_first_frame onwards, see chunk()
+    particle_trajectories: np.ndarray
+    particle_live: np.ndarray
+    particle_intro_fade: np.ndarray
+    particle_outro_fade: np.ndarray
+    particle_colors: np.ndarray
+    particle_first_frame: int
+    particle_hist_size: int
+    particle_hist_stride: int
+    legend_html: Optional[str]
+
+    def __init__(self, **arrays):
+        self.particle_first_frame = 0
+        for key, value in arrays.items():
+            setattr(self, key, value)
+        self.particle_hist_size = 7
+        self.particle_hist_stride = max(int((0.02 / self.timestep) / self.particle_hist_size), 1)
+
+    def load_skeleton(self):
+        import nimblephysics as nimble
+        subject = nimble.biomechanics.SubjectOnDisk(self.file_path)
+        skel = subject.readSkel(self.trial_pass, self.geometry)
+        skel.setGravity([0, -9.81, 0])
+        return skel
+
+    def chunk(self, start: int, end: int) -> 'EnergyFrames':
+        """
+        A copy that can only draw frames [start, end), and the frame before start. The particle arrays are by far the
+        largest, so we trim those down to just the frames that drawing this chunk looks at, so we don't send every
+        worker the whole trial.
+        """
+        chunk = copy.copy(self)
+        first_frame = max(start - 1 - self.particle_hist_size * self.particle_hist_stride, 0)
+        chunk.particle_first_frame = first_frame
+        for key in ['particle_trajectories', 'particle_live', 'particle_intro_fade', 'particle_outro_fade',
+                    'particle_colors']:
+            values = getattr(self, key)[..., first_frame - self.particle_first_frame:end - self.particle_first_frame]
+            setattr(chunk, key, np.copy(values))
+        return chunk
+
+    def setup(self, gui):
+        """
+        Create the plots, text and layers that stay put for the whole trial.
+        """
+        if self.graph_dof is not None:
+            gui.createSphere('active_joint', [0.05, 0.05, 0.05], self.graph_joint_positions[:, 0], [1, 0, 0, 1])
+            dof_poses, dof_vels, dof_accs, dof_taus, dof_power, dof_work = self.graph_values
+            timesteps = np.arange(self.graph_values.shape[1]) * self.timestep
+            max_over_all = np.percentile(np.concatenate((dof_poses, dof_vels, dof_accs, dof_taus, dof_power)), 95)
+            min_over_all = np.percentile(np.concatenate((dof_poses, dof_vels, dof_accs, dof_taus, dof_power)), 5)
+
+            gui.createRichPlot('dof_plot', [50, 100], [400, 200], 0, self.graph_duration, min_over_all, max_over_all, 'DOF '+self.graph_dof, 'Time (s)', 'Values')
+
+            gui.setRichPlotData('dof_plot', 'Pose', 'blue', 'line', timesteps, dof_poses)
+            gui.setRichPlotData('dof_plot', 'Vel', 'green', 'line', timesteps, dof_vels)
+            gui.setRichPlotData('dof_plot', 'Tau', 'red', 'line', timesteps, dof_taus)
+            # gui.setRichPlotData('dof_plot', 'Power', 'purple', 'line', timesteps, dof_power)
+            gui.setRichPlotData('dof_plot', 'Net Work', 'purple', 'line', timesteps, dof_work)
+
+            gui.createText('dof_plot_text', 'DOF '+self.graph_dof+' values', [50, 350], [400, 50])
+
+        gui.createLayer(SKELETON_LAYER_NAME)
+        gui.createLayer(ENERGY_LAYER_NAME)
+        # gui.createLayer(TENDON_LAYER_NAME, defaultShow=True)
+
+        if self.legend_html is not None:
+            gui.createText('energy_plot_text', self.legend_html, [20, 200], [180, 30], ENERGY_LAYER_NAME)
+
+    def particle_tails(self, particle_frame: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Each particle is drawn as a short line, trailing back through its recent positions. This walks back through
+        time for all the particles that are alive on this frame at once, and returns their indices, the points of their
+        lines (num_live x hist_size x 3, oldest first), and the widths of those points (num_live x hist_size).
+        """
+        live_particles = np.nonzero(self.particle_live[:, particle_frame])[0]
+        rows = live_particles[:, np.newaxis]
+        cursors = np.full(len(live_particles), particle_frame, dtype=np.int64)
+        tail_frames = np.zeros((len(live_particles), self.particle_hist_size), dtype=np.int64)
+        for hist in range(self.particle_hist_size * self.particle_hist_stride):
+            # Don't walk back past the start of the trial, or the start of the particle's life
+            before_trial = cursors + self.particle_first_frame < 0
+            dead = before_trial | (self.particle_live[live_particles, np.where(before_trial, 0, cursors)] == 0)
+            cursors += dead
+            if hist % self.particle_hist_stride == 0:
+                tail_frames[:, self.particle_hist_size - 1 - hist // self.particle_hist_stride] = cursors
+            cursors -= 1
+        trajectories = self.particle_trajectories.reshape(-1, 3, self.particle_trajectories.shape[-1])
+        tail_points = trajectories[rows, :, tail_frames]
+        tail_widths = 1.0 + (self.particle_outro_fade[rows, tail_frames] + self.particle_intro_fade[rows, tail_frames]) * 4.0
+        return live_particles, tail_points, tail_widths
+
+    def render_frame(self, gui, skel, frame: int):
+        """
+        Draw a frame. This only looks up values in the arrays, apart from the forward kinematics to pose the skeleton.
+        """
+        skel.setPositions(self.poses[:, frame])
+        gui.renderSkeleton(skel, overrideColor=[-1, -1, -1, -1], layer=SKELETON_LAYER_NAME)
+
+        for f in range(self.contact_forces.shape[0]):
+            if self.contact[f, frame]:
+                cop = self.contact_cops[f, :, frame]
+                force = self.contact_forces[f, :, frame]
+                gui.createLine('grf'+str(f), [cop, cop + force * 0.001], [1, 0, 0, 1], layer=SKELETON_LAYER_NAME)
+            else:
+                gui.deleteObject('grf'+str(f))
+
+        if self.graph_dof is not None:
+            gui.setObjectPosition('active_joint', self.graph_joint_positions[:, frame])
+            p, v, a, t, power, work = self.graph_values[:, frame]
+            gui.setTextContents('dof_plot_text', 'DOF '+self.graph_dof+' values<br>Pos: '+str(p)+'<br>Vel: '+str(v)+'<br>Acc: '+str(a)+'<br>Tau: '+str(t)+'<br>Power:'+str(power)+'<br>Work: '+str(work))
+
+        for i in range(len(self.body_names)):
+            color = self.body_colors[i, :, frame]
+            for key in self.body_shape_keys[i]:
+                gui.setObjectColor(key, color)
+                gui.setObjectTooltip(key, self.body_names[i] + " Energy: " + str(round(self.body_energy[i, frame], 1))+'J')
+
+        particle_frame = frame - self.particle_first_frame
+        live_particles, tail_points, tail_widths = self.particle_tails(particle_frame)
+        num_drawn = 0
+        for i in range(self.particle_live.shape[0]):
+            if self.particle_live[i, particle_frame] == 0:
+                gui.deleteObject('particle'+str(i))
+            else:
+                transition = self.particle_intro_fade[i, particle_frame] + self.particle_outro_fade[i, particle_frame]
+                rgb = self.particle_colors[i, :, particle_frame]
+                color = [rgb[0], rgb[1], rgb[2], 1.0 - transition]
+
+                gui.createLine('particle'+str(i), tail_points[num_drawn], color, layer=ENERGY_LAYER_NAME, width=tail_widths[num_drawn])
+                num_drawn += 1
+
+        for j, name in enumerate(self.joint_names):
+            # Don't store energy in "tendons" at the root joint, since the residuals aren't physical anyways
+            if j > 0:
+                tendon_percent = self.tendon_energy[j, frame] / self.peak_tendon_storage
+                tendon_rgb = self.tendon_colors[j, :, frame]
+                tendon_color = [tendon_rgb[0], tendon_rgb[1], tendon_rgb[2], 0.5]
+                gui.createSphere('tendon_'+name, np.ones(3) * tendon_percent * 0.15, self.joint_centers[j, :, frame], tendon_color, layer=ENERGY_LAYER_NAME)
+                gui.setObjectTooltip('tendon_'+name, "Spring at " + name + ": " + str(round(self.tendon_energy[j, frame], 1))+'J')
+
+
+def record_energy_frames(energy_frames: EnergyFrames, start: int, end: int, path: str) -> int:
+    """
+    Draw frames [start, end) into a GUIRecording, and write them to `path`. The frames are written exactly as they
+    would be if we'd recorded every frame before `start` as well, so recordings of consecutive chunks of frames can be
+    concatenated into one recording. This lives outside the command, so it can run in a worker process.
+    """
+    import nimblephysics as nimble
+    skel = energy_frames.load_skeleton()
+    gui = nimble.server.GUIRecording()
+    energy_frames.setup(gui)
+    gui.setFramesPerSecond(int(1.0 / energy_frames.timestep))
+    first_frame_to_write = 0
+    if start > 0:
+        # Recordings only store what changed since the previous frame, and give each object (and layer) an id the first
+        # time they see it. Every frame touches the same objects in the same order, on layers created in setup(), so
+        # drawing the frame just before this chunk puts the recording in the same state as if it had drawn every frame
+        # before it. We then leave that frame out.
+        energy_frames.render_frame(gui, skel, start - 1)
+        gui.saveFrame()
+        first_frame_to_write = 1
+    for frame in range(start, end):
+        energy_frames.render_frame(gui, skel, frame)
+        gui.saveFrame()
+    gui.writeFramesJson(path, first_frame_to_write)
+    return end - start
+
+
+def write_energy_recording(energy_frames: EnergyFrames, num_frames: int, path: str, jobs: int = 1):
+    """
+    Record the first num_frames frames to `path`, as fast as we can draw them. With more than one job, the frames are
+    split into consecutive chunks, each drawn in its own process, and the chunks are then joined together.
+    """
+    if jobs <= 1 or num_frames < 2 * jobs:
+        print('Constructing '+str(num_frames)+' frames...')
+        record_energy_frames(energy_frames, 0, num_frames, path)
+        return
+
+    bounds: List[int] = [int(b) for b in np.linspace(0, num_frames, jobs + 1)]
+    chunks: List[Tuple[int, int]] = [(bounds[i], bounds[i + 1]) for i in range(jobs)]
+    print('Constructing '+str(num_frames)+' frames in '+str(len(chunks))+' chunks, with '+str(jobs)+' parallel jobs...')
+    with tempfile.TemporaryDirectory() as chunk_folder:
+        chunk_paths = [os.path.join(chunk_folder, 'chunk_'+str(i)+'.bin') for i in range(len(chunks))]
+        frames_done = 0
+        for _, chunk_frames in map_in_processes(record_energy_frames,
+                                                [(energy_frames.chunk(start, end), start, end, chunk_path)
+                                                 for (start, end), chunk_path in zip(chunks, chunk_paths)], jobs):
+            frames_done += chunk_frames
+            print('  '+str(frames_done)+'/'+str(num_frames)+' frames')
+
+        # Recordings are just a sequence of length-prefixed frames, so the chunks can be joined back to back
+        def join_chunks(temp_path: str):
+            with open(temp_path, 'wb') as out_file:
+                for chunk_path in chunk_paths:
+                    with open(chunk_path, 'rb') as chunk_file:
+                        shutil.copyfileobj(chunk_file, out_file)
+        atomic_write(path, join_chunks)
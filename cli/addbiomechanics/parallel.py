@@ -0,0 +1,43 @@
+"""
+The helpers the batch commands share to spread their work over several processes (the --jobs option), and to write
+their outputs safely while they do it.
+"""
+import os
+import concurrent.futures
+import multiprocessing
+from typing import Any, Callable, Iterator, Sequence, Tuple, TypeVar
+
+T = TypeVar('T')
+
+
+def map_in_processes(fn: Callable[..., T], args_list: Sequence[Tuple[Any, ...]], jobs: int) -> Iterator[Tuple[int, T]]:
+    """
+    Call fn(*args) for each of the args in `args_list`, in a pool of `jobs` worker processes, and yield the index of
+    each call in `args_list` along with its result, in the order the calls finish.
+
+    We spawn the workers rather than forking them, so they don't inherit whatever native library state this process
+    has already built up. That means `fn` and its arguments have to be picklable (so `fn` has to be a module level
+    function, or a functools.partial of one).
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+                                                mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(fn, *args): index for index, args in enumerate(args_list)}
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
+
+
+def atomic_write(path: str, writer: Callable[[str], T]) -> T:
+    """
+    Call writer(temp_path) to write a file, and then move it into place at `path`, returning whatever the writer
+    returns. An interrupted run never leaves a half-written file behind that the next run would skip over (or that
+    anyone reading the old file would see), and if the writer fails the temporary file is removed. The temporary file
+    is named after this process, so workers that happen to write the same path don't trip over each other.
+    """
+    temp_path = path + '.' + str(os.getpid()) + '.tmp'
+    try:
+        result = writer(temp_path)
+        os.replace(temp_path, path)
+        return result
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
@@ -1,4 +1,5 @@
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Optional
+import bisect
 import datetime
 from addbiomechanics.auth import AuthContext
 
@@ -10,6 +11,68 @@ def sizeof_fmt(num: int, suffix="B"):
     return f"{num:.1f}Yi{suffix}"
 
 
+class PrefixIndex:
+    """
+    Finds which of a set of prefixes (e.g. subject paths) a key starts with, with a binary search over the sorted
+    prefixes instead of trying every one of them. If a key starts with several of the prefixes, the one that came
+    first in the list the index was built from wins, which is what a linear scan over that list would find.
+    """
+    sorted_prefixes: List[str]
+    # For each sorted prefix, the index of the longest other prefix it starts with, or -1
+    parents: List[int]
+    # For each sorted prefix, the index of the first (in the original order) prefix out of itself and its parents
+    firsts: List[int]
+
+    def __init__(self, prefixes: List[str]):
+        order: Dict[str, int] = {}
+        for i, prefix in enumerate(prefixes):
+            order.setdefault(prefix, i)
+        self.sorted_prefixes = sorted(order.keys())
+        self.parents = []
+        self.firsts = []
+        # Sorting puts every prefix right before the run of prefixes that start with it, so we can find the parents
+        # with a stack of the chain of prefixes that contain the current one
+        stack: List[int] = []
+        for i, prefix in enumerate(self.sorted_prefixes):
+            while len(stack) > 0 and not prefix.startswith(self.sorted_prefixes[stack[-1]]):
+                stack.pop()
+            parent = stack[-1] if len(stack) > 0 else -1
+            self.parents.append(parent)
+            if parent == -1 or order[prefix] < order[self.sorted_prefixes[self.firsts[parent]]]:
+                self.firsts.append(i)
+            else:
+                self.firsts.append(self.firsts[parent])
+            stack.append(i)
+
+    def find(self, key: str) -> Optional[str]:
+        # Every prefix of the key sorts at or before it, and anything that sorts between a prefix of the key and the
+        # key itself also starts with that prefix. So the prefixes of the key are all in the chain of parents of the
+        # last prefix that sorts at or before the key.
+        i = bisect.bisect_right(self.sorted_prefixes, key) - 1
+        while i >= 0 and not key.startswith(self.sorted_prefixes[i]):
+            i = self.parents[i]
+        if i < 0:
+            return None
+        return self.sorted_prefixes[self.firsts[i]]
+
+
+def group_files_by_prefix(files: List[Tuple[str, int, str]],
+                          prefixes: List[str]) -> Dict[str, List[Tuple[str, int, str]]]:
+    """
+    Group (key, size, e_tag) tuples by which of the prefixes their key starts with, keeping them in their original
+    order. Files that don't start with any of the prefixes are left out.
+    """
+    index = PrefixIndex(prefixes)
+    groups: Dict[str, List[Tuple[str, int, str]]] = {}
+    for file in files:
+        prefix = index.find(file[0])
+        if prefix is not None:
+            if prefix not in groups:
+                groups[prefix] = []
+            groups[prefix].append(file)
+    return groups
+
+
 class S3Node:
     name: str
     parent: 'S3Node' = None
@@ -0,0 +1,189 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from addbiomechanics.auth import AuthContext
+from addbiomechanics.s3_structure import sizeof_fmt
+
+MiB = 1024 * 1024
+# These are the part sizes that boto3 and the AWS CLI use by default, which covers almost everything in our buckets
+COMMON_PART_SIZES: List[int] = [8 * MiB, 16 * MiB, 5 * MiB, 15 * MiB]
+# We upload in parts of this size, so that large files go up in parallel and a failure only loses one part
+UPLOAD_PART_SIZE = 8 * MiB
+
+
+class TransferProgress:
+    """
+    Keeps track of how many bytes and files have been transferred across all the worker threads, and prints a
+    progress line with the throughput every few seconds. add_bytes() has the signature boto3 expects of a transfer
+    Callback.
+    """
+    verb: str
+    total_bytes: int
+    total_files: int
+    transferred_bytes: int
+    transferred_files: int
+
+    def __init__(self, total_bytes: int, total_files: int, verb: str = 'Downloaded', report_interval_s: float = 2.0):
+        self.verb = verb
+        self.total_bytes = total_bytes
+        self.total_files = total_files
+        self.transferred_bytes = 0
+        self.transferred_files = 0
+        self.report_interval_s = report_interval_s
+        self.start_time = time.time()
+        self.last_report_time = 0.0
+        self.lock = threading.Lock()
+
+    def add_bytes(self, num_bytes: int):
+        with self.lock:
+            self.transferred_bytes += num_bytes
+        self.report()
+
+    def file_done(self):
+        with self.lock:
+            self.transferred_files += 1
+        self.report()
+
+    def bytes_per_second(self) -> float:
+        return self.transferred_bytes / max(time.time() - self.start_time, 1e-6)
+
+    def report(self, force: bool = False):
+        now = time.time()
+        with self.lock:
+            if not force and now - self.last_report_time < self.report_interval_s:
+                return
+            self.last_report_time = now
+            percent = 100.0 * self.transferred_bytes / self.total_bytes if self.total_bytes > 0 else 100.0
+            line = (self.verb + ' ' + sizeof_fmt(self.transferred_bytes) + '/' + sizeof_fmt(self.total_bytes) +
+                    ' (' + str(round(percent, 1)) + '%), ' + str(self.transferred_files) + '/' +
+                    str(self.total_files) + ' files, ' + sizeof_fmt(self.bytes_per_second()) + '/s')
+        print(line, flush=True)
+
+
+class RefreshingS3Client:
+    """
+    A boto3 S3 client that can be shared between threads. Our AWS credentials are temporary, so when a transfer fails
+    the worker asks for a refresh. Only the first worker to ask for a given client actually refreshes the session, and
+    everyone else just picks up the new client.
+    """
+
+    def __init__(self, ctx: AuthContext):
+        self.ctx = ctx
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.client = ctx.aws_session.client('s3')
+
+    def get(self) -> Tuple[object, int]:
+        with self.lock:
+            return self.client, self.generation
+
+    def refresh(self, generation: int):
+        with self.lock:
+            if generation == self.generation:
+                self.ctx.refresh()
+                self.client = self.ctx.aws_session.client('s3')
+                self.generation += 1
+
+
+def backoff_delay(attempt: int, base_delay_s: float = 0.5, max_delay_s: float = 30.0) -> float:
+    """
+    How long to wait before retrying after the given (zero-based) failed attempt. The wait doubles with each attempt,
+    and is randomized ("full jitter") so that workers that failed together don't all retry at the same moment.
+    """
+    return random.uniform(0, min(max_delay_s, base_delay_s * (2 ** attempt)))
+
+
+def compute_etag(path: str, part_size: Optional[int] = None) -> str:
+    """
+    Compute the ETag S3 would give this file, if it were uploaded in parts of part_size bytes (or in a single part, if
+    part_size is None). Multipart ETags are the MD5 of the concatenated part MD5s, followed by the number of parts.
+    """
+    with open(path, 'rb') as f:
+        if part_size is None:
+            md5 = hashlib.md5()
+            for chunk in iter(lambda: f.read(MiB), b''):
+                md5.update(chunk)
+            return '"' + md5.hexdigest() + '"'
+        part_digests: List[bytes] = []
+        while True:
+            remaining = part_size
+            md5 = hashlib.md5()
+            while remaining > 0:
+                chunk = f.read(min(remaining, MiB))
+                if not chunk:
+                    break
+                md5.update(chunk)
+                remaining -= len(chunk)
+            if remaining == part_size:
+                break
+            part_digests.append(md5.digest())
+        return '"' + hashlib.md5(b''.join(part_digests)).hexdigest() + '-' + str(len(part_digests)) + '"'
+
+
+def local_file_matches_etag(path: str, size: int, e_tag: str) -> bool:
+    """
+    Check that a local file has the same contents as the S3 object with this size and ETag. For multipart uploads we
+    have to guess the part size, so we try the common ones that give the right number of parts, and if none of them
+    reproduce the ETag we report a mismatch.
+    """
+    if not os.path.isfile(path) or os.path.getsize(path) != size:
+        return False
+    e_tag = e_tag if e_tag.startswith('"') else '"' + e_tag + '"'
+    if '-' not in e_tag:
+        return compute_etag(path) == e_tag
+    num_parts = int(e_tag.strip('"').split('-')[1])
+    part_sizes: List[int] = list(COMMON_PART_SIZES)
+    if num_parts > 0:
+        # If the uploader picked the smallest whole number of MiB that fit the file in this many parts
+        part_sizes.append(((size + num_parts - 1) // num_parts + MiB - 1) // MiB * MiB)
+    for part_size in part_sizes:
+        if (size + part_size - 1) // part_size == num_parts and compute_etag(path, part_size) == e_tag:
+            return True
+    return False
+
+
+class TransferManifest:
+    """
+    An append-only record of the files that have been transferred completely, and the ETags they had at the time,
+    stored as JSON lines. If a transfer gets interrupted, the next run reads this back in to tell which files it can
+    skip, without having to re-hash all of them.
+    """
+    path: str
+    entries: Dict[str, Tuple[str, int]]
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                lines = f.readlines()
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                    self.entries[entry['key']] = (entry['etag'], entry['size'])
+                except (ValueError, KeyError):
+                    # The last line may be cut off if we were interrupted while writing it
+                    continue
+            if len(lines) > 0 and not lines[-1].endswith('\n'):
+                # Make sure the next entry starts on a line of its own, rather than the end of a cut off one
+                with open(path, 'a') as f:
+                    f.write('\n')
+
+    def is_complete(self, key: str, local_path: str, size: int, e_tag: str) -> bool:
+        """
+        A file is complete if the manifest says we finished transferring this exact version of it, and the local copy
+        is still there with the right size.
+        """
+        return self.entries.get(key) == (e_tag, size) and os.path.isfile(local_path) and \
+            os.path.getsize(local_path) == size
+
+    def record(self, key: str, size: int, e_tag: str):
+        with self.lock:
+            self.entries[key] = (e_tag, size)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps({'key': key, 'etag': e_tag, 'size': size}) + '\n')
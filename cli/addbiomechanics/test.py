@@ -1,5 +1,17 @@
 import unittest
-from addbiomechanics.commands.__test_upload import TestParserFolderStructure
+from addbiomechanics.commands.__test_upload import TestParserFolderStructure, TestUploadFiles, TestSyncUpload
+from addbiomechanics.commands.__test_post_process import TestPostProcess
+from addbiomechanics.commands.__test_describe_dataset import TestDescribeDataset
+from addbiomechanics.commands.__test_download import TestDownload, TestSubjectGrouping
+from addbiomechanics.commands.__test_clean_up import TestCleanUp
+from addbiomechanics.commands.__test_viewer_data import TestViewerData
+from addbiomechanics.commands.__test_view_energy import TestViewEnergy
+from addbiomechanics.commands.__test_create_b3d import TestCreateB3D
+from addbiomechanics.commands.__test_export_csv import TestExportCSV
+from addbiomechanics.commands.__test_export_dataset import TestExportDataset
+from addbiomechanics.commands.__test_stats import TestStats
+from addbiomechanics.commands.__test_thresholds import TestThresholds
+from addbiomechanics.commands.__test_parallel import TestParallel
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,113 @@
+import numpy as np
+from typing import List, Iterator
+
+
+class TrialArrays:
+    """
+    Everything we usually want out of one trial of a SubjectOnDisk, for a single processing pass, as contiguous arrays
+    with one column per frame. This is read in one go from the pass-level getters, instead of decoding the trial frame
+    by frame with readFrames().
+    """
+    trial: int
+    processing_pass: int
+    pass_type: 'nimble.biomechanics.ProcessingPassType'
+    timestep: float
+    # These are all (num_dofs x num_frames)
+    poses: np.ndarray
+    vels: np.ndarray
+    accs: np.ndarray
+    taus: np.ndarray
+    # These are (6 * num_contact_bodies x num_frames), and (9 * num_contact_bodies x num_frames)
+    ground_body_wrenches: np.ndarray
+    ground_body_cop_torque_force: np.ndarray
+    # These are (3 x num_frames)
+    com_poses: np.ndarray
+    com_vels: np.ndarray
+    com_accs: np.ndarray
+    # These are (num_frames,), and not_missing_grf is True on frames where we trust the ground reaction forces
+    missing_grf_reason: List['nimble.biomechanics.MissingGRFReason']
+    not_missing_grf: np.ndarray
+
+    def __init__(self, subject, trial: int, processing_pass: int = -1):
+        import nimblephysics as nimble
+        trial_proto = subject.getHeaderProto().getTrials()[trial]
+        trial_passes = trial_proto.getPasses()
+        if len(trial_passes) == 0:
+            raise ValueError(f'Trial {trial} has no processing passes')
+        if processing_pass < 0:
+            processing_pass += len(trial_passes)
+        if processing_pass < 0 or processing_pass >= len(trial_passes):
+            raise ValueError(f'Trial {trial} has no processing pass {processing_pass}')
+        trial_pass = trial_passes[processing_pass]
+
+        self.trial = trial
+        self.processing_pass = processing_pass
+        self.pass_type = trial_pass.getType()
+        self.timestep = subject.getTrialTimestep(trial)
+        self.poses = np.ascontiguousarray(trial_pass.getPoses())
+        self.vels = np.ascontiguousarray(trial_pass.getVels())
+        self.accs = np.ascontiguousarray(trial_pass.getAccs())
+        self.taus = np.ascontiguousarray(trial_pass.getTaus())
+        self.ground_body_wrenches = np.ascontiguousarray(trial_pass.getGroundBodyWrenches())
+        self.ground_body_cop_torque_force = np.ascontiguousarray(trial_pass.getGroundBodyCopTorqueForce())
+        self.com_poses = np.ascontiguousarray(trial_pass.getComPoses())
+        self.com_vels = np.ascontiguousarray(trial_pass.getComVels())
+        self.com_accs = np.ascontiguousarray(trial_pass.getComAccs())
+        self.missing_grf_reason = list(trial_proto.getMissingGRFReason())
+        self.not_missing_grf = np.array([reason == nimble.biomechanics.MissingGRFReason.notMissingGRF
+                                         for reason in self.missing_grf_reason], dtype=bool)
+
+    @property
+    def num_frames(self) -> int:
+        return self.poses.shape[1]
+
+    @property
+    def times(self) -> np.ndarray:
+        return np.arange(self.num_frames) * self.timestep
+
+
+def load_subject(path: str):
+    """
+    Open a SubjectOnDisk and load all of its frames into memory, which is what the pass-level getters read from.
+    """
+    import nimblephysics as nimble
+    subject = nimble.biomechanics.SubjectOnDisk(path)
+    subject.loadAllFrames()
+    return subject
+
+
+def read_trial_arrays(subject, trial: int, processing_pass: int = -1) -> TrialArrays:
+    """
+    Read one trial as contiguous arrays. `processing_pass` indexes the trial's passes, and counts back from the last
+    one if it is negative. This loads all the subject's frames first, if they aren't loaded already.
+    """
+    if not subject.hasLoadedAllFrames():
+        subject.loadAllFrames()
+    return TrialArrays(subject, trial, processing_pass)
+
+
+def iter_trial_arrays(subject, processing_pass: int = -1) -> Iterator[TrialArrays]:
+    """
+    Read every trial of the subject as contiguous arrays, skipping any trials that have no processing passes. Trials
+    can have different numbers of passes, so we also skip (with a warning) any trial that doesn't have the requested
+    `processing_pass`.
+    """
+    if not subject.hasLoadedAllFrames():
+        subject.loadAllFrames()
+    for trial in range(subject.getNumTrials()):
+        num_passes = len(subject.getHeaderProto().getTrials()[trial].getPasses())
+        if num_passes == 0:
+            continue
+        if processing_pass >= num_passes or processing_pass < -num_passes:
+            print('Warning! Skipping trial ' + str(trial) + ', because it has no processing pass ' +
+                  str(processing_pass) + ' (it has ' + str(num_passes) + ')')
+            continue
+        yield TrialArrays(subject, trial, processing_pass)
+
+
+def get_dof_names(subject) -> List[str]:
+    """
+    The names of the subject's degrees of freedom, in the same order as the rows of the pose arrays.
+    """
+    skel = subject.readSkel(0, ignoreGeometry=True)
+    return [skel.getDofByIndex(i).getName() for i in range(skel.getNumDofs())]
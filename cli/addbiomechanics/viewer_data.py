@@ -0,0 +1,123 @@
+import numpy as np
+from typing import List, Dict, Optional, Sequence
+from addbiomechanics.trial_arrays import TrialArrays, read_trial_arrays
+
+
+def get_display_stride(timestep: float, display_hz: Optional[float]) -> int:
+    """
+    How many captured frames to step over for each displayed frame, so that playback runs at no more than display_hz.
+    """
+    if display_hz is None or display_hz <= 0 or timestep <= 0:
+        return 1
+    return max(1, int(round((1.0 / timestep) / display_hz)))
+
+
+class ViewerTrial:
+    """
+    Everything the interactive viewers need to play back one trial of a SubjectOnDisk, for a single processing pass,
+    read into memory up front. Playback ticks only index into these arrays, instead of going back to the file with
+    readFrames() on every frame.
+
+    The arrays all keep every captured frame, so plots are drawn at full resolution, but playback only steps through
+    `frames`. When display_hz is lower than the capture rate, that is every n-th frame, which keeps playback of high
+    rate (e.g. 1000Hz) captures in realtime without rendering frames the browser would drop anyway.
+    """
+    arrays: TrialArrays
+    # The indices of the captured frames we play back, in order, and the time between them
+    frames: np.ndarray
+    display_timestep: float
+    # These are (num_contact_bodies x 3 x num_frames), in world frame and in the root frame
+    contact_cops: np.ndarray
+    contact_torques: np.ndarray
+    contact_forces: np.ndarray
+    contact_cops_in_root_frame: np.ndarray
+    contact_forces_in_root_frame: np.ndarray
+    # This is (num_contact_bodies x num_frames), and True when the contact force is over contact_threshold
+    contact: np.ndarray
+    # These are (3 * num_joints x num_frames), (3 * history_len x num_frames) and (3 x num_frames)
+    joint_centers_in_root_frame: np.ndarray
+    root_pos_history_in_root_frame: np.ndarray
+    root_linear_acc_in_root_frame: np.ndarray
+    # These are (num_force_plates x 3 x num_frames)
+    raw_force_plate_cops: np.ndarray
+    raw_force_plate_forces: np.ndarray
+    marker_observations: List[Dict[str, np.ndarray]]
+    # These are filled in by precompute_body_transforms(), with one entry per frame in `frames`:
+    # (num_displayed_frames x num_bodies x 4 x 4), (num_displayed_frames x num_bodies x 3) and
+    # (num_displayed_frames x 3 * num_joints)
+    body_world_transforms: Optional[np.ndarray]
+    body_coms: Optional[np.ndarray]
+    joint_world_positions: Optional[np.ndarray]
+
+    def __init__(self,
+                 subject,
+                 trial: int,
+                 processing_pass: int = -1,
+                 display_hz: Optional[float] = None,
+                 frames: Optional[Sequence[int]] = None,
+                 contact_threshold: float = 20.0):
+        self.arrays = read_trial_arrays(subject, trial, processing_pass)
+        num_frames = self.arrays.num_frames
+        trial_proto = subject.getHeaderProto().getTrials()[trial]
+        trial_pass = trial_proto.getPasses()[self.arrays.processing_pass]
+
+        stride = get_display_stride(self.arrays.timestep, display_hz)
+        if frames is None or len(frames) == 0:
+            frames = range(num_frames)
+        self.frames = np.asarray(frames, dtype=np.int64)[::stride]
+        self.display_timestep = self.arrays.timestep * stride
+
+        # Each contact body has 9 rows: the CoP, then the torque, then the force
+        cop_torque_force = self.arrays.ground_body_cop_torque_force.reshape(-1, 3, 3, num_frames)
+        self.contact_cops = cop_torque_force[:, 0]
+        self.contact_torques = cop_torque_force[:, 1]
+        self.contact_forces = cop_torque_force[:, 2]
+        self.contact = np.linalg.norm(self.contact_forces, axis=1) > contact_threshold
+        cop_torque_force_in_root = np.asarray(trial_pass.getGroundBodyCopTorqueForceInRootFrame()).reshape(
+            -1, 3, 3, num_frames)
+        self.contact_cops_in_root_frame = cop_torque_force_in_root[:, 0]
+        self.contact_forces_in_root_frame = cop_torque_force_in_root[:, 2]
+
+        self.joint_centers_in_root_frame = np.asarray(trial_pass.getJointCentersInRootFrame())
+        self.root_pos_history_in_root_frame = np.asarray(trial_pass.getRootPosHistoryInRootFrame())
+        # The spatial acceleration is angular, then linear
+        self.root_linear_acc_in_root_frame = np.asarray(trial_pass.getRootSpatialAccInRootFrame())[3:6]
+
+        force_plates = trial_proto.getForcePlates()
+        self.raw_force_plate_cops = np.zeros((len(force_plates), 3, num_frames))
+        self.raw_force_plate_forces = np.zeros((len(force_plates), 3, num_frames))
+        for i, force_plate in enumerate(force_plates):
+            if len(force_plate.forces) == num_frames:
+                self.raw_force_plate_cops[i] = np.array(force_plate.centersOfPressure).T
+                self.raw_force_plate_forces[i] = np.array(force_plate.forces).T
+        self.marker_observations = trial_proto.getMarkerObservations()
+
+        self.body_world_transforms = None
+        self.body_coms = None
+        self.joint_world_positions = None
+
+    @property
+    def num_frames(self) -> int:
+        return self.arrays.num_frames
+
+    @property
+    def num_displayed_frames(self) -> int:
+        return len(self.frames)
+
+    def precompute_body_transforms(self, skel):
+        """
+        Run forward kinematics once for every displayed frame, and keep the world transform and COM of every body, and
+        the world position of every joint. This leaves the skeleton at the pose of the last displayed frame.
+        """
+        num_bodies = skel.getNumBodyNodes()
+        joints = [skel.getJoint(j) for j in range(skel.getNumJoints())]
+        self.body_world_transforms = np.zeros((len(self.frames), num_bodies, 4, 4))
+        self.body_coms = np.zeros((len(self.frames), num_bodies, 3))
+        self.joint_world_positions = np.zeros((len(self.frames), 3 * len(joints)))
+        bodies = [skel.getBodyNode(b) for b in range(num_bodies)]
+        for i, frame in enumerate(self.frames):
+            skel.setPositions(self.arrays.poses[:, frame])
+            for b, body in enumerate(bodies):
+                self.body_world_transforms[i, b] = body.getWorldTransform().matrix()
+                self.body_coms[i, b] = body.getCOM()
+            self.joint_world_positions[i] = skel.getJointWorldPositions(joints)
@@ -106,10 +106,14 @@ class LiveDirectoryImpl extends LiveDirectory {
         const updateTopic = "/" + this.pubsub.deployment + "/UPDATE/#";
         this.pubsub.subscribe(updateTopic, ({topic, message}) => {
             const msg: any = JSON.parse(message);
-            this._onReceivedPubSubUpdate({
-                key: msg.key, 
-                lastModified: new Date(msg.lastModified),
-                size: msg.size
+            // Bulk uploads send one message per folder, with every file that changed listed under "files"
+            const files: any[] = msg.files != null ? msg.files : [msg];
+            files.forEach((file) => {
+                this._onReceivedPubSubUpdate({
+                    key: file.key,
+                    lastModified: new Date(file.lastModified),
+                    size: file.size
+                });
             });
         });
 
@@ -0,0 +1,52 @@
+import { parseSegmentData, parseSegmentCSV, segmentDataToCSV, SegmentDataHeader } from "./SegmentData";
+
+describe("SegmentData", () => {
+    const header: SegmentDataHeader = {
+        version: 1,
+        dtype: 'float32',
+        layout: 'columns',
+        numFrames: 3,
+        timestep: 0.01,
+        startTime: 1.5,
+        columns: ['hip_flexion_r_pos', 'hip_flexion_r_tau', 'missing_grf_data']
+    };
+
+    function writeColumns(columns: number[][]): ArrayBuffer {
+        const buffer = new ArrayBuffer(4 * columns.length * columns[0].length);
+        const view = new DataView(buffer);
+        columns.forEach((column, c) => {
+            column.forEach((value, t) => {
+                view.setFloat32(4 * (c * column.length + t), value, true);
+            });
+        });
+        return buffer;
+    }
+
+    test("Parse binary columns", () => {
+        const dataset = parseSegmentData(header, writeColumns([[0.5, 0.25, -1.0], [10, 20, 30], [0, 1, 0]]));
+        expect(dataset.length).toBe(3);
+        expect(Array.from(dataset[0].keys())).toEqual(['timestamp', 'hip_flexion_r_pos', 'hip_flexion_r_tau', 'missing_grf_data']);
+        expect(dataset.map((row) => row.get('timestamp'))).toEqual([1.5, 1.51, 1.52]);
+        expect(dataset.map((row) => row.get('hip_flexion_r_pos'))).toEqual([0.5, 0.25, -1.0]);
+        expect(dataset.map((row) => row.get('hip_flexion_r_tau'))).toEqual([10, 20, 30]);
+        expect(dataset.map((row) => row.get('missing_grf_data'))).toEqual([false, true, false]);
+    });
+
+    test("Reject binary data that doesn't match its header", () => {
+        expect(() => parseSegmentData(header, writeColumns([[0.5, 0.25, -1.0], [10, 20, 30]]))).toThrow();
+        expect(() => parseSegmentData({ ...header, version: 2 }, writeColumns([[0, 0, 0], [0, 0, 0], [0, 0, 0]]))).toThrow();
+    });
+
+    test("Binary and CSV data read the same", () => {
+        const dataset = parseSegmentData(header, writeColumns([[0.5, 0.25, -1.0], [10, 20, 30], [0, 1, 0]]));
+        expect(parseSegmentCSV(segmentDataToCSV(dataset))).toEqual(dataset);
+    });
+
+    test("Parse CSV", () => {
+        const dataset = parseSegmentCSV("timestamp,knee_angle_r_pos,missing_grf_data\n0.0,0.1,False\n0.01,0.2,True\n");
+        expect(dataset.length).toBe(2);
+        expect(dataset[1].get('timestamp')).toBe(0.01);
+        expect(dataset[1].get('knee_angle_r_pos')).toBe(0.2);
+        expect(dataset.map((row) => row.get('missing_grf_data'))).toEqual([false, true]);
+    });
+});
@@ -0,0 +1,99 @@
+/**
+ * The per-frame quantities we plot for a trial segment. Each row maps column names (including "timestamp" and
+ * "missing_grf_data") to their values on one frame.
+ */
+type SegmentDataRow = Map<string, number | boolean>;
+
+/**
+ * The contents of a segment's data_header.json, which describes the data.bin file next to it.
+ */
+type SegmentDataHeader = {
+    version: number;
+    dtype: string;
+    layout: string;
+    numFrames: number;
+    timestep: number;
+    startTime: number;
+    columns: string[];
+};
+
+/**
+ * This reads the data.bin file the server writes for each segment, which is every column (in the order of the header)
+ * stored one after another as little-endian float32 values. The timestamps aren't stored, because they're just
+ * `startTime + t * timestep`.
+ */
+function parseSegmentData(header: SegmentDataHeader, buffer: ArrayBuffer): SegmentDataRow[] {
+    if (header.version !== 1 || header.dtype !== 'float32' || header.layout !== 'columns') {
+        throw new Error("Unsupported segment data format: version " + header.version + ", " + header.dtype + ", " + header.layout);
+    }
+    const numFrames = header.numFrames;
+    if (buffer.byteLength !== 4 * numFrames * header.columns.length) {
+        throw new Error("Segment data has " + buffer.byteLength + " bytes, but the header describes " + header.columns.length + " columns of " + numFrames + " frames");
+    }
+    const view = new DataView(buffer);
+    let dataset: SegmentDataRow[] = [];
+    for (let t = 0; t < numFrames; t++) {
+        let row: SegmentDataRow = new Map();
+        row.set('timestamp', Math.round((header.startTime + t * header.timestep) * 1000) / 1000);
+        dataset.push(row);
+    }
+    header.columns.forEach((column, c) => {
+        for (let t = 0; t < numFrames; t++) {
+            const value = view.getFloat32(4 * (c * numFrames + t), true);
+            dataset[t].set(column, column === 'missing_grf_data' ? value > 0 : value);
+        }
+    });
+    return dataset;
+}
+
+/**
+ * This reads the data.csv file that older results have instead of data.bin.
+ */
+function parseSegmentCSV(text: string): SegmentDataRow[] {
+    const lines = text.split('\n');
+    let headers = lines[0].split(',');
+    let dataset: SegmentDataRow[] = [];
+    for (let i = 1; i < lines.length; i++) {
+        if (lines[i].trim().length === 0) continue;
+        let values = lines[i].split(',');
+        let valuesMap: SegmentDataRow = new Map();
+        for (let j = 0; j < values.length; j++) {
+            if (values[j].toLocaleLowerCase().trim() === 'true') {
+                valuesMap.set(headers[j], true);
+            }
+            else if (values[j].toLocaleLowerCase().trim() === 'false') {
+                valuesMap.set(headers[j], false);
+            }
+            else {
+                let asNumber = Number.parseFloat(values[j]);
+                if (Number.isNaN(asNumber)) {
+                    console.warn("Got a non-number type in the trial plot CSV: " + headers[j]);
+                    // TODO: handle other datatypes?
+                    valuesMap.set(headers[j], 0.0);
+                }
+                else {
+                    valuesMap.set(headers[j], asNumber);
+                }
+            }
+        }
+        dataset.push(valuesMap);
+    }
+    return dataset;
+}
+
+/**
+ * This formats the rows as a CSV file, with the same columns as data.csv, so people can still download the raw data
+ * as a CSV when we only store data.bin.
+ */
+function segmentDataToCSV(dataset: SegmentDataRow[]): string {
+    if (dataset.length === 0) return '';
+    const headers = Array.from(dataset[0].keys());
+    let lines: string[] = [headers.join(',')];
+    dataset.forEach((row) => {
+        lines.push(headers.map((header) => String(row.get(header))).join(','));
+    });
+    return lines.join('\n') + '\n';
+}
+
+export type { SegmentDataRow, SegmentDataHeader };
+export { parseSegmentData, parseSegmentCSV, segmentDataToCSV };
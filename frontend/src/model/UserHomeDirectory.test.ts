@@ -174,6 +174,8 @@ describe("UserHomeDirectory", () => {
         expect(api.getPathType('/ASB2023/TestProsthetic/trials/walking/segment_1')).toBe('trial_segment');
         expect(api.getTrialSegmentContents('/ASB2023/TestProsthetic/trials/walking/segment_1').name).toBe("segment_1");
         expect(api.getTrialSegmentContents('/ASB2023/TestProsthetic/trials/walking/segment_1').dataPath).toBe("ASB2023/TestProsthetic/trials/walking/segment_1/data.csv");
+        expect(api.getTrialSegmentContents('/ASB2023/TestProsthetic/trials/walking/segment_1').dataBinPath).toBe("ASB2023/TestProsthetic/trials/walking/segment_1/data.bin");
+        expect(api.getTrialSegmentContents('/ASB2023/TestProsthetic/trials/walking/segment_1').dataHeaderPath).toBe("ASB2023/TestProsthetic/trials/walking/segment_1/data_header.json");
     });
 
     test("Upload folder creates a folder", async () => {
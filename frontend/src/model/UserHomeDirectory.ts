@@ -55,7 +55,11 @@ type TrialSegmentContents = {
     name: string;
     resultsJsonPath: string;
     previewPath: string;
+    // The plotting data, as a CSV file (which is all that older results have)
     dataPath: string;
+    // The plotting data, as float32 columns described by a JSON header
+    dataBinPath: string;
+    dataHeaderPath: string;
     // The path to the review flag file
     reviewFlagPath: string;
     reviewFlagExists: boolean;
@@ -632,6 +636,8 @@ class UserHomeDirectory {
         const resultsJsonPath = path + '/_results.json';
         const previewPath = path + '/preview.bin';
         const dataPath = path + '/data.csv';
+        const dataBinPath = path + '/data.bin';
+        const dataHeaderPath = path + '/data_header.json';
 
         const reviewFlagPath = path + '/REVIEWED';
         const reviewJsonPath = path + '/review.json';
@@ -649,6 +655,8 @@ class UserHomeDirectory {
             resultsJsonPath,
             previewPath,
             dataPath,
+            dataBinPath,
+            dataHeaderPath,
             reviewFlagPath,
             reviewFlagExists: segment?.files.map((file) => {
                 return file.key;
@@ -21,6 +21,7 @@ import UserHomeDirectory, { FolderReviewStatus, TrialSegmentContents } from "../
 import Session from "../../model/Session";
 import LiveJsonFile from "../../model/LiveJsonFile";
 import LiveFile from "../../model/LiveFile";
+import { SegmentDataRow, SegmentDataHeader, parseSegmentData, parseSegmentCSV, segmentDataToCSV } from "../../model/SegmentData";
 
 type ProcessingResultsJSON = {
     autoAvgMax: number;
@@ -163,46 +164,35 @@ const TrialSegmentView = observer((props: TrialSegmentViewProps) => {
             }
         }).catch(() => { });
 
-        // Load the results CSV, for plotting quantities
-        dir.downloadText(segmentContents.dataPath).then((text: string) => {
-            const lines = text.split('\n');
-            let headers = lines[0].split(',');
-            let dataset: Map<string, number | boolean>[] = [];
+        // Load the data for plotting quantities. Newer results store it as binary columns described by a JSON
+        // header, and older results only have a CSV file.
+        const setPlotData = (dataset: SegmentDataRow[]) => {
             let csvMissingGrfArray: boolean[] = [];
-            for (let i = 1; i < lines.length; i++) {
-                let values = lines[i].split(',');
-                let valuesMap: Map<string, number | boolean> = new Map();
-                for (let j = 0; j < values.length; j++) {
-                    if (values[j].toLocaleLowerCase().trim() === 'true') {
-                        valuesMap.set(headers[j], true);
-                    }
-                    else if (values[j].toLocaleLowerCase().trim() === 'false') {
-                        valuesMap.set(headers[j], false);
-                    }
-                    else {
-                        let asNumber = Number.parseFloat(values[j]);
-                        if (Number.isNaN(asNumber)) {
-                            console.warn("Got a non-number type in the trial plot CSV: " + headers[j]);
-                            // TODO: handle other datatypes?
-                            valuesMap.set(headers[j], 0.0);
-                        }
-                        else {
-                            valuesMap.set(headers[j], asNumber);
-                        }
-                    }
-                    if (headers[j] === 'missing_grf_data') {
-                        csvMissingGrfArray.push(valuesMap.get(headers[j]) as boolean);
-                    }
-                }
-                dataset.push(valuesMap);
+            if (dataset.length > 0 && dataset[0].has('missing_grf_data')) {
+                csvMissingGrfArray = dataset.map((row) => row.get('missing_grf_data') as boolean);
             }
-
-            if (csvMissingGrfArray.length === 0) {
+            else {
                 csvMissingGrfArray = new Array(dataset.length).fill(true);
             }
-
             setCsvMissingGrfArray(csvMissingGrfArray);
             setPlotCSV(dataset);
+        };
+        dir.downloadText(segmentContents.dataHeaderPath).then((text: string) => {
+            const header: SegmentDataHeader = JSON.parse(text);
+            return dir.getSignedURL(segmentContents.dataBinPath, 3600).then((url: string) => {
+                return fetch(url);
+            }).then((response: Response) => {
+                if (!response.ok) {
+                    throw new Error("Unable to download " + segmentContents.dataBinPath + ": " + response.status);
+                }
+                return response.arrayBuffer();
+            }).then((buffer: ArrayBuffer) => {
+                setPlotData(parseSegmentData(header, buffer));
+            });
+        }).catch(() => {
+            return dir.downloadText(segmentContents.dataPath).then((text: string) => {
+                setPlotData(parseSegmentCSV(text));
+            });
         }).catch((e) => { });
     }, [path]);
 
@@ -540,10 +530,23 @@ const TrialSegmentView = observer((props: TrialSegmentViewProps) => {
             labels, datasets
         };
 
+        // We don't always store a CSV file on the server any more, so we build it from the data we've already loaded
+        const downloadPlotCSV = () => {
+            const blob = new Blob([segmentDataToCSV(plotCSV)], { type: 'text/csv' });
+            const url = URL.createObjectURL(blob);
+            const link = document.createElement('a');
+            link.href = url;
+            link.setAttribute('download', 'data.csv');
+            document.body.appendChild(link);
+            link.click();
+            link.remove();
+            URL.revokeObjectURL(url);
+        };
+
         let downloadButton = null;
         if (dir != null) {
             downloadButton = (
-                <Button onClick={() => dir.downloadFile(segmentContents.dataPath)}>
+                <Button onClick={() => downloadPlotCSV()}>
                     <i className="mdi mdi-download me-2 vertical-middle"></i>
                     Download Raw Data CSV
                 </Button>
@@ -1433,12 +1433,16 @@ class ReactiveIndex {
 
         this.socket.subscribe("/UPDATE/" + this.globalPrefix + "#", (topic: string, message: string) => {
             const msg: any = JSON.parse(message);
-            const globalKey: string = msg.key;
-            const key: string = globalKey.substring(this.globalPrefix.length);
-            const lastModified: Date = new Date(msg.lastModified);
-            const size: number = msg.size;
-            this._onReceivedPubSubUpdate({
-                key, lastModified, size
+            // Bulk uploads send one message per folder, with every file that changed listed under "files"
+            const files: any[] = msg.files != null ? msg.files : [msg];
+            files.forEach((file) => {
+                const globalKey: string = file.key;
+                const key: string = globalKey.substring(this.globalPrefix.length);
+                const lastModified: Date = new Date(file.lastModified);
+                const size: number = file.size;
+                this._onReceivedPubSubUpdate({
+                    key, lastModified, size
+                });
             });
         });
 
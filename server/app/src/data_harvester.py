@@ -1,24 +1,37 @@
 import argparse
 import os
+import sys
 from reactive_s3 import ReactiveS3Index, FileMetadata
-from typing import Dict, List
+from motion_file_headers import MotionFileHeader, read_header, HEADER_BYTES
+from typing import Dict, List, Deque, Optional, Any
 import time
 import nimblephysics as nimble
 from nimblephysics import absPath
 import json
 import shutil
+import tempfile
 import hashlib
 import multiprocessing
 import time
 import traceback
+import collections
 
 # ===================== CONSTANTS =====================
 GEOMETRY_FOLDER_PATH = absPath('../../data/Geometry')
 DATA_FOLDER_PATH = absPath('../../data')
 MIN_TRIAL_LENGTH = 15  # trials with timesteps shorter than this will be removed
+TRANSLATION_CACHE_PATH = os.path.join(tempfile.gettempdir(), 'addb_marker_translation_cache')
 # =====================================================
 
 
+def is_input_file(path: str) -> bool:
+    """
+    These are the files a user uploads for a subject, as opposed to the results of processing it.
+    """
+    return path.endswith('.osim') or path.endswith('.trc') or path.endswith('.mot') or path.endswith('.c3d') or \
+        path.endswith('_subject.json')
+
+
 class StandardizedDataset:
     """
     This class represents a dataset that has been standardized to a common skeleton, and exists on S3.
@@ -112,7 +125,8 @@ class SubjectSnapshot:
         # If we make it through all these checks
         return True
 
-    def copy_snapshots(self, datasets: List[StandardizedDataset]):
+    def copy_snapshots(self, datasets: List[StandardizedDataset],
+                       translation_cache: Optional['MarkerTranslationCache'] = None):
         """
         This function downloads the subject data, translates it to the standard skeleton, and re-uploads it to S3
         """
@@ -122,19 +136,14 @@ class SubjectSnapshot:
         if len(datasets) == 0:
             return
 
-        # Download the dataset locally
-        tmp_folder: str = self.index.download_to_tmp(self.path)
+        # Only download the files we're going to change. Everything else gets copied over on the S3 side.
+        tmp_folder: str = tempfile.mkdtemp() + '/'
+        for file in ['_subject.json', 'unscaled_generic.osim']:
+            if self.index.exists(self.path + file):
+                self.index.download(self.path + file, tmp_folder + file)
 
         # Identify trials that are too short. We don't want to process these
-        trial_paths_to_remove: List[str] = self.id_short_trials(tmp_folder)
-
-        # Remove those trials from tmp folder
-        for trial in trial_paths_to_remove:
-            trial_folder = os.path.dirname(trial)
-            try:
-                shutil.rmtree(trial_folder)
-            except OSError as e:
-                print(f"Error: {e}")
+        short_trials: List[str] = self.id_short_trials_from_headers()
 
         # Prepare the original skeleton model for translation step
         self.prep_unscaled_skeleton(tmp_folder)
@@ -149,28 +158,52 @@ class SubjectSnapshot:
             self.index.download(dataset.osim_model_path,
                                 tmp_folder + 'target_skeleton.osim')
 
-            # Check if the original model is compatible with the target model
-            target_model = nimble.biomechanics.OpenSimParser.parseOsim(
-                tmp_folder + 'target_skeleton.osim')
-            if nimble.biomechanics.OpenSimParser.hasArms(target_model.skeleton):
-                source_model = nimble.biomechanics.OpenSimParser.parseOsim(
-                    tmp_folder + 'original_model.osim')
-                if not nimble.biomechanics.OpenSimParser.hasArms(source_model.skeleton):
-                    print('Detected that the target skeleton has arms, but the original skeleton does not. This is not'
-                          ' supported, because we will not have any marker data to move the arms during simulation.')
-                    self.index.uploadText(self.get_target_path(
-                        dataset) + '/INCOMPATIBLE', '')
-                    continue
+            # Preset skeletons translate to each target the same way every time, so check if we've done this before
+            source_model_path = tmp_folder + 'original_model.osim'
+            target_model_path = tmp_folder + 'target_skeleton.osim'
+            translated_model_path = tmp_folder + 'unscaled_generic.osim'
+            translation: Optional[Dict[str, Any]] = None
+            if translation_cache is not None:
+                translation = translation_cache.load(source_model_path, target_model_path, translated_model_path)
+                if translation is not None:
+                    print('Using cached marker translation to target skeleton at ' + dataset.osim_model_path)
+
+            if translation is None:
+                # Check if the original model is compatible with the target model
+                incompatible = False
+                target_model = nimble.biomechanics.OpenSimParser.parseOsim(target_model_path)
+                if nimble.biomechanics.OpenSimParser.hasArms(target_model.skeleton):
+                    source_model = nimble.biomechanics.OpenSimParser.parseOsim(source_model_path)
+                    if not nimble.biomechanics.OpenSimParser.hasArms(source_model.skeleton):
+                        incompatible = True
+                translation = {'incompatible': incompatible}
+                if incompatible and translation_cache is not None:
+                    translation_cache.store(source_model_path, target_model_path, None, translation)
+            if translation['incompatible']:
+                print('Detected that the target skeleton has arms, but the original skeleton does not. This is not'
+                      ' supported, because we will not have any marker data to move the arms during simulation.')
+                self.index.uploadText(self.get_target_path(
+                    dataset) + '/INCOMPATIBLE', '')
+                continue
 
-            # 1.2. Translate the skeleton
-            print('Translating markers to target skeleton at ' +
-                  dataset.osim_model_path)
             try:
-                markers_guessed, markers_missing = nimble.biomechanics.OpenSimParser.translateOsimMarkers(
-                    tmp_folder + 'original_model.osim',
-                    tmp_folder + 'target_skeleton.osim',
-                    tmp_folder + 'unscaled_generic.osim',
-                    verbose=True)
+                if 'markersGuessed' not in translation:
+                    # 1.2. Translate the skeleton
+                    print('Translating markers to target skeleton at ' +
+                          dataset.osim_model_path)
+                    markers_guessed, markers_missing = nimble.biomechanics.OpenSimParser.translateOsimMarkers(
+                        source_model_path,
+                        target_model_path,
+                        translated_model_path,
+                        verbose=True)
+                    translation = {'incompatible': False,
+                                   'markersGuessed': markers_guessed,
+                                   'markersMissing': markers_missing}
+                    if translation_cache is not None:
+                        translation_cache.store(source_model_path, target_model_path, translated_model_path,
+                                                translation)
+                markers_guessed = translation['markersGuessed']
+                markers_missing = translation['markersMissing']
                 print('Markers guessed: ' + str(markers_guessed))
                 print('Markers missing: ' + str(markers_missing))
                 target_path = self.get_target_path(dataset)
@@ -188,17 +221,29 @@ class SubjectSnapshot:
                 self.index.uploadText(
                     target_path + '/_translation.json', json.dumps(translation_data))
 
-                # 2.2. Upload every file in the tmpFolder (excluding filtered out trials)
+                # 2.2. Upload every file in the tmpFolder, which are the ones we changed
+                uploaded: List[str] = []
                 for root, dirs, files in os.walk(tmp_folder):
                     for file in files:
-                        if file.endswith('.osim') or file.endswith('.trc') or file.endswith('.mot') or file.endswith(
-                                '.c3d') or file.endswith('_subject.json'):
+                        if is_input_file(file):
                             relative_path = os.path.relpath(root, tmp_folder)
                             full_path = file if relative_path == '.' else os.path.join(
                                 relative_path, file)
                             print('Uploading ' + full_path)
                             self.index.uploadFile(
                                 target_path + '/'+full_path, os.path.join(root, file))
+                            uploaded.append(full_path)
+
+                # 2.3. Copy over the rest of the input files unchanged (excluding filtered out trials), and let
+                # everyone know about them all at once
+                copied: List[Dict[str, Any]] = []
+                for child in self.index.getChildren(self.path):
+                    if not is_input_file(child) or child in uploaded:
+                        continue
+                    if any(child.startswith('trials/' + trial + '/') for trial in short_trials):
+                        continue
+                    copied.append(self.index.copyFile(self.path + child, target_path + '/' + child))
+                self.index.publishFolderUpdate(target_path + '/', copied)
 
                 # Mark the subject as ready to process
                 self.index.uploadText(target_path + '/READY_TO_PROCESS', '')
@@ -214,6 +259,34 @@ class SubjectSnapshot:
         # Delete the tmp folder
         os.system('rm -rf ' + tmp_folder)
 
+    def id_short_trials_from_headers(self) -> List[str]:
+        """
+        Find the names of the trials that are too short to process. We only read the header of each markers file to
+        get its length, unless the header can't be read or says the trial is anywhere near too short, in which case we
+        download it and load it in full to make sure.
+        """
+        short_trials: List[str] = []
+        for child, metadata in self.index.getChildren(self.path + 'trials/').items():
+            parts = child.split('/')
+            if len(parts) != 2 or not (parts[1].endswith('.trc') or parts[1].endswith('.c3d')):
+                continue
+            key = self.path + 'trials/' + child
+            header: Optional[MotionFileHeader] = read_header(key, self.index.downloadBytes(key, HEADER_BYTES),
+                                                             metadata.size)
+            # The length we get from the header is only an estimate, so we leave a wide margin before trusting it
+            if header is not None and header.num_frames is not None and header.num_frames >= 2 * MIN_TRIAL_LENGTH:
+                continue
+            tmp_folder: str = tempfile.mkdtemp() + '/'
+            try:
+                os.makedirs(tmp_folder + 'trials/' + parts[0])
+                self.index.download(key, tmp_folder + 'trials/' + child)
+                if len(self.id_short_trials(tmp_folder)) > 0:
+                    print('Skipping trial ' + parts[0] + ', because it is too short to process')
+                    short_trials.append(parts[0])
+            finally:
+                shutil.rmtree(tmp_folder, ignore_errors=True)
+        return short_trials
+
     @staticmethod
     def id_short_trials(tmp_folder: str) -> List[str]:
         # Collect markers files corresponding to trials that are too short
@@ -279,6 +352,112 @@ class SubjectSnapshot:
         print('Finished marking datasets as incompatible')
 
 
+class MarkerTranslationCache:
+    """
+    Translating a markerset onto a target skeleton gives the same answer every time for the same pair of models, and
+    most subjects use one of a handful of preset skeletons. So we keep the results on local disk, in a folder named by
+    the hashes of the contents of the source and target models, which the worker processes all share.
+    """
+    folder: str
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+
+    @staticmethod
+    def file_hash(path: str) -> str:
+        hash_object = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                hash_object.update(chunk)
+        return hash_object.hexdigest()
+
+    def get_entry_path(self, source_model_path: str, target_model_path: str) -> str:
+        return os.path.join(self.folder, self.file_hash(source_model_path) + '_' + self.file_hash(target_model_path))
+
+    def load(self, source_model_path: str, target_model_path: str, translated_model_path: str) -> Optional[Dict[str, Any]]:
+        """
+        If we've translated these models before, this copies the translated model to translated_model_path, and
+        returns what we recorded about the translation. Otherwise this returns None.
+        """
+        entry_path = self.get_entry_path(source_model_path, target_model_path)
+        try:
+            with open(os.path.join(entry_path, 'translation.json')) as f:
+                translation: Dict[str, Any] = json.load(f)
+            if not translation['incompatible']:
+                shutil.copy(os.path.join(entry_path, 'unscaled_generic.osim'), translated_model_path)
+            return translation
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def store(self,
+              source_model_path: str,
+              target_model_path: str,
+              translated_model_path: Optional[str],
+              translation: Dict[str, Any]):
+        """
+        Save the result of a translation. The entry is written to a temporary folder, and then renamed into place, so
+        other workers never see a half-written one.
+        """
+        entry_path = self.get_entry_path(source_model_path, target_model_path)
+        if os.path.exists(entry_path):
+            return
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            tmp_path = tempfile.mkdtemp(dir=self.folder)
+            if translated_model_path is not None:
+                shutil.copy(translated_model_path, os.path.join(tmp_path, 'unscaled_generic.osim'))
+            with open(os.path.join(tmp_path, 'translation.json'), 'w') as f:
+                json.dump(translation, f)
+            try:
+                os.rename(tmp_path, entry_path)
+            except OSError:
+                # Another worker got there first, with the same result
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        except OSError as e:
+            print('Failed to cache the marker translation: ' + str(e))
+
+
+class SnapshotWorker:
+    """
+    A process that is copying one subject's snapshots, and when it started.
+    """
+    snapshot: SubjectSnapshot
+    process: multiprocessing.Process
+    start_time: float
+
+    def __init__(self, snapshot: SubjectSnapshot, process: multiprocessing.Process) -> None:
+        self.snapshot = snapshot
+        self.process = process
+        self.start_time = time.time()
+
+
+class ThroughputMeter:
+    """
+    Counts how many snapshots have been copied over a sliding window, so we can see how fast a backfill is going.
+    """
+    window_s: float
+    start_time: float
+    completion_times: Deque[float]
+
+    def __init__(self, window_s: float = 60 * 60) -> None:
+        self.window_s = window_s
+        self.start_time = time.time()
+        self.completion_times = collections.deque()
+
+    def record(self, now: Optional[float] = None):
+        self.completion_times.append(time.time() if now is None else now)
+
+    def per_hour(self, now: Optional[float] = None) -> float:
+        now = time.time() if now is None else now
+        while len(self.completion_times) > 0 and self.completion_times[0] < now - self.window_s:
+            self.completion_times.popleft()
+        # Until we've been running for a whole window, only average over the time we have been running
+        elapsed = min(self.window_s, now - self.start_time)
+        if elapsed <= 0:
+            return 0.0
+        return len(self.completion_times) * 3600.0 / elapsed
+
+
 class DataHarvester:
     """
     Raw data uploaded to AddBiomechanics has several problems:
@@ -295,12 +474,34 @@ class DataHarvester:
     index: ReactiveS3Index
     queue: List[SubjectSnapshot]
     datasets: List[StandardizedDataset]
-
-    def __init__(self, bucket: str, deployment: str, disable_pubsub: bool) -> None:
+    num_workers: int
+    worker_timeout: float
+    max_attempts: int
+    workers: Dict[str, 'SnapshotWorker']
+    failures: Dict[str, int]
+    throughput: 'ThroughputMeter'
+    translation_cache: Optional[MarkerTranslationCache]
+
+    def __init__(self,
+                 bucket: str,
+                 deployment: str,
+                 disable_pubsub: bool,
+                 num_workers: int = 4,
+                 worker_timeout: float = 60 * 60,
+                 max_attempts: int = 3,
+                 translation_cache_path: Optional[str] = TRANSLATION_CACHE_PATH) -> None:
         self.bucket = bucket
         self.deployment = deployment
         self.queue = []
         self.datasets = []
+        self.num_workers = max(1, num_workers)
+        self.worker_timeout = worker_timeout
+        self.max_attempts = max(1, max_attempts)
+        self.workers = {}
+        self.failures = {}
+        self.throughput = ThroughputMeter()
+        self.translation_cache = MarkerTranslationCache(translation_cache_path) \
+            if translation_cache_path is not None else None
         self.index = ReactiveS3Index(bucket, deployment, disable_pubsub)
         self.index.refreshIndex()
         if not disable_pubsub:
@@ -339,7 +540,7 @@ class DataHarvester:
         print('Updating datasets to have ' + str(len(new_datasets)) + ' items')
         self.datasets = new_datasets
         new_queue = [entry for entry in new_queue if len(
-            entry.has_snapshots_to_copy(self.datasets)) > 0]
+            entry.has_snapshots_to_copy(self.datasets)) > 0 and entry.path not in self.workers]
         print('Updating queue to have ' + str(len(new_queue)) + ' items')
         self.queue = new_queue
 
@@ -348,13 +549,13 @@ class DataHarvester:
 
     def process_queue_forever(self):
         """
-        This busy-waits on the queue updating, and will process the head of the queue one at a time when it
-        becomes available.
+        This busy-waits on the queue updating, and keeps up to `num_workers` snapshots from the head of the queue
+        being copied at once, each in its own process.
 
-        While processing, this blocks, so even though the queue is updating in the background, that shouldn't change
-        the outcome of this process.
+        While the workers run, the queue keeps updating in the background. Snapshots that are already being copied
+        are skipped when we pick the next one to start, so each snapshot only has one worker at a time.
         """
-        print('Starting processing queue.')
+        print('Starting processing queue with ' + str(self.num_workers) + ' workers.')
         print('Computing inital queue...')
         start_time = time.time()
         self.recompute_queue()
@@ -374,55 +575,93 @@ class DataHarvester:
                     self.recompute_queue()
                     print('[PERFORMANCE] Recomputed queue in ' + str(time.time() - start_time) + ' seconds')
 
-                if len(self.queue) > 0:
-                    print('Processing queue: ' +
-                          str(len(self.queue)) + ' items remaining')
-                    # Create a new process to handle the copy_snapshots call, to shield the server from segfaults in
-                    # Nimble as it is attempting to convert whatever crazy raw OpenSim file the user has uploaded into
-                    # our standard skeletons.
-                    p = multiprocessing.Process(target=self.copy_snashots_other_process_entry_point, args=(self.queue[0],))
-                    p.start()  # Start the process
-                    p.join()  # Wait for the process to complete
-                    # Check the process exit code (0 means success)
-                    if p.exitcode == 0:
-                        print('Snapshot copied successfully.')
-                    else:
-                        print('Error in copying snapshots. Exit code:', p.exitcode)
-                        # We will mark this dataset as incompatible, because we can't process it. This will prevent
-                        # us from trying to process it again in the future.
-                        try:
-                            self.queue[0].mark_incompatible(self.datasets)
-                        except Exception as e2:
-                            print('Got an exception when trying to mark dataset as incompatible ' +
-                                  self.queue[0].path)
-                            print('Caught exception in mark_incompatible(): '+str(e2))
-                            traceback.print_exc()  # Print the traceback
-                            print('We will now quit, because it is pointless to keep looping on this dataset')
-                            break
-
-                    self.queue.pop(0)  # Remove the processed item from the queue
-
+                if not self.reap_workers():
+                    print('We will now quit, because it is pointless to keep looping on this dataset')
+                    self.stop_workers()
+                    break
+                self.start_workers()
             except Exception as e:
                 print('Caught overall processing loop exception: '+str(e))
                 traceback.print_exc()  # Print the traceback
             time.sleep(1)
 
+    def start_workers(self):
+        """
+        Start copying snapshots from the head of the queue, until we've got `num_workers` running.
+        """
+        while len(self.workers) < self.num_workers and len(self.queue) > 0:
+            snapshot = self.queue.pop(0)
+            if snapshot.path in self.workers:
+                continue
+            print('Processing queue: ' + str(len(self.queue) + 1) + ' items remaining, starting ' + snapshot.path)
+            # Create a new process to handle the copy_snapshots call, to shield the server from segfaults in Nimble as
+            # it is attempting to convert whatever crazy raw OpenSim file the user has uploaded into our standard
+            # skeletons.
+            p = multiprocessing.Process(target=self.copy_snashots_other_process_entry_point, args=(snapshot,))
+            p.start()
+            self.workers[snapshot.path] = SnapshotWorker(snapshot, p)
+
+    def reap_workers(self) -> bool:
+        """
+        Collect the workers that have finished, or run out of time. A snapshot that fails gets put back on the end of
+        the queue to try again, and we only mark it as incompatible once it has failed `max_attempts` times in a row.
+
+        Returns False if we couldn't even mark a snapshot as incompatible, in which case we should stop.
+        """
+        for path in list(self.workers.keys()):
+            worker = self.workers[path]
+            if worker.process.is_alive():
+                if time.time() - worker.start_time < self.worker_timeout:
+                    continue
+                print('Copying snapshots of ' + path + ' timed out after ' + str(self.worker_timeout) +
+                      ' seconds, terminating the worker')
+                worker.process.terminate()
+            worker.process.join()
+            del self.workers[path]
+            if worker.process.exitcode == 0:
+                print('Snapshot copied successfully: ' + path)
+                self.failures.pop(path, None)
+                self.throughput.record()
+            else:
+                self.failures[path] = self.failures.get(path, 0) + 1
+                print('Error in copying snapshots of ' + path + '. Exit code: ' + str(worker.process.exitcode) +
+                      ' (attempt ' + str(self.failures[path]) + '/' + str(self.max_attempts) + ')')
+                if self.failures[path] < self.max_attempts:
+                    self.queue.append(worker.snapshot)
+                else:
+                    # We will mark this dataset as incompatible, because we can't process it. This will prevent us
+                    # from trying to process it again in the future.
+                    del self.failures[path]
+                    try:
+                        worker.snapshot.mark_incompatible(self.datasets)
+                    except Exception as e2:
+                        print('Got an exception when trying to mark dataset as incompatible ' + path)
+                        print('Caught exception in mark_incompatible(): '+str(e2))
+                        traceback.print_exc()  # Print the traceback
+                        return False
+            print('[PERFORMANCE] Throughput: ' + str(round(self.throughput.per_hour(), 1)) + ' snapshots/hour, ' +
+                  str(len(self.workers)) + ' running, ' + str(len(self.queue)) + ' queued')
+        return True
+
+    def stop_workers(self):
+        for worker in self.workers.values():
+            worker.process.terminate()
+            worker.process.join()
+        self.workers = {}
+
     def copy_snashots_other_process_entry_point(self, dataset):
         """
         Method to call copy_snapshots in a separate process, so that if it segfaults, it doesn't take down the whole
-        server. The server can then mark the dataset as incompatible, and move on.
+        server. If this fails, the process exits with a non-zero code, and the server decides whether to try again or
+        mark the dataset as incompatible.
         """
         try:
-            dataset.copy_snapshots(self.datasets)
+            dataset.copy_snapshots(self.datasets, self.translation_cache)
         except Exception as e:
             print(f'Got an exception when trying to process dataset {dataset.path}')
             print(e)
-            try:
-                dataset.mark_incompatible(self.datasets)
-            except Exception as e2:
-                print(f'Got an exception when trying to mark dataset as incompatible {dataset.path}')
-                print(e2)
-                raise Exception('Critical error, terminating process')
+            traceback.print_exc()
+            sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -436,10 +675,27 @@ if __name__ == "__main__":
     parser.add_argument('--disable-pubsub', type=bool,
                         default=False,
                         help='Set this to true to disable the pubsub S3 change listener')
+    parser.add_argument('--workers', type=int,
+                        default=4,
+                        help='The number of subjects to copy snapshots of at once, each in its own process')
+    parser.add_argument('--worker-timeout', type=float,
+                        default=60 * 60,
+                        help='The number of seconds to let a worker copy a single subject, before killing it')
+    parser.add_argument('--max-attempts', type=int,
+                        default=3,
+                        help='The number of times a subject can fail to copy (crash or time out) before we mark it as '
+                             'incompatible and stop trying')
+    parser.add_argument('--translation-cache', type=str,
+                        default=TRANSLATION_CACHE_PATH,
+                        help='A folder to cache the markersets we translate onto each target skeleton in, so subjects '
+                             'with the same model (e.g. a preset skeleton) are only translated once. Pass an empty '
+                             'string to disable the cache.')
     args = parser.parse_args()
 
     # 1. Launch a harvesting server
-    server = DataHarvester(args.bucket, args.deployment, args.disable_pubsub)
+    server = DataHarvester(args.bucket, args.deployment, args.disable_pubsub, num_workers=args.workers,
+                           worker_timeout=args.worker_timeout, max_attempts=args.max_attempts,
+                           translation_cache_path=args.translation_cache if args.translation_cache != '' else None)
 
     # 2. Run forever
     server.process_queue_forever()
@@ -1,5 +1,6 @@
-from typing import Dict, List
+from typing import Dict, List, Optional
 from reactive_s3 import ReactiveS3Index, FileMetadata
+from motion_file_headers import MotionFileHeader, read_header, HEADER_BYTES
 import time
 import tempfile
 import os
@@ -21,6 +22,20 @@ def absPath(path: str):
     return absolute_path
 
 
+# Subjects with fewer marker observations (frames times markers, summed over all trials) than this fit comfortably in
+# the smaller SLURM allocation
+SMALL_SUBJECT_MARKER_OBSERVATIONS = 1_000_000
+
+
+def estimate_slurm_resources(marker_observations: int) -> Tuple[int, int]:
+    """
+    This returns the (memory in MB, number of CPUs) to ask SLURM for, to process a subject of this size.
+    """
+    if marker_observations < SMALL_SUBJECT_MARKER_OBSERVATIONS:
+        return 32000, 8
+    return 64000, 16
+
+
 class TrialToProcess:
     index: ReactiveS3Index
 
@@ -115,6 +130,28 @@ class TrialToProcess:
         else:
             return 0
 
+    def countMarkerObservations(self) -> int:
+        """
+        This reads just the header of the marker file from S3, and returns the number of frames times the number of
+        markers, which is a much better guess at how much work this trial will be than the size of the file. If we
+        can't read the header, we fall back to guessing from the size of the file.
+        """
+        for path in [self.c3dFile, self.trcFile]:
+            if not self.index.exists(path):
+                continue
+            size = self.index.getMetadata(path).size
+            try:
+                header: Optional[MotionFileHeader] = read_header(path, self.index.downloadBytes(path, HEADER_BYTES),
+                                                                 size)
+            except Exception as e:
+                print('Failed to read the header of ' + path + ': ' + str(e))
+                header = None
+            if header is not None and header.num_frames is not None and header.num_markers is not None:
+                return header.num_frames * header.num_markers
+            # Roughly 3 floats per marker observation, at 4 bytes each in a C3D and ~10 characters each in a TRC
+            return int(size / (12 if path.endswith('.c3d') else 30))
+        return 0
+
     def updateTrialSize(self, trialsFolderPath: str):
         # Set the size of the trial, in bytes.
         trialPath = trialsFolderPath + self.trialName
@@ -765,18 +802,15 @@ class MocapServer:
                             else:
                                 job_name += '_new'
 
-                            # Allocate Sherlock resources based on the total size of the subject data.
-                            subject_size = 0
+                            # Allocate Sherlock resources based on how many marker observations the subject has,
+                            # which we read from the headers of the marker files without downloading them.
+                            marker_observations = 0
                             for trial_name, trial in self.currentlyProcessing.trials.items():
-                                # Convert to MB
-                                subject_size += trial.trialSize / 1024 / 1024
-
-                            # Use 4GB of RAM per 25MB of subject data, with a minimum of 16GB and a maximum of 64GB in
-                            # 4GB increments.
-                            mem = 64000 # max(32000, min(64000, int(subject_size / 25 * 4000)))
-
-                            # Use 1 CPU per 4GB of RAM, with a minimum of 4 CPU and a maximum of 16 CPUs.
-                            cpus = 16 # max(4, min(16, int(mem / 4000)))
+                                marker_observations += trial.countMarkerObservations()
+                            mem, cpus = estimate_slurm_resources(marker_observations)
+                            print('Estimated ' + str(marker_observations) + ' marker observations for ' +
+                                  self.currentlyProcessing.subjectPath + ', requesting ' + str(mem) + 'MB of RAM and ' +
+                                  str(cpus) + ' CPUs')
 
                             sbatch_command = 'sbatch -p owners --job-name ' + job_name + f' --cpus-per-task={cpus} --mem={mem}M --output=processing-%j.out --time=8:00:00 --wrap="' + \
                                 raw_command.replace('"', '\\"')+'"'
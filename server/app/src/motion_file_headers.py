@@ -0,0 +1,351 @@
+"""
+Reads the headers of the motion capture files people upload (C3D, TRC and .mot) to find out how long they are, and what
+they contain, without reading or parsing any of the sample data. This is orders of magnitude faster than loading the
+files, and only needs the first few KB of each one, so it works on partial (ranged) downloads too.
+"""
+import os
+import struct
+from typing import Dict, List, Optional, Tuple
+
+# Enough to hold the header block and the start of the parameter section of a C3D file (which has the frame range and
+# number of markers), or the header lines of a TRC or .mot file.
+HEADER_BYTES = 4096
+C3D_BLOCK_BYTES = 512
+
+
+class MotionFileHeader:
+    """
+    What we can learn about a motion capture file from its header. Anything the header doesn't say is left as None (or
+    empty).
+    """
+    file_type: str
+    num_frames: Optional[int]
+    frame_rate: Optional[float]
+    num_markers: Optional[int]
+    marker_names: List[str]
+    num_analog_channels: Optional[int]
+    num_force_plates: Optional[int]
+    column_names: List[str]
+
+    def __init__(self, file_type: str) -> None:
+        self.file_type = file_type
+        self.num_frames = None
+        self.frame_rate = None
+        self.num_markers = None
+        self.marker_names = []
+        self.num_analog_channels = None
+        self.num_force_plates = None
+        self.column_names = []
+
+    def duration(self) -> Optional[float]:
+        if self.num_frames is None or self.frame_rate is None or self.frame_rate <= 0:
+            return None
+        return self.num_frames / self.frame_rate
+
+    def __repr__(self) -> str:
+        return '<' + self.file_type + ' header: ' + str(self.num_frames) + ' frames @ ' + str(self.frame_rate) + \
+            'Hz, ' + str(self.num_markers) + ' markers, ' + str(self.num_analog_channels) + ' analog channels, ' + \
+            str(self.num_force_plates) + ' force plates>'
+
+
+def probe_file(path: str) -> Optional[MotionFileHeader]:
+    """
+    Read the header of a local C3D, TRC or .mot file, or return None if it isn't one of those or we can't read it.
+    """
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        data = f.read(HEADER_BYTES)
+        if path.endswith('.c3d'):
+            # The parameter section can run past the first few KB if there are lots of markers, so read all of it
+            needed = get_c3d_header_length(data)
+            if needed is not None and needed > len(data):
+                data += f.read(needed - len(data))
+    return read_header(path, data, file_size)
+
+
+def read_header(path: str, data: bytes, file_size: Optional[int] = None) -> Optional[MotionFileHeader]:
+    """
+    Read the header of a file, given the first bytes of it (at least HEADER_BYTES of them, if the file is that long).
+    The extension of the path decides how to read it.
+    """
+    if path.endswith('.c3d'):
+        return read_c3d_header(data, file_size)
+    elif path.endswith('.trc'):
+        return read_trc_header(data, file_size)
+    elif path.endswith('.mot'):
+        return read_mot_header(data)
+    return None
+
+
+# ===================== C3D =====================
+
+
+def _get_c3d_byte_order(data: bytes) -> Optional[Tuple[str, int]]:
+    """
+    The processor type that wrote the file is in the header of the parameter section, and tells us the byte order of
+    everything else (and whether floats are in DEC format).
+    """
+    if len(data) < C3D_BLOCK_BYTES or data[1] != 0x50:
+        return None
+    parameter_start = (data[0] - 1) * C3D_BLOCK_BYTES
+    if parameter_start < C3D_BLOCK_BYTES or len(data) < parameter_start + 4:
+        return None
+    processor_type = data[parameter_start + 3]
+    if processor_type == 84 or processor_type == 85:
+        return '<', processor_type  # Intel or DEC
+    elif processor_type == 86:
+        return '>', processor_type  # MIPS
+    return None
+
+
+def _read_c3d_float(data: bytes, offset: int, byte_order: str, processor_type: int) -> float:
+    if processor_type == 85:
+        # DEC floats store their 16 bit halves in the opposite order to Intel, and their exponent is off by 2
+        return struct.unpack('<f', data[offset + 2:offset + 4] + data[offset:offset + 2])[0] / 4.0
+    return struct.unpack(byte_order + 'f', data[offset:offset + 4])[0]
+
+
+def get_c3d_header_length(data: bytes) -> Optional[int]:
+    """
+    The number of bytes from the start of the file to the end of the parameter section, which is everything we need
+    to read the full header.
+    """
+    if len(data) < C3D_BLOCK_BYTES or data[1] != 0x50:
+        return None
+    parameter_start = (data[0] - 1) * C3D_BLOCK_BYTES
+    if len(data) < parameter_start + 4:
+        return parameter_start + C3D_BLOCK_BYTES
+    return parameter_start + max(1, data[parameter_start + 2]) * C3D_BLOCK_BYTES
+
+
+def read_c3d_parameters(data: bytes) -> Dict[str, Tuple[int, List[int], bytes]]:
+    """
+    Read the parameter section of a C3D file into a map from 'GROUP:NAME' to the (data type, dimensions, raw bytes)
+    of each parameter. If the data is cut off partway through the section, this returns the parameters we got to.
+    """
+    byte_order_and_type = _get_c3d_byte_order(data)
+    if byte_order_and_type is None:
+        return {}
+    byte_order, processor_type = byte_order_and_type
+    offset = (data[0] - 1) * C3D_BLOCK_BYTES + 4
+    groups: Dict[int, str] = {}
+    parameters: List[Tuple[int, str, int, List[int], bytes]] = []
+    while offset + 4 <= len(data):
+        name_length = abs(struct.unpack('b', data[offset:offset + 1])[0])
+        group_id = struct.unpack('b', data[offset + 1:offset + 2])[0]
+        if name_length == 0 or group_id == 0:
+            break
+        name = data[offset + 2:offset + 2 + name_length].decode('ascii', errors='replace').upper()
+        next_field = offset + 2 + name_length
+        if next_field + 2 > len(data):
+            break
+        next_offset = struct.unpack(byte_order + 'h', data[next_field:next_field + 2])[0]
+        if group_id < 0:
+            groups[-group_id] = name
+        else:
+            body = next_field + 2
+            if body + 2 > len(data):
+                break
+            data_type = struct.unpack('b', data[body:body + 1])[0]
+            num_dimensions = data[body + 1]
+            dimensions = list(data[body + 2:body + 2 + num_dimensions])
+            num_bytes = abs(data_type)
+            for dimension in dimensions:
+                num_bytes *= dimension
+            start = body + 2 + num_dimensions
+            if start + num_bytes > len(data):
+                break
+            parameters.append((group_id, name, data_type, dimensions, data[start:start + num_bytes]))
+        if next_offset <= 0:
+            break
+        offset = next_field + next_offset
+    return {groups.get(group_id, str(group_id)) + ':' + name: (data_type, dimensions, raw)
+            for group_id, name, data_type, dimensions, raw in parameters}
+
+
+def _get_c3d_int(parameters: Dict[str, Tuple[int, List[int], bytes]], key: str, byte_order: str) -> Optional[int]:
+    if key not in parameters:
+        return None
+    data_type, dimensions, raw = parameters[key]
+    if data_type == 2 and len(raw) >= 2:
+        return struct.unpack(byte_order + 'H', raw[:2])[0]
+    elif data_type == 1 and len(raw) >= 1:
+        return raw[0]
+    elif data_type == 4 and len(raw) >= 4:
+        return int(struct.unpack(byte_order + 'f', raw[:4])[0])
+    return None
+
+
+def _get_c3d_strings(parameters: Dict[str, Tuple[int, List[int], bytes]], key: str) -> List[str]:
+    if key not in parameters:
+        return []
+    data_type, dimensions, raw = parameters[key]
+    if data_type != -1 or len(dimensions) == 0 or dimensions[0] == 0:
+        return []
+    length = dimensions[0]
+    return [raw[i:i + length].decode('ascii', errors='replace').strip() for i in range(0, len(raw), length)]
+
+
+def read_c3d_header(data: bytes, file_size: Optional[int] = None) -> Optional[MotionFileHeader]:
+    """
+    Read a C3D header from the first bytes of the file. The header block has the frame range, frame rate, and number of
+    markers and analog samples. The rest (marker names, the number of analog channels and force plates, and the real
+    frame count for trials too long for the header's 16 bit frame numbers) comes from the parameter section, if the
+    data reaches that far.
+
+    Headers can claim more frames than the file actually holds (e.g. if it was cut short), so if we know the size of
+    the file we don't report more frames than could fit in it.
+    """
+    byte_order_and_type = _get_c3d_byte_order(data)
+    if byte_order_and_type is None:
+        return None
+    byte_order, processor_type = byte_order_and_type
+    header = MotionFileHeader('c3d')
+    num_points, analog_per_frame, first_frame, last_frame = struct.unpack(byte_order + 'HHHH', data[2:10])
+    scale = _read_c3d_float(data, 12, byte_order, processor_type)
+    data_start = (struct.unpack(byte_order + 'H', data[16:18])[0] - 1) * C3D_BLOCK_BYTES
+    header.frame_rate = _read_c3d_float(data, 20, byte_order, processor_type)
+    header.num_markers = num_points
+    if last_frame >= first_frame:
+        header.num_frames = last_frame - first_frame + 1
+
+    parameters = read_c3d_parameters(data)
+    # Files with more frames than fit in the header store the real frame count in the parameters
+    frames = _get_c3d_int(parameters, 'POINT:FRAMES', byte_order)
+    if frames is not None and (header.num_frames is None or frames > header.num_frames):
+        header.num_frames = frames
+    if 'TRIAL:ACTUAL_START_FIELD' in parameters and 'TRIAL:ACTUAL_END_FIELD' in parameters:
+        # These are 32 bit frame numbers, stored as two 16 bit words (low word first)
+        start_raw = parameters['TRIAL:ACTUAL_START_FIELD'][2]
+        end_raw = parameters['TRIAL:ACTUAL_END_FIELD'][2]
+        if len(start_raw) >= 4 and len(end_raw) >= 4:
+            start_low, start_high = struct.unpack(byte_order + 'HH', start_raw[:4])
+            end_low, end_high = struct.unpack(byte_order + 'HH', end_raw[:4])
+            frames = (end_high << 16 | end_low) - (start_high << 16 | start_low) + 1
+            if frames > 0 and (header.num_frames is None or frames > header.num_frames):
+                header.num_frames = frames
+    labels = _get_c3d_strings(parameters, 'POINT:LABELS')
+    for i in range(2, 100):
+        if 'POINT:LABELS' + str(i) not in parameters:
+            break
+        labels += _get_c3d_strings(parameters, 'POINT:LABELS' + str(i))
+    header.marker_names = labels[:num_points]
+    header.num_analog_channels = _get_c3d_int(parameters, 'ANALOG:USED', byte_order)
+    header.num_force_plates = _get_c3d_int(parameters, 'FORCE_PLATFORM:USED', byte_order)
+
+    if file_size is not None and header.num_frames is not None:
+        bytes_per_sample = 4 if scale < 0 else 2
+        bytes_per_frame = (num_points * 4 + analog_per_frame) * bytes_per_sample
+        if bytes_per_frame > 0 and data_start > 0:
+            header.num_frames = min(header.num_frames, max(0, file_size - data_start) // bytes_per_frame)
+    return header
+
+
+# ===================== TRC =====================
+
+
+def read_trc_header(data: bytes, file_size: Optional[int] = None) -> Optional[MotionFileHeader]:
+    """
+    Read a TRC header from the first bytes of the file. The third line has the frame rate, frame count and number of
+    markers, and the fourth has the marker names.
+
+    Headers can claim more frames than the file actually holds, so if we know the size of the file we also estimate
+    the number of frames from it, using the length of the data lines at the start of the file, and report whichever
+    is smaller. Data lines vary in length, so this can be off by a few percent.
+    """
+    lines = data.split(b'\n')
+    if len(lines) < 3:
+        return None
+    keys = lines[1].decode('utf-8', errors='replace').split()
+    values = lines[2].decode('utf-8', errors='replace').split()
+    fields = dict(zip(keys, values))
+    header = MotionFileHeader('trc')
+    try:
+        header.num_frames = int(fields['NumFrames'])
+    except (KeyError, ValueError):
+        return None
+    try:
+        header.frame_rate = float(fields['DataRate'])
+    except (KeyError, ValueError):
+        pass
+    try:
+        header.num_markers = int(fields['NumMarkers'])
+    except (KeyError, ValueError):
+        pass
+    if len(lines) > 4:
+        header.marker_names = [name.strip() for name in lines[3].decode('utf-8', errors='replace').split('\t')[2:]
+                               if len(name.strip()) > 0]
+    header.num_analog_channels = 0
+    header.num_force_plates = 0
+
+    if file_size is not None:
+        # The last line may be cut off, unless we've got the whole file
+        complete_lines = lines if len(data) >= file_size else lines[:-1]
+        data_start = 0
+        data_lengths: List[int] = []
+        for i, line in enumerate(complete_lines):
+            if i >= 5 and len(line.strip()) > 0 and line.strip()[:1].isdigit():
+                if len(data_lengths) == 0:
+                    data_start = sum(len(previous) + 1 for previous in lines[:i])
+                data_lengths.append(len(line) + 1)
+        if len(data_lengths) > 0:
+            average_length = sum(data_lengths) / len(data_lengths)
+            header.num_frames = min(header.num_frames, int(round(max(0, file_size - data_start) / average_length)))
+    return header
+
+
+# ===================== MOT =====================
+
+
+def read_mot_header(data: bytes) -> Optional[MotionFileHeader]:
+    """
+    Read an OpenSim .mot (or .sto) header from the first bytes of the file, e.g. for the ground reaction forces of a
+    trial. The header is a list of key=value lines ending in "endheader", followed by the column names. We estimate
+    the frame rate from the times of the first couple of rows, if we have them.
+    """
+    lines = data.decode('utf-8', errors='replace').split('\n')
+    header = MotionFileHeader('mot')
+    end_header = -1
+    for i, line in enumerate(lines):
+        line = line.strip()
+        if line.lower() == 'endheader':
+            end_header = i
+            break
+        # Newer files write "nRows=100", and older ones "datarows 100"
+        parts = line.split('=', 1) if '=' in line else line.split(None, 1)
+        if len(parts) == 2:
+            key = parts[0].strip().lower()
+            try:
+                if key in ['nrows', 'datarows']:
+                    header.num_frames = int(parts[1])
+                elif key in ['ncolumns', 'datacolumns']:
+                    header.num_analog_channels = int(parts[1]) - 1
+            except ValueError:
+                pass
+    if end_header < 0:
+        return None
+    column_line = end_header + 1
+    while column_line < len(lines) and len(lines[column_line].strip()) == 0:
+        column_line += 1
+    if column_line >= len(lines):
+        return None
+    header.column_names = lines[column_line].split()
+    if len(header.column_names) > 0:
+        header.num_analog_channels = len(header.column_names) - 1
+    # Each force plate has a force, a center of pressure and a torque, and the force columns end in "vx"
+    header.num_force_plates = len([name for name in header.column_names if name.endswith('vx')])
+    header.num_markers = 0
+    # Skip the last line, which may be cut off
+    times: List[float] = []
+    for line in lines[column_line + 1:-1]:
+        if len(times) >= 2:
+            break
+        parts = line.split()
+        if len(parts) > 0:
+            try:
+                times.append(float(parts[0]))
+            except ValueError:
+                break
+    if len(times) == 2 and times[1] > times[0]:
+        header.frame_rate = 1.0 / (times[1] - times[0])
+    return header
@@ -313,6 +313,34 @@ class ReactiveS3Index:
             self.queue_pub_sub_update_message(topic, json.dumps(body).encode('utf-8'))
             self.pubSub.publish(topic, body)
 
+    def copyFile(self, fromBucketPath: str, toBucketPath: str) -> Dict[str, Any]:
+        """
+        This copies a file to another spot in the bucket. The copy happens on the S3 side, so the bytes never have to
+        come down to this machine and back up again. Copies usually come in batches, so this doesn't publish anything
+        itself. Instead it returns the update for the new file, to pass on to publishFolderUpdate() with the rest of
+        the batch.
+        """
+        print('copying file '+fromBucketPath+' to '+toBucketPath)
+        self.bucket.copy({'Bucket': self.bucketName, 'Key': fromBucketPath}, toBucketPath)
+        size = self.files[fromBucketPath].size if fromBucketPath in self.files else 0
+        return {'key': toBucketPath, 'lastModified': time.time() * 1000, 'size': size}
+
+    def publishFolderUpdate(self, folder: str, files: List[Dict[str, Any]]):
+        """
+        This sends a single UPDATE message for a batch of files that changed under `folder`, with every file listed
+        under "files", the same way bulk uploads do. The top level of the message describes the last file, for any
+        listeners that only read one file per message.
+        """
+        if len(files) == 0:
+            return
+        if 'pubSub' in self.__dict__ and self.pubSub is not None:
+            topic = makeTopicPubSubSafe("/UPDATE/"+folder)
+            body = dict(files[-1])
+            body['folder'] = folder
+            body['files'] = files
+            self.queue_pub_sub_update_message(topic, json.dumps(body).encode('utf-8'))
+            self.pubSub.publish(topic, body)
+
     def uploadText(self, bucketPath: str, text: str):
         """
         This uploads text to the file at this path
@@ -348,6 +376,13 @@ class ReactiveS3Index:
         print('downloading file '+bucketPath+' into '+localPath)
         self.bucket.download_file(bucketPath, localPath)
 
+    def downloadBytes(self, bucketPath: str, numBytes: int) -> bytes:
+        """
+        This downloads just the first numBytes bytes of a file (or the whole file, if it is shorter than that), which
+        is enough to read the header of most file formats.
+        """
+        return self.s3.Object(self.bucketName, bucketPath).get(Range='bytes=0-'+str(numBytes - 1))['Body'].read()
+
     def download_to_tmp(self, bucketPath: str) -> str:
         """
         This downloads a folder, or a file, creating a temporary folder.
@@ -394,9 +429,18 @@ class ReactiveS3Index:
 
     def _onUpdate(self, topic: str, payload: bytes) -> bool:
         """
-        We received a PubSub message telling us a file was created
+        We received a PubSub message telling us a file was created. Bulk uploads send one message per folder, with
+        every file that changed listed under "files".
         """
         body = json.loads(payload)
+        if 'files' in body:
+            any_changes = False
+            for file_body in body['files']:
+                any_changes |= self._onFileUpdate(file_body)
+            return any_changes
+        return self._onFileUpdate(body)
+
+    def _onFileUpdate(self, body: Dict[str, Any]) -> bool:
         key: str = body['key']
         last_modified_str: str = body['lastModified']
         last_modified: int
@@ -1,7 +1,51 @@
 import unittest
 import os
+import time
+import tempfile
 from typing import List
-from src.data_harvester import SubjectSnapshot
+from src.data_harvester import SubjectSnapshot, DataHarvester, ThroughputMeter, MarkerTranslationCache
+
+
+class FakeSnapshot:
+    """
+    Stands in for a SubjectSnapshot, without needing an index, and behaves however the test asks it to when copied.
+    """
+    def __init__(self, path: str, behavior: str) -> None:
+        self.path = path
+        self.behavior = behavior
+        self.marked_incompatible = False
+
+    def copy_snapshots(self, datasets, translation_cache=None):
+        if self.behavior == 'crash':
+            os._exit(-11)
+        elif self.behavior == 'raise':
+            raise ValueError('Bad data')
+        elif self.behavior == 'hang':
+            time.sleep(60)
+
+    def mark_incompatible(self, datasets):
+        self.marked_incompatible = True
+
+
+def make_harvester(queue: List[FakeSnapshot], num_workers: int, worker_timeout: float = 30.0) -> DataHarvester:
+    harvester = DataHarvester.__new__(DataHarvester)
+    harvester.queue = list(queue)
+    harvester.datasets = []
+    harvester.num_workers = num_workers
+    harvester.worker_timeout = worker_timeout
+    harvester.max_attempts = 2
+    harvester.workers = {}
+    harvester.failures = {}
+    harvester.throughput = ThroughputMeter()
+    harvester.translation_cache = None
+    return harvester
+
+
+def run_until_idle(harvester: DataHarvester):
+    while len(harvester.queue) > 0 or len(harvester.workers) > 0:
+        harvester.start_workers()
+        time.sleep(0.05)
+        assert harvester.reap_workers()
 
 class DataHarvesterTest(unittest.TestCase):
 
@@ -31,6 +75,63 @@ class DataHarvesterTest(unittest.TestCase):
         self.assertCountEqual(trials_to_remove, [])
 
 
+    def test_worker_pool_retries_before_marking_incompatible(self):
+        ok = [FakeSnapshot('ok' + str(i) + '/', 'ok') for i in range(3)]
+        crash = FakeSnapshot('crash/', 'crash')
+        raises = FakeSnapshot('raise/', 'raise')
+        harvester = make_harvester(ok + [crash, raises], num_workers=3)
+        harvester.start_workers()
+        self.assertEqual(len(harvester.workers), 3)
+        run_until_idle(harvester)
+        # The workers are separate processes, so the snapshots we mark incompatible are the ones held by the harvester
+        self.assertTrue(crash.marked_incompatible)
+        self.assertTrue(raises.marked_incompatible)
+        self.assertFalse(any(snapshot.marked_incompatible for snapshot in ok))
+        self.assertEqual(harvester.failures, {})
+        self.assertEqual(len(harvester.throughput.completion_times), 3)
+
+    def test_worker_timeout(self):
+        hang = FakeSnapshot('hang/', 'hang')
+        harvester = make_harvester([hang], num_workers=1, worker_timeout=0.2)
+        run_until_idle(harvester)
+        self.assertTrue(hang.marked_incompatible)
+
+    def test_throughput(self):
+        meter = ThroughputMeter(window_s=3600)
+        meter.start_time = 0.0
+        for t in [100.0, 200.0, 1000.0]:
+            meter.record(t)
+        # Over the first half hour, 3 snapshots is 6 per hour
+        self.assertAlmostEqual(meter.per_hour(1800.0), 6.0)
+        # Once the first two fall out of the window, only the last one counts
+        self.assertAlmostEqual(meter.per_hour(4000.0), 1.0)
+
+    def test_translation_cache(self):
+        with tempfile.TemporaryDirectory() as folder:
+            def write(name: str, contents: str) -> str:
+                path = os.path.join(folder, name)
+                with open(path, 'w') as f:
+                    f.write(contents)
+                return path
+            source = write('source.osim', '<source/>')
+            target = write('target.osim', '<target/>')
+            other_target = write('other_target.osim', '<other/>')
+            translated = write('translated.osim', '<translated/>')
+            output = os.path.join(folder, 'output.osim')
+            cache = MarkerTranslationCache(os.path.join(folder, 'cache'))
+
+            self.assertIsNone(cache.load(source, target, output))
+            translation = {'incompatible': False, 'markersGuessed': ['RASI'], 'markersMissing': []}
+            cache.store(source, target, translated, translation)
+            cache.store(source, other_target, None, {'incompatible': True})
+
+            # The cache is keyed on the contents of the models, not their paths
+            self.assertEqual(cache.load(write('copy.osim', '<source/>'), target, output), translation)
+            with open(output) as f:
+                self.assertEqual(f.read(), '<translated/>')
+            self.assertEqual(cache.load(source, other_target, output), {'incompatible': True})
+            self.assertIsNone(cache.load(target, source, output))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,117 @@
+import unittest
+import os
+import struct
+from typing import List, Tuple
+from src.motion_file_headers import probe_file, read_c3d_header, read_trc_header, read_mot_header, HEADER_BYTES
+
+
+def make_c3d(num_frames: int, marker_names: List[str], analog_channels: int, force_plates: int,
+             frame_rate: float = 100.0, processor_type: int = 84) -> bytes:
+    """
+    Write a minimal C3D file, with float samples and a single parameter block, to check the header reader against.
+    """
+    byte_order = '>' if processor_type == 86 else '<'
+    num_points = len(marker_names)
+    analog_per_frame = analog_channels * 10
+
+    def parameter(group_id: int, name: str, data_type: int, dimensions: List[int], raw: bytes) -> bytes:
+        body = struct.pack('bB', data_type, len(dimensions)) + bytes(dimensions) + raw + b'\x00'
+        return struct.pack('bb', len(name), group_id) + name.encode() + struct.pack(byte_order + 'h', 2 + len(body)) + \
+            body
+
+    def group(group_id: int, name: str) -> bytes:
+        return struct.pack('bb', len(name), -group_id) + name.encode() + struct.pack(byte_order + 'h', 3) + b'\x00'
+
+    label_length = 4
+    labels = b''.join(name.ljust(label_length).encode() for name in marker_names)
+    parameters = group(1, 'POINT') + \
+        parameter(1, 'USED', 2, [], struct.pack(byte_order + 'H', num_points)) + \
+        parameter(1, 'FRAMES', 2, [], struct.pack(byte_order + 'H', min(num_frames, 65535))) + \
+        parameter(1, 'LABELS', -1, [label_length, num_points], labels) + \
+        group(2, 'ANALOG') + \
+        parameter(2, 'USED', 2, [], struct.pack(byte_order + 'H', analog_channels)) + \
+        group(3, 'FORCE_PLATFORM') + \
+        parameter(3, 'USED', 2, [], struct.pack(byte_order + 'H', force_plates))
+    parameter_block = (struct.pack('BBBB', 1, 80, 1, processor_type) + parameters).ljust(512, b'\x00')
+    header = struct.pack(byte_order + 'BBHHHHHf', 2, 0x50, num_points, analog_per_frame, 1, min(num_frames, 65535),
+                         0, -1.0)
+    header += struct.pack(byte_order + 'HHf', 3, 10, frame_rate)
+    header = header.ljust(512, b'\x00')
+    frame = b'\x00' * ((num_points * 4 + analog_per_frame) * 4)
+    return header + parameter_block + frame * num_frames
+
+
+class MotionFileHeadersTest(unittest.TestCase):
+    def test_c3d_header(self):
+        for processor_type in [84, 86]:
+            data = make_c3d(120, ['RASI', 'LASI', 'C7'], analog_channels=12, force_plates=2,
+                            processor_type=processor_type)
+            header = read_c3d_header(data[:HEADER_BYTES], len(data))
+            self.assertEqual(header.num_frames, 120)
+            self.assertEqual(header.frame_rate, 100.0)
+            self.assertEqual(header.num_markers, 3)
+            self.assertEqual(header.marker_names, ['RASI', 'LASI', 'C7'])
+            self.assertEqual(header.num_analog_channels, 12)
+            self.assertEqual(header.num_force_plates, 2)
+            self.assertAlmostEqual(header.duration(), 1.2)
+
+    def test_c3d_cut_short(self):
+        data = make_c3d(120, ['RASI', 'LASI', 'C7'], analog_channels=0, force_plates=0)
+        frame_bytes = 3 * 4 * 4
+        # If the file was cut short, we only count the frames that are actually there
+        self.assertEqual(read_c3d_header(data[:HEADER_BYTES], len(data) - 20 * frame_bytes).num_frames, 100)
+        # Without the file size, we have to take the header's word for it
+        self.assertEqual(read_c3d_header(data[:HEADER_BYTES]).num_frames, 120)
+
+    def test_trc_headers(self):
+        # These test files were cut short, but their headers still claim the original number of frames, so we should
+        # notice from the size of the file that they're shorter than that
+        path = os.path.abspath('../test_data/data_harvester_test_long/trials/example1/markers.trc')
+        with open(path, 'rb') as f:
+            data = f.read(HEADER_BYTES)
+        self.assertEqual(read_trc_header(data).num_frames, 11983)
+        header = probe_file(path)
+        self.assertAlmostEqual(header.num_frames, 500, delta=25)
+        self.assertEqual(header.frame_rate, 100.0)
+        self.assertEqual(header.num_markers, len(header.marker_names))
+        self.assertLess(probe_file(os.path.abspath(
+            '../test_data/data_harvester_test_short/trials/example2/markers.trc')).num_frames, 30)
+
+    def test_mot_headers(self):
+        new_style = b'grf.mot\nversion=1\nnRows=3\nnColumns=7\ninDegrees=no\nendheader\n' \
+                    b'time\tground_force_vx\tground_force_vy\tground_force_vz\tground_force_px\tground_force_py\t' \
+                    b'ground_force_pz\n0.00\t1\t2\t3\t4\t5\t6\n0.01\t1\t2\t3\t4\t5\t6\n0.02\t1\t2\t3\t4\t5\t6\n'
+        header = read_mot_header(new_style)
+        self.assertEqual(header.num_frames, 3)
+        self.assertEqual(header.num_analog_channels, 6)
+        self.assertEqual(header.num_force_plates, 1)
+        self.assertAlmostEqual(header.frame_rate, 100.0)
+
+        old_style = b'name grf.mot\ndatacolumns 7\ndatarows 4500\nrange 0 4.5\nendheader\n\n' \
+                    b'time\tground_force_vx\tground_force_vy\tground_force_vz\t1_ground_force_vx\t1_ground_force_vy\t' \
+                    b'1_ground_force_vz\n'
+        header = read_mot_header(old_style)
+        self.assertEqual(header.num_frames, 4500)
+        self.assertEqual(header.num_force_plates, 2)
+        self.assertIsNone(header.frame_rate)
+
+    def test_not_a_motion_file(self):
+        self.assertIsNone(read_c3d_header(b'not a c3d file'))
+        self.assertIsNone(read_trc_header(b'not a trc file'))
+        self.assertIsNone(read_mot_header(b'not a mot file'))
+
+    def test_cli_copy_in_sync(self):
+        # The CLI is installed on its own, so it keeps a copy of this module to check files before they're uploaded.
+        # The two have to read headers the same way, so any change here has to be made there too.
+        src_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+        cli_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'cli', 'addbiomechanics')
+        with open(os.path.join(src_folder, 'motion_file_headers.py')) as f:
+            server_source = f.read()
+        with open(os.path.join(cli_folder, 'motion_file_headers.py')) as f:
+            cli_source = f.read()
+        self.assertEqual(server_source, cli_source,
+                         'server/app/src/motion_file_headers.py and cli/addbiomechanics/motion_file_headers.py differ')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import json
+import unittest
+from typing import Any, Dict, List, Tuple
+from src.reactive_s3.reactive_s3_index import ReactiveS3Index, FileMetadata
+
+
+class FakeBucket:
+    def __init__(self) -> None:
+        self.copies: List[Tuple[str, str]] = []
+
+    def copy(self, source: Dict[str, str], key: str):
+        self.copies.append((source['Key'], key))
+
+
+class FakePubSub:
+    def __init__(self) -> None:
+        self.published: List[Tuple[str, Dict[str, Any]]] = []
+
+    def publish(self, topic: str, payload: Dict[str, Any] = {}):
+        self.published.append((topic, payload))
+
+
+def make_index() -> ReactiveS3Index:
+    index = ReactiveS3Index.__new__(ReactiveS3Index)
+    index.bucketName = 'bucket'
+    index.bucket = FakeBucket()
+    index.pubSub = FakePubSub()
+    index.files = {}
+    index.children = {}
+    index.incomingMessages = []
+    return index
+
+
+class ReactiveS3IndexTest(unittest.TestCase):
+    def test_copies_publish_one_message_per_folder(self):
+        index = make_index()
+        source = 'protected/us-west-2:abc/data/S01/'
+        target = 'protected/us-west-2:abc/data/S01_rajagopal/'
+        children = ['trials/walk/markers.c3d', 'trials/walk/grf.mot', 'trials/run/markers.c3d']
+        for i, child in enumerate(children):
+            index.files[source + child] = FileMetadata(source + child, 0, 100 + i, '')
+
+        copied = [index.copyFile(source + child, target + child) for child in children]
+        self.assertEqual(index.bucket.copies, [(source + child, target + child) for child in children])
+        self.assertEqual(index.pubSub.published, [])
+
+        index.publishFolderUpdate(target, copied)
+        self.assertEqual(len(index.pubSub.published), 1)
+        topic, body = index.pubSub.published[0]
+        self.assertTrue(topic.startswith('/UPDATE/'))
+        self.assertEqual(body['folder'], target)
+        self.assertEqual([file['key'] for file in body['files']], [target + child for child in children])
+        self.assertEqual([file['size'] for file in body['files']], [100, 101, 102])
+        self.assertEqual(body['key'], target + children[-1])
+
+        # We hear our own message too, and it adds every copied file to the index
+        self.assertEqual(len(index.incomingMessages), 1)
+        self.assertTrue(index._onUpdate(topic, index.incomingMessages[0][2]))
+        for i, child in enumerate(children):
+            self.assertEqual(index.files[target + child].size, 100 + i)
+
+        # An empty batch doesn't send anything
+        index.publishFolderUpdate(target, [])
+        self.assertEqual(len(index.pubSub.published), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
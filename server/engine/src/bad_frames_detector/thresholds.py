@@ -260,6 +260,105 @@ class ThresholdsDetector(AbstractDetector):
 
         return largest_min_weighted_distance
 
+    @staticmethod
+    def get_total_force_magnitudes(raw_force_plate_forces: List[List[np.ndarray]]) -> np.ndarray:
+        """
+        Get the sum over all the force plates of the magnitude of the force on each plate, for every frame.
+        """
+        # This is (num_force_plates x num_frames x 3)
+        forces = np.asarray(raw_force_plate_forces, dtype=np.float64)
+        # This is the same dot product np.linalg.norm() takes of a single vector, so the magnitudes match it to the bit,
+        # and so do all the comparisons between them below
+        magnitudes = np.sqrt(np.matmul(forces[..., np.newaxis, :], forces[..., :, np.newaxis])[..., 0, 0])
+        return np.sum(magnitudes, axis=0)
+
+    @staticmethod
+    def get_force_ramp_ends(force_mags: np.ndarray, extend_frames: int) -> np.ndarray:
+        """
+        For each frame i, find the furthest of the next `extend_frames` frames with more force than frame i, and return
+        the frame just before it. If none of them has more force, this is i - 1.
+        """
+        num_frames = len(force_mags)
+        frames = np.arange(num_frames)
+        ramp_ends = frames - 1
+        # Later (larger) j overwrite earlier ones, so we end up with the furthest
+        for j in range(1, min(extend_frames, num_frames - 1) + 1):
+            rises = force_mags[:num_frames - j] < force_mags[j:]
+            ramp_ends[:num_frames - j][rises] = frames[:num_frames - j][rises] + j - 1
+        return ramp_ends
+
+    @staticmethod
+    def extend_missing_into_rising_force(missing: np.ndarray, force_mags: np.ndarray, extend_frames: int) -> np.ndarray:
+        """
+        Scanning left to right, every frame that is missing, and the first frame, marks itself and the frames after it
+        as missing, up to just before the furthest of the next `extend_frames` frames with more force than it. The
+        frames it marks go on to extend the segment the same way when the scan reaches them. This returns which frames
+        get marked.
+        """
+        num_frames = len(force_mags)
+        if num_frames == 0:
+            return np.zeros(0, dtype=bool)
+        ramp_ends = ThresholdsDetector.get_force_ramp_ends(force_mags, extend_frames)
+        extends = np.copy(missing)
+        extends[0] = True
+        # Frames that aren't missing only extend the segment if one reaching in from the left has marked them. So, in
+        # each run of frames that aren't missing, the ones that extend it are the frames up to where the furthest
+        # reach so far first falls short.
+        edges = np.diff(np.concatenate([[1], extends.astype(np.int8), [1]]))
+        run_starts = np.nonzero(edges == -1)[0]
+        run_ends = np.nonzero(edges == 1)[0]
+        furthest = -1
+        last_end = 0
+        for start, end in zip(run_starts, run_ends):
+            if start > last_end:
+                furthest = max(furthest, int(np.max(ramp_ends[last_end:start])))
+            # How far the frames before each frame of the run reach
+            reach_before = np.maximum(furthest, np.concatenate([[furthest],
+                                                                np.maximum.accumulate(ramp_ends[start:end - 1])]))
+            reached = reach_before >= np.arange(start, end)
+            num_reached = end - start if np.all(reached) else int(np.argmin(reached))
+            if num_reached > 0:
+                extends[start:start + num_reached] = True
+                furthest = max(furthest, int(np.max(ramp_ends[start:start + num_reached])))
+            last_end = end
+        # Every frame up to the furthest ramp end of a frame that extends the segment gets marked
+        return np.maximum.accumulate(np.where(extends, ramp_ends, -1)) >= np.arange(num_frames)
+
+    @staticmethod
+    def get_overground_missing_grfs(raw_force_plate_forces: List[List[np.ndarray]],
+                                    trial_len: int,
+                                    extend_frames: int = 20) -> List[nimble.biomechanics.MissingGRFReason]:
+        """
+        Label each frame of an overground trial as missing GRF if it has too little total force on the force plates,
+        or if it's on the rising or falling force ramp at the edge of a stretch with too little force.
+        """
+        # 1. Grab the frames with too little force, mark them as missing.
+        force_mags = ThresholdsDetector.get_total_force_magnitudes(raw_force_plate_forces)[:trial_len]
+        zero_force = force_mags < 10.0
+
+        # 2. Now we can go through and extend all the missing segments into the "rising force ramp" and "falling force
+        # ramp" regions at the edge of the missing segments.
+
+        # 2.1. Start with the rising force ramp, which we can tell by checking left-to-right if any frame has more
+        # force magnitude than any of the previous few frames which may have been marked as missing, and if so, extend
+        # the missing segment to include that frame.
+        rising = ThresholdsDetector.extend_missing_into_rising_force(zero_force, force_mags, extend_frames)
+
+        # 2.2. Now do the same for the falling force ramp, but right-to-left.
+        falling = ThresholdsDetector.extend_missing_into_rising_force((zero_force | rising)[::-1],
+                                                                      force_mags[::-1],
+                                                                      extend_frames)[::-1]
+
+        missing: List[nimble.biomechanics.MissingGRFReason] = []
+        for i in range(len(force_mags)):
+            if rising[i] or falling[i]:
+                missing.append(nimble.biomechanics.MissingGRFReason.extendedToNearestPeakForce)
+            elif zero_force[i]:
+                missing.append(nimble.biomechanics.MissingGRFReason.zeroForceFrame)
+            else:
+                missing.append(nimble.biomechanics.MissingGRFReason.notMissingGRF)
+        return missing
+
     def estimate_missing_grfs(self, subject: nimble.biomechanics.SubjectOnDisk, trials: List[int]) -> List[List[nimble.biomechanics.MissingGRFReason]]:
         osim: nimble.biomechanics.OpenSimFile = subject.readOpenSimFile(processingPass=0, ignoreGeometry=True)
         skel: nimble.dynamics.Skeleton = osim.skeleton
@@ -346,51 +445,7 @@ class ThresholdsDetector(AbstractDetector):
             # getting dynamics on them. We can always come back and add a more sophisticated heuristic later. This is
             # a simple and extremely effective heuristic, which catches 99.8% of remaining bad frames in the dataset.
             if trial_type == nimble.biomechanics.BasicTrialType.OVERGROUND:
-                missing = []
-                force_mags: List[float] = []
-                # 6.1. Grab the frames with too little force, mark them as missing.
-                for i in range(trial_len):
-                    forces = [raw_force_plate_forces[f][i] for f in range(len(raw_force_plate_forces))]
-                    total_force_mag = 0.0
-                    for force in forces:
-                        total_force_mag += np.linalg.norm(force)
-                    if total_force_mag < 10.0:
-                        missing.append(nimble.biomechanics.MissingGRFReason.zeroForceFrame)
-                    else:
-                        missing.append(nimble.biomechanics.MissingGRFReason.notMissingGRF)
-                    force_mags.append(total_force_mag)
-
-                # 6.2. Now we can go through and extend all the missing segments into the "rising force ramp" and
-                # "falling force ramp" regions at the edge of the missing segments.
-
-                # 6.2.1. Start with the rising force ramp, which we can tell by checking left-to-right if any frame has
-                # more force magnitude than any of the previous few frames which may have been marked as missing, and
-                # if so, extend the missing segment to include that frame.
-                extend_frames = 20
-                extended_frames = 0
-
-                for i in range(trial_len):
-                    if missing[i] != nimble.biomechanics.MissingGRFReason.notMissingGRF or i == 0:
-                        for j in range(1, extend_frames + 1):
-                            if i + j < trial_len and force_mags[i] < force_mags[i + j]:
-                                for k in range(j):
-                                    if not missing[i + k]:
-                                        extended_frames += 1
-                                    missing[i + k] = nimble.biomechanics.MissingGRFReason.extendedToNearestPeakForce
-                                # break
-
-                # 6.2.2. Now do the same for the falling force ramp, but right-to-left.
-                for i in range(trial_len - 1, -1, -1):
-                    if missing[i] != nimble.biomechanics.MissingGRFReason.notMissingGRF or i == trial_len - 1:
-                        for j in range(1, extend_frames + 1):
-                            if i - j >= 0 and force_mags[i] < force_mags[i - j]:
-                                for k in range(j):
-                                    if not missing[i - k]:
-                                        extended_frames += 1
-                                    missing[i - k] = nimble.biomechanics.MissingGRFReason.extendedToNearestPeakForce
-                                # break
-
-                result.append(missing)
+                result.append(self.get_overground_missing_grfs(raw_force_plate_forces, trial_len))
             else:
                 result.append([nimble.biomechanics.MissingGRFReason.notMissingGRF] * trial_len)
         return result
\ No newline at end of file
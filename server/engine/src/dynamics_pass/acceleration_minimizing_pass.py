@@ -3,7 +3,7 @@ import numpy as np
 from typing import List, Tuple
 
 
-def add_acceleration_minimizing_pass(subject: nimble.biomechanics.SubjectOnDisk):
+def add_acceleration_minimizing_pass(subject: nimble.biomechanics.SubjectOnDisk) -> bool:
     """
     This serves the same function as the more familiar Butterworth lowpass filter. The trouble with a simple Butterworth
     lowpass filter is that even though it smooths the signal, when you double-finite-difference to get acceleration, you
@@ -14,6 +14,9 @@ def add_acceleration_minimizing_pass(subject: nimble.biomechanics.SubjectOnDisk)
     to directly minimize acceleration, while still tracking the original position signals. This has a _much better_
     ability to reconstruct low-noise velocity and acceleration estimates than a Butterworth, while preserving more
     signal. See the experimental log here: https://docs.google.com/document/d/16dgRho13iFyfhQSlYNsdIj7Rer2-MZP_aKtYQj41CQs/edit
+
+    This returns False if the subject turns out to be corrupt (a trial is missing its kinematics pass), in which case
+    the pass is incomplete and the subject shouldn't be used.
     """
 
     # Apply an acceleration minimizing filter pass
@@ -240,3 +243,5 @@ def add_acceleration_minimizing_pass(subject: nimble.biomechanics.SubjectOnDisk)
                                                         lowpass_force_plates)
         acc_min_pass_proto.setAccelerationMinimizingRegularization(pose_regularization)
         acc_min_pass_proto.setAccelerationMinimizingForceRegularization(pose_regularization)
+
+    return not corrupt_file
@@ -2,68 +2,76 @@ import nimblephysics as nimble
 from typing import List, Tuple
 import numpy as np
 
+# A force plate, or a foot, is in contact with the ground when it has more than this much force on it
+CONTACT_THRESHOLD_N = 10.0
+
+
+def get_contact_runs(contact: np.ndarray) -> List[Tuple[int, int, int]]:
+    """
+    Find every run of consecutive frames where a row of a (num_rows x num_frames) boolean array is True, and return
+    them as (row, first frame, last frame) tuples, sorted by row and then by time.
+    """
+    padded = np.zeros((contact.shape[0], contact.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = contact
+    edges = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return [(int(row), int(start), int(end) - 1) for row, start, end in zip(rows, starts, ends)]
+
+
+def get_force_plate_contact(raw_force_plate_forces: List[List[np.ndarray]]) -> np.ndarray:
+    """
+    Get a (num_force_plates x num_frames) boolean array of when each force plate is loaded.
+    """
+    if len(raw_force_plate_forces) == 0:
+        return np.zeros((0, 0), dtype=bool)
+    # This is (num_force_plates x num_frames x 3)
+    forces = np.asarray(raw_force_plate_forces, dtype=np.float64)
+    return np.linalg.norm(forces, axis=2) > CONTACT_THRESHOLD_N
+
+
+def get_ground_body_forces(trial_pass: nimble.biomechanics.SubjectOnDiskTrialPass) -> np.ndarray:
+    """
+    Get the (num_ground_bodies x 3 x num_frames) world frame ground reaction forces assigned to each foot in a pass.
+    """
+    cop_torque_force = np.asarray(trial_pass.getGroundBodyCopTorqueForce())
+    # Each contact body has 9 rows: the CoP, then the torque, then the force
+    return cop_torque_force.reshape(-1, 3, 3, cop_torque_force.shape[-1])[:, 2]
+
 
 def get_num_steps(raw_force_plate_forces: List[List[np.ndarray]],
                   raw_force_plate_cops: List[List[np.ndarray]]) -> Tuple[int, List[int]]:
-    if len(raw_force_plate_forces) == 0:
-        return 0, []
-    num_force_plates = len(raw_force_plate_forces)
-    trial_len = len(raw_force_plate_forces[0])
-    num_steps = 0
-    num_steps_per_force_plate = [0 for _ in range(num_force_plates)]
-    last_in_contact = [False for _ in range(num_force_plates)]
-    for t in range(trial_len):
-        forces = [raw_force_plate_forces[f][t] for f in range(num_force_plates)]
-        for f in range(len(forces)):
-            force = forces[f]
-            if np.linalg.norm(force) > 10.0:
-                if not last_in_contact[f]:
-                    last_in_contact[f] = True
-            else:
-                if last_in_contact[f]:
-                    last_in_contact[f] = False
-                    num_steps += 1
-                    num_steps_per_force_plate[f] += 1
-                last_in_contact[f] = False
-    for f in range(num_force_plates):
-        if last_in_contact[f]:
-            num_steps += 1
-            num_steps_per_force_plate[f] += 1
-    return num_steps, num_steps_per_force_plate
+    contact = get_force_plate_contact(raw_force_plate_forces)
+    # Each step is a run of frames where the plate is loaded
+    num_steps_per_force_plate = [0 for _ in range(contact.shape[0])]
+    for plate, _, _ in get_contact_runs(contact):
+        num_steps_per_force_plate[plate] += 1
+    return sum(num_steps_per_force_plate), num_steps_per_force_plate
 
 
 def get_foot_travel_distance_in_contact(skel: nimble.dynamics.Skeleton,
                                         ground_bodies: List[nimble.dynamics.BodyNode],
                                         positions: np.ndarray,
-                                        raw_force_plate_forces: List[List[np.ndarray]],
-                                        raw_force_plate_cops: List[List[np.ndarray]]) -> List[float]:
-    if len(raw_force_plate_forces) == 0:
+                                        ground_body_forces: np.ndarray) -> List[float]:
+    """
+    For each step any of the ground bodies takes, find how far the body moved between the first and last frames it was
+    in contact with the ground. On a treadmill the belt carries the foot back while it's on the ground, so this is
+    much larger than it is overground.
+    """
+    if len(ground_bodies) == 0 or ground_body_forces.shape[-1] == 0:
         return []
-    trial_len = len(raw_force_plate_forces[0])
-    num_contact_bodies = len(ground_bodies)
-    body_last_in_contact = [False for _ in range(num_contact_bodies)]
-    body_started_contact = [np.zeros(3) for _ in range(num_contact_bodies)]
-    body_last_position = [np.zeros(3) for _ in range(num_contact_bodies)]
-    step_travel_distances = []
-    for t in range(trial_len):
-        skel.setPositions(positions[:, t])
-        ground_body_locations = [body.getWorldTransform().translation() for body in ground_bodies]
-        forces = [raw_force_plate_forces[f][t] for f in range(len(raw_force_plate_forces))]
-        for f in range(len(ground_body_locations)):
-            force = forces[f * 3:f * 3 + 3]
-            if np.linalg.norm(force) > 10.0:
-                body_last_position[f] = ground_body_locations[f]
-                if not body_last_in_contact[f]:
-                    body_started_contact[f] = ground_body_locations[f]
-                    body_last_in_contact[f] = True
-            else:
-                if body_last_in_contact[f]:
-                    body_last_in_contact[f] = False
-                    step_travel_distances.append(np.linalg.norm(body_last_position[f] - body_started_contact[f]))
-    for f in range(num_contact_bodies):
-        if body_last_in_contact[f]:
-            step_travel_distances.append(np.linalg.norm(body_last_position[f] - body_started_contact[f]))
-    return step_travel_distances
+    contact = np.linalg.norm(ground_body_forces, axis=1) > CONTACT_THRESHOLD_N
+    steps = get_contact_runs(contact)
+    # We only need the feet at the start and end of each step, so we only run forward kinematics on those frames
+    frames = sorted(set([start for _, start, _ in steps] + [end for _, _, end in steps]))
+    body_locations = np.zeros((len(frames), len(ground_bodies), 3))
+    for i, frame in enumerate(frames):
+        skel.setPositions(positions[:, frame])
+        for b, body in enumerate(ground_bodies):
+            body_locations[i, b] = body.getWorldTransform().translation()
+    frame_indices = {frame: i for i, frame in enumerate(frames)}
+    return [float(np.linalg.norm(body_locations[frame_indices[end], body] - body_locations[frame_indices[start], body]))
+            for body, start, end in steps]
 
 
 def get_root_box_volume(positions: np.ndarray):
@@ -75,33 +83,85 @@ def get_root_box_volume(positions: np.ndarray):
     return root_box_volume
 
 
-def estimate_trial_type(skel: nimble.dynamics.Skeleton,
-                        foot_bodies: List[nimble.dynamics.BodyNode],
-                        positions: np.ndarray,
-                        velocities: np.ndarray,
-                        raw_force_plate_forces: List[List[np.ndarray]],
-                        raw_force_plate_cops: List[List[np.ndarray]]) -> nimble.biomechanics.BasicTrialType:
-    num_force_plates = len(raw_force_plate_forces)
+class TrialFeatures:
+    """
+    The measurements of a trial that the trial type heuristics are based on. These are also useful on their own, for
+    example to cluster or filter trials, so to_vector() packs them into an array in the order of FEATURE_NAMES.
+    """
+    FEATURE_NAMES: List[str] = ['num_force_plates',
+                                'num_steps',
+                                'max_step_travel_distance',
+                                'root_box_volume',
+                                'max_root_rot_vel']
+    num_force_plates: int
+    num_steps: int
+    step_travel_distances: List[float]
+    root_box_volume: float
+    max_root_rot_vel: float
+
+    def __init__(self,
+                 num_force_plates: int,
+                 num_steps: int,
+                 step_travel_distances: List[float],
+                 root_box_volume: float,
+                 max_root_rot_vel: float):
+        self.num_force_plates = num_force_plates
+        self.num_steps = num_steps
+        self.step_travel_distances = step_travel_distances
+        self.root_box_volume = root_box_volume
+        self.max_root_rot_vel = max_root_rot_vel
+
+    def max_step_travel_distance(self) -> float:
+        return max(self.step_travel_distances) if len(self.step_travel_distances) > 0 else 0.0
+
+    def to_vector(self) -> np.ndarray:
+        return np.array([self.num_force_plates,
+                         self.num_steps,
+                         self.max_step_travel_distance(),
+                         self.root_box_volume,
+                         self.max_root_rot_vel], dtype=np.float64)
+
+
+def get_trial_features(skel: nimble.dynamics.Skeleton,
+                       foot_bodies: List[nimble.dynamics.BodyNode],
+                       trial_proto: nimble.biomechanics.SubjectOnDiskTrial,
+                       trial_pass: nimble.biomechanics.SubjectOnDiskTrialPass) -> TrialFeatures:
+    """
+    Measure a trial, using the motion and foot contact forces from one of its processing passes. This leaves the
+    skeleton at an arbitrary pose.
+    """
+    raw_force_plates: List[nimble.biomechanics.ForcePlate] = trial_proto.getForcePlates()
+    raw_force_plate_forces: List[List[np.ndarray]] = [plate.forces for plate in raw_force_plates]
+    raw_force_plate_cops: List[List[np.ndarray]] = [plate.centersOfPressure for plate in raw_force_plates]
+    positions = trial_pass.getPoses()
+    velocities = trial_pass.getVels()
+
     num_steps, _ = get_num_steps(raw_force_plate_forces, raw_force_plate_cops)
     step_travel_distances = get_foot_travel_distance_in_contact(skel, foot_bodies, positions,
-                                                                raw_force_plate_forces, raw_force_plate_cops)
-    root_box_volume = get_root_box_volume(positions)
-    max_root_rot_vel = np.max(np.abs(velocities[0:3, :]))
+                                                                get_ground_body_forces(trial_pass))
+    return TrialFeatures(num_force_plates=len(raw_force_plates),
+                         num_steps=num_steps,
+                         step_travel_distances=step_travel_distances,
+                         root_box_volume=get_root_box_volume(positions),
+                         max_root_rot_vel=np.max(np.abs(velocities[0:3, :])))
+
 
-    if root_box_volume < 0.06 or max_root_rot_vel < 0.1:
+def estimate_trial_type(features: TrialFeatures) -> nimble.biomechanics.BasicTrialType:
+    if features.root_box_volume < 0.06 or features.max_root_rot_vel < 0.1:
         return nimble.biomechanics.BasicTrialType.STATIC_TRIAL
-    if root_box_volume > 0.8:
+    if features.root_box_volume > 0.8:
         return nimble.biomechanics.BasicTrialType.OVERGROUND
-    if len(step_travel_distances) > 0 and np.max(step_travel_distances) > 0.4 and num_force_plates == 2:
+    if features.max_step_travel_distance() > 0.4 and features.num_force_plates == 2:
         return nimble.biomechanics.BasicTrialType.TREADMILL
-    if num_steps > 15 and num_force_plates == 2:
+    if features.num_steps > 15 and features.num_force_plates == 2:
         return nimble.biomechanics.BasicTrialType.TREADMILL
     return nimble.biomechanics.BasicTrialType.OVERGROUND
 
 
 def classification_pass(subject: nimble.biomechanics.SubjectOnDisk):
     """
-    This
+    This labels each trial with its BasicTrialType (static, treadmill or overground), using heuristics on its last
+    processing pass.
     """
     header_proto = subject.getHeaderProto()
     trial_protos = header_proto.getTrials()
@@ -114,13 +174,5 @@ def classification_pass(subject: nimble.biomechanics.SubjectOnDisk):
         passes = trial_proto.getPasses()
 
         if len(passes) > 0:
-            raw_force_plates: List[nimble.biomechanics.ForcePlate] = trial_proto.getForcePlates()
-            raw_force_plate_forces: List[List[np.ndarray]] = [plate.forces for plate in raw_force_plates]
-            raw_force_plate_cops: List[List[np.ndarray]] = [plate.centersOfPressure for plate in raw_force_plates]
-
-            positions = passes[-1].getPoses()
-            vels = passes[-1].getVels()
-
-            estimated_type = estimate_trial_type(skel, foot_bodies, positions, vels, raw_force_plate_forces, raw_force_plate_cops)
-
-            trial_proto.setBasicTrialType(estimated_type)
+            features = get_trial_features(skel, foot_bodies, trial_proto, passes[-1])
+            trial_proto.setBasicTrialType(estimate_trial_type(features))
@@ -4,7 +4,7 @@ from typing import List, Tuple
 from utilities.scale_opensim_model import scale_opensim_model
 
 
-def dynamics_pass(subject: nimble.biomechanics.SubjectOnDisk):
+def dynamics_pass(subject: nimble.biomechanics.SubjectOnDisk, min_good_grf_frames: int = 5) -> bool:
     """
     This function is responsible for running the dynamics pass on the subject. It assumes that we already have a
     reasonably accurate guess for the subject's body scales, marker offsets, and motion. This function will then
@@ -13,6 +13,9 @@ def dynamics_pass(subject: nimble.biomechanics.SubjectOnDisk):
     observed GRF data, while smoothing the motion that does not have observed GRF data.
     - Run a full "kitchen sink" optimization to further refine everything about that initial guess, and improve metrics
     on average around 20%.
+
+    Trials with fewer than min_good_grf_frames frames of good GRF data are left out. This returns True if at least one
+    trial got a dynamics pass.
     """
     header_proto = subject.getHeaderProto()
     trial_protos = header_proto.getTrials()
@@ -22,14 +25,16 @@ def dynamics_pass(subject: nimble.biomechanics.SubjectOnDisk):
     skel = osim.skeleton
     markers_map = osim.markersMap
 
+    any_good_dynamics_trials = False
     dynamics_trials: List[int] = []
     for i in range(subject.getNumTrials()):
         missing_grf = trial_protos[i].getMissingGRFReason()
         num_not_missing = sum(
             [missing == nimble.biomechanics.MissingGRFReason.notMissingGRF for missing in missing_grf])
         print(f"Trial {i} has {num_not_missing} frames of good GRF data")
-        if num_not_missing < 5:
-            print(f"Trial {i} has less than 5 frames of good GRF data. Skipping dynamics optimization.")
+        if num_not_missing < min_good_grf_frames:
+            print(f"Trial {i} has less than {min_good_grf_frames} frames of good GRF data. Skipping dynamics "
+                  f"optimization.")
             continue
         # Run the dynamics optimization
         print('Running dynamics optimization on trial ' + str(i) + '/' + str(num_trials))
@@ -328,3 +333,5 @@ def dynamics_pass(subject: nimble.biomechanics.SubjectOnDisk):
                     trial_dynamics_data.setMarkerRMS(dynamics_ik_error_report.rootMeanSquaredError)
                     trial_dynamics_data.setMarkerMax(dynamics_ik_error_report.maxError)
                     any_good_dynamics_trials = True
+
+    return any_good_dynamics_trials
@@ -8,6 +8,7 @@ Author(s): Keenon Werling, Nicholas Bianco
 
 import sys
 import os
+import concurrent.futures
 from nimblephysics.loader import absPath
 import json
 from exceptions import Error
@@ -18,6 +19,8 @@ from dynamics_pass.missing_grf_detection import missing_grf_detection
 from dynamics_pass.dynamics_pass import dynamics_pass
 from writers.opensim_writer import write_opensim_results
 from writers.web_results_writer import write_web_results
+from writers.b3d_writer import write_dynamics_trials_only_b3d
+from writers.output_pool import create_output_executor
 
 import numpy as np
 import nimblephysics as nimble
@@ -93,38 +96,38 @@ def main():
                   'just like the kinematics pass, except now we will balance the marker RMS _and_ the residual RMS.')
             dynamics_pass(subject_on_disk)
 
-        # This will write out a folder of OpenSim results files.
-        print('Writing OpenSim results', flush=True)
-        write_opensim_results(subject_on_disk, path + output_name, GEOMETRY_FOLDER_PATH)
-        # This will write out all the results to display in the web UI back into the existing folder structure
-        print('Writing web visualizer results', flush=True)
-        write_web_results(subject_on_disk, GEOMETRY_FOLDER_PATH, path)
-
-        # This will write out a B3D file
+        # This will write out a B3D file. We write it first, because the output writers' worker processes each load
+        # their own copy of the subject from it.
         print('Writing B3D file encoded results', flush=True)
-        nimble.biomechanics.SubjectOnDisk.writeB3D(path + output_name + '.b3d', subject_on_disk.getHeaderProto())
-
-        # Check if we have any dynamics trials
-        pass_index = -1
-        for p in range(subject_on_disk.getNumProcessingPasses()):
-            if subject_on_disk.getProcessingPassType(p) == nimble.biomechanics.ProcessingPassType.DYNAMICS:
-                pass_index = p
-
-        num_dynamics_trials = 0
-        include_dynamics_trials = []
-        if pass_index > -1:
-            for trial in range(subject_on_disk.getNumTrials()):
-                if subject_on_disk.getTrialNumProcessingPasses(trial) > pass_index:
-                    include_dynamics_trials.append(True)
-                    num_dynamics_trials += 1
-                else:
-                    include_dynamics_trials.append(False)
-
-        if num_dynamics_trials > 0:
-            print('Writing B3D file encoded results which have been filtered to only include dynamics trials', flush=True)
-            subject_on_disk.getHeaderProto().filterTrials(include_dynamics_trials)
-            nimble.biomechanics.SubjectOnDisk.writeB3D(path + output_name + '_dynamics_trials_only.b3d', subject_on_disk.getHeaderProto())
-        else:
+        b3d_path = path + output_name + '.b3d'
+        nimble.biomechanics.SubjectOnDisk.writeB3D(b3d_path, subject_on_disk.getHeaderProto())
+
+        # The OpenSim results folder (and zip), the web visualizer results and the B3D file with just the dynamics
+        # trials only read the finished subject, so we write them all at the same time. The per-trial work inside the
+        # first two is spread over a shared pool of processes, and the last one filters its own copy of the subject.
+        print('Writing OpenSim results, web visualizer results and the dynamics trials B3D file', flush=True)
+        with create_output_executor() as executor, concurrent.futures.ThreadPoolExecutor(max_workers=3) as writers:
+            opensim_results = writers.submit(write_opensim_results,
+                                             subject_on_disk,
+                                             path + output_name,
+                                             GEOMETRY_FOLDER_PATH,
+                                             b3d_path,
+                                             executor,
+                                             subject.plotResults)
+            web_results = writers.submit(write_web_results,
+                                         subject_on_disk,
+                                         GEOMETRY_FOLDER_PATH,
+                                         path,
+                                         b3d_path=b3d_path,
+                                         executor=executor)
+            dynamics_trials_only = writers.submit(write_dynamics_trials_only_b3d,
+                                                  b3d_path,
+                                                  path + output_name + '_dynamics_trials_only.b3d')
+            opensim_results.result()
+            web_results.result()
+            wrote_dynamics_trials = dynamics_trials_only.result()
+
+        if not wrote_dynamics_trials:
             print('No dynamics trials found', flush=True)
             # Write a flag file to the output directory to indicate that no dynamics trials were found
             with open(path + 'NO_DYNAMICS_TRIALS', 'w') as f:
@@ -74,6 +74,7 @@ class Subject(metaclass=ExceptionHandlingMeta):
         self.exportMJCF = False
         self.exportOSIM = True
         self.exportMoco = False
+        self.plotResults = 'inline'
         self.kinematicsIterations = 500
         self.initialIKRestarts = 150
         self.ignoreJointLimits = False
@@ -174,6 +175,17 @@ class Subject(metaclass=ExceptionHandlingMeta):
             self.runMoco = subject_json['runMoco']
             self.exportMoco = True if self.runMoco else self.exportMoco
 
+        if 'plotResults' in subject_json:
+            # This can be 'inline', 'deferred' or 'skip', or a boolean for whether to plot the results at all.
+            plot_results = subject_json['plotResults']
+            if isinstance(plot_results, bool):
+                plot_results = 'inline' if plot_results else 'skip'
+            if plot_results in ['inline', 'deferred', 'skip']:
+                self.plotResults = plot_results
+            else:
+                print(f'Ignoring unknown plotResults option "{plot_results}", and plotting the results inline',
+                      flush=True)
+
         if 'ignoreJointLimits' in subject_json:
             self.ignoreJointLimits = subject_json['ignoreJointLimits']
 
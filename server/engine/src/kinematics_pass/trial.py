@@ -17,6 +17,26 @@ def fast_count_lines(path: str) -> int:
             line_count += 1
     return line_count
 
+
+def get_segment_length(segment_path: str) -> Optional[int]:
+    """
+    Get the number of frames in a previously processed segment folder, or None if the folder has no segment data. This
+    reads the length from `data_header.json` if it's there, and otherwise falls back to counting the rows of
+    `data.csv`, which is all that older results have.
+    """
+    if not segment_path.endswith('/'):
+        segment_path += '/'
+    header_path = segment_path + 'data_header.json'
+    if os.path.exists(header_path):
+        with open(header_path, 'r') as f:
+            return int(json.load(f)['numFrames'])
+    data_path = segment_path + 'data.csv'
+    if os.path.exists(data_path):
+        # Number of rows in data_path - 1 is the length of this segment
+        return fast_count_lines(data_path) - 1
+    return None
+
+
 class ProcessingStatus(enum.Enum):
     NOT_STARTED = 0
     IN_PROGRESS = 1
@@ -148,16 +168,13 @@ class Trial:
         pre_loaded_review_frames: List[nimble.biomechanics.MissingGRFStatus] = []
         segment_index = 1
         while True:
-            data_path = trial_path + f'segment_{segment_index}/data.csv'
+            segment_length = get_segment_length(trial_path + f'segment_{segment_index}/')
             reviewed_path = trial_path + f'segment_{segment_index}/REVIEWED'
             segment_json_path = trial_path + f'segment_{segment_index}/review.json'
 
-            if not os.path.exists(data_path):
+            if segment_length is None:
                 break
 
-            # Number of rows in data_path - 1 is the length of this segment
-            segment_length = fast_count_lines(data_path) - 1
-
             if os.path.exists(reviewed_path) and os.path.exists(segment_json_path):
                 with open(segment_json_path, 'r') as f:
                     segment_json = json.load(f)
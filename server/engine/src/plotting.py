@@ -6,10 +6,13 @@ Author(s): Nicholas Bianco
 """
 
 import os
+import threading
 import numpy as np
 from collections import defaultdict, OrderedDict
-import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.ticker import FormatStrFormatter
 import matplotlib.lines as mlines
 import matplotlib
 matplotlib.use('Agg')
@@ -111,28 +114,71 @@ def bilateralize(name, ls_dict, data_type):
     return name, ls_dict
 
 
+# A page of report plots that gets reused for every page of every report this process renders. Building the figure,
+# its axes and the tight layout is a large share of the plotting time, and every page shares the same grid, so we only
+# pay for that once and just clear the axes between pages.
+class ReportPage:
+    plots_per_page = 15
+    num_cols = 3
+
+    def __init__(self):
+        num_rows = self.plots_per_page // self.num_cols + 1
+        self.fig = Figure(figsize=(8.5, 11))
+        FigureCanvasAgg(self.fig)
+        # The top row is left empty for the figure legend.
+        self.axes = [self.fig.add_subplot(num_rows, self.num_cols, p + self.num_cols)
+                     for p in range(1, self.plots_per_page + 1)]
+        self.subplot_params = None
+
+    def reset(self):
+        for ax in self.axes:
+            ax.clear()
+            ax.set_visible(False)
+        for legend in list(self.fig.legends):
+            legend.remove()
+
+    def layout(self):
+        # The first page we render computes the tight layout, and every later page reuses it.
+        if self.subplot_params is None:
+            self.fig.tight_layout()
+            params = self.fig.subplotpars
+            self.subplot_params = dict(left=params.left, right=params.right, bottom=params.bottom, top=params.top,
+                                       wspace=params.wspace, hspace=params.hspace)
+        else:
+            self.fig.subplots_adjust(**self.subplot_params)
+
+
+# Figures aren't safe to share between threads, so each thread gets its own page.
+_report_pages = threading.local()
+
+
+def get_report_page():
+    if not hasattr(_report_pages, 'page'):
+        _report_pages.page = ReportPage()
+    return _report_pages.page
+
+
 # Plot the DataFrame 'table' results into a PDF of figures at handle 'pdf'.
 def plot_table(pdf, table, refs, colors, title_dict, ls_dict, label_dict,
                legend_handles, legend_labels, motion_type, data_type):
 
     # Set plot parameters.
-    plots_per_page = 15.0
-    num_cols = 3
-    num_rows = (plots_per_page / num_cols) + 1
+    page = get_report_page()
+    plots_per_page = page.plots_per_page
 
     # Get time column.
-    time = table['time']
+    time = np.asarray(table['time'])
 
     # Loop through all keys in the dictionary and plot all variables.
     p = 1  # Counter to keep track of number of plots per page.
     for i, key in enumerate(title_dict.keys()):
         # If this is first key or if we filled up the previous page with
-        # plots, create a new figure that will become the next page.
+        # plots, clear the page so we can draw the next one on it.
         if p % plots_per_page == 1:
-            fig = plt.figure(figsize=(8.5, 11))
+            page.reset()
 
-        plt.subplot(int(num_rows), int(num_cols),
-                    int(p + num_cols))
+        ax = page.axes[p - 1]
+        ax.set_visible(True)
         # Loop through all the state variable paths for this key.
         ymin = np.inf
         ymax = -np.inf
@@ -143,15 +189,15 @@ def plot_table(pdf, table, refs, colors, title_dict, ls_dict, label_dict,
         is_moment = '_moment' in key
         is_residual = ('pelvis' in key) and (is_force or is_moment)
         for path, ls in zip(title_dict[key], ls_dict[key]):
-            var = table[path]
+            var = np.asarray(table[path])
             ymin = np.minimum(ymin, np.min(var))
             ymax = np.maximum(ymax, np.max(var))
 
             # Plot the variable values from the MocoTrajectory.
-            plt.plot(time, var, ls=ls,
-                     color='k',
-                     linewidth=1.5,
-                     zorder=4)
+            ax.plot(time, var, ls=ls,
+                    color='k',
+                    linewidth=1.5,
+                    zorder=4)
 
             # Save legend handles to report marker or residual RMSE.
             if data_type == 'marker':
@@ -172,35 +218,32 @@ def plot_table(pdf, table, refs, colors, title_dict, ls_dict, label_dict,
                     labels.append(f'RMSE = {rmse:1.2f} N-m')
 
         # Plot labels and settings.
-        plt.title(truncate(key, 38), fontsize=10)
-        plt.xlabel('time (s)', fontsize=8)
-        plt.ylabel(label_dict[key], fontsize=8)
-        plt.xticks(fontsize=6)
-        plt.yticks(fontsize=6)
-        plt.xlim(time[0], time[time.size-1])
-        plt.ticklabel_format(axis='y', style='sci', scilimits=(-3, 3))
-        ax = plt.gca()
+        ax.set_title(truncate(key, 38), fontsize=10)
+        ax.set_xlabel('time (s)', fontsize=8)
+        ax.set_ylabel(label_dict[key], fontsize=8)
+        ax.tick_params(labelsize=6)
+        ax.set_xlim(time[0], time[time.size-1])
+        ax.ticklabel_format(axis='y', style='sci', scilimits=(-3, 3))
         ax.get_yaxis().get_offset_text().set_position((-0.15, 0))
         ax.get_yaxis().get_offset_text().set_fontsize(6)
         ax.tick_params(direction='in', gridOn=True, zorder=0)
-        from matplotlib.ticker import FormatStrFormatter
         ax.xaxis.set_major_formatter(
             FormatStrFormatter('%.1f'))
 
         # Report marker or residual RMSE in axis legend.
         if data_type == 'marker':
             if ymax > 10:
-                plt.ylim(0, 2.0 * np.ceil(ymax / 2.0))
+                ax.set_ylim(0, 2.0 * np.ceil(ymax / 2.0))
             else:
-                plt.ylim(0, 10)
-                plt.yticks([0, 2, 4, 6, 8, 10])
+                ax.set_ylim(0, 10)
+                ax.set_yticks([0, 2, 4, 6, 8, 10])
 
-            plt.axhline(y=2, color='g', linestyle='--', zorder=3, lw=1.0)
-            plt.axhline(y=4, color='r', linestyle='--', zorder=3, lw=1.0)
-            plt.legend(handles, labels, fontsize=7)
+            ax.axhline(y=2, color='g', linestyle='--', zorder=3, lw=1.0)
+            ax.axhline(y=4, color='r', linestyle='--', zorder=3, lw=1.0)
+            ax.legend(handles, labels, fontsize=7)
 
         elif is_residual:
-            plt.legend(handles, labels, fontsize=7)
+            ax.legend(handles, labels, fontsize=7)
 
         # If we filled up the current figure or ran out of keys, add this
         # figure as a new page to the PDF. Otherwise, increment the plot
@@ -209,14 +252,13 @@ def plot_table(pdf, table, refs, colors, title_dict, ls_dict, label_dict,
             legfontsize = 64 / len(legend_handles)
             if legfontsize > 10:
                 legfontsize = 10
-            fig.tight_layout()
-            plt.figlegend(legend_handles, legend_labels,
-                          loc='lower center',
-                          bbox_to_anchor=(0.5, 0.85),
-                          fancybox=True, shadow=True,
-                          prop={'size': legfontsize})
-            pdf.savefig(fig)
-            plt.close()
+            page.layout()
+            page.fig.legend(legend_handles, legend_labels,
+                            loc='lower center',
+                            bbox_to_anchor=(0.5, 0.85),
+                            fancybox=True, shadow=True,
+                            prop={'size': legfontsize})
+            pdf.savefig(page.fig)
             p = 1
         else:
             p += 1
@@ -335,28 +377,19 @@ def generate_report_for_table(table, filename, output_fpath, data_type, bilatera
 # Plot joint angle results located in MOT files under results/IK.
 def plot_ik_results(data_fpath):
     table = storage2pandas(data_fpath, header_shift=-1)
-    filename = os.path.basename(data_fpath)
-    output_fpath = data_fpath.replace('.mot', '.pdf')
-    data_type = 'kinematic'
-    generate_report_for_table(table, filename, output_fpath, data_type)
+    plot_ik_table(table, data_fpath.replace('.mot', '.pdf'), os.path.basename(data_fpath))
 
 
 # Plot residual loads and joint torques located in STO files under results/ID.
 def plot_id_results(data_fpath):
     table = storage2pandas(data_fpath, header_shift=-1)
-    filename = os.path.basename(data_fpath)
-    output_fpath = data_fpath.replace('.sto', '.pdf')
-    data_type = 'kinetic'
-    generate_report_for_table(table, filename, output_fpath, data_type)
+    plot_id_table(table, data_fpath.replace('.sto', '.pdf'), os.path.basename(data_fpath))
 
 
 # Plot ground reaction force data located in MOT files under results/ID.
 def plot_grf_data(data_fpath):
     table = storage2pandas(data_fpath, header_shift=1)
-    filename = os.path.basename(data_fpath)
-    output_fpath = data_fpath.replace('.mot', '.pdf')
-    data_type = 'grf'
-    generate_report_for_table(table, filename, output_fpath, data_type, bilateral=False)
+    plot_grf_table(table, data_fpath.replace('.mot', '.pdf'), os.path.basename(data_fpath))
 
 
 # Plot marker errors located in CSV files under results/IK.
@@ -377,7 +410,35 @@ def plot_marker_errors(data_fpath, ik_fpath):
     table.insert(0, 'time', ik_table['time'])
 
     # Plot marker errors.
-    filename = os.path.basename(data_fpath)
-    output_fpath = data_fpath.replace('.csv', '.pdf')
-    data_type = 'marker'
-    generate_report_for_table(table, filename, output_fpath, data_type)
+    plot_marker_error_table(table, data_fpath.replace('.csv', '.pdf'), os.path.basename(data_fpath))
+
+
+# The functions below plot tables that are already in memory, so the writers can plot the results they just computed
+# without parsing them back out of the files they wrote. Each table has a 'time' column, followed by one column per
+# variable, named the same way as the columns of the corresponding results file.
+
+# Build a table from a (num_columns x num_timesteps) array, the same shape the processing passes store their results in.
+def table_from_array(timestamps, column_names, values):
+    table = pd.DataFrame(np.asarray(values, dtype=np.float64).T, columns=list(column_names))
+    table.insert(0, 'time', np.asarray(timestamps, dtype=np.float64))
+    return table
+
+
+# Plot a table of joint angles (in radians).
+def plot_ik_table(table, output_fpath, filename):
+    generate_report_for_table(table, filename, output_fpath, 'kinematic')
+
+
+# Plot a table of residual loads and joint torques.
+def plot_id_table(table, output_fpath, filename):
+    generate_report_for_table(table, filename, output_fpath, 'kinetic')
+
+
+# Plot a table of ground reaction forces, centers of pressure and moments.
+def plot_grf_table(table, output_fpath, filename):
+    generate_report_for_table(table, filename, output_fpath, 'grf', bilateral=False)
+
+
+# Plot a table of marker errors (in cm).
+def plot_marker_error_table(table, output_fpath, filename):
+    generate_report_for_table(table, filename, output_fpath, 'marker')
@@ -1,9 +1,22 @@
 import nimblephysics as nimble
-from typing import Dict, List, Tuple
+from typing import Dict, List, Tuple, Optional, Callable
 import tempfile
 import shutil
 import numpy as np
 import subprocess
+import xml.etree.ElementTree as ET
+
+# Components that carry a `location` on a parent frame, which the OpenSim ScaleTool scales by that frame's body scale.
+STATION_TAGS = ['Marker', 'Station', 'PathPoint', 'ConditionalPathPoint']
+# Components whose location is a function of a coordinate, one function per axis.
+MOVING_POINT_TAGS = ['MovingPathPoint']
+# Path-based forces store these rest lengths, which OpenSim scales by the ratio of post- to pre-scale path length.
+PATH_LENGTH_PROPERTIES = ['optimal_fiber_length', 'tendon_slack_length', 'resting_length']
+# Components whose scaling rules we have not mirrored from OpenSim's ScaleTool. Models containing any of them are
+# scaled with opensim-cmd instead.
+UNSUPPORTED_TAGS = ['ConstantCurvatureJoint', 'EllipsoidJoint', 'ScapulothoracicJoint', 'WrapTorus']
+# OpenSim function types that don't end with "Function".
+FUNCTION_TAGS = ['SimmSpline', 'NaturalCubicSpline', 'GCVSpline', 'Constant', 'StepFunction', 'Sine']
 
 
 def scale_opensim_model(unscaled_generic_osim_text: str,
@@ -11,7 +24,49 @@ def scale_opensim_model(unscaled_generic_osim_text: str,
                         mass_kg: float,
                         height_m: float,
                         markers: Dict[str, Tuple[nimble.dynamics.BodyNode, np.ndarray]],
-                        overwrite_inertia: bool = False) -> str:
+                        overwrite_inertia: bool = False,
+                        use_opensim_cmd: bool = False) -> str:
+    """
+    Apply the body scales and marker offsets from `skel` and `markers` to the unscaled OpenSim model, and rescale the
+    body masses so that the model weighs `mass_kg`. By default this edits the OpenSim XML directly, following the same
+    rules as the OpenSim ScaleTool. Pass `use_opensim_cmd=True` to run the ScaleTool itself through `opensim-cmd`
+    instead. That path is also used automatically for pre-4.0 model files, and for models with components (see
+    `UNSUPPORTED_TAGS`) that the in-process path doesn't know how to scale.
+    """
+    if use_opensim_cmd or not supports_in_process_scaling(unscaled_generic_osim_text):
+        return scale_opensim_model_with_opensim_cmd(unscaled_generic_osim_text,
+                                                    skel,
+                                                    mass_kg,
+                                                    height_m,
+                                                    markers,
+                                                    overwrite_inertia)
+    return scale_opensim_model_in_process(unscaled_generic_osim_text,
+                                          skel,
+                                          mass_kg,
+                                          markers,
+                                          overwrite_inertia)
+
+
+def supports_in_process_scaling(osim_text: str) -> bool:
+    try:
+        root = ET.fromstring(osim_text)
+    except ET.ParseError:
+        return False
+    try:
+        version = int(root.get('Version', '0'))
+    except ValueError:
+        return False
+    if root.find('Model') is None or version < 40000:
+        return False
+    return not any(root.find('.//' + tag) is not None for tag in UNSUPPORTED_TAGS)
+
+
+def scale_opensim_model_with_opensim_cmd(unscaled_generic_osim_text: str,
+                                         skel: nimble.dynamics.Skeleton,
+                                         mass_kg: float,
+                                         height_m: float,
+                                         markers: Dict[str, Tuple[nimble.dynamics.BodyNode, np.ndarray]],
+                                         overwrite_inertia: bool = False) -> str:
     marker_names: List[str] = []
     if skel is not None:
         print('Adjusting marker locations on scaled OpenSim file', flush=True)
@@ -75,3 +130,362 @@ def scale_opensim_model(unscaled_generic_osim_text: str,
         with open(tmpdirname + 'output_scaled.osim') as f:
             output_file_raw_text = '\n'.join(f.readlines())
     return output_file_raw_text
+
+
+def scale_opensim_model_in_process(unscaled_generic_osim_text: str,
+                                   skel: nimble.dynamics.Skeleton,
+                                   mass_kg: float,
+                                   markers: Dict[str, Tuple[nimble.dynamics.BodyNode, np.ndarray]],
+                                   overwrite_inertia: bool = False) -> str:
+    """
+    This reproduces what `opensim-cmd run-tool` does with the "manualScale" setup file written by
+    `saveOsimScalingXMLFile`, without leaving the process:
+    - Marker locations are replaced by the optimized offsets (the equivalent of `moveOsimMarkers`)
+    - Joint offset frames, custom joint translation functions, markers, path points, wrap objects, contact geometry
+    and attached geometry are scaled by the scale of the body they are attached to
+    - Body mass centers and inertias are scaled, and masses are scaled by volume and then renormalized to `mass_kg`
+    - Muscle and ligament rest lengths are scaled by the change in path length in the default pose. Unlike OpenSim,
+    this path length ignores wrapping surfaces and moving path points.
+    """
+    print('Scaling OpenSim file in-process', flush=True)
+    parser = ET.XMLParser(target=ET.TreeBuilder(insert_comments=True))
+    root = ET.fromstring(unscaled_generic_osim_text, parser=parser)
+    model = root.find('Model')
+
+    body_scales: Dict[str, np.ndarray] = {}
+    for i in range(skel.getNumBodyNodes()):
+        body_node: nimble.dynamics.BodyNode = skel.getBodyNode(i)
+        body_scales[body_node.getName()] = np.array(body_node.getScale())
+
+    bodies: Dict[str, ET.Element] = {body.get('name'): body for body in model.iter('Body')}
+    parents: Dict[ET.Element, ET.Element] = {child: parent for parent in model.iter() for child in parent}
+    named_components: Dict[str, ET.Element] = {}
+    for component in model.iter():
+        if component.get('name') is not None and component.get('name') not in named_components:
+            named_components[component.get('name')] = component
+
+    def owner(element: ET.Element) -> Optional[ET.Element]:
+        element = parents.get(element)
+        while element is not None and (element.get('name') is None or element.tag.endswith('Set')):
+            element = parents.get(element)
+        return element
+
+    def body_for_socket(element: ET.Element, socket: str, depth: int = 0) -> Optional[str]:
+        """
+        Find the name of the body that the frame at the `socket` path (relative to `element`) is ultimately attached to.
+        """
+        socket_element = element.find(socket)
+        if socket_element is None or socket_element.text is None or depth > 16:
+            return None
+        path = socket_element.text.strip()
+        frame: Optional[ET.Element] = element
+        if path.startswith('/'):
+            frame = named_components.get(path.rstrip('/').split('/')[-1])
+        else:
+            for part in path.split('/'):
+                if part == '..':
+                    frame = owner(frame)
+                elif part not in ['', '.'] and frame is not None:
+                    frame = next((child for child in frame.iter() if child.get('name') == part),
+                                 named_components.get(part))
+        if frame is None:
+            return None
+        if frame.tag == 'Body':
+            return frame.get('name')
+        if frame.tag == 'PhysicalOffsetFrame':
+            return body_for_socket(frame, 'socket_parent', depth + 1)
+        return None
+
+    def scale_for_socket(element: ET.Element, socket: str) -> Optional[np.ndarray]:
+        body_name = body_for_socket(element, socket)
+        if body_name is None:
+            return None
+        return body_scales.get(body_name)
+
+    # 1. Move the markers to their optimized locations, before any scaling is applied. Like OpenSim, we only keep the
+    # first marker with any given name.
+    seen_markers = set()
+    for marker_set in model.iter('MarkerSet'):
+        for marker in _children(marker_set, 'objects'):
+            marker_name = marker.get('name')
+            if marker_name in seen_markers:
+                parents[marker].remove(marker)
+                continue
+            seen_markers.add(marker_name)
+            if marker_name in markers:
+                _set_vec(marker, 'location', markers[marker_name][1])
+
+    # 2. Record the muscle and ligament path lengths in the default pose, before scaling
+    default_positions = _default_positions(model, skel)
+    unscaled_skel = skel.clone()
+    unscaled_skel.setBodyScales(np.ones(unscaled_skel.getNumBodyNodes() * 3))
+    unscaled_skel.setPositions(default_positions)
+    paths = [force for force in model.iter() if force.find('GeometryPath') is not None]
+
+    def point_body(point: ET.Element) -> Optional[str]:
+        return body_for_socket(point, 'socket_parent_frame')
+
+    pre_scale_lengths = [_path_length(force, unscaled_skel, point_body, default_positions) for force in paths]
+
+    # 3. Scale everything that is attached to a body
+    for frame in model.iter('PhysicalOffsetFrame'):
+        scale = scale_for_socket(frame, 'socket_parent')
+        if scale is not None:
+            _scale_vec(frame, 'translation', scale)
+            for geometry in _children(frame, 'attached_geometry'):
+                _scale_vec(geometry, 'scale_factors', scale)
+
+    for joint in model.iter('CustomJoint'):
+        # OpenSim scales every translation axis by the parent frame's body scale, projected onto the axis direction.
+        scale = scale_for_socket(joint, 'socket_parent_frame')
+        if scale is None:
+            continue
+        for axis in _children(joint, 'SpatialTransform'):
+            direction = _get_vec(axis, 'axis')
+            if axis.get('name', '').startswith('translation') and direction is not None:
+                _multiply_function(axis, float(np.dot(np.abs(direction), scale) / np.linalg.norm(direction)))
+
+    for tag in STATION_TAGS:
+        for station in model.iter(tag):
+            scale = scale_for_socket(station, 'socket_parent_frame')
+            if scale is not None:
+                _scale_vec(station, 'location', scale)
+
+    for tag in MOVING_POINT_TAGS:
+        for station in model.iter(tag):
+            scale = scale_for_socket(station, 'socket_parent_frame')
+            if scale is None:
+                continue
+            for i, location_property in enumerate(['x_location', 'y_location', 'z_location']):
+                location = station.find(location_property)
+                if location is not None:
+                    _multiply_function(location, scale[i])
+
+    for contact_geometry_set in model.iter('ContactGeometrySet'):
+        for geometry in _children(contact_geometry_set, 'objects'):
+            scale = scale_for_socket(geometry, 'socket_frame')
+            if scale is not None:
+                _scale_vec(geometry, 'location', scale)
+
+    for body_name, body in bodies.items():
+        scale = body_scales.get(body_name)
+        if scale is None:
+            continue
+        for geometry in _children(body, 'attached_geometry'):
+            _scale_vec(geometry, 'scale_factors', scale)
+        for wrap_object in _children(body, 'WrapObjectSet/objects'):
+            _scale_wrap_object(wrap_object, scale)
+        _scale_inertial_properties(body, scale)
+
+    # 4. Normalize the total mass, the same way the ScaleTool does with `preserve_mass_distribution` off
+    total_mass = sum(_get_float(body, 'mass') for body in bodies.values())
+    if mass_kg > 0 and total_mass > 0:
+        mass_ratio = mass_kg / total_mass
+        for body in bodies.values():
+            _set_text(body, 'mass', _format(_get_float(body, 'mass') * mass_ratio))
+            _scale_vec(body, 'inertia', np.ones(6) * mass_ratio)
+
+    # 5. Scale the rest lengths of muscles and ligaments by the change in their path length
+    scaled_skel = skel.clone()
+    scaled_skel.setPositions(default_positions)
+    for force, pre_scale_length in zip(paths, pre_scale_lengths):
+        post_scale_length = _path_length(force, scaled_skel, point_body, default_positions)
+        if pre_scale_length <= 0:
+            continue
+        for length_property in PATH_LENGTH_PROPERTIES:
+            if force.find(length_property) is not None:
+                _set_text(force, length_property,
+                          _format(_get_float(force, length_property) * post_scale_length / pre_scale_length))
+
+    output_text = ET.tostring(root, encoding='unicode')
+    output_text = '<?xml version="1.0" encoding="UTF-8" ?>\n' + output_text + '\n'
+
+    if overwrite_inertia:
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            if not tmpdirname.endswith('/'):
+                tmpdirname += '/'
+            with open(tmpdirname + 'optimized_scale_and_markers.osim', 'w') as f:
+                f.write(output_text)
+            nimble.biomechanics.OpenSimParser.replaceOsimInertia(
+                tmpdirname + 'optimized_scale_and_markers.osim',
+                skel,
+                tmpdirname + 'output_scaled.osim')
+            with open(tmpdirname + 'output_scaled.osim') as f:
+                output_text = f.read()
+
+    return output_text
+
+
+def _children(element: ET.Element, path: Optional[str] = None) -> List[ET.Element]:
+    """
+    The child elements of `element` (or of the element at `path` under it), skipping comments.
+    """
+    if path is not None:
+        element = element.find(path)
+    if element is None:
+        return []
+    return [child for child in element if isinstance(child.tag, str)]
+
+
+def _format(value: float) -> str:
+    return repr(float(value))
+
+
+def _get_float(element: ET.Element, tag: str) -> float:
+    child = element.find(tag)
+    if child is None or child.text is None:
+        return 0.0
+    return float(child.text.strip())
+
+
+def _get_vec(element: ET.Element, tag: str) -> Optional[np.ndarray]:
+    child = element.find(tag)
+    if child is None or child.text is None:
+        return None
+    return np.array([float(x) for x in child.text.split()])
+
+
+def _set_text(element: ET.Element, tag: str, text: str):
+    child = element.find(tag)
+    if child is None:
+        child = ET.SubElement(element, tag)
+    child.text = text
+
+
+def _set_vec(element: ET.Element, tag: str, values: np.ndarray):
+    _set_text(element, tag, ' '.join(_format(v) for v in values))
+
+
+def _scale_vec(element: ET.Element, tag: str, scale: np.ndarray):
+    values = _get_vec(element, tag)
+    if values is not None and len(values) == len(scale):
+        _set_vec(element, tag, values * scale)
+
+
+def _multiply_function(parent: ET.Element, scale: float):
+    """
+    Wrap the function stored under `parent` in a MultiplierFunction, or update the scale of an existing one, which is
+    how OpenSim scales coordinate-dependent translations.
+    """
+    function = None
+    for child in _children(parent):
+        if child.tag.endswith('Function') or child.tag in FUNCTION_TAGS:
+            function = child
+            break
+    if function is None:
+        return
+    if function.tag == 'MultiplierFunction':
+        _set_text(function, 'scale', _format(_get_float(function, 'scale') * scale))
+        return
+    index = list(parent).index(function)
+    parent.remove(function)
+    multiplier = ET.Element('MultiplierFunction')
+    if function.get('name') is not None:
+        multiplier.set('name', function.get('name'))
+        del function.attrib['name']
+    ET.SubElement(multiplier, 'function').append(function)
+    _set_text(multiplier, 'scale', _format(scale))
+    parent.insert(index, multiplier)
+
+
+def _scale_wrap_object(wrap_object: ET.Element, scale: np.ndarray):
+    _scale_vec(wrap_object, 'translation', scale)
+    rotation = _get_vec(wrap_object, 'xyz_body_rotation')
+    if rotation is None:
+        rotation = np.zeros(3)
+    # Express each of the wrap object's local axes in the body frame, and measure how much the body scale stretches it
+    axes_in_body = nimble.math.eulerXYZToMatrix(rotation)
+    axis_scales = np.linalg.norm(axes_in_body * scale[:, np.newaxis], axis=0)
+    if wrap_object.tag == 'WrapCylinder':
+        _set_text(wrap_object, 'radius', _format(_get_float(wrap_object, 'radius') *
+                                                 0.5 * (axis_scales[0] + axis_scales[1])))
+        _set_text(wrap_object, 'length', _format(_get_float(wrap_object, 'length') * axis_scales[2]))
+    elif wrap_object.tag == 'WrapSphere':
+        _set_text(wrap_object, 'radius', _format(_get_float(wrap_object, 'radius') * np.mean(axis_scales)))
+    elif wrap_object.tag == 'WrapEllipsoid':
+        _scale_vec(wrap_object, 'dimensions', axis_scales)
+
+
+def _scale_inertial_properties(body: ET.Element, scale: np.ndarray):
+    """
+    This follows OpenSim's Body::scaleInertialProperties(), with the mass scaled by volume.
+    """
+    unscaled_mass = _get_float(body, 'mass')
+    mass = unscaled_mass * abs(scale[0] * scale[1] * scale[2])
+    _set_text(body, 'mass', _format(mass))
+    _scale_vec(body, 'mass_center', scale)
+
+    inertia_vec = _get_vec(body, 'inertia')
+    if inertia_vec is None or len(inertia_vec) != 6:
+        return
+    inertia = np.array([[inertia_vec[0], inertia_vec[3], inertia_vec[4]],
+                        [inertia_vec[3], inertia_vec[1], inertia_vec[5]],
+                        [inertia_vec[4], inertia_vec[5], inertia_vec[2]]])
+    abs_scale = np.abs(scale)
+    if mass <= np.finfo(float).eps:
+        inertia *= 0.0
+    elif np.isclose(abs_scale[0], abs_scale[1]) and np.isclose(abs_scale[1], abs_scale[2]):
+        inertia *= abs(scale[0] * scale[1] * scale[2]) * scale[0] * scale[0]
+    else:
+        # If the scale factors are not equal, assume that the segment is a cylinder, whose axis is along the direction
+        # with the smallest moment of inertia.
+        axis = int(np.argmin(np.diag(inertia)))
+        term = 2.0 * inertia[axis, axis] / unscaled_mass
+        radius = np.sqrt(term) if term >= 0.0 else 0.0
+        other_axis = 1 if axis == 0 else 0
+        term = 12.0 * (inertia[other_axis, other_axis] - 0.25 * unscaled_mass * radius * radius) / unscaled_mass
+        length = np.sqrt(term) if term >= 0.0 else 0.0
+        length *= scale[axis]
+        radial_axes = [i for i in range(3) if i != axis]
+        rad_sqr = radius * scale[radial_axes[0]] * radius * scale[radial_axes[1]]
+        for i in range(3):
+            if i == axis:
+                inertia[i, i] = 0.5 * mass * rad_sqr
+            else:
+                inertia[i, i] = mass * ((length * length / 12.0) + 0.25 * rad_sqr)
+        # The products of inertia scale like the mass distribution they integrate over.
+        inertia[0, 1] *= scale[0] * scale[1] * mass / unscaled_mass
+        inertia[0, 2] *= scale[0] * scale[2] * mass / unscaled_mass
+        inertia[1, 2] *= scale[1] * scale[2] * mass / unscaled_mass
+    _set_vec(body, 'inertia', np.array([inertia[0, 0], inertia[1, 1], inertia[2, 2],
+                                        inertia[0, 1], inertia[0, 2], inertia[1, 2]]))
+
+
+def _default_positions(model: ET.Element, skel: nimble.dynamics.Skeleton) -> np.ndarray:
+    positions = np.zeros(skel.getNumDofs())
+    for coordinate in model.iter('Coordinate'):
+        dof = skel.getDof(coordinate.get('name', ''))
+        if dof is not None:
+            positions[dof.getIndexInSkeleton()] = _get_float(coordinate, 'default_value')
+    return positions
+
+
+def _path_length(force: ET.Element,
+                 skel: nimble.dynamics.Skeleton,
+                 point_body: Callable[[ET.Element], Optional[str]],
+                 positions: np.ndarray) -> float:
+    """
+    The length of the straight line segments between the active path points of `force`, in the default pose.
+    """
+    points: List[np.ndarray] = []
+    for point in force.find('GeometryPath').iter():
+        if point.tag not in ['PathPoint', 'ConditionalPathPoint']:
+            continue
+        if point.tag == 'ConditionalPathPoint':
+            coordinate = point.find('socket_coordinate')
+            coordinate_range = _get_vec(point, 'range')
+            if coordinate is not None and coordinate.text is not None and coordinate_range is not None:
+                dof = skel.getDof(coordinate.text.strip().split('/')[-1])
+                if dof is not None:
+                    value = positions[dof.getIndexInSkeleton()]
+                    if value < coordinate_range[0] or value > coordinate_range[1]:
+                        continue
+        location = _get_vec(point, 'location')
+        body_name = point_body(point)
+        if location is None:
+            continue
+        body_node = skel.getBodyNode(body_name) if body_name is not None else None
+        if body_node is None:
+            continue
+        points.append(body_node.getWorldTransform().multiply(location))
+    return float(sum(np.linalg.norm(points[i + 1] - points[i]) for i in range(len(points) - 1)))
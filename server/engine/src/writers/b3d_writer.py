@@ -0,0 +1,35 @@
+import nimblephysics as nimble
+
+
+def write_dynamics_trials_only_b3d(b3d_path: str, output_path: str) -> bool:
+    """
+    Write a copy of the B3D file at `b3d_path` to `output_path`, keeping only the trials that made it through the
+    dynamics pass. This returns False, and doesn't write anything, if there aren't any. We load our own copy of the
+    subject, rather than filtering the trials of the one in memory, so this can run while the other writers are still
+    reading that one.
+    """
+    subject = nimble.biomechanics.SubjectOnDisk(b3d_path)
+    subject.loadAllFrames(doNotStandardizeForcePlateData=True)
+
+    # Check if we have any dynamics trials
+    pass_index = -1
+    for p in range(subject.getNumProcessingPasses()):
+        if subject.getProcessingPassType(p) == nimble.biomechanics.ProcessingPassType.DYNAMICS:
+            pass_index = p
+
+    num_dynamics_trials = 0
+    include_dynamics_trials = []
+    if pass_index > -1:
+        for trial in range(subject.getNumTrials()):
+            if subject.getTrialNumProcessingPasses(trial) > pass_index:
+                include_dynamics_trials.append(True)
+                num_dynamics_trials += 1
+            else:
+                include_dynamics_trials.append(False)
+
+    if num_dynamics_trials == 0:
+        return False
+    print('Writing B3D file encoded results which have been filtered to only include dynamics trials', flush=True)
+    subject.getHeaderProto().filterTrials(include_dynamics_trials)
+    nimble.biomechanics.SubjectOnDisk.writeB3D(output_path, subject.getHeaderProto())
+    return True
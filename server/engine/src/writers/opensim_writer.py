@@ -1,17 +1,34 @@
 import os
+import concurrent.futures
 import nimblephysics as nimble
 import shutil
-from typing import List, Optional
-from plotting import plot_ik_results, plot_id_results, plot_marker_errors, plot_grf_data
+from typing import Dict, List, Optional
+from plotting import table_from_array, plot_ik_table, plot_id_table, plot_marker_error_table, plot_grf_table
+from writers.output_pool import load_subject, load_opensim_file, StreamingZipWriter
 import numpy as np
 
 KINEMATIC_OSIM_NAME = 'match_markers_but_ignore_physics.osim'
 DYNAMICS_OSIM_NAME = 'match_markers_and_physics.osim'
 
+# How to handle the PDF plots of the results: 'inline' renders each trial's plots along with its result files,
+# 'deferred' renders all the plots once every trial's result files are written, and 'skip' doesn't render them at all.
+PLOT_MODES = ['inline', 'deferred', 'skip']
+
 
 def write_opensim_results(subject: nimble.biomechanics.SubjectOnDisk,
                           output_folder: str,
-                          original_geometry_folder_path: Optional[str] = None):
+                          original_geometry_folder_path: Optional[str] = None,
+                          b3d_path: Optional[str] = None,
+                          executor: Optional[concurrent.futures.Executor] = None,
+                          plots: str = 'inline'):
+    """
+    Write out a folder of OpenSim results files, and a zip of that folder next to it. If `executor` and `b3d_path` are
+    given, each trial is written by a pool worker that loads its own copy of the subject from the B3D file, and the zip
+    is built as the trials come back. `plots` is one of PLOT_MODES.
+    """
+    if plots not in PLOT_MODES:
+        raise ValueError(f'Unknown plot mode "{plots}", expected one of {PLOT_MODES}')
+    trial_plots = 'inline' if plots == 'inline' else 'skip'
     if not output_folder.endswith('/'):
         output_folder += '/'
 
@@ -29,158 +46,316 @@ def write_opensim_results(subject: nimble.biomechanics.SubjectOnDisk,
     if not os.path.exists(output_folder + 'MarkerData'):
         os.mkdir(output_folder + 'MarkerData')
 
-    # Write the OpenSim model file to the output folder.
-    model_text = subject.getOpensimFileText(subject.getNumProcessingPasses()-1)
-    with open(output_folder + 'Models/unscaled_generic.osim', 'w') as f:
-        f.write(model_text)
+    with StreamingZipWriter(output_folder[:-1] + '.zip',
+                            output_folder,
+                            os.path.basename(output_folder[:-1])) as zip_writer:
+        # Write the OpenSim model file to the output folder.
+        model_text = subject.getOpensimFileText(subject.getNumProcessingPasses()-1)
+        with open(output_folder + 'Models/unscaled_generic.osim', 'w') as f:
+            f.write(model_text)
+        zip_writer.add_files([output_folder + 'Models/unscaled_generic.osim'])
 
-    osim_path: str = 'Models/' + KINEMATIC_OSIM_NAME
+        # Copy over the geometry files, so the model can be loaded directly in OpenSim without chasing down
+        # Geometry files somewhere else.
+        if original_geometry_folder_path is not None:
+            shutil.copytree(original_geometry_folder_path, output_folder + 'Models/Geometry')
+            zip_writer.add_folder(output_folder + 'Models/Geometry')
 
-    # Copy over the geometry files, so the model can be loaded directly in OpenSim without chasing down
-    # Geometry files somewhere else.
-    if original_geometry_folder_path is not None:
-        shutil.copytree(original_geometry_folder_path, output_folder + 'Models/Geometry')
+        # 9.9. Write the results to disk, adding each trial's files to the zip as soon as they're done.
+        if executor is not None and b3d_path is not None:
+            futures = [executor.submit(_write_opensim_trial_results_from_b3d, b3d_path, i, output_folder, trial_plots)
+                       for i in range(subject.getNumTrials())]
+            for future in concurrent.futures.as_completed(futures):
+                zip_writer.add_files(future.result())
+            if plots == 'deferred':
+                futures = [executor.submit(_plot_opensim_trial_results_from_b3d, b3d_path, i, output_folder)
+                           for i in range(subject.getNumTrials())]
+                for future in concurrent.futures.as_completed(futures):
+                    zip_writer.add_files(future.result())
+        else:
+            # Load the OpenSim file
+            osim = subject.readOpenSimFile(subject.getNumProcessingPasses()-1, ignoreGeometry=True)
+            for i in range(subject.getNumTrials()):
+                zip_writer.add_files(write_opensim_trial_results(subject, i, output_folder, osim, trial_plots))
+            if plots == 'deferred':
+                for i in range(subject.getNumTrials()):
+                    zip_writer.add_files(plot_opensim_trial_results(subject, i, output_folder, osim))
+    print('Finished outputting OpenSim files.', flush=True)
 
-    # Load the OpenSim file
-    osim = subject.readOpenSimFile(subject.getNumProcessingPasses()-1, ignoreGeometry=True)
-    marker_names: List[str] = list(osim.markersMap.keys())
 
-    # 9.9. Write the results to disk.
+def _write_opensim_trial_results_from_b3d(b3d_path: str,
+                                          trial_index: int,
+                                          output_folder: str,
+                                          plots: str = 'inline') -> List[str]:
+    subject = load_subject(b3d_path)
+    osim = load_opensim_file(b3d_path, subject.getNumProcessingPasses()-1)
+    return write_opensim_trial_results(subject, trial_index, output_folder, osim, plots)
+
+
+def _plot_opensim_trial_results_from_b3d(b3d_path: str, trial_index: int, output_folder: str) -> List[str]:
+    subject = load_subject(b3d_path)
+    osim = load_opensim_file(b3d_path, subject.getNumProcessingPasses()-1)
+    return plot_opensim_trial_results(subject, trial_index, output_folder, osim)
+
+
+def write_opensim_trial_results(subject: nimble.biomechanics.SubjectOnDisk,
+                                i: int,
+                                output_folder: str,
+                                osim: nimble.biomechanics.OpenSimFile,
+                                plots: str = 'inline') -> List[str]:
+    """
+    Write out the OpenSim files for trial `i` (and, if `plots` is 'inline', their plots), and return the paths of
+    every file written.
+    """
+    osim_path: str = 'Models/' + KINEMATIC_OSIM_NAME
+    marker_names: List[str] = list(osim.markersMap.keys())
     trial_protos = subject.getHeaderProto().getTrials()
-    for i in range(subject.getNumTrials()):
-        trial_proto = trial_protos[i]
-        trial_name = subject.getTrialName(i)
-        print('Writing OpenSim output for trial ' + trial_name, flush=True)
-
-        trial_passes = trial_proto.getPasses()
-        any_dynamics_passes = any([p.getType() == nimble.biomechanics.ProcessingPassType.DYNAMICS for p in trial_passes])
-        any_kinematics_passes = any([p.getType() == nimble.biomechanics.ProcessingPassType.KINEMATICS for p in trial_passes])
-
-        ik_fpath = ''
-        id_fpath = ''
-        grf_fpath = ''
-        grf_raw_fpath = ''
-        # Write out the result data files.
-        result_ik: Optional[nimble.biomechanics.IKErrorReport] = None
-        marker_observations = None
-        if any_dynamics_passes:
-            last_pass = trial_passes[-1]
-            poses = last_pass.getPoses()
-            taus = last_pass.getTaus()
-            marker_observations = trial_proto.getMarkerObservations()
-            print(f'Writing OpenSim ID file, shape={str(poses.shape)}', flush=True)
-            timestamps = np.array(list(range(poses.shape[1]))) * subject.getTrialTimestep(i)
-
-            # Write out the inverse kinematics results,
-            ik_fpath = f'{output_folder}IK/{trial_name}_ik.mot'
-            print(f'Writing OpenSim {ik_fpath} file, shape={str(poses.shape)}', flush=True)
-            nimble.biomechanics.OpenSimParser.saveMot(osim.skeleton,
-                                                      ik_fpath,
-                                                      timestamps,
-                                                      poses)
-            # Write the inverse dynamics results.
-            id_fpath = f'{output_folder}ID/{trial_name}_id.sto'
-            nimble.biomechanics.OpenSimParser.saveIDMot(osim.skeleton,
-                                                        id_fpath,
-                                                        timestamps,
-                                                        taus)
-            # Create the IK error report for this segment
-            result_ik = nimble.biomechanics.IKErrorReport(
-                osim.skeleton,
-                osim.markersMap,
-                poses,
-                marker_observations)
-            # Write out the OpenSim ID files:
-            grf_fpath = f'{output_folder}ID/{trial_name}_grf.mot'
-            grf_raw_fpath = f'{output_folder}ID/{trial_name}_grf_raw.mot'
-
-            force_plates = last_pass.getProcessedForcePlates()
-
-            nimble.biomechanics.OpenSimParser.saveProcessedGRFMot(
-                grf_fpath,
-                timestamps,
-                [osim.skeleton.getBodyNode(name) for name in subject.getGroundForceBodies()],
-                osim.skeleton,
-                poses,
-                force_plates,
-                last_pass.getGroundBodyWrenches())
-            nimble.biomechanics.OpenSimParser.saveOsimInverseDynamicsProcessedForcesXMLFile(
-                trial_name,
-                [osim.skeleton.getBodyNode(name) for name in subject.getGroundForceBodies()],
-                trial_name + '_grf.mot',
-                output_folder + 'ID/' + trial_name + '_external_forces.xml')
-            nimble.biomechanics.OpenSimParser.saveRawGRFMot(grf_fpath, timestamps, force_plates)
-            nimble.biomechanics.OpenSimParser.saveOsimInverseDynamicsRawForcesXMLFile(
-                trial_name,
-                osim.skeleton,
-                poses,
-                force_plates,
-                trial_name + '_grf.mot',
-                output_folder + 'ID/' + trial_name + '_external_forces.xml')
-            nimble.biomechanics.OpenSimParser.saveOsimInverseDynamicsXMLFile(
-                trial_name,
-                '../Models/' + DYNAMICS_OSIM_NAME,
-                '../IK/' + trial_name + '_ik.mot',
-                trial_name + '_external_forces.xml',
-                trial_name + '_id.sto',
-                trial_name + '_id_body_forces.sto',
-                output_folder + 'ID/' + trial_name + '_id_setup.xml',
-                min(timestamps), max(timestamps))
-
-        elif any_kinematics_passes:
-            # Write out the inverse kinematics results,
-            ik_fpath = f'{output_folder}IK/{trial_name}_ik.mot'
-            last_pass = trial_passes[-1]
-            poses = last_pass.getPoses()
-            marker_observations = trial_proto.getMarkerObservations()
-            timestamps = np.array(range(poses.shape[1])) * subject.getTrialTimestep(i)
-            print(f'Writing OpenSim {ik_fpath} file, shape={str(poses.shape)}', flush=True)
-            nimble.biomechanics.OpenSimParser.saveMot(osim.skeleton, ik_fpath, timestamps,
-                                                      poses)
-            # Create the IK error report for this segment
-            result_ik = nimble.biomechanics.IKErrorReport(
-                osim.skeleton, osim.markersMap, poses, marker_observations)
-
-        if result_ik is not None:
-            # Save OpenSim setup files to make it easy to (re)run IK on the results in OpenSim
-            nimble.biomechanics.OpenSimParser.saveOsimInverseKinematicsXMLFile(
-                trial_name,
-                marker_names,
-                f'../{osim_path}',
-                f'../MarkerData/{trial_name}.trc',
-                f'{trial_name}_ik_by_opensim.mot',
-                f'{output_folder}IK/{trial_name}_ik_setup.xml')
-
-        if marker_observations is not None:
-            # Write out the marker trajectories.
-            markers_fpath = f'{output_folder}MarkerData/{trial_name}.trc'
-            print('Saving TRC for trial ' + trial_name, flush=True)
-            timestamps = np.array(range(len(marker_observations))) * subject.getTrialTimestep(i)
-            nimble.biomechanics.OpenSimParser.saveTRC(
-                markers_fpath, timestamps, marker_observations)
-            print('Saved', flush=True)
-
-        # Write out the marker errors.
-        if result_ik is not None:
-            marker_errors_fpath = f'{output_folder}IK/{trial_name}_marker_errors.csv'
-            result_ik.saveCSVMarkerErrorReport(marker_errors_fpath)
-
-        # 9.9.11. Plot results.
-        print(f'Plotting results for trial {trial_name}')
-        if ik_fpath and os.path.exists(ik_fpath):
-            plot_ik_results(ik_fpath)
-            plot_marker_errors(marker_errors_fpath, ik_fpath)
-
-        if id_fpath and os.path.exists(id_fpath):
-            plot_id_results(id_fpath)
-
-        if grf_fpath and os.path.exists(grf_fpath):
-            plot_grf_data(grf_fpath)
-
-        if os.path.exists(grf_raw_fpath):
-            plot_grf_data(grf_raw_fpath)
-
-    print('Zipping up OpenSim files...', flush=True)
-    shutil.make_archive(output_folder, 'zip', output_folder, output_folder)
-    print('Finished outputting OpenSim files.', flush=True)
+    trial_proto = trial_protos[i]
+    trial_name = subject.getTrialName(i)
+    print('Writing OpenSim output for trial ' + trial_name, flush=True)
+
+    trial_passes = trial_proto.getPasses()
+    any_dynamics_passes = any([p.getType() == nimble.biomechanics.ProcessingPassType.DYNAMICS for p in trial_passes])
+    any_kinematics_passes = any([p.getType() == nimble.biomechanics.ProcessingPassType.KINEMATICS for p in trial_passes])
+
+    ik_fpath = ''
+    id_fpath = ''
+    grf_fpath = ''
+    written_files: List[str] = []
+    # Write out the result data files.
+    result_ik: Optional[nimble.biomechanics.IKErrorReport] = None
+    marker_observations = None
+    if any_dynamics_passes:
+        last_pass = trial_passes[-1]
+        poses = last_pass.getPoses()
+        taus = last_pass.getTaus()
+        marker_observations = trial_proto.getMarkerObservations()
+        print(f'Writing OpenSim ID file, shape={str(poses.shape)}', flush=True)
+        timestamps = np.array(list(range(poses.shape[1]))) * subject.getTrialTimestep(i)
+
+        # Write out the inverse kinematics results,
+        ik_fpath = f'{output_folder}IK/{trial_name}_ik.mot'
+        print(f'Writing OpenSim {ik_fpath} file, shape={str(poses.shape)}', flush=True)
+        nimble.biomechanics.OpenSimParser.saveMot(osim.skeleton,
+                                                  ik_fpath,
+                                                  timestamps,
+                                                  poses)
+        written_files.append(ik_fpath)
+        # Write the inverse dynamics results.
+        id_fpath = f'{output_folder}ID/{trial_name}_id.sto'
+        nimble.biomechanics.OpenSimParser.saveIDMot(osim.skeleton,
+                                                    id_fpath,
+                                                    timestamps,
+                                                    taus)
+        written_files.append(id_fpath)
+        # Create the IK error report for this segment
+        result_ik = nimble.biomechanics.IKErrorReport(
+            osim.skeleton,
+            osim.markersMap,
+            poses,
+            marker_observations)
+        # Write out the OpenSim ID files:
+        grf_fpath = f'{output_folder}ID/{trial_name}_grf.mot'
+        external_forces_fpath = f'{output_folder}ID/{trial_name}_external_forces.xml'
+        id_setup_fpath = f'{output_folder}ID/{trial_name}_id_setup.xml'
+
+        force_plates = last_pass.getProcessedForcePlates()
+
+        nimble.biomechanics.OpenSimParser.saveProcessedGRFMot(
+            grf_fpath,
+            timestamps,
+            [osim.skeleton.getBodyNode(name) for name in subject.getGroundForceBodies()],
+            osim.skeleton,
+            poses,
+            force_plates,
+            last_pass.getGroundBodyWrenches())
+        nimble.biomechanics.OpenSimParser.saveOsimInverseDynamicsProcessedForcesXMLFile(
+            trial_name,
+            [osim.skeleton.getBodyNode(name) for name in subject.getGroundForceBodies()],
+            trial_name + '_grf.mot',
+            external_forces_fpath)
+        nimble.biomechanics.OpenSimParser.saveRawGRFMot(grf_fpath, timestamps, force_plates)
+        nimble.biomechanics.OpenSimParser.saveOsimInverseDynamicsRawForcesXMLFile(
+            trial_name,
+            osim.skeleton,
+            poses,
+            force_plates,
+            trial_name + '_grf.mot',
+            external_forces_fpath)
+        nimble.biomechanics.OpenSimParser.saveOsimInverseDynamicsXMLFile(
+            trial_name,
+            '../Models/' + DYNAMICS_OSIM_NAME,
+            '../IK/' + trial_name + '_ik.mot',
+            trial_name + '_external_forces.xml',
+            trial_name + '_id.sto',
+            trial_name + '_id_body_forces.sto',
+            id_setup_fpath,
+            min(timestamps), max(timestamps))
+        # The raw GRF and external forces files overwrite the processed ones above, so each is only written once
+        written_files += [grf_fpath, external_forces_fpath, id_setup_fpath]
+
+    elif any_kinematics_passes:
+        # Write out the inverse kinematics results,
+        ik_fpath = f'{output_folder}IK/{trial_name}_ik.mot'
+        last_pass = trial_passes[-1]
+        poses = last_pass.getPoses()
+        marker_observations = trial_proto.getMarkerObservations()
+        timestamps = np.array(range(poses.shape[1])) * subject.getTrialTimestep(i)
+        print(f'Writing OpenSim {ik_fpath} file, shape={str(poses.shape)}', flush=True)
+        nimble.biomechanics.OpenSimParser.saveMot(osim.skeleton, ik_fpath, timestamps,
+                                                  poses)
+        written_files.append(ik_fpath)
+        # Create the IK error report for this segment
+        result_ik = nimble.biomechanics.IKErrorReport(
+            osim.skeleton, osim.markersMap, poses, marker_observations)
+
+    if result_ik is not None:
+        # Save OpenSim setup files to make it easy to (re)run IK on the results in OpenSim
+        nimble.biomechanics.OpenSimParser.saveOsimInverseKinematicsXMLFile(
+            trial_name,
+            marker_names,
+            f'../{osim_path}',
+            f'../MarkerData/{trial_name}.trc',
+            f'{trial_name}_ik_by_opensim.mot',
+            f'{output_folder}IK/{trial_name}_ik_setup.xml')
+        written_files.append(f'{output_folder}IK/{trial_name}_ik_setup.xml')
+
+    if marker_observations is not None:
+        # Write out the marker trajectories.
+        markers_fpath = f'{output_folder}MarkerData/{trial_name}.trc'
+        print('Saving TRC for trial ' + trial_name, flush=True)
+        timestamps = np.array(range(len(marker_observations))) * subject.getTrialTimestep(i)
+        nimble.biomechanics.OpenSimParser.saveTRC(
+            markers_fpath, timestamps, marker_observations)
+        written_files.append(markers_fpath)
+        print('Saved', flush=True)
+
+    # Write out the marker errors.
+    if result_ik is not None:
+        marker_errors_fpath = f'{output_folder}IK/{trial_name}_marker_errors.csv'
+        result_ik.saveCSVMarkerErrorReport(marker_errors_fpath)
+        written_files.append(marker_errors_fpath)
+
+    # 9.9.11. Plot results.
+    if plots == 'inline':
+        written_files += plot_opensim_trial_results(subject, i, output_folder, osim)
+
+    return written_files
+
+
+def plot_opensim_trial_results(subject: nimble.biomechanics.SubjectOnDisk,
+                               i: int,
+                               output_folder: str,
+                               osim: nimble.biomechanics.OpenSimFile) -> List[str]:
+    """
+    Plot the OpenSim results for trial `i` next to the files `write_opensim_trial_results()` writes, and return the
+    paths of the PDFs. The plots are built straight from the processing passes, rather than by parsing the results
+    files back in.
+    """
+    trial_proto = subject.getHeaderProto().getTrials()[i]
+    trial_name = subject.getTrialName(i)
+    trial_passes = trial_proto.getPasses()
+    if len(trial_passes) == 0:
+        return []
+    last_pass = trial_passes[-1]
+    any_dynamics_passes = any([p.getType() == nimble.biomechanics.ProcessingPassType.DYNAMICS for p in trial_passes])
+    any_kinematics_passes = any([p.getType() == nimble.biomechanics.ProcessingPassType.KINEMATICS for p in trial_passes])
+    if not any_dynamics_passes and not any_kinematics_passes:
+        return []
+
+    print(f'Plotting results for trial {trial_name}')
+    poses = last_pass.getPoses()
+    timestamps = np.array(range(poses.shape[1])) * subject.getTrialTimestep(i)
+    dof_names = [osim.skeleton.getDofByIndex(d).getName() for d in range(osim.skeleton.getNumDofs())]
+
+    pdf_paths: List[str] = []
+    ik_pdf_path = f'{output_folder}IK/{trial_name}_ik.pdf'
+    plot_ik_table(table_from_array(timestamps, dof_names, poses), ik_pdf_path, f'{trial_name}_ik.mot')
+    pdf_paths.append(ik_pdf_path)
+
+    marker_errors_pdf_path = f'{output_folder}IK/{trial_name}_marker_errors.pdf'
+    plot_marker_error_table(get_marker_error_table(osim, poses, trial_proto.getMarkerObservations(), timestamps),
+                            marker_errors_pdf_path,
+                            f'{trial_name}_marker_errors.csv')
+    pdf_paths.append(marker_errors_pdf_path)
+
+    if any_dynamics_passes:
+        id_pdf_path = f'{output_folder}ID/{trial_name}_id.pdf'
+        plot_id_table(table_from_array(timestamps, get_id_column_names(osim.skeleton), last_pass.getTaus()),
+                      id_pdf_path,
+                      f'{trial_name}_id.sto')
+        pdf_paths.append(id_pdf_path)
+
+        grf_pdf_path = f'{output_folder}ID/{trial_name}_grf.pdf'
+        plot_grf_table(get_grf_table(last_pass.getProcessedForcePlates(), timestamps),
+                       grf_pdf_path,
+                       f'{trial_name}_grf.mot')
+        pdf_paths.append(grf_pdf_path)
+
+    return pdf_paths
+
+
+def get_id_column_names(skel: nimble.dynamics.Skeleton) -> List[str]:
+    """
+    The column names OpenSimParser.saveIDMot() writes: the translational coordinates of the root joint are forces, and
+    everything else is a moment.
+    """
+    names: List[str] = []
+    for j in range(skel.getNumJoints()):
+        joint = skel.getJoint(j)
+        is_free_joint = joint.getType() in ['FreeJoint', 'EulerFreeJoint']
+        for d in range(joint.getNumDofs()):
+            suffix = '_force' if is_free_joint and d >= 3 else '_moment'
+            names.append(joint.getDofName(d) + suffix)
+    return names
+
+
+def get_grf_table(force_plates: List[nimble.biomechanics.ForcePlate], timestamps: np.ndarray):
+    """
+    The same columns OpenSimParser.saveRawGRFMot() writes to the _grf.mot file: the force, center of pressure and
+    moment of every force plate.
+    """
+    names: List[str] = []
+    columns: List[np.ndarray] = []
+    num_timesteps = len(timestamps)
+    for k, force_plate in enumerate(force_plates):
+        for prefix, values in [('v', force_plate.forces),
+                               ('p', force_plate.centersOfPressure),
+                               ('m', force_plate.moments)]:
+            values = np.zeros((num_timesteps, 3)) if len(values) == 0 else np.array(values)[:num_timesteps]
+            for axis, axis_name in enumerate(['x', 'y', 'z']):
+                names.append(f'ground_force_{k+1}_{prefix}{axis_name}')
+                columns.append(values[:, axis])
+    return table_from_array(timestamps, names, np.array(columns).reshape((len(columns), num_timesteps)))
+
+
+def get_marker_error_table(osim: nimble.biomechanics.OpenSimFile,
+                           poses: np.ndarray,
+                           marker_observations: List[Dict[str, np.ndarray]],
+                           timestamps: np.ndarray):
+    """
+    The per-timestep marker errors (in cm) that IKErrorReport.saveCSVMarkerErrorReport() writes (in m), with a column
+    for every marker that was observed, and zeros wherever a marker wasn't observed or isn't in the model.
+    """
+    # Like the CSV report, the columns are in the order we first see each marker, sorted within each timestep.
+    marker_names: List[str] = []
+    seen_marker_names = set()
+    for observations in marker_observations:
+        new_marker_names = sorted(name for name in observations if name not in seen_marker_names)
+        marker_names.extend(new_marker_names)
+        seen_marker_names.update(new_marker_names)
+    model_markers = [name for name in marker_names if name in osim.markersMap]
+    model_marker_index = {name: m for m, name in enumerate(model_markers)}
+    markers = [osim.markersMap[name] for name in model_markers]
 
+    skel = osim.skeleton
+    original_positions = skel.getPositions()
+    errors = np.zeros((len(marker_names), len(marker_observations)))
+    for t, observations in enumerate(marker_observations):
+        skel.setPositions(poses[:, t])
+        world_positions = skel.getMarkerWorldPositions(markers).reshape((-1, 3))
+        for m, name in enumerate(marker_names):
+            if name in observations and name in model_marker_index:
+                errors[m, t] = np.linalg.norm(world_positions[model_marker_index[name]] - observations[name])
+    skel.setPositions(original_positions)
+    return table_from_array(timestamps[:len(marker_observations)], marker_names, errors * 100.0)
@@ -0,0 +1,104 @@
+import concurrent.futures
+import multiprocessing
+import os
+import zipfile
+import nimblephysics as nimble
+from typing import Dict, Iterable, Optional, Tuple
+
+# nimble objects can't be pickled, so instead of shipping the finished SubjectOnDisk to each worker process, the engine
+# writes the B3D file first and every worker loads (and keeps) its own copy of the subject from that file.
+_subjects: Dict[str, nimble.biomechanics.SubjectOnDisk] = {}
+_opensim_files: Dict[Tuple[str, int, Optional[str]], nimble.biomechanics.OpenSimFile] = {}
+
+
+# Every worker process loads its own copy of the whole subject, with all of its frames, so the writers' memory use grows
+# with the number of workers. We keep the default small, and let the OUTPUT_JOBS environment variable raise (or lower)
+# it on machines that have the memory to spare.
+DEFAULT_OUTPUT_JOBS = 2
+
+
+def get_output_jobs() -> int:
+    """
+    Get the number of worker processes to write outputs with, from the OUTPUT_JOBS environment variable if it's set.
+    """
+    jobs = os.getenv('OUTPUT_JOBS', '')
+    if jobs == '':
+        return DEFAULT_OUTPUT_JOBS
+    try:
+        return max(1, int(jobs))
+    except ValueError:
+        print('Ignoring OUTPUT_JOBS=' + jobs + ', because it is not a whole number. Using ' +
+              str(DEFAULT_OUTPUT_JOBS) + ' output workers instead.', flush=True)
+        return DEFAULT_OUTPUT_JOBS
+
+
+def create_output_executor(jobs: Optional[int] = None) -> concurrent.futures.ProcessPoolExecutor:
+    """
+    Create the process pool that the writers farm their per-trial work out to. Each worker holds a full copy of the
+    subject in memory, so this defaults to get_output_jobs() workers rather than one per CPU.
+    """
+    if jobs is None:
+        jobs = get_output_jobs()
+    # We spawn rather than fork, because the writers submit work from several threads in the parent, and forking a
+    # process with live threads can deadlock inside native libraries.
+    return concurrent.futures.ProcessPoolExecutor(max_workers=max(1, jobs),
+                                                  mp_context=multiprocessing.get_context('spawn'))
+
+
+def load_subject(b3d_path: str) -> nimble.biomechanics.SubjectOnDisk:
+    """
+    Load the subject in a worker process, reusing it for every task this worker runs.
+    """
+    if b3d_path not in _subjects:
+        subject = nimble.biomechanics.SubjectOnDisk(b3d_path)
+        subject.loadAllFrames(doNotStandardizeForcePlateData=True)
+        _subjects[b3d_path] = subject
+    return _subjects[b3d_path]
+
+
+def load_opensim_file(b3d_path: str,
+                      pass_index: int,
+                      geometry_folder: Optional[str] = None) -> nimble.biomechanics.OpenSimFile:
+    """
+    Load the OpenSim model for a processing pass in a worker process, reusing it for every task this worker runs.
+    """
+    key = (b3d_path, pass_index, geometry_folder)
+    if key not in _opensim_files:
+        subject = load_subject(b3d_path)
+        if geometry_folder is None:
+            _opensim_files[key] = subject.readOpenSimFile(pass_index, ignoreGeometry=True)
+        else:
+            _opensim_files[key] = subject.readOpenSimFile(pass_index, geometryFolder=geometry_folder)
+    return _opensim_files[key]
+
+
+class StreamingZipWriter:
+    """
+    Builds a zip archive of a folder while the files in it are still being produced, so we don't have to walk and
+    re-read the whole folder once everything is written.
+    """
+
+    def __init__(self, zip_path: str, root_folder: str, archive_root: str = ''):
+        if not root_folder.endswith('/'):
+            root_folder += '/'
+        self.root_folder = root_folder
+        self.archive_root = archive_root
+        self.archive = zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED)
+
+    def add_files(self, paths: Iterable[str]):
+        for path in paths:
+            if os.path.isfile(path):
+                self.archive.write(path, os.path.join(self.archive_root, os.path.relpath(path, self.root_folder)))
+
+    def add_folder(self, folder: str):
+        for dir_path, _, file_names in os.walk(folder):
+            self.add_files(sorted(os.path.join(dir_path, file_name) for file_name in file_names))
+
+    def close(self):
+        self.archive.close()
+
+    def __enter__(self) -> 'StreamingZipWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,10 +1,12 @@
 import os
+import concurrent.futures
 import nimblephysics as nimble
 import shutil
 from typing import List, Optional, Dict, Any, Tuple
 import json
 import textwrap
 import numpy as np
+from writers.output_pool import load_subject, load_opensim_file
 
 
 def get_segment_results_json(trial_proto: nimble.biomechanics.SubjectOnDiskTrial) -> Dict[str, Any]:
@@ -69,20 +71,55 @@ def get_segment_results_json(trial_proto: nimble.biomechanics.SubjectOnDiskTrial
     return results
 
 
+# Marker and force plate positions in preview.bin are rounded to this many meters, and joint positions to this many
+# radians (or meters, for translational DOFs). Anything that hasn't moved by at least one step since the last frame
+# isn't re-sent for that frame.
+PREVIEW_POSITION_QUANTUM = 1e-4
+PREVIEW_POSE_QUANTUM = 1e-4
+
+
+def _quantize(values: np.ndarray, quantum: float) -> np.ndarray:
+    return np.round(np.asarray(values) / quantum) * quantum
+
+
+def _changed_since_previous_frame(values: np.ndarray) -> np.ndarray:
+    """
+    For a (num_frames x num_objects x ...) array, where NaN marks an object that isn't shown on a frame, return a
+    (num_frames x num_objects) mask of which objects need to be re-sent on each frame.
+    """
+    flat = values.reshape((values.shape[0], values.shape[1], int(np.prod(values.shape[2:]))))
+    changed = np.zeros(flat.shape[:2], dtype=bool)
+    changed[0] = True
+    with np.errstate(invalid='ignore'):
+        changed[1:] = np.any(flat[1:] != flat[:-1], axis=2)
+    # NaN != NaN, so a hidden object would always look like it moved
+    changed[1:] &= ~(np.all(np.isnan(flat[1:]), axis=2) & np.all(np.isnan(flat[:-1]), axis=2))
+    return changed
+
+
 def save_segment_to_gui(trial_proto: nimble.biomechanics.SubjectOnDiskTrial,
                         gui_file_path: str,
                         kinematics_pass_index: int = -1,
                         kinematics_osim: Optional[nimble.biomechanics.OpenSimFile] = None,
                         dynamics_pass_index: int = -1,
-                        dynamics_osim: Optional[nimble.biomechanics.OpenSimFile] = None):
+                        dynamics_osim: Optional[nimble.biomechanics.OpenSimFile] = None,
+                        display_fps: Optional[float] = None):
     """
-    Write this trial segment to a file that can be read by the 3D web GUI
+    Write this trial segment to a file that can be read by the 3D web GUI. Positions are quantized, and each frame only
+    records the objects that moved since the previous one. If `display_fps` is set, frames are dropped to play back at
+    no more than that rate. That changes the frame count, so it's off by default, because the frontend lines up
+    preview frames with the rows of the plotting data.
     """
     dt = trial_proto.getTimestep()
     marker_observations = trial_proto.getMarkerObservations()
 
+    stride = 1
+    if display_fps is not None and display_fps > 0:
+        stride = max(1, int(np.floor((1.0 / dt) / display_fps)))
+    frames = list(range(0, len(marker_observations), stride))
+
     gui = nimble.server.GUIRecording()
-    gui.setFramesPerSecond(int(1.0 / dt))
+    gui.setFramesPerSecond(int(1.0 / (dt * stride)))
 
     markers_layer_name: str = 'Markers'
     warnings_layer_name: str = 'Warnings'
@@ -117,20 +154,29 @@ def save_segment_to_gui(trial_proto: nimble.biomechanics.SubjectOnDiskTrial,
     gui.createLayer(warnings_layer_name, [1.0, 0.0, 0.0, 1.0], defaultShow=default_show_markers_and_warnings)
     gui.createLayer(force_plate_layer_name, [1.0, 0.0, 0.0, 1.0], defaultShow=True)
 
+    # Each skeleton is (skeleton, quantized poses for the frames we render, which frames changed, prefix, layer)
+    skeletons: List[Tuple[nimble.dynamics.Skeleton, np.ndarray, np.ndarray, str, str]] = []
     if has_kinematics_pass:
         # Default to showing kinematics only if dynamics didn't finish
         gui.createLayer(kinematics_fit_layer_name,
                         defaultShow=(not has_dynamics_pass))
+        poses = _quantize(kinematics_poses[:, frames].T, PREVIEW_POSE_QUANTUM)
+        skeletons.append((kinematics_osim.skeleton, poses, _changed_since_previous_frame(poses[:, np.newaxis])[:, 0],
+                          'kinematics_', kinematics_fit_layer_name))
     if has_dynamics_pass:
         # Default to showing dynamics if it finished
         gui.createLayer(dynamics_fit_layer_name, defaultShow=True)
+        poses = _quantize(dynamics_poses[:, frames].T, PREVIEW_POSE_QUANTUM)
+        skeletons.append((dynamics_osim.skeleton, poses, _changed_since_previous_frame(poses[:, np.newaxis])[:, 0],
+                          'dynamics_', dynamics_fit_layer_name))
 
     # 1.2. Create the marker set objects, so we don't recreate them every frame
     render_markers_set = set()
     for obs in marker_observations:
         for key in obs:
             render_markers_set.add(key)
-    for marker in render_markers_set:
+    render_markers: List[str] = sorted(render_markers_set)
+    for marker in render_markers:
         gui.createBox('marker_' + str(marker),
                       np.ones(3, dtype=np.float64) * 0.02,
                       np.zeros(3, dtype=np.float64),
@@ -139,130 +185,161 @@ def save_segment_to_gui(trial_proto: nimble.biomechanics.SubjectOnDiskTrial,
                       layer=markers_layer_name)
         gui.setObjectTooltip('marker_' + str(marker), str(marker))
 
-    for t in range(len(marker_observations)):
-        if t % 50 == 0:
+    # 1.3. Collect everything that moves into arrays, with NaN for "not shown", so we can work out up front which
+    # objects actually change on each frame.
+    marker_positions = np.full((len(frames) + 1, len(render_markers), 3), np.nan)
+    # The markers all start out at the origin
+    marker_positions[0] = 0.0
+    for n, t in enumerate(frames):
+        obs = marker_observations[t]
+        for m, marker in enumerate(render_markers):
+            if marker in obs:
+                marker_positions[n + 1, m] = obs[marker]
+    marker_positions = _quantize(marker_positions, PREVIEW_POSITION_QUANTUM)
+    markers_changed = _changed_since_previous_frame(marker_positions)[1:]
+    markers_shown = ~np.isnan(marker_positions[:, :, 0])
+
+    # The force plate lines just stay where they were on frames that are missing data, so we forward-fill them
+    force_plate_lines = np.full((len(frames), len(force_plates), 2, 3), np.nan)
+    for i in range(len(force_plates)):
+        # IMPORTANT PERFORMANCE NOTE: Every time force_plate.forces is referenced, it copies the ENTIRE ARRAY from
+        # C++ to Python, even if we're only asking for force_plate.forces[i]. So to avoid the performance hit, we
+        # need to use copies of these values that are already accessible from Python
+        num_force_plate_frames = min(len(force_plate_raw_cops[i]),
+                                     len(force_plate_raw_forces[i]),
+                                     len(force_plate_raw_moments[i]))
+        if num_force_plate_frames == 0:
+            continue
+        cops = np.array(force_plate_raw_cops[i][:num_force_plate_frames]).reshape((-1, 3))
+        forces = np.array(force_plate_raw_forces[i][:num_force_plate_frames]).reshape((-1, 3))
+        for n, t in enumerate(frames):
+            if t < num_force_plate_frames:
+                force_plate_lines[n, i, 0] = cops[t]
+                force_plate_lines[n, i, 1] = cops[t] + forces[t] * 0.001
+            elif n > 0:
+                force_plate_lines[n, i] = force_plate_lines[n - 1, i]
+    force_plate_lines = _quantize(force_plate_lines, PREVIEW_POSITION_QUANTUM)
+    force_plates_changed = _changed_since_previous_frame(force_plate_lines) & ~np.isnan(force_plate_lines[:, :, 0, 0])
+
+    for n, t in enumerate(frames):
+        if n % 500 == 0:
             print(f'> Rendering frame {t} of {len(marker_observations)}')
 
         # 2. Always render the markers, even if we don't have kinematics or dynamics
-        for marker in render_markers_set:
-            if marker in marker_observations[t]:
-                # Render all the marker observations
+        for m in np.nonzero(markers_changed[n])[0]:
+            marker = render_markers[m]
+            if not markers_shown[n + 1, m]:
+                gui.deleteObject('marker_' + str(marker))
+            elif not markers_shown[n, m]:
                 gui.createBox('marker_' + str(marker),
                               np.ones(3, dtype=np.float64) * 0.02,
-                              marker_observations[t][marker],
+                              marker_positions[n + 1, m],
                               np.zeros(3, dtype=np.float64),
                               [0.5, 0.5, 0.5, 1.0],
                               layer=markers_layer_name)
+                gui.setObjectTooltip('marker_' + str(marker), str(marker))
             else:
-                gui.deleteObject('marker_' + str(marker))
-
-            # Render any marker warnings
-            # if self.marker_error_report is not None:
-            #     renamed_from_to: Set[Tuple[str, str]] = set(self.marker_error_report.markersRenamedFromTo[t])
-            #     for from_marker, to_marker in renamed_from_to:
-            #         from_marker_location = None
-            #         if from_marker in self.marker_observations[t]:
-            #             from_marker_location = self.marker_observations[t][from_marker]
-            #         to_marker_location = None
-            #         if to_marker in self.marker_observations[t]:
-            #             to_marker_location = self.marker_observations[t][to_marker]
-            #
-            #         if to_marker_location is not None and from_marker_location is not None:
-            #             gui.createLine('marker_renamed_' + str(from_marker) + '_to_' + str(to_marker), [to_marker_location, from_marker_location], [1.0, 0.0, 0.0, 1.0], layer=warnings_layer_name)
-            #         gui.setObjectWarning('marker_'+str(to_marker), 'warning_marker_renamed_' + str(from_marker) + '_to_' + str(to_marker), 'Marker ' + str(to_marker) + ' was originally named ' + str(from_marker), warnings_layer_name)
-            #     for from_marker, to_marker in self.render_markers_renamed_set:
-            #         if (from_marker, to_marker) not in renamed_from_to:
-            #             gui.deleteObject('marker_renamed_' + str(from_marker) + '_to_' + str(to_marker))
-            #         gui.deleteObjectWarning('marker_'+str(to_marker), 'warning_marker_renamed_' + str(from_marker) + '_to_' + str(to_marker))
+                gui.setObjectPosition('marker_' + str(marker), marker_positions[n + 1, m])
 
         # 3. Always render the force plates if we've got them, even if we don't have kinematics or dynamics
-        for i, force_plate in enumerate(force_plates):
-            # IMPORTANT PERFORMANCE NOTE: Every time force_plate.forces is referenced, it copies the ENTIRE ARRAY from
-            # C++ to Python, even if we're only asking for force_plate.forces[i]. So to avoid the performance hit, we
-            # need to use copies of these values that are already accessible from Python
-            if len(force_plate_raw_cops[i]) > t and len(force_plate_raw_forces[i]) > t and len(
-                    force_plate_raw_moments[i]) > t:
-                cop = force_plate_raw_cops[i][t]
-                force = force_plate_raw_forces[i][t]
-                moment = force_plate_raw_moments[i][t]
-                line = [cop, cop + force * 0.001]
-                gui.createLine('force_plate_' + str(i), line, [1.0, 0.0, 0.0, 1.0], layer=force_plate_layer_name,
-                               width=[2.0, 1.0])
-
-        # 4. Render the kinematics skeleton, if we have it
-        if has_kinematics_pass:
-            kinematics_osim.skeleton.setPositions(kinematics_poses[:, t])
-            gui.renderSkeleton(kinematics_osim.skeleton, prefix='kinematics_', layer=kinematics_fit_layer_name)
-
-        # 5. Render the dynamics skeleton, if we have it
-        if has_dynamics_pass:
-            dynamics_osim.skeleton.setPositions(dynamics_poses[:, t])
-            gui.renderSkeleton(dynamics_osim.skeleton, prefix='dynamics_', layer=dynamics_fit_layer_name)
+        for i in np.nonzero(force_plates_changed[n])[0]:
+            gui.createLine('force_plate_' + str(i), list(force_plate_lines[n, i]), [1.0, 0.0, 0.0, 1.0],
+                           layer=force_plate_layer_name, width=[2.0, 1.0])
+
+        # 4. Render the kinematics and dynamics skeletons, if we have them, skipping frames where the pose didn't change
+        for skeleton, poses, poses_changed, prefix, layer in skeletons:
+            if poses_changed[n]:
+                skeleton.setPositions(poses[n])
+                gui.renderSkeleton(skeleton, prefix=prefix, layer=layer)
         gui.saveFrame()
 
     gui.writeFramesJson(gui_file_path)
 
 
-def save_segment_csv(
+def get_segment_data_columns(
         trial_proto: nimble.biomechanics.SubjectOnDiskTrial,
-        csv_file_path: str,
-        final_skeleton: Optional[nimble.dynamics.Skeleton] = None):
-    if len(trial_proto.getPasses()) == 0:
-        return
+        final_skeleton: Optional[nimble.dynamics.Skeleton] = None) -> Tuple[List[str], np.ndarray]:
+    """
+    Collect the per-frame joint quantities we plot on the frontend for this segment, as a list of column names and a
+    (num_frames x num_columns) array. Timestamps are not included, since they are just `start + t * dt`.
+    """
+    num_frames = trial_proto.getTrialLength()
+    if len(trial_proto.getPasses()) == 0 or final_skeleton is None:
+        return [], np.zeros((num_frames, 0))
 
-    # Finite difference out the joint quantities we care about
     final_pass = trial_proto.getPasses()[-1]
     poses: np.ndarray = final_pass.getPoses()
     vels: np.ndarray = final_pass.getVels()
     accs: np.ndarray = final_pass.getAccs()
     taus: np.ndarray = final_pass.getTaus()
-    marker_observations = trial_proto.getMarkerObservations()
-    dt = trial_proto.getTimestep()
     missing_grf_reason = trial_proto.getMissingGRFReason()
+    missing_grf = np.array([reason != nimble.biomechanics.MissingGRFReason.notMissingGRF
+                            for reason in missing_grf_reason], dtype=np.float64)
+
+    dof_names = [final_skeleton.getDofByIndex(i).getName() for i in range(final_skeleton.getNumDofs())]
+    columns: List[str] = []
+    for suffix in ['_pos', '_vel', '_acc', '_tau', '_pwr']:
+        columns += [name + suffix for name in dof_names]
+    columns.append('missing_grf_data')
+    data = np.concatenate([poses, vels, accs, taus, vels * taus, missing_grf[np.newaxis, :]], axis=0).T
+    return columns, data
 
-    # Write the CSV file
+
+def save_segment_csv(
+        trial_proto: nimble.biomechanics.SubjectOnDiskTrial,
+        csv_file_path: str,
+        final_skeleton: Optional[nimble.dynamics.Skeleton] = None):
+    if len(trial_proto.getPasses()) == 0:
+        return
+
+    columns, data = get_segment_data_columns(trial_proto, final_skeleton)
+    num_frames = len(trial_proto.getMarkerObservations())
+    timestamps = np.arange(num_frames) * trial_proto.getTimestep() + trial_proto.getOriginalTrialStartTime()
+
+    # Write the CSV file, formatting a whole row at a time. The object array keeps Python floats and bools, so the
+    # values print the same way `str()` would.
+    rows = np.empty((num_frames, len(columns) + 1), dtype=object)
+    rows[:, 0] = np.round(timestamps, 3)
+    if len(columns) > 0:
+        rows[:, 1:-1] = data[:num_frames, :-1]
+        rows[:, -1] = data[:num_frames, -1] > 0
     with open(csv_file_path, 'w') as f:
-        f.write('timestamp')
-        if final_skeleton is not None:
-            # Joint positions
-            for i in range(final_skeleton.getNumDofs()):
-                f.write(',' + final_skeleton.getDofByIndex(i).getName() + '_pos')
-            # Joint velocities
-            for i in range(final_skeleton.getNumDofs()):
-                f.write(',' + final_skeleton.getDofByIndex(i).getName() + '_vel')
-            # Joint accelerations
-            for i in range(final_skeleton.getNumDofs()):
-                f.write(',' + final_skeleton.getDofByIndex(i).getName() + '_acc')
-            # Joint torques
-            for i in range(final_skeleton.getNumDofs()):
-                f.write(',' + final_skeleton.getDofByIndex(i).getName() + '_tau')
-            # Joint powers
-            for i in range(final_skeleton.getNumDofs()):
-                f.write(',' + final_skeleton.getDofByIndex(i).getName() + '_pwr')
-            f.write(',missing_grf_data')
-        f.write('\n')
-
-        for t in range(len(marker_observations)):
-            timestamp = t * dt + trial_proto.getOriginalTrialStartTime()
-            f.write(str(round(timestamp, 3)))
-            if final_skeleton is not None:
-                # Joint positions
-                for i in range(final_skeleton.getNumDofs()):
-                    f.write(',' + str(poses[i, t]))
-                # Joint velocities
-                for i in range(final_skeleton.getNumDofs()):
-                    f.write(',' + str(vels[i, t]))
-                # Joint accelerations
-                for i in range(final_skeleton.getNumDofs()):
-                    f.write(',' + str(accs[i, t]))
-                # Joint torques
-                for i in range(final_skeleton.getNumDofs()):
-                    f.write(',' + str(taus[i, t]))
-                # Joint power
-                for i in range(final_skeleton.getNumDofs()):
-                    f.write(',' + str(vels[i, t] * taus[i, t]))
-                f.write(',' + str(missing_grf_reason[t] != nimble.biomechanics.MissingGRFReason.notMissingGRF))
-            f.write('\n')
+        f.write(','.join(['timestamp'] + columns) + '\n')
+        np.savetxt(f, rows, fmt='%s', delimiter=',')
+
+
+def save_segment_data(
+        trial_proto: nimble.biomechanics.SubjectOnDiskTrial,
+        data_file_path: str,
+        header_file_path: str,
+        final_skeleton: Optional[nimble.dynamics.Skeleton] = None):
+    """
+    Write the segment's plotting data as a flat little-endian float32 file, one column after another, along with a
+    small JSON header that carries the column names and the number of frames needed to slice it back up.
+    """
+    columns, data = get_segment_data_columns(trial_proto, final_skeleton)
+    header: Dict[str, Any] = {
+        'version': 1,
+        'dtype': 'float32',
+        'layout': 'columns',
+        'numFrames': int(data.shape[0]),
+        'timestep': trial_proto.getTimestep(),
+        'startTime': trial_proto.getOriginalTrialStartTime(),
+        'columns': columns
+    }
+    np.ascontiguousarray(data.T, dtype='<f4').tofile(data_file_path)
+    with open(header_file_path, 'w') as f:
+        json.dump(header, f)
+
+
+def load_segment_data(data_file_path: str, header_file_path: str) -> Tuple[Dict[str, Any], np.ndarray]:
+    """
+    Read back a file written by `save_segment_data`, returning the header and a (num_frames x num_columns) array.
+    """
+    with open(header_file_path, 'r') as f:
+        header = json.load(f)
+    data = np.fromfile(data_file_path, dtype='<f4').reshape((len(header['columns']), header['numFrames']))
+    return header, data.T
 
 
 def get_overall_results_json(subject: nimble.biomechanics.SubjectOnDisk) -> Dict[str, Any]:
@@ -301,7 +378,16 @@ def generate_readme() -> str:
 def write_web_results(
         subject: nimble.biomechanics.SubjectOnDisk,
         geometry_folder: str,
-        output_folder: str):
+        output_folder: str,
+        write_csv: bool = False,
+        b3d_path: Optional[str] = None,
+        executor: Optional[concurrent.futures.Executor] = None):
+    """
+    Write out the results files the web UI reads, into the existing subject folder structure. The plotting data for
+    each segment goes in data.bin (described by data_header.json), and `write_csv` also writes it out as data.csv. If
+    `executor` and `b3d_path` are given, each segment is written by a pool worker that loads its own copy of the
+    subject from the B3D file.
+    """
     if not output_folder.endswith('/'):
         output_folder += '/'
     if not os.path.exists(output_folder):
@@ -325,44 +411,103 @@ def write_web_results(
             trial_names_to_segments[original_trial_name] = []
         trial_names_to_segments[original_trial_name].append(i)
 
-    kinematics_osim: Optional[nimble.biomechanics.OpenSimFile] = None
     kinematics_pass_index = -1
-    dynamics_osim: Optional[nimble.biomechanics.OpenSimFile] = None
     dynamics_pass_index = -1
-
     for p in range(subject.getNumProcessingPasses()):
         if subject.getProcessingPassType(p) == nimble.biomechanics.ProcessingPassType.KINEMATICS:
-            kinematics_osim = subject.readOpenSimFile(p, geometryFolder=geometry_folder)
             kinematics_pass_index = p
         elif subject.getProcessingPassType(p) == nimble.biomechanics.ProcessingPassType.DYNAMICS:
-            dynamics_osim = subject.readOpenSimFile(p, geometryFolder=geometry_folder)
             dynamics_pass_index = p
 
+    segment_paths: Dict[int, str] = {}
     for trial_name in trial_names_to_segments:
         trial_path = output_folder + 'trials/' + trial_name + '/'
         if not os.path.exists(trial_path):
             os.mkdir(trial_path)
-
         for i, segment_index in enumerate(sorted(trial_names_to_segments[trial_name])):
-            trial_proto = trial_protos[segment_index]
             segment_path = trial_path + 'segment_' + str(i + 1) + '/'
             if not os.path.exists(segment_path):
                 os.mkdir(segment_path)
-            # Write out the result summary JSON
-            print('Writing JSON result to ' + segment_path + '_results.json', flush=True)
-            segment_json = get_segment_results_json(trial_proto)
-            with open(segment_path + '_results.json', 'w') as f:
-                json.dump(segment_json, f, indent=4)
-            # Write out the animation preview binary
-            save_segment_to_gui(
-                trial_proto,
-                segment_path + 'preview.bin',
-                kinematics_pass_index,
-                kinematics_osim,
-                dynamics_pass_index,
-                dynamics_osim)
-            # Write out the data CSV for the plotting software to synchronize on the frontend
-            save_segment_csv(
-                trial_proto,
-                segment_path + 'data.csv',
-                dynamics_osim.skeleton if dynamics_pass_index != -1 else kinematics_osim.skeleton)
+            segment_paths[segment_index] = segment_path
+
+    if executor is not None and b3d_path is not None:
+        futures = [executor.submit(_write_web_segment_results_from_b3d,
+                                   b3d_path,
+                                   segment_index,
+                                   segment_path,
+                                   geometry_folder,
+                                   kinematics_pass_index,
+                                   dynamics_pass_index,
+                                   write_csv)
+                   for segment_index, segment_path in segment_paths.items()]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+    else:
+        kinematics_osim: Optional[nimble.biomechanics.OpenSimFile] = None
+        if kinematics_pass_index != -1:
+            kinematics_osim = subject.readOpenSimFile(kinematics_pass_index, geometryFolder=geometry_folder)
+        dynamics_osim: Optional[nimble.biomechanics.OpenSimFile] = None
+        if dynamics_pass_index != -1:
+            dynamics_osim = subject.readOpenSimFile(dynamics_pass_index, geometryFolder=geometry_folder)
+        for segment_index, segment_path in segment_paths.items():
+            write_web_segment_results(trial_protos[segment_index],
+                                      segment_path,
+                                      kinematics_pass_index,
+                                      kinematics_osim,
+                                      dynamics_pass_index,
+                                      dynamics_osim,
+                                      write_csv)
+
+
+def _write_web_segment_results_from_b3d(b3d_path: str,
+                                        segment_index: int,
+                                        segment_path: str,
+                                        geometry_folder: str,
+                                        kinematics_pass_index: int,
+                                        dynamics_pass_index: int,
+                                        write_csv: bool):
+    subject = load_subject(b3d_path)
+    kinematics_osim: Optional[nimble.biomechanics.OpenSimFile] = None
+    if kinematics_pass_index != -1:
+        kinematics_osim = load_opensim_file(b3d_path, kinematics_pass_index, geometry_folder)
+    dynamics_osim: Optional[nimble.biomechanics.OpenSimFile] = None
+    if dynamics_pass_index != -1:
+        dynamics_osim = load_opensim_file(b3d_path, dynamics_pass_index, geometry_folder)
+    write_web_segment_results(subject.getHeaderProto().getTrials()[segment_index],
+                              segment_path,
+                              kinematics_pass_index,
+                              kinematics_osim,
+                              dynamics_pass_index,
+                              dynamics_osim,
+                              write_csv)
+
+
+def write_web_segment_results(trial_proto: nimble.biomechanics.SubjectOnDiskTrial,
+                              segment_path: str,
+                              kinematics_pass_index: int,
+                              kinematics_osim: Optional[nimble.biomechanics.OpenSimFile],
+                              dynamics_pass_index: int,
+                              dynamics_osim: Optional[nimble.biomechanics.OpenSimFile],
+                              write_csv: bool = False):
+    # Write out the result summary JSON
+    print('Writing JSON result to ' + segment_path + '_results.json', flush=True)
+    segment_json = get_segment_results_json(trial_proto)
+    with open(segment_path + '_results.json', 'w') as f:
+        json.dump(segment_json, f, indent=4)
+    # Write out the animation preview binary
+    save_segment_to_gui(
+        trial_proto,
+        segment_path + 'preview.bin',
+        kinematics_pass_index,
+        kinematics_osim,
+        dynamics_pass_index,
+        dynamics_osim)
+    # Write out the plotting data for the frontend to synchronize with the animation
+    final_skeleton = dynamics_osim.skeleton if dynamics_pass_index != -1 else kinematics_osim.skeleton
+    save_segment_data(
+        trial_proto,
+        segment_path + 'data.bin',
+        segment_path + 'data_header.json',
+        final_skeleton)
+    if write_csv:
+        save_segment_csv(trial_proto, segment_path + 'data.csv', final_skeleton)
@@ -0,0 +1,53 @@
+import os
+import re
+import unittest
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+CLI_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'cli', 'addbiomechanics')
+
+# The CLI is installed on its own, so it keeps copies of these engine modules, with their imports of each other moved
+# under the addbiomechanics package. Everything else has to stay exactly the same, so a change here has to be made
+# there too.
+CLI_COPIES = [
+    'bad_frames_detector/abstract_detector.py',
+    'bad_frames_detector/thresholds.py',
+    'dynamics_pass/dynamics_pass.py',
+    'dynamics_pass/acceleration_minimizing_pass.py',
+    'dynamics_pass/missing_grf_detection.py',
+    'dynamics_pass/classification_pass.py',
+    'utilities/scale_opensim_model.py',
+]
+COPIED_PACKAGES = sorted(set(path.split('/')[0] for path in CLI_COPIES))
+
+
+def rewrite_imports(source: str) -> str:
+    """
+    Move the imports of the copied packages under addbiomechanics, the way the CLI copies do.
+    """
+    return re.sub(r'^([ \t]*)(from|import) (' + '|'.join(COPIED_PACKAGES) + r')\b', r'\1\2 addbiomechanics.\3',
+                  source, flags=re.MULTILINE)
+
+
+class TestCLICopies(unittest.TestCase):
+    def test_cli_copies_in_sync(self):
+        for path in CLI_COPIES:
+            with self.subTest(path=path):
+                with open(os.path.join(SRC_PATH, path)) as f:
+                    engine_source = f.read()
+                with open(os.path.join(CLI_PATH, path)) as f:
+                    cli_source = f.read()
+                self.assertEqual(rewrite_imports(engine_source), cli_source,
+                                 'server/engine/src/' + path + ' and cli/addbiomechanics/' + path + ' differ by more '
+                                 'than their imports')
+
+    def test_rewrite_imports(self):
+        self.assertEqual(rewrite_imports('from utilities.scale_opensim_model import scale_opensim_model\n'
+                                         'from utilities_extra import x\n'
+                                         '    from dynamics_pass.dynamics_pass import DynamicsPass\n'),
+                         'from addbiomechanics.utilities.scale_opensim_model import scale_opensim_model\n'
+                         'from utilities_extra import x\n'
+                         '    from addbiomechanics.dynamics_pass.dynamics_pass import DynamicsPass\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
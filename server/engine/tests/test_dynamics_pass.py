@@ -3,7 +3,7 @@ import unittest
 import os
 from inspect import getsourcefile
 from dynamics_pass.dynamics_pass import dynamics_pass
-from dynamics_pass.classification_pass import classification_pass
+from dynamics_pass.classification_pass import classification_pass, get_contact_runs, get_num_steps
 from dynamics_pass.missing_grf_detection import missing_grf_detection
 from dynamics_pass.acceleration_minimizing_pass import add_acceleration_minimizing_pass
 import numpy as np
@@ -48,6 +48,22 @@ class TestDynamicsPass(unittest.TestCase):
 
         self.assertEqual(subject.getHeaderProto().getTrials()[0].getBasicTrialType(), nimble.biomechanics.BasicTrialType.OVERGROUND)
 
+    def test_contact_runs(self):
+        contact = np.array([[True, True, False, True, False, False],
+                            [False, False, False, False, False, False],
+                            [False, True, True, True, True, True]])
+        self.assertEqual(get_contact_runs(contact), [(0, 0, 1), (0, 3, 3), (2, 1, 5)])
+
+    def test_num_steps(self):
+        on = np.array([0.0, 400.0, 0.0])
+        off = np.array([0.0, 5.0, 0.0])
+        raw_force_plate_forces = [[on, on, off, on, off],
+                                  [off, off, off, off, off],
+                                  [off, on, on, on, on]]
+        raw_force_plate_cops = [[np.zeros(3)] * 5 for _ in range(3)]
+        self.assertEqual(get_num_steps(raw_force_plate_forces, raw_force_plate_cops), (3, [2, 0, 1]))
+        self.assertEqual(get_num_steps([], []), (0, []))
+
     def test_missing_grf_detection(self):
         path = os.path.join(TEST_DATA_PATH, 'b3ds', 'falisse2017_small.b3d')
         subject = nimble.biomechanics.SubjectOnDisk(path)
@@ -1,4 +1,7 @@
 import shutil
+import tempfile
+import numpy as np
+import xml.etree.ElementTree as ET
 import unittest
 from kinematics_pass.subject import Subject
 from kinematics_pass.trial import TrialSegment, Trial
@@ -35,3 +38,59 @@ class TestScaleOsim(unittest.TestCase):
         new_xml = scale_opensim_model(unscaled_generic_osim_text, subject.skeleton, mass_kg, height_m, subject.markerSet)
         self.assertTrue(new_xml is not None)
         self.assertTrue(len(new_xml) > 0)
+
+    def test_in_process_scaling_applies_scales_and_mass(self):
+        osim_path = os.path.join(DATA_PATH, 'PresetSkeletons', 'Rajagopal2015_ViconPlugInGait.osim')
+        osim = nimble.biomechanics.OpenSimParser.parseOsim(osim_path, ignoreGeometry=True)
+        skel = osim.skeleton
+        np.random.seed(0)
+        skel.setBodyScales(np.random.uniform(0.8, 1.2, size=skel.getNumBodyNodes() * 3))
+        markers = {name: (body, offset + np.random.uniform(-0.01, 0.01, 3)) for name, (body, offset) in osim.markersMap.items()}
+        with open(osim_path, 'r') as f:
+            unscaled_generic_osim_text = f.read()
+
+        new_xml = scale_opensim_model(unscaled_generic_osim_text, skel, 80.0, 1.8, markers)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            scaled_path = os.path.join(tmpdir, 'scaled.osim')
+            with open(scaled_path, 'w') as f:
+                f.write(new_xml)
+            scaled = nimble.biomechanics.OpenSimParser.parseOsim(scaled_path, ignoreGeometry=True)
+        # nimble drops some bodies (e.g. the patellas) when loading, so sum the masses in the file itself
+        total_mass = sum(float(body.find('mass').text) for body in ET.fromstring(new_xml).iter('Body'))
+        self.assertAlmostEqual(total_mass, 80.0, places=6)
+        for name, (body, offset) in markers.items():
+            scaled_body, scaled_offset = scaled.markersMap[name]
+            self.assertEqual(scaled_body.getName(), body.getName())
+            np.testing.assert_allclose(scaled_offset, offset * body.getScale(), atol=1e-8)
+
+    @unittest.skipIf(shutil.which('opensim-cmd') is None, 'opensim-cmd is not installed')
+    def test_in_process_scaling_matches_opensim_cmd(self):
+        osim_path = os.path.join(DATA_PATH, 'PresetSkeletons', 'Rajagopal2015_ViconPlugInGait.osim')
+        osim = nimble.biomechanics.OpenSimParser.parseOsim(osim_path, ignoreGeometry=True)
+        skel = osim.skeleton
+        np.random.seed(0)
+        skel.setBodyScales(np.random.uniform(0.8, 1.2, size=skel.getNumBodyNodes() * 3))
+        with open(osim_path, 'r') as f:
+            unscaled_generic_osim_text = f.read()
+
+        in_process_xml = scale_opensim_model(unscaled_generic_osim_text, skel, 80.0, 1.8, osim.markersMap)
+        opensim_cmd_xml = scale_opensim_model(unscaled_generic_osim_text, skel, 80.0, 1.8, osim.markersMap, use_opensim_cmd=True)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            results = []
+            for i, xml in enumerate([in_process_xml, opensim_cmd_xml]):
+                path = os.path.join(tmpdir, f'scaled_{i}.osim')
+                with open(path, 'w') as f:
+                    f.write(xml)
+                results.append(nimble.biomechanics.OpenSimParser.parseOsim(path, ignoreGeometry=True))
+        in_process, opensim_cmd = results
+        self.assertAlmostEqual(in_process.skeleton.getMass(), opensim_cmd.skeleton.getMass(), places=6)
+        for _ in range(3):
+            q = skel.getRandomPose()
+            in_process.skeleton.setPositions(q)
+            opensim_cmd.skeleton.setPositions(q)
+            in_process_markers = in_process.skeleton.getMarkerMapWorldPositions(in_process.markersMap)
+            opensim_cmd_markers = opensim_cmd.skeleton.getMarkerMapWorldPositions(opensim_cmd.markersMap)
+            for name in in_process_markers:
+                np.testing.assert_allclose(in_process_markers[name], opensim_cmd_markers[name], atol=1e-6)
@@ -0,0 +1,98 @@
+import nimblephysics as nimble
+import unittest
+import numpy as np
+from typing import List
+from bad_frames_detector.thresholds import ThresholdsDetector
+
+
+def reference_missing_grf_labels(raw_force_plate_forces: List[List[np.ndarray]],
+                                 trial_len: int) -> List[nimble.biomechanics.MissingGRFReason]:
+    """
+    The original frame-by-frame version of step 6 of ThresholdsDetector.estimate_missing_grfs(), which the thresholds
+    were tuned with, kept here to check that the vectorized version gives exactly the same labels.
+    """
+    missing = []
+    force_mags: List[float] = []
+    for i in range(trial_len):
+        forces = [raw_force_plate_forces[f][i] for f in range(len(raw_force_plate_forces))]
+        total_force_mag = 0.0
+        for force in forces:
+            total_force_mag += np.linalg.norm(force)
+        if total_force_mag < 10.0:
+            missing.append(nimble.biomechanics.MissingGRFReason.zeroForceFrame)
+        else:
+            missing.append(nimble.biomechanics.MissingGRFReason.notMissingGRF)
+        force_mags.append(total_force_mag)
+
+    extend_frames = 20
+    for i in range(trial_len):
+        if missing[i] != nimble.biomechanics.MissingGRFReason.notMissingGRF or i == 0:
+            for j in range(1, extend_frames + 1):
+                if i + j < trial_len and force_mags[i] < force_mags[i + j]:
+                    for k in range(j):
+                        missing[i + k] = nimble.biomechanics.MissingGRFReason.extendedToNearestPeakForce
+    for i in range(trial_len - 1, -1, -1):
+        if missing[i] != nimble.biomechanics.MissingGRFReason.notMissingGRF or i == trial_len - 1:
+            for j in range(1, extend_frames + 1):
+                if i - j >= 0 and force_mags[i] < force_mags[i - j]:
+                    for k in range(j):
+                        missing[i - k] = nimble.biomechanics.MissingGRFReason.extendedToNearestPeakForce
+    return missing
+
+
+def make_overground_forces(random: np.random.RandomState, num_plates: int, trial_len: int) -> List[List[np.ndarray]]:
+    """
+    Each plate gets a few footsteps (smooth bumps of vertical force, with noise, plateaus and spikes) separated by
+    stretches with no force at all, so we get lots of ramps, ties and cascading extensions.
+    """
+    plates = []
+    for _ in range(num_plates):
+        vertical = np.zeros(trial_len)
+        t = random.randint(0, 30)
+        while t < trial_len:
+            length = random.randint(1, 80)
+            bump = np.sin(np.linspace(0, np.pi, length)) * random.uniform(5, 900)
+            if random.rand() < 0.3:
+                bump = np.round(bump / 50) * 50
+            if random.rand() < 0.3:
+                bump += random.randn(length) * 20
+            vertical[t:t + length] = bump[:trial_len - t]
+            t += length + random.randint(0, 40)
+        vertical[random.rand(trial_len) < 0.02] = random.uniform(0, 30)
+        forces = np.stack([random.randn(trial_len) * 5 * (vertical > 0), vertical, np.zeros(trial_len)], axis=1)
+        plates.append([forces[i] for i in range(trial_len)])
+    return plates
+
+
+class TestThresholds(unittest.TestCase):
+    def test_overground_missing_grfs_match_reference(self):
+        random = np.random.RandomState(0)
+        num_frames = 0
+        for _ in range(150):
+            num_plates = random.randint(1, 4)
+            trial_len = random.randint(1, 2000) if random.rand() < 0.8 else random.choice([1, 2, 3, 21, 22])
+            raw_force_plate_forces = make_overground_forces(random, num_plates, trial_len)
+            self.assertEqual(ThresholdsDetector.get_overground_missing_grfs(raw_force_plate_forces, trial_len),
+                             reference_missing_grf_labels(raw_force_plate_forces, trial_len))
+            num_frames += trial_len
+        self.assertGreater(num_frames, 100000)
+
+    def test_constant_force(self):
+        # With no force anywhere nothing ramps, so the frames stay zero force frames
+        raw_force_plate_forces = [[np.zeros(3)] * 50]
+        self.assertEqual(ThresholdsDetector.get_overground_missing_grfs(raw_force_plate_forces, 50),
+                         [nimble.biomechanics.MissingGRFReason.zeroForceFrame] * 50)
+        raw_force_plate_forces = [[np.array([0, 700.0, 0])] * 50]
+        self.assertEqual(ThresholdsDetector.get_overground_missing_grfs(raw_force_plate_forces, 50),
+                         [nimble.biomechanics.MissingGRFReason.notMissingGRF] * 50)
+
+    def test_ramp_extension(self):
+        vertical = [0.0, 0.0, 100.0, 200.0] + [300.0] * 60 + [200.0, 100.0, 0.0, 0.0]
+        raw_force_plate_forces = [[np.array([0, f, 0]) for f in vertical]]
+        labels = ThresholdsDetector.get_overground_missing_grfs(raw_force_plate_forces, len(vertical))
+        self.assertEqual(labels, reference_missing_grf_labels(raw_force_plate_forces, len(vertical)))
+        # The ramps reach up to 20 frames past the frames on them into the plateau, from both ends, and the middle of
+        # the plateau is left alone
+        extended = nimble.biomechanics.MissingGRFReason.extendedToNearestPeakForce
+        self.assertEqual(labels, [extended] * 23 + [nimble.biomechanics.MissingGRFReason.notMissingGRF] * 22 +
+                         [extended] * 23)
@@ -3,13 +3,52 @@ import unittest
 import os
 from inspect import getsourcefile
 import shutil
-from writers.opensim_writer import write_opensim_results
-from writers.web_results_writer import write_web_results
+from writers.opensim_writer import write_opensim_results, write_opensim_trial_results, plot_opensim_trial_results, \
+    get_id_column_names, get_grf_table, get_marker_error_table
+from plotting import storage2pandas, table_from_array
+from writers.web_results_writer import write_web_results, save_segment_data, load_segment_data, save_segment_csv, \
+    save_segment_to_gui
+from kinematics_pass.trial import get_segment_length
+from writers.output_pool import create_output_executor, get_output_jobs, DEFAULT_OUTPUT_JOBS
+from writers.b3d_writer import write_dynamics_trials_only_b3d
+from unittest import mock
+import zipfile
+import numpy as np
 import tempfile
+from typing import List
 
 TESTS_PATH = os.path.dirname(getsourcefile(lambda:0))
 TEST_DATA_PATH = os.path.join(TESTS_PATH, 'data')
 GEOMETRY_PATH = os.path.join(TESTS_PATH, '../Geometry') + '/'
+DATA_PATH = os.path.join(TESTS_PATH, '..', '..', 'data')
+
+
+def make_trial_proto(header: nimble.biomechanics.SubjectOnDiskHeader,
+                     osim: nimble.biomechanics.OpenSimFile,
+                     poses: np.ndarray) -> nimble.biomechanics.SubjectOnDiskTrial:
+    """
+    Build a segment at 100Hz that follows `poses`, with markers where the skeleton puts them and GRF missing on every
+    frame after the third.
+    """
+    num_frames = poses.shape[1]
+    trial_proto = header.addTrial()
+    trial_proto.setTimestep(0.01)
+    trial_proto.setTrialLength(num_frames)
+    trial_proto.setOriginalTrialStartTime(1.0)
+    marker_observations = []
+    for t in range(num_frames):
+        osim.skeleton.setPositions(poses[:, t])
+        marker_observations.append(osim.skeleton.getMarkerMapWorldPositions(osim.markersMap))
+    trial_proto.setMarkerObservations(marker_observations)
+    trial_proto.setMissingGRFReason(
+        [nimble.biomechanics.MissingGRFReason.notMissingGRF] * 3 +
+        [nimble.biomechanics.MissingGRFReason.measuredGrfZeroWhenAccelerationNonZero] * (num_frames - 3))
+    trial_pass = trial_proto.addPass()
+    trial_pass.setPoses(poses)
+    trial_pass.setVels(poses * 2)
+    trial_pass.setAccs(poses * 3)
+    trial_pass.setTaus(poses * 4)
+    return trial_proto
 
 
 class TestWriters(unittest.TestCase):
@@ -34,3 +73,239 @@ class TestWriters(unittest.TestCase):
             print(f"Temporary directory created: {temp_dir}")
 
             write_web_results(subject, GEOMETRY_PATH, temp_dir)
+
+    def test_segment_data_round_trip(self):
+        osim = nimble.biomechanics.OpenSimParser.parseOsim(
+            os.path.join(DATA_PATH, 'PresetSkeletons', 'Rajagopal2015_ViconPlugInGait.osim'), ignoreGeometry=True)
+        skel = osim.skeleton
+        num_dofs = skel.getNumDofs()
+        num_frames = 7
+        header = nimble.biomechanics.SubjectOnDiskHeader()
+        poses = np.random.randn(num_dofs, num_frames)
+        trial_proto = make_trial_proto(header, osim, poses)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            segment_path = temp_dir + '/'
+            save_segment_data(trial_proto, segment_path + 'data.bin', segment_path + 'data_header.json', skel)
+            save_segment_csv(trial_proto, segment_path + 'data.csv', skel)
+            data_header, data = load_segment_data(segment_path + 'data.bin', segment_path + 'data_header.json')
+            self.assertEqual(num_frames, get_segment_length(segment_path))
+            os.remove(segment_path + 'data_header.json')
+            self.assertEqual(num_frames, get_segment_length(segment_path))
+            with open(segment_path + 'data.csv', 'r') as f:
+                csv_lines = f.read().splitlines()
+
+        self.assertEqual(data_header['numFrames'], num_frames)
+        self.assertEqual(data.shape, (num_frames, 5 * num_dofs + 1))
+        np.testing.assert_allclose(data[:, :num_dofs], poses.T, atol=1e-5)
+        np.testing.assert_allclose(data[:, 4 * num_dofs:5 * num_dofs], (poses * 2 * poses * 4).T, rtol=1e-5)
+        np.testing.assert_equal(data[:, -1], [0, 0, 0, 1, 1, 1, 1])
+        self.assertEqual(csv_lines[0].split(','), ['timestamp'] + data_header['columns'])
+        self.assertEqual(len(csv_lines), num_frames + 1)
+        self.assertEqual(csv_lines[1].split(',')[-1], 'False')
+        self.assertEqual(csv_lines[-1].split(',')[-1], 'True')
+
+    def test_save_segment_to_gui(self):
+        osim = nimble.biomechanics.OpenSimParser.parseOsim(
+            os.path.join(DATA_PATH, 'PresetSkeletons', 'Rajagopal2015_ViconPlugInGait.osim'), GEOMETRY_PATH)
+        num_frames = 100
+        header = nimble.biomechanics.SubjectOnDiskHeader()
+        moving_poses = np.outer(osim.skeleton.getPositions(), np.ones(num_frames)) + \
+            0.3 * np.sin(np.outer(np.arange(osim.skeleton.getNumDofs()) + 1, np.linspace(0, 2 * np.pi, num_frames)))
+        moving_trial = make_trial_proto(header, osim, moving_poses)
+        still_trial = make_trial_proto(header, osim, np.outer(osim.skeleton.getPositions(), np.ones(num_frames)))
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            sizes = {}
+            for name, trial_proto, display_fps in [('moving', moving_trial, None),
+                                                   ('decimated', moving_trial, 25),
+                                                   ('still', still_trial, None)]:
+                path = os.path.join(temp_dir, name + '.bin')
+                save_segment_to_gui(trial_proto, path, 0, osim, display_fps=display_fps)
+                sizes[name] = os.path.getsize(path)
+
+        # Frames where nothing moved shouldn't cost anything, and decimating should drop most of the moving frames
+        self.assertLess(sizes['still'], sizes['moving'])
+        self.assertLess(sizes['decimated'], sizes['moving'])
+
+    def test_write_opensim_in_parallel(self):
+        osim_path = os.path.join(DATA_PATH, 'PresetSkeletons', 'Rajagopal2015_ViconPlugInGait.osim')
+        osim = nimble.biomechanics.OpenSimParser.parseOsim(osim_path, ignoreGeometry=True)
+        skel = osim.skeleton
+        header = nimble.biomechanics.SubjectOnDiskHeader()
+        header.setNumDofs(skel.getNumDofs())
+        header.setNumJoints(skel.getNumJoints())
+        header.setGroundForceBodies(['calcn_r', 'calcn_l'])
+        pass_header = header.addProcessingPass()
+        pass_header.setProcessingPassType(nimble.biomechanics.ProcessingPassType.KINEMATICS)
+        with open(osim_path, 'r') as f:
+            pass_header.setOpenSimFileText(f.read())
+        num_frames = 50
+        for i in range(2):
+            poses = np.outer(skel.getPositions(), np.ones(num_frames)) + 0.1 * np.random.randn(skel.getNumDofs(), 1)
+            trial_proto = header.addTrial()
+            trial_proto.setName(f'trial{i}')
+            trial_proto.setOriginalTrialName(f'trial{i}')
+            trial_proto.setTimestep(0.01)
+            trial_proto.setTrialLength(num_frames)
+            skel.setPositions(poses[:, 0])
+            trial_proto.setMarkerObservations([skel.getMarkerMapWorldPositions(osim.markersMap)] * num_frames)
+            trial_proto.setMissingGRFReason([nimble.biomechanics.MissingGRFReason.notMissingGRF] * num_frames)
+            trial_pass = trial_proto.addPass()
+            trial_pass.setType(nimble.biomechanics.ProcessingPassType.KINEMATICS)
+            trial_pass.computeValuesFromForcePlates(skel, 0.01, poses, ['calcn_r', 'calcn_l'], [])
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            b3d_path = os.path.join(temp_dir, 'subject.b3d')
+            nimble.biomechanics.SubjectOnDisk.writeB3D(b3d_path, header)
+            subject = nimble.biomechanics.SubjectOnDisk(b3d_path)
+            subject.loadAllFrames(doNotStandardizeForcePlateData=True)
+            with create_output_executor(2) as executor:
+                write_opensim_results(subject, os.path.join(temp_dir, 'osim_results'), b3d_path=b3d_path,
+                                      executor=executor)
+                write_web_results(subject, GEOMETRY_PATH, os.path.join(temp_dir, 'web_results'), b3d_path=b3d_path,
+                                  executor=executor)
+            with zipfile.ZipFile(os.path.join(temp_dir, 'osim_results.zip')) as archive:
+                names = set(archive.namelist())
+            segment_files = set(os.listdir(os.path.join(temp_dir, 'web_results', 'trials', 'trial0', 'segment_1')))
+
+        for i in range(2):
+            self.assertIn(f'osim_results/IK/trial{i}_ik.mot', names)
+            self.assertIn(f'osim_results/MarkerData/trial{i}.trc', names)
+        self.assertIn('osim_results/Models/unscaled_generic.osim', names)
+        # The frontend plots from data.bin, so we only write data.csv when asked to
+        self.assertEqual(segment_files, {'_results.json', 'preview.bin', 'data.bin', 'data_header.json'})
+
+    def test_write_dynamics_trials_only(self):
+        osim_path = os.path.join(DATA_PATH, 'PresetSkeletons', 'Rajagopal2015_ViconPlugInGait.osim')
+        osim = nimble.biomechanics.OpenSimParser.parseOsim(osim_path, ignoreGeometry=True)
+
+        def write_b3d(b3d_path: str, dynamics_trials: List[int]):
+            header = nimble.biomechanics.SubjectOnDiskHeader()
+            header.setNumDofs(osim.skeleton.getNumDofs())
+            header.setNumJoints(osim.skeleton.getNumJoints())
+            for pass_type in [nimble.biomechanics.ProcessingPassType.KINEMATICS,
+                              nimble.biomechanics.ProcessingPassType.DYNAMICS]:
+                header.addProcessingPass().setProcessingPassType(pass_type)
+            for i in range(3):
+                trial_proto = make_trial_proto(header, osim, np.random.randn(osim.skeleton.getNumDofs(), 10))
+                trial_proto.setName(f'trial{i}')
+                trial_proto.getPasses()[0].setType(nimble.biomechanics.ProcessingPassType.KINEMATICS)
+                if i in dynamics_trials:
+                    dynamics_pass = trial_proto.addPass()
+                    dynamics_pass.copyValuesFrom(trial_proto.getPasses()[0])
+                    dynamics_pass.setType(nimble.biomechanics.ProcessingPassType.DYNAMICS)
+            nimble.biomechanics.SubjectOnDisk.writeB3D(b3d_path, header)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            b3d_path = os.path.join(temp_dir, 'subject.b3d')
+            output_path = os.path.join(temp_dir, 'subject_dynamics_trials_only.b3d')
+            write_b3d(b3d_path, [1])
+            self.assertTrue(write_dynamics_trials_only_b3d(b3d_path, output_path))
+            filtered = nimble.biomechanics.SubjectOnDisk(output_path)
+            self.assertEqual([filtered.getTrialName(t) for t in range(filtered.getNumTrials())], ['trial1'])
+            # The original file is left alone
+            self.assertEqual(nimble.biomechanics.SubjectOnDisk(b3d_path).getNumTrials(), 3)
+
+            os.remove(output_path)
+            write_b3d(b3d_path, [])
+            self.assertFalse(write_dynamics_trials_only_b3d(b3d_path, output_path))
+            self.assertFalse(os.path.exists(output_path))
+
+    def test_get_output_jobs(self):
+        with mock.patch.dict(os.environ, {}, clear=True):
+            self.assertEqual(get_output_jobs(), DEFAULT_OUTPUT_JOBS)
+        with mock.patch.dict(os.environ, {'OUTPUT_JOBS': '6'}):
+            self.assertEqual(get_output_jobs(), 6)
+        with mock.patch.dict(os.environ, {'OUTPUT_JOBS': '0'}):
+            self.assertEqual(get_output_jobs(), 1)
+        with mock.patch.dict(os.environ, {'OUTPUT_JOBS': 'lots'}):
+            self.assertEqual(get_output_jobs(), DEFAULT_OUTPUT_JOBS)
+
+    def test_plot_tables_match_result_files(self):
+        osim_path = os.path.join(DATA_PATH, 'PresetSkeletons', 'Rajagopal2015_ViconPlugInGait.osim')
+        osim = nimble.biomechanics.OpenSimParser.parseOsim(osim_path, ignoreGeometry=True)
+        skel = osim.skeleton
+        header = nimble.biomechanics.SubjectOnDiskHeader()
+        header.setNumDofs(skel.getNumDofs())
+        header.setNumJoints(skel.getNumJoints())
+        header.setGroundForceBodies(['calcn_r', 'calcn_l'])
+        pass_header = header.addProcessingPass()
+        pass_header.setProcessingPassType(nimble.biomechanics.ProcessingPassType.DYNAMICS)
+        with open(osim_path, 'r') as f:
+            pass_header.setOpenSimFileText(f.read())
+        num_frames = 40
+        ts = np.linspace(0, 2 * np.pi, num_frames)
+        poses = np.outer(skel.getPositions(), np.ones(num_frames)) + 0.1 * np.sin(np.outer(np.arange(skel.getNumDofs()), ts))
+        marker_observations = []
+        for t in range(num_frames):
+            skel.setPositions(poses[:, t])
+            observations = skel.getMarkerMapWorldPositions(osim.markersMap)
+            observations = {name: position + 0.01 * np.random.randn(3) for name, position in observations.items()}
+            if t % 5 == 0:
+                del observations['C7']
+            marker_observations.append(observations)
+        force_plate = nimble.biomechanics.ForcePlate()
+        force_plate.forces = [np.array([0, 700 * np.sin(x) ** 2, 0]) for x in ts]
+        force_plate.moments = [np.zeros(3)] * num_frames
+        force_plate.centersOfPressure = [np.array([x * 0.1, 0, 0]) for x in ts]
+        force_plate.timestamps = list(ts)
+        trial_proto = header.addTrial()
+        trial_proto.setName('trial0')
+        trial_proto.setOriginalTrialName('trial0')
+        trial_proto.setTimestep(0.01)
+        trial_proto.setTrialLength(num_frames)
+        trial_proto.setMarkerObservations(marker_observations)
+        trial_proto.setMissingGRFReason([nimble.biomechanics.MissingGRFReason.notMissingGRF] * num_frames)
+        trial_proto.setForcePlates([force_plate])
+        trial_pass = trial_proto.addPass()
+        trial_pass.setType(nimble.biomechanics.ProcessingPassType.DYNAMICS)
+        trial_pass.computeValuesFromForcePlates(skel, 0.01, poses, ['calcn_r', 'calcn_l'], [force_plate])
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            b3d_path = os.path.join(temp_dir, 'subject.b3d')
+            nimble.biomechanics.SubjectOnDisk.writeB3D(b3d_path, header)
+            subject = nimble.biomechanics.SubjectOnDisk(b3d_path)
+            subject.loadAllFrames(doNotStandardizeForcePlateData=True)
+            subject_osim = subject.readOpenSimFile(0, ignoreGeometry=True)
+            output_folder = temp_dir + '/'
+            for folder in ['IK', 'ID', 'MarkerData']:
+                os.mkdir(output_folder + folder)
+            written = write_opensim_trial_results(subject, 0, output_folder, subject_osim, plots='skip')
+            self.assertFalse(any(path.endswith('.pdf') for path in written))
+            on_disk = [output_folder + folder + '/' + name for folder in ['IK', 'ID', 'MarkerData']
+                       for name in os.listdir(output_folder + folder)]
+            self.assertEqual(sorted(written), sorted(on_disk))
+
+            # The tables we plot from memory should be the same as the ones we'd get by parsing the files back in.
+            loaded_pass = subject.getHeaderProto().getTrials()[0].getPasses()[-1]
+            timestamps = np.arange(num_frames) * 0.01
+            ik_table = storage2pandas(output_folder + 'IK/trial0_ik.mot', header_shift=-1)
+            dof_names = [subject_osim.skeleton.getDofByIndex(d).getName() for d in range(skel.getNumDofs())]
+            self.assertEqual(list(ik_table.columns), ['time'] + dof_names)
+            np.testing.assert_allclose(ik_table.values, table_from_array(timestamps, dof_names, loaded_pass.getPoses()).values, atol=1e-5)
+
+            id_table = storage2pandas(output_folder + 'ID/trial0_id.sto', header_shift=-1)
+            self.assertEqual(list(id_table.columns), ['time'] + get_id_column_names(subject_osim.skeleton))
+            np.testing.assert_allclose(id_table.values[:, 1:], loaded_pass.getTaus().T, rtol=1e-4, atol=1e-4)
+
+            grf_table = storage2pandas(output_folder + 'ID/trial0_grf.mot', header_shift=1)
+            memory_grf_table = get_grf_table(loaded_pass.getProcessedForcePlates(), timestamps)
+            self.assertEqual(list(grf_table.columns), list(memory_grf_table.columns))
+            np.testing.assert_allclose(grf_table.values, memory_grf_table.values, rtol=1e-4, atol=1e-4)
+
+            marker_errors_table = np.genfromtxt(output_folder + 'IK/trial0_marker_errors.csv', delimiter=',',
+                                                names=True, dtype=None, encoding='utf-8')
+            memory_marker_errors_table = get_marker_error_table(subject_osim, loaded_pass.getPoses(),
+                                                                subject.getHeaderProto().getTrials()[0].getMarkerObservations(),
+                                                                timestamps)
+            self.assertEqual(list(marker_errors_table.dtype.names[1:]), list(memory_marker_errors_table.columns[1:]))
+            for name in marker_errors_table.dtype.names[1:]:
+                np.testing.assert_allclose(marker_errors_table[name][1:].astype(np.float64) * 100.0,
+                                           memory_marker_errors_table[name].values, rtol=1e-3, atol=1e-4)
+
+            pdf_paths = plot_opensim_trial_results(subject, 0, output_folder, subject_osim)
+            self.assertEqual(sorted(os.path.basename(path) for path in pdf_paths),
+                             ['trial0_grf.pdf', 'trial0_id.pdf', 'trial0_ik.pdf', 'trial0_marker_errors.pdf'])
+            for path in pdf_paths:
+                self.assertTrue(os.path.getsize(path) > 0)